@@ -0,0 +1,350 @@
+"""Admission control and load shedding.
+
+Each classified endpoint belongs to a route class (feed, profile, write,
+auth). Before one of their requests runs it takes a slot under a
+concurrency limit that follows observed latency: while each class stays
+under its latency target the limit grows, and when the database slows
+down and latency climbs past it the limit shrinks, so extra requests wait
+here instead of piling onto the database.
+
+Classes differ in priority. Feed and profile pages may only fill part of
+the limit, keeping the rest for writes and auth, and a freed slot goes to
+the highest-priority waiter. Each class also has a queue budget: the time
+a request may spend waiting, counting both gunicorn's backlog (from the
+router's X-Request-Start header) and the wait for a slot. A request over
+budget is shed with a cheap 503 and Retry-After rather than run late, so
+under overload the feed degrades first and `/login` keeps answering.
+
+Slots are per process. With sync workers a process runs one request at a
+time, so only the queue budget applies; the limit matters with threaded
+workers. Metrics (also per process) are served in Prometheus text format
+at /metrics/admission to holders of ADMISSION_METRICS_TOKEN.
+"""
+
+import hmac
+import threading
+import time
+
+from flask import abort, current_app, g, request
+from werkzeug.exceptions import ServiceUnavailable
+
+FEED = "feed"
+PROFILE = "profile"
+WRITE = "write"
+AUTH = "auth"
+
+# Higher goes first.
+PRIORITIES = {FEED: 0, PROFILE: 1, WRITE: 2, AUTH: 3}
+
+DEFAULT_CLASSES = {
+    'warbler.homepage': FEED,
+    'warbler.list_users': PROFILE,
+    'warbler.users_show': PROFILE,
+    'warbler.show_following': PROFILE,
+    'warbler.show_users_followers': PROFILE,
+    'warbler.show_users_likes': PROFILE,
+    'warbler.messages_show': PROFILE,
+    'warbler.show_notifications': PROFILE,
+    'warbler.admin_stats': PROFILE,
+    'warbler.messages_add': WRITE,
+    'warbler.messages_destroy': WRITE,
+    'warbler.add_or_remove_like': WRITE,
+    'warbler.add_follow': WRITE,
+    'warbler.stop_following': WRITE,
+    'warbler.update_profile': WRITE,
+    'warbler.delete_user': WRITE,
+    'warbler.login': AUTH,
+    'warbler.signup': AUTH,
+    'warbler.logout': AUTH,
+    'api.feed': FEED,
+    'api.user': PROFILE,
+    'api.user_messages': PROFILE,
+    'api.following': PROFILE,
+    'api.followers': PROFILE,
+    'api.likes': PROFILE,
+    'api.message': PROFILE,
+    'api.create_message': WRITE,
+    'api.delete_message': WRITE,
+    'api.login': AUTH,
+    'api.logout': AUTH,
+}
+
+# Seconds a request may have queued before it's shed. Heroku's router
+# gives up after 30.
+DEFAULT_QUEUE_BUDGETS = {FEED: 1, PROFILE: 2, WRITE: 5, AUTH: 10}
+
+# Seconds of average latency each class should stay under.
+DEFAULT_LATENCY_TARGETS = {FEED: 0.5, PROFILE: 0.5, WRITE: 0.25, AUTH: 0.25}
+
+# Share of the limit each class may fill.
+DEFAULT_SHARES = {FEED: 0.6, PROFILE: 0.8, WRITE: 1.0, AUTH: 1.0}
+
+
+class LatencyLimit:
+    """A concurrency limit that holds latency near a target: additive
+    increase, multiplicative decrease, as TCP does with its window.
+
+    Each route class has a moving average of its latency. While it's
+    under that class's target and the limit is in use, the limit grows by
+    about one per `limit` completions; when it's over, the limit is cut by
+    `backoff`, at most once per average latency so that one slow batch of
+    requests counts once. The limit stays within [min_limit, max_limit].
+    Not thread-safe; AdmissionControl calls it under its lock.
+    """
+
+    def __init__(self, initial=10, min_limit=1, max_limit=100, backoff=0.9):
+        self.limit = float(initial)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.backoff = backoff
+        self.latency = {}
+        self._cut_at = 0.0
+
+    def update(self, route_class, latency, in_flight, target, now=None):
+        """Take one request's latency into account. `in_flight` is how
+        many requests were running, this one included."""
+
+        now = time.monotonic() if now is None else now
+        average = self.latency.get(route_class, latency)
+        average += 0.2 * (latency - average)
+        self.latency[route_class] = average
+
+        if average > target:
+            if now - self._cut_at >= average:
+                self._cut_at = now
+                self.limit = max(self.min_limit, self.limit * self.backoff)
+        # A limit that isn't being used says nothing about whether it
+        # could be higher.
+        elif in_flight >= self.limit / 2:
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+
+
+class AdmissionControl:
+    """Queue, admit or shed requests by route class.
+
+    Configuration (app.config):
+
+    - ADMISSION_ENABLED: turn admission control on (default False)
+    - ADMISSION_CLASSES: endpoint -> route class; merged over
+      DEFAULT_CLASSES, None leaves an endpoint unmanaged
+    - ADMISSION_QUEUE_BUDGETS: route class -> seconds (default
+      DEFAULT_QUEUE_BUDGETS)
+    - ADMISSION_LATENCY_TARGETS: route class -> seconds (default
+      DEFAULT_LATENCY_TARGETS)
+    - ADMISSION_SHARES: route class -> share of the limit it may fill
+      (default DEFAULT_SHARES)
+    - ADMISSION_INITIAL_LIMIT / ADMISSION_MIN_LIMIT / ADMISSION_MAX_LIMIT:
+      concurrent requests per process (default 10 / 1 / 100)
+    - ADMISSION_RETRY_AFTER: Retry-After seconds on a 503 (default 5)
+    - ADMISSION_REQUEST_START_HEADER: header with the time the router
+      accepted the request, in seconds, milliseconds or microseconds since
+      the epoch, optionally prefixed "t=" (default X-Request-Start)
+    - ADMISSION_METRICS_TOKEN: bearer token for /metrics/admission; the
+      endpoint 404s without one (default None)
+    """
+
+    def __init__(self, app=None):
+        self.classes = {}
+        self.limit = None
+        self._cond = threading.Condition()
+        self._in_flight = {}
+        self._waiting = {}
+        self._stats = {}
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Register the request hooks and the metrics endpoint."""
+
+        app.config.setdefault('ADMISSION_ENABLED', False)
+        app.config.setdefault('ADMISSION_CLASSES', {})
+        app.config.setdefault('ADMISSION_QUEUE_BUDGETS', DEFAULT_QUEUE_BUDGETS)
+        app.config.setdefault('ADMISSION_LATENCY_TARGETS',
+                              DEFAULT_LATENCY_TARGETS)
+        app.config.setdefault('ADMISSION_SHARES', DEFAULT_SHARES)
+        app.config.setdefault('ADMISSION_INITIAL_LIMIT', 10)
+        app.config.setdefault('ADMISSION_MIN_LIMIT', 1)
+        app.config.setdefault('ADMISSION_MAX_LIMIT', 100)
+        app.config.setdefault('ADMISSION_RETRY_AFTER', 5)
+        app.config.setdefault('ADMISSION_REQUEST_START_HEADER',
+                              "X-Request-Start")
+        app.config.setdefault('ADMISSION_METRICS_TOKEN', None)
+
+        classes = {**DEFAULT_CLASSES, **app.config['ADMISSION_CLASSES']}
+        self.classes = {endpoint: route_class
+                        for endpoint, route_class in classes.items()
+                        if route_class is not None}
+        self.limit = LatencyLimit(app.config['ADMISSION_INITIAL_LIMIT'],
+                                  app.config['ADMISSION_MIN_LIMIT'],
+                                  app.config['ADMISSION_MAX_LIMIT'])
+
+        for route_class in PRIORITIES:
+            self._in_flight[route_class] = 0
+            self._waiting[route_class] = 0
+            self._stats[route_class] = dict(
+                admitted=0, shed_queue=0, shed_limit=0,
+                wait_sum=0.0, wait_count=0)
+
+        app.add_url_rule("/metrics/admission", "admission_metrics",
+                         self.metrics_view)
+
+        if app.config['ADMISSION_ENABLED']:
+            app.before_request(self.admit)
+            app.teardown_request(self.release)
+
+    ##########################################################################
+    # Request hooks
+
+    def _backlog_wait(self, header):
+        """Seconds since the router accepted the current request, or 0
+        without a usable header."""
+
+        value = request.headers.get(header, "").strip()
+        if value.startswith("t="):
+            value = value[2:]
+        try:
+            started = float(value)
+        except ValueError:
+            return 0.0
+
+        # Scale milliseconds and microseconds down to seconds.
+        while started > 1e11:
+            started /= 1000
+
+        return max(0.0, time.time() - started)
+
+    def _can_enter(self, route_class, shares):
+        total = sum(self._in_flight.values())
+        if total == 0:
+            return True
+        if total >= self.limit.limit * shares[route_class]:
+            return False
+
+        priority = PRIORITIES[route_class]
+        return not any(count for other, count in self._waiting.items()
+                       if PRIORITIES[other] > priority)
+
+    def _shed(self, route_class, reason):
+        """Count and raise a 503 (with the lock held)."""
+
+        self._stats[route_class][f"shed_{reason}"] += 1
+        raise ServiceUnavailable(
+            retry_after=current_app.config['ADMISSION_RETRY_AFTER'])
+
+    def admit(self):
+        """before_request: take a slot for a classified request, waiting
+        for one if need be, or shed it once it's over its queue budget."""
+
+        config = current_app.config
+        route_class = self.classes.get(request.endpoint)
+        if route_class is None:
+            return
+
+        budget = config['ADMISSION_QUEUE_BUDGETS'][route_class]
+        shares = config['ADMISSION_SHARES']
+        backlog = self._backlog_wait(config['ADMISSION_REQUEST_START_HEADER'])
+        arrived = time.monotonic()
+        deadline = arrived + budget - backlog
+
+        with self._cond:
+            if backlog >= budget:
+                self._shed(route_class, "queue")
+
+            self._waiting[route_class] += 1
+            try:
+                while not self._can_enter(route_class, shares):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._shed(route_class, "limit")
+                    self._cond.wait(remaining)
+            finally:
+                self._waiting[route_class] -= 1
+                # Leaving the queue, admitted or not, can unblock others.
+                self._cond.notify_all()
+
+            self._in_flight[route_class] += 1
+            stats = self._stats[route_class]
+            stats['admitted'] += 1
+            stats['wait_sum'] += backlog + time.monotonic() - arrived
+            stats['wait_count'] += 1
+
+        g.admission = (route_class, time.monotonic())
+
+    def release(self, exc):
+        """teardown_request: give the slot back and feed the request's
+        latency to the limit."""
+
+        admitted = g.pop('admission', None)
+        if admitted is None:
+            return
+
+        route_class, started = admitted
+        latency = time.monotonic() - started
+        target = current_app.config['ADMISSION_LATENCY_TARGETS'][route_class]
+
+        with self._cond:
+            in_flight = sum(self._in_flight.values())
+            self._in_flight[route_class] -= 1
+            self.limit.update(route_class, latency, in_flight, target)
+            self._cond.notify_all()
+
+    ##########################################################################
+    # Metrics
+
+    def metrics(self):
+        """A snapshot: the current limit and, per route class, requests
+        in flight and waiting, decisions taken and queue wait."""
+
+        with self._cond:
+            return {
+                'limit': self.limit.limit,
+                'classes': {
+                    route_class: dict(
+                        self._stats[route_class],
+                        in_flight=self._in_flight[route_class],
+                        waiting=self._waiting[route_class],
+                        latency=self.limit.latency.get(route_class, 0.0))
+                    for route_class in PRIORITIES
+                },
+            }
+
+    def metrics_text(self):
+        """metrics() in Prometheus text format."""
+
+        snapshot = self.metrics()
+        lines = [f"warbler_admission_limit {snapshot['limit']:.3f}"]
+
+        for route_class, stats in snapshot['classes'].items():
+            label = f'class="{route_class}"'
+            lines += [
+                f"warbler_admission_in_flight{{{label}}} "
+                f"{stats['in_flight']}",
+                f"warbler_admission_waiting{{{label}}} {stats['waiting']}",
+                f"warbler_admission_admitted_total{{{label}}} "
+                f"{stats['admitted']}",
+                f'warbler_admission_shed_total{{{label},reason="queue"}} '
+                f"{stats['shed_queue']}",
+                f'warbler_admission_shed_total{{{label},reason="limit"}} '
+                f"{stats['shed_limit']}",
+                f"warbler_admission_queue_wait_seconds_sum{{{label}}} "
+                f"{stats['wait_sum']:.6f}",
+                f"warbler_admission_queue_wait_seconds_count{{{label}}} "
+                f"{stats['wait_count']}",
+                f"warbler_admission_latency_seconds{{{label}}} "
+                f"{stats['latency']:.6f}",
+            ]
+
+        return "\n".join(lines) + "\n"
+
+    def metrics_view(self):
+        """GET /metrics/admission, for a bearer of ADMISSION_METRICS_TOKEN."""
+
+        token = current_app.config['ADMISSION_METRICS_TOKEN']
+        given = request.headers.get("Authorization", "").encode()
+        if not token or not hmac.compare_digest(given,
+                                                f"Bearer {token}".encode()):
+            abort(404)
+
+        return (self.metrics_text(), 200,
+                {'Content-Type': "text/plain; version=0.0.4"})
@@ -1,44 +1,151 @@
-import os
-
-from flask import Flask, render_template, request, flash, redirect, session, g
-from flask_debugtoolbar import DebugToolbarExtension
+from flask import Blueprint, Flask, current_app, render_template, request, flash, redirect, session, g, abort
 from sqlalchemy.exc import IntegrityError
-from sqlalchemy import or_
-from werkzeug.exceptions import Unauthorized
+from werkzeug.datastructures import MultiDict
+from werkzeug.exceptions import HTTPException, Unauthorized
+from werkzeug.local import LocalProxy
 
+from config import PROFILES, profile_from_env
 from forms import UserAddForm, LoginForm, MessageForm, CsrfForm, UserEditForm
 from models import db, connect_db, User, Message, Follows, Like
-
-import dotenv
-dotenv.load_dotenv()
+import queries
+from admission import AdmissionControl
+from ratelimit import RateLimiter
+from idempotency import Idempotency
+from writebuffer import WriteBuffer
+from rendering import TemplatePipeline, render_page
+from assets import Assets
+from imageproxy import ImageProxy
+from entitycache import EntityCache
+from outbox import Outbox
+from pagecache import PageCache
+from trending import Trending
+from profiler import Profiler
+from compression import Compression
+from warmup import WarmUp
+from userdata import FORMATS, UserData
+from sharding import Sharding
+from asyncreads import AsyncReads, home_page, message_page, user_page
+from partitions import MessagePartitions, archived_message
+from notifications import FOLLOW, LIKE, Notifications
+from rollups import Rollups, daily_totals, top_users
+from serializers import (MESSAGE_FIELDS, PROFILE_FIELDS, USER_FIELDS,
+                         api_response, dump_messages, dump_profile,
+                         dump_user, message_cursor, page, page_after,
+                         page_size, requested_fields, user_cursor)
 
 CURR_USER_KEY = "curr_user"
 
-app = Flask(__name__)
-
-# Get DB_URI from environ variable (useful for production/testing) or,
-# if not set there, use development local db.
-app.config['SQLALCHEMY_DATABASE_URI'] = (os.environ['DATABASE_URL'].replace("postgres://", "postgresql://"))
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['SQLALCHEMY_ECHO'] = False
-app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = True
-app.config['SECRET_KEY'] = os.environ['SECRET_KEY']
-toolbar = DebugToolbarExtension(app)
+views = Blueprint('warbler', __name__)
+api = Blueprint('api', __name__, url_prefix='/api/v1')
+
+profiler = Profiler()
+compression = Compression()
+admission = AdmissionControl()
+limiter = RateLimiter()
+idempotency = Idempotency()
+outbox = Outbox()
+entity_cache = EntityCache()
+page_cache = PageCache()
+write_buffer = WriteBuffer()
+assets = Assets()
+image_proxy = ImageProxy()
+trending = Trending()
+notifications = Notifications()
+rollups = Rollups()
+async_reads = AsyncReads()
+message_partitions = MessagePartitions()
+templates = TemplatePipeline()
+warm_up = WarmUp()
+user_data = UserData()
+sharding = Sharding()
+
+
+@warm_up.primer
+def prime_entity_cache(user_id):
+    entity_cache.get(User, user_id)
+
+
+def create_app(config=None):
+    """Build the Warbler app.
+
+    `config` is a profile name from config.PROFILES or a config class;
+    by default the profile comes from the environment.
+    """
 
-connect_db(app)
+    if config is None:
+        config = profile_from_env()
+    elif isinstance(config, str):
+        config = PROFILES[config]
+
+    app = Flask(__name__)
+    app.config.from_object(config)
+    app.config['RATELIMIT_SESSION_KEY'] = CURR_USER_KEY
+    app.config['IDEMPOTENCY_SESSION_KEY'] = CURR_USER_KEY
+
+    if not app.config['SECRET_KEY']:
+        raise RuntimeError("SECRET_KEY must be set")
+
+    if app.config['DEBUG_TOOLBAR']:
+        # Imported here so production workers never load it.
+        from flask_debugtoolbar import DebugToolbarExtension
+        DebugToolbarExtension(app)
+
+    connect_db(app)
+
+    # First, so its timing covers the other extensions' request hooks.
+    profiler.init_app(app)
+    # Second, so its after_request hook sees responses after every other
+    # extension's but the profiler's.
+    compression.init_app(app)
+    # Next, so shed requests cost as little as possible.
+    admission.init_app(app)
+    limiter.init_app(app)
+    idempotency.init_app(app)
+    outbox.init_app(app)
+    entity_cache.init_app(app)
+    page_cache.init_app(app)
+    write_buffer.init_app(app)
+    assets.init_app(app)
+    image_proxy.init_app(app)
+    trending.init_app(app)
+    notifications.init_app(app)
+    rollups.init_app(app)
+    async_reads.init_app(app)
+    message_partitions.init_app(app)
+    warm_up.init_app(app)
+    user_data.init_app(app)
+    sharding.init_app(app)
+    app.register_blueprint(views)
+    app.register_blueprint(api)
+
+    # Last, so every template filter and global is registered before
+    # templates are precompiled.
+    templates.init_app(app)
+
+    return app
 
 
 ##############################################################################
 # User signup/login/logout
 
 
-@app.before_request
+def csrf_form():
+    """This request's CsrfForm, built on first use. Building it puts a
+    CSRF token in the session, and a page that sets a session cookie
+    can't be cached, so anonymous pages that show no forms mustn't."""
+
+    if 'csrf_form_instance' not in g:
+        g.csrf_form_instance = CsrfForm()
+    return g.csrf_form_instance
+
+
+@views.before_app_request
 def add_user_to_g():
     """If we're logged in, add curr user and CsrfForm() to Flask global"""
-    g.csrf_form = CsrfForm()
+    g.csrf_form = LocalProxy(csrf_form)
 
     if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+        g.user = entity_cache.get(User, session[CURR_USER_KEY])
         # g.user.liked_messages = g.user.set_of_liked_messages()
 
     else:
@@ -57,7 +164,7 @@ def do_logout():
         del session[CURR_USER_KEY]
 
 
-@app.route('/signup', methods=["GET", "POST"])
+@views.route('/signup', methods=["GET", "POST"])
 def signup():
     """Handle user signup.
 
@@ -79,6 +186,8 @@ def signup():
                 email=form.email.data,
                 image_url=form.image_url.data or User.image_url.default.arg,
             )
+            db.session.flush()
+            sharding.save_user(user)
             db.session.commit()
 
         except IntegrityError:
@@ -93,7 +202,7 @@ def signup():
         return render_template('users/signup.html', form=form)
 
 
-@app.route('/login', methods=["GET", "POST"])
+@views.route('/login', methods=["GET", "POST"])
 def login():
     """Handle user login."""
 
@@ -113,7 +222,7 @@ def login():
     return render_template('users/login.html', form=form)
 
 
-@app.post('/logout')
+@views.post('/logout')
 def logout():
     """Handle logout of user."""
 
@@ -130,7 +239,7 @@ def logout():
 ##############################################################################
 # General user routes:
 
-@app.get('/users')
+@views.get('/users')
 def list_users():
     """Page with listing of users.
 
@@ -138,25 +247,28 @@ def list_users():
     """
 
     search = request.args.get('q')
-
-    if not search:
-        users = User.query.all()
-    else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+    users = queries.list_users(search)
 
     return render_template('users/index.html', users=users)
 
 
-@app.get('/users/<int:user_id>')
+@views.get('/users/<int:user_id>')
 def users_show(user_id):
     """Show user profile."""
 
-    user = User.query.get_or_404(user_id)
+    viewer_id = g.user and g.user.id
+    if async_reads.enabled:
+        user = async_reads.run(user_page, user_id, viewer_id)
+    else:
+        user = queries.user_profile(user_id, viewer_id=viewer_id)
+
+    if user is None:
+        abort(404)
 
-    return render_template('users/show.html', user=user)
+    return render_page('users/show.html', user=user)
 
 
-@app.get('/users/<int:user_id>/following')
+@views.get('/users/<int:user_id>/following')
 def show_following(user_id):
     """Show list of people this user is following."""
 
@@ -164,11 +276,11 @@ def show_following(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
+    user = entity_cache.get_or_404(User, user_id)
     return render_template('users/following.html', user=user)
 
 
-@app.get('/users/<int:user_id>/followers')
+@views.get('/users/<int:user_id>/followers')
 def show_users_followers(user_id):
     """Show list of followers of this user."""
 
@@ -177,10 +289,10 @@ def show_users_followers(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
+    user = entity_cache.get_or_404(User, user_id)
     return render_template('users/followers.html', user=user)
 
-@app.get('/users/<int:user_id>/likes')
+@views.get('/users/<int:user_id>/likes')
 def show_users_likes(user_id):
     """Show list of messages liked by this user."""
 
@@ -188,11 +300,14 @@ def show_users_likes(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-    return render_template('users/likes.html', user=user)
+    user = queries.user_likes(user_id, viewer_id=g.user.id)
+    if user is None:
+        abort(404)
 
+    return render_page('users/likes.html', user=user)
 
-@app.post('/users/follow/<int:follow_id>')
+
+@views.post('/users/follow/<int:follow_id>')
 def add_follow(follow_id):
     """Add a follow for the currently-logged-in user."""
 
@@ -200,14 +315,16 @@ def add_follow(follow_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get_or_404(follow_id)
-    g.user.following.append(followed_user)
-    db.session.commit()
+    followed_user = entity_cache.get_or_404(User, follow_id)
+    sharding.set_following(g.user.id, followed_user.id, True)
+    if write_buffer.set_following(g.user, followed_user, True):
+        notifications.record(FOLLOW, followed_user.id, g.user.id)
+        rollups.followed(followed_user.id)
 
     return redirect(f"/users/{g.user.id}/following")
 
 
-@app.post('/users/stop-following/<int:follow_id>')
+@views.post('/users/stop-following/<int:follow_id>')
 def stop_following(follow_id):
     """Have currently-logged-in-user stop following this user."""
 
@@ -215,13 +332,15 @@ def stop_following(follow_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get(follow_id)
-    g.user.following.remove(followed_user)
-    db.session.commit()
+    followed_user = entity_cache.get(User, follow_id)
+    sharding.set_following(g.user.id, followed_user.id, False)
+    if write_buffer.set_following(g.user, followed_user, False):
+        notifications.retract(FOLLOW, followed_user.id, g.user.id)
+        rollups.followed(followed_user.id, following=False)
 
     return redirect(f"/users/{g.user.id}/following")
 
-@app.route('/users/profile', methods=["GET", "POST"])
+@views.route('/users/profile', methods=["GET", "POST"])
 def update_profile():
     """Update profile for current user."""
 
@@ -239,6 +358,8 @@ def update_profile():
             g.user.image_url = form.image_url.data or User.DEFAULT_IMG_URL
             g.user.header_image_url = form.header_image_url.data or User.DEFAULT_HEADER_IMG_URL
             g.user.bio = form.bio.data or ""
+            db.session.flush()
+            sharding.save_user(g.user)
             db.session.commit()
             return redirect(f"/users/{g.user.id}")
         else:
@@ -248,7 +369,7 @@ def update_profile():
     return render_template("users/edit.html", form=form, user_id=g.user.id)
 
 
-@app.post('/users/delete')
+@views.post('/users/delete')
 def delete_user():
     """Delete user."""
 
@@ -259,18 +380,40 @@ def delete_user():
     if g.csrf_form.validate_on_submit():    
         do_logout()
 
-        db.session.delete(g.user)
+        user_id = g.user.id
+        sharding.delete_user(user_id)
+        User.delete_by_id(user_id)
+        outbox.publish(f"user:{user_id}")
         db.session.commit()
+        write_buffer.forget(user_id=user_id)
+        page_cache.invalidate(f"user:{user_id}")
+        entity_cache.invalidate(f"user:{user_id}")
 
         return redirect("/signup")
 
     flash("Access unauthorized.", "danger")
     return redirect("/")
 
+@views.get('/notifications')
+def show_notifications():
+    """Show the current user's notifications and mark them read."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    rows = notifications.for_user(g.user.id)
+    if notifications.unread_count():
+        notifications.mark_read(g.user.id)
+        db.session.commit()
+
+    return render_template('users/notifications.html', notifications=rows)
+
+
 ##############################################################################
 # Messages routes:
 
-@app.route('/messages/new', methods=["GET", "POST"])
+@views.route('/messages/new', methods=["GET", "POST"])
 def messages_add():
     """Add a message:
 
@@ -286,22 +429,39 @@ def messages_add():
     if form.validate_on_submit():
         msg = Message(text=form.text.data)
         g.user.messages.append(msg)
+        db.session.flush()
+        sharding.save_message(msg)
         db.session.commit()
+        trending.record(msg.text)
+        rollups.posted(g.user.id)
 
         return redirect(f"/users/{g.user.id}")
 
     return render_template('messages/new.html', form=form)
 
 
-@app.get('/messages/<int:message_id>')
+@views.get('/messages/<int:message_id>')
 def messages_show(message_id):
     """Show a message."""
 
-    msg = Message.query.get(message_id)
-    return render_template('messages/show.html', message=msg)
+    if async_reads.enabled:
+        msg = async_reads.run(message_page, message_id, g.user and g.user.id)
+    else:
+        msg = entity_cache.get(Message, message_id)
+
+    # Past the retention horizon, messages live on in the archive.
+    archived = msg is None
+    if archived:
+        msg = archived_message(message_id)
+        if msg is None:
+            abort(404)
 
+    page_cache.depends_on(f"user:{msg.user.id}")
+    return render_template('messages/show.html', message=msg,
+                           archived=archived)
 
-@app.post('/messages/<int:message_id>/delete')
+
+@views.post('/messages/<int:message_id>/delete')
 def messages_destroy(message_id):
     """Delete a message."""
 
@@ -309,9 +469,17 @@ def messages_destroy(message_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    msg = Message.query.get(message_id)
-    db.session.delete(msg)
+    if not Message.delete_owned(message_id, g.user.id):
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    sharding.delete_message(message_id, g.user.id)
+    notifications.forget(message_id, g.user.id)
+    outbox.publish(f"message:{message_id}", f"user:{g.user.id}")
     db.session.commit()
+    write_buffer.forget(message_id=message_id)
+    page_cache.invalidate(f"message:{message_id}", f"user:{g.user.id}")
+    entity_cache.invalidate(f"message:{message_id}")
 
     return redirect(f"/users/{g.user.id}")
 
@@ -319,7 +487,7 @@ def messages_destroy(message_id):
 ##############################################################################
 # Likes routes
 
-@app.post('/messages/<int:message_id>/like')
+@views.post('/messages/<int:message_id>/like')
 def add_or_remove_like(message_id):
     """Add/Remove like from message"""
 
@@ -328,10 +496,18 @@ def add_or_remove_like(message_id):
         return redirect("/")
 
     if g.csrf_form.validate_on_submit(): 
-        message = Message.query.get_or_404(message_id)
+        message = entity_cache.get_or_404(Message, message_id)
         
-        g.user.add_or_remove_like(message)
-        db.session.commit()
+        # Which way the toggle goes is only known after it, so check
+        # first that the shard will take it.
+        sharding.check_writable({g.user.id})
+        liked = write_buffer.toggle_like(g.user, message)
+        sharding.set_like(g.user.id, message.id, liked)
+        rollups.liked(g.user.id, message.user_id, liked)
+        if liked:
+            notifications.record(LIKE, message.user_id, g.user.id, message.id)
+        else:
+            notifications.retract(LIKE, message.user_id, g.user.id, message.id)
         return redirect(f"/messages/{message.id}")
 
     else:
@@ -343,7 +519,7 @@ def add_or_remove_like(message_id):
 # Homepage and error pages
 
 
-@app.get('/')
+@views.get('/')
 def homepage():
     """Show homepage:
 
@@ -352,22 +528,269 @@ def homepage():
     """
 
     if g.user:
-        user = User.query.get_or_404(session[CURR_USER_KEY])
-        following_user_ids = [user.id for user in user.following]
-
-        messages = (Message
-                    .query
-                    .filter(or_(Message.user_id.in_(following_user_ids),Message.user_id==user.id))
-                    .order_by(Message.timestamp.desc())
-                    .limit(100)
-                    .all())
+        if sharding.enabled:
+            me = queries.user_summary(g.user.id)
+            messages = sharding.home_feed(g.user.id)
+        elif async_reads.enabled:
+            me, messages = async_reads.run(
+                home_page, g.user.id, write_buffer.pending_follows)
+        else:
+            me = queries.user_summary(g.user.id)
+            following_user_ids = write_buffer.following_ids(g.user)
+            messages = queries.home_feed(g.user.id, following_user_ids)
 
-        return render_template('home.html', messages=messages)
+        return render_page('home.html', me=me, messages=messages)
 
     else:
         return render_template('home-anon.html')
 
 
+##############################################################################
+# Admin
+
+
+@views.get('/admin/stats')
+def admin_stats():
+    """Site activity from the daily rollups; only for ADMIN_USERNAMES."""
+
+    if not g.user or g.user.username not in current_app.config[
+            'ADMIN_USERNAMES']:
+        abort(404)
+
+    return render_template(
+        'admin/stats.html',
+        days=daily_totals(14),
+        most_liked=top_users('likes_received', 7),
+        most_posts=top_users('posts', 7),
+        most_followed=top_users('follows_gained', 7),
+        entity_cache=entity_cache.stats() if entity_cache.enabled else None,
+        compression=compression.metrics())
+
+
+##############################################################################
+# JSON API
+#
+# The same queries as the pages above, as compact JSON (see
+# serializers.py). Clients log in with POST /api/v1/session and then use
+# the session cookie. Writes take JSON bodies only; browsers won't send
+# those cross-site without CORS, so they need no CSRF token.
+
+
+@api.errorhandler(HTTPException)
+def api_error(error):
+    """Errors as JSON, keeping headers like Retry-After."""
+
+    headers = [(name, value) for name, value in error.get_headers()
+               if name != "Content-Type"]
+    return api_response(
+        {"error": {"status": error.code, "message": error.description}},
+        error.code, headers)
+
+
+def require_api_user():
+    """The logged-in user; 401 if there isn't one."""
+
+    if not g.user:
+        raise Unauthorized("Log in with POST /api/v1/session.")
+    return g.user
+
+
+def json_body():
+    """The request's JSON object; 415 or 400 if it isn't one."""
+
+    if not request.is_json:
+        abort(415)
+    data = request.get_json()
+    if not isinstance(data, dict):
+        abort(400, "Expected a JSON object.")
+    return data
+
+
+def with_pending_likes(messages):
+    """Apply the viewer's likes still in the write buffer to MessageRows."""
+
+    if write_buffer.enabled and g.user:
+        for message in messages:
+            message.liked = write_buffer.has_liked(message)
+    return messages
+
+
+def message_list(fetch):
+    """A page of messages from `fetch(limit, before)`."""
+
+    limit = page_size()
+    messages, cursor = page(fetch(limit + 1, page_after('message')), limit,
+                            message_cursor)
+    fields = requested_fields(MESSAGE_FIELDS, {'user': USER_FIELDS})
+
+    return api_response({
+        "data": dump_messages(with_pending_likes(messages), fields),
+        "next_cursor": cursor,
+    })
+
+
+def user_list(fetch):
+    """A page of users from `fetch(limit, after)`."""
+
+    limit = page_size()
+    users, cursor = page(fetch(limit + 1, page_after('user')), limit,
+                         user_cursor)
+    fields = requested_fields(USER_FIELDS)
+
+    return api_response({
+        "data": [dump_user(user, fields) for user in users],
+        "next_cursor": cursor,
+    })
+
+
+@api.post('/session', endpoint='login')
+def api_login():
+    """Log in with {"username": ..., "password": ...}."""
+
+    data = json_body()
+    username = data.get('username')
+    password = data.get('password')
+    user = (isinstance(username, str) and isinstance(password, str)
+            and User.authenticate(username, password))
+    if not user:
+        raise Unauthorized("Invalid credentials.")
+
+    do_login(user)
+    return api_response(dump_user(user), 201)
+
+
+@api.delete('/session', endpoint='logout')
+def api_logout():
+    do_logout()
+    return "", 204
+
+
+@api.get('/feed', endpoint='feed')
+def api_feed():
+    """The logged-in user's home feed."""
+
+    user = require_api_user()
+    if sharding.enabled:
+        return message_list(lambda limit, before: sharding.home_feed(
+            user.id, limit, before))
+
+    following_ids = write_buffer.following_ids(user)
+
+    return message_list(lambda limit, before: queries.home_feed(
+        user.id, following_ids, limit, before))
+
+
+@api.get('/users/<int:user_id>', endpoint='user')
+def api_user(user_id):
+    """A profile with its counts."""
+
+    profile = queries.user_summary(user_id)
+    if profile is None:
+        abort(404)
+
+    return api_response(dump_profile(profile,
+                                     requested_fields(PROFILE_FIELDS)))
+
+
+@api.get('/users/<int:user_id>/messages', endpoint='user_messages')
+def api_user_messages(user_id):
+    viewer_id = g.user and g.user.id
+    return message_list(lambda limit, before: queries.user_messages(
+        user_id, viewer_id, limit, before))
+
+
+@api.get('/users/<int:user_id>/following', endpoint='following')
+def api_following(user_id):
+    require_api_user()
+    return user_list(lambda limit, after: queries.following(
+        user_id, limit, after))
+
+
+@api.get('/users/<int:user_id>/followers', endpoint='followers')
+def api_followers(user_id):
+    require_api_user()
+    return user_list(lambda limit, after: queries.followers(
+        user_id, limit, after))
+
+
+@api.get('/users/<int:user_id>/likes', endpoint='likes')
+def api_likes(user_id):
+    viewer_id = require_api_user().id
+    return message_list(lambda limit, before: queries.liked_messages(
+        user_id, viewer_id, limit, before))
+
+
+@api.post('/export', endpoint='export')
+def api_export():
+    """Download the logged-in user's profile, messages, likes and follows,
+    as ?format=ndjson (the default) or csv. A POST, so it's rate limited."""
+
+    user = require_api_user()
+    fmt = request.args.get('format', "ndjson")
+    if fmt not in FORMATS:
+        abort(400, f"format must be one of: {', '.join(FORMATS)}.")
+
+    return user_data.export_response(user, fmt)
+
+
+@api.post('/messages', endpoint='create_message')
+def api_create_message():
+    """Post {"text": ...} as the logged-in user."""
+
+    user = require_api_user()
+    data = json_body()
+    form = MessageForm(formdata=MultiDict({
+        name: value for name, value in data.items()
+        if isinstance(value, str)}), meta={'csrf': False})
+    if not form.validate():
+        return api_response({"error": {"status": 422,
+                                       "message": "Invalid message.",
+                                       "fields": form.errors}}, 422)
+
+    msg = Message(text=form.text.data, user_id=user.id)
+    db.session.add(msg)
+    db.session.flush()
+    sharding.save_message(msg)
+    db.session.commit()
+    trending.record(msg.text)
+    rollups.posted(user.id)
+
+    fields = requested_fields(MESSAGE_FIELDS, {'user': USER_FIELDS})
+    return api_response(
+        dump_messages([queries.message(msg.id, user.id)], fields)[0], 201,
+        {'Location': f"/api/v1/messages/{msg.id}"})
+
+
+@api.get('/messages/<int:message_id>', endpoint='message')
+def api_message(message_id):
+    msg = (queries.message(message_id, g.user and g.user.id)
+           or archived_message(message_id))
+    if msg is None:
+        abort(404)
+
+    fields = requested_fields(MESSAGE_FIELDS, {'user': USER_FIELDS})
+    return api_response(dump_messages(with_pending_likes([msg]), fields)[0])
+
+
+@api.delete('/messages/<int:message_id>', endpoint='delete_message')
+def api_delete_message(message_id):
+    """Delete one of the logged-in user's messages."""
+
+    user = require_api_user()
+    if not Message.delete_owned(message_id, user.id):
+        abort(404 if Message.query.get(message_id) is None else 403)
+
+    sharding.delete_message(message_id, user.id)
+    notifications.forget(message_id, user.id)
+    outbox.publish(f"message:{message_id}", f"user:{user.id}")
+    db.session.commit()
+    write_buffer.forget(message_id=message_id)
+    page_cache.invalidate(f"message:{message_id}", f"user:{user.id}")
+    entity_cache.invalidate(f"message:{message_id}")
+
+    return "", 204
+
+
 ##############################################################################
 # Turn off all caching in Flask
 #   (useful for dev; in production, this kind of stuff is typically
@@ -375,10 +798,15 @@ def homepage():
 #
 # https://stackoverflow.com/questions/34066804/disabling-caching-in-flask
 
-@app.after_request
+@views.after_app_request
 def add_header(response):
-    """Add non-caching headers on every request."""
+    """Add non-caching headers on every request that didn't set its own
+    caching policy (like fingerprinted assets)."""
 
     # https://developer.mozilla.org/en-US/docs/Web/HTTP/Headers/Cache-Control
-    response.cache_control.no_store = True
+    if 'Cache-Control' not in response.headers:
+        response.cache_control.no_store = True
     return response
+
+
+app = create_app()
@@ -0,0 +1,229 @@
+"""Fingerprinted, precompressed static assets.
+
+`flask build-assets`, and every startup with fingerprinting on, copies
+everything under static/ to ASSETS_OUTPUT_DIR with a content hash in the
+filename, writes .gz (and .br, if the brotli package is installed) variants
+of compressible files next to them, and records the mapping in
+manifest.json. Templates link to assets through the `asset_url` helper, so
+a changed file gets a new URL and unchanged files can be cached by
+browsers forever. Rebuilding is cheap: it reads and hashes the sources,
+but only writes files whose content is new.
+
+Fingerprinted files are served from /assets/ with immutable caching and,
+when the client accepts it, the precompressed variant. In production the
+output directory can instead be handed to a front proxy / CDN and
+ASSETS_URL_PREFIX pointed at it, so Python workers never serve them.
+"""
+
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import posixpath
+import re
+
+import click
+from flask import current_app, request, send_from_directory
+from werkzeug.exceptions import NotFound
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+MANIFEST = "manifest.json"
+
+COMPRESSIBLE = {".css", ".js", ".svg", ".ico", ".txt", ".json", ".html"}
+
+# Fingerprinted files never change, so they can be cached for a year.
+ONE_YEAR = 60 * 60 * 24 * 365
+
+CSS_URL_RE = re.compile(r"""url\(\s*(['"]?)/static/([^'")]+)\1\s*\)""")
+
+
+class Assets:
+    """Build, link to and serve fingerprinted static files.
+
+    Configuration (app.config):
+
+    - ASSETS_FINGERPRINT: link to fingerprinted files (default False, plain
+      /static/ URLs)
+    - ASSETS_OUTPUT_DIR: where built files and the manifest are written
+    - ASSETS_URL_PREFIX: URL prefix for built files (default "/assets";
+      set to a CDN or proxy location to serve them elsewhere)
+    """
+
+    def __init__(self, app=None):
+        self.manifest = {}
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Register the asset route, template helper and CLI command."""
+
+        app.config.setdefault('ASSETS_FINGERPRINT', False)
+        app.config.setdefault(
+            'ASSETS_OUTPUT_DIR', os.path.join(app.instance_path, "assets"))
+        app.config.setdefault('ASSETS_URL_PREFIX', "/assets")
+
+        app.add_url_rule(
+            "/assets/<path:filename>", "assets", self.serve)
+        app.add_template_global(self.asset_url)
+        app.add_template_filter(self.asset_url)
+
+        @app.cli.command("build-assets")
+        def build_assets_command():
+            """Fingerprint and compress everything under static/."""
+
+            manifest = build(app.static_folder,
+                             app.config['ASSETS_OUTPUT_DIR'])
+            click.echo(f"Built {len(manifest)} assets.")
+
+        if app.config['ASSETS_FINGERPRINT']:
+            # Rebuilt rather than loaded from a previous run, so an output
+            # directory that outlives a deploy never serves stale files.
+            self.manifest = build(
+                app.static_folder, app.config['ASSETS_OUTPUT_DIR'])
+
+    def asset_url(self, path):
+        """URL for a static file, fingerprinted when possible.
+
+        Takes a path relative to static/ ("stylesheets/style.css") or a
+        /static/ URL. Anything else (external URLs, unknown files) is
+        returned unchanged.
+        """
+
+        if path is None:
+            return path
+
+        name = path[len("/static/"):] if path.startswith("/static/") else path
+        built = self.manifest.get(name)
+
+        if built is not None:
+            return f"{current_app.config['ASSETS_URL_PREFIX']}/{built}"
+        if path.startswith(("/", "http://", "https://")):
+            return path
+
+        return f"/static/{path}"
+
+    def serve(self, filename):
+        """Send a fingerprinted file, precompressed if the client accepts
+        it, with immutable caching."""
+
+        directory = current_app.config['ASSETS_OUTPUT_DIR']
+        if filename == MANIFEST:
+            raise NotFound()
+
+        mimetype = mimetypes.guess_type(filename)[0]
+        accepted = request.accept_encodings
+
+        for encoding, suffix in (("br", ".br"), ("gzip", ".gz")):
+            if (accepted[encoding]
+                    and os.path.isfile(os.path.join(directory, filename + suffix))):
+                resp = send_from_directory(
+                    directory, filename + suffix, mimetype=mimetype,
+                    max_age=ONE_YEAR)
+                resp.headers['Content-Encoding'] = encoding
+                break
+        else:
+            resp = send_from_directory(
+                directory, filename, mimetype=mimetype, max_age=ONE_YEAR)
+
+        resp.vary.add("Accept-Encoding")
+        resp.cache_control.public = True
+        resp.cache_control.immutable = True
+        return resp
+
+
+def build(static_dir, output_dir):
+    """Fingerprint and compress every file in `static_dir` into
+    `output_dir`. Returns the manifest: source path -> built path.
+
+    Stylesheets are built last so their url(/static/...) references can be
+    rewritten to fingerprinted names first.
+    """
+
+    os.makedirs(output_dir, exist_ok=True)
+
+    sources = []
+    for root, _dirs, files in os.walk(static_dir):
+        for filename in files:
+            full = os.path.join(root, filename)
+            sources.append(os.path.relpath(full, static_dir).replace(os.sep, "/"))
+    sources.sort(key=lambda name: (name.endswith(".css"), name))
+
+    manifest = {}
+    for name in sources:
+        with open(os.path.join(static_dir, name), "rb") as f:
+            data = f.read()
+
+        if name.endswith(".css"):
+            data = _rewrite_css_urls(name, data, manifest)
+
+        built = _fingerprint(name, data)
+        manifest[name] = built
+        _write_asset(os.path.join(output_dir, built), data)
+
+    _write_atomic(os.path.join(output_dir, MANIFEST),
+                  json.dumps(manifest, indent=2, sort_keys=True).encode())
+
+    return manifest
+
+
+def _fingerprint(name, data):
+    """"images/logo.png" -> "images/logo.<hash>.png"."""
+
+    root, ext = os.path.splitext(name)
+    digest = hashlib.sha256(data).hexdigest()[:12]
+    return f"{root}.{digest}{ext}"
+
+
+def _rewrite_css_urls(name, data, manifest):
+    """Point url(/static/...) references at fingerprinted files, relative
+    to the stylesheet so they resolve under any ASSETS_URL_PREFIX."""
+
+    css_dir = posixpath.dirname(name)
+
+    def replace(match):
+        built = manifest.get(match.group(2))
+        if built is None:
+            return match.group(0)
+        return f'url("{posixpath.relpath(built, css_dir or ".")}")'
+
+    css = CSS_URL_RE.sub(replace, data.decode("utf-8"))
+    return css.encode("utf-8")
+
+
+def _write_asset(path, data):
+    """Write a built file plus its compressed variants. Files are content
+    addressed, so one that already exists is already correct."""
+
+    if os.path.exists(path):
+        return
+
+    _write_atomic(path, data)
+
+    if os.path.splitext(path)[1] not in COMPRESSIBLE:
+        return
+
+    gz = gzip.compress(data, compresslevel=9, mtime=0)
+    if len(gz) < len(data):
+        _write_atomic(path + ".gz", gz)
+
+    if brotli is not None:
+        br = brotli.compress(data, quality=11)
+        if len(br) < len(data):
+            _write_atomic(path + ".br", br)
+
+
+def _write_atomic(path, data):
+    """Write via a temp file so concurrent workers never see partial
+    files."""
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
@@ -0,0 +1,176 @@
+"""Async read path for the home feed, profile and message pages.
+
+Experimental, and off by default (ASYNC_READS_ENABLED). With it on, those
+views run their SELECTs on an async SQLAlchemy engine (asyncpg for
+PostgreSQL, aiosqlite for SQLite) and issue all of a page's reads
+together with asyncio.gather, then wait once: the home page's counters
+and feed, or a profile's counters and messages, take one round trip
+instead of two or three.
+
+The engine lives on one event loop per process, in a background thread.
+Views hand it a coroutine with run() and block until it's done, so this
+doesn't let a worker serve more requests at once: what it saves is a
+request's own latency, the round trips it no longer makes one after
+another. That pays off only when the database is far enough away for
+round trips to outweigh the hop onto the loop. benchmarks/bench_async.py
+measures it: with a 10ms round trip a lone request is faster, but under
+load, and at local-socket latencies, the sync path has more throughput.
+Leave it off unless the database is remote and requests are few.
+
+Flask 2.0's own `async def` views would not work here: they start a fresh
+event loop for every request, and asyncpg connections can't be used
+outside the loop they were opened on, so nothing could be pooled.
+"""
+
+import asyncio
+import os
+import threading
+
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine
+
+import queries
+
+ASYNC_DRIVERS = {
+    'postgresql': "asyncpg",
+    'sqlite': "aiosqlite",
+}
+
+
+def async_database_url(url):
+    """The async-driver equivalent of a sync database URL."""
+
+    url = make_url(url)
+    backend = url.get_backend_name()
+    return url.set(drivername=f"{backend}+{ASYNC_DRIVERS[backend]}")
+
+
+class AsyncReads:
+    """Run read-only page queries concurrently on an async engine.
+
+    Configuration (app.config):
+
+    - ASYNC_READS_ENABLED: use the (experimental) async path in the views
+      that support it (default False)
+    - ASYNC_DATABASE_URL: defaults to SQLALCHEMY_DATABASE_URI with the
+      async driver for its database
+    - ASYNC_POOL_SIZE / ASYNC_MAX_OVERFLOW: connection pool limits
+      (default 10 / 10); PostgreSQL only, SQLite doesn't pool
+    - ASYNC_TIMEOUT: seconds a view waits for its queries (default 10)
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.enabled = False
+        self._loop = None
+        self._engine = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('ASYNC_READS_ENABLED', False)
+        app.config.setdefault(
+            'ASYNC_DATABASE_URL',
+            async_database_url(app.config['SQLALCHEMY_DATABASE_URI']))
+        app.config.setdefault('ASYNC_POOL_SIZE', 10)
+        app.config.setdefault('ASYNC_MAX_OVERFLOW', 10)
+        app.config.setdefault('ASYNC_TIMEOUT', 10)
+
+        self.app = app
+        self.enabled = app.config['ASYNC_READS_ENABLED']
+
+    ##########################################################################
+    # Loop and engine
+
+    def _start(self):
+        """Start this process's loop thread and engine on first use. A
+        forked worker gets its own rather than sharing its parent's."""
+
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+
+            config = self.app.config
+            url = make_url(config['ASYNC_DATABASE_URL'])
+            options = {}
+            if url.get_backend_name() != "sqlite":
+                options = dict(pool_size=config['ASYNC_POOL_SIZE'],
+                               max_overflow=config['ASYNC_MAX_OVERFLOW'])
+
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name="async-reads",
+                             daemon=True).start()
+
+            self._loop = loop
+            self._engine = create_async_engine(url, **options)
+            self._pid = os.getpid()
+
+    def run(self, coro_fn, *args):
+        """Call `coro_fn(self, *args)` on the loop and return its result."""
+
+        self._start()
+        future = asyncio.run_coroutine_threadsafe(
+            coro_fn(self, *args), self._loop)
+        return future.result(self.app.config['ASYNC_TIMEOUT'])
+
+    async def execute(self, stmt):
+        """Run one SELECT on its own pooled connection and return the rows,
+        so several can run at once."""
+
+        async with self._engine.connect() as conn:
+            result = await conn.execute(stmt)
+            return result.all()
+
+    async def scalars(self, stmt):
+        async with self._engine.connect() as conn:
+            result = await conn.execute(stmt)
+            return result.scalars().all()
+
+
+##############################################################################
+# Pages
+#
+# Each returns what the matching sync view would pass to its template.
+
+
+async def home_page(reads, user_id, pending_follows):
+    """(viewer summary, feed rows), fetched together. The feed reads the
+    followed ids in a subquery, with `pending_follows(user_id)`'s
+    unflushed changes applied on top."""
+
+    summary, feed = await asyncio.gather(
+        reads.execute(queries.user_summary_select(user_id)),
+        reads.execute(queries.live_home_feed_select(
+            user_id, pending_follows(user_id))),
+    )
+
+    return (queries.profile_from(summary[0] if summary else None),
+            queries.message_rows_from(feed))
+
+
+async def user_page(reads, user_id, viewer_id):
+    """ProfileRow with messages, or None; counters and messages are
+    fetched together."""
+
+    summary, messages = await asyncio.gather(
+        reads.execute(queries.user_summary_select(user_id)),
+        reads.execute(queries.user_messages_select(user_id, viewer_id)),
+    )
+
+    profile = queries.profile_from(summary[0] if summary else None)
+    if profile is not None:
+        profile.messages = queries.message_rows_from(messages)
+
+    return profile
+
+
+async def message_page(reads, message_id, viewer_id):
+    """MessageRow with its author and the viewer's like state, or None."""
+
+    rows = queries.message_rows_from(
+        await reads.execute(queries.message_select(message_id, viewer_id)))
+
+    return rows[0] if rows else None
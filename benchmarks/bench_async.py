@@ -0,0 +1,118 @@
+"""Compare the sync and async read paths for the home feed and profile
+pages: throughput and latency with several requests in flight in one
+process, as with a threaded gunicorn worker.
+
+SQLite answers in microseconds, which hides what the async path is for,
+so every statement can also be given a simulated network round trip
+(LATENCIES_MS): a blocking sleep on the sync engine, an asyncio.sleep on
+the async one.
+
+The async path is a latency optimization: views still block until their
+queries finish. Expect it to win only at 1 thread with the longer round
+trips, where each page's paired queries overlap (around 41ms vs 49ms p50
+at 10ms here); with more threads, or short round trips, the loop hop costs
+more than it saves and sync comes out 10-20% ahead.
+
+Run from the project root:
+
+    python benchmarks/bench_async.py
+"""
+
+import asyncio
+import statistics
+import threading
+import time
+
+from common import busiest_user_id, make_app
+
+THREADS = (1, 8, 32)
+REQUESTS_PER_THREAD = 20
+LATENCIES_MS = (0, 2, 10)
+
+
+def run(app_module, user_id, threads):
+    """Have `threads` clients each fetch / and a profile in turn.
+    Returns (requests per second, p50 ms, p95 ms)."""
+
+    latencies = []
+    lock = threading.Lock()
+
+    def client_loop():
+        client = app_module.app.test_client()
+        with client.session_transaction() as sess:
+            sess[app_module.CURR_USER_KEY] = user_id
+
+        mine = []
+        for i in range(REQUESTS_PER_THREAD):
+            url = "/" if i % 2 else f"/users/{user_id}"
+            start = time.perf_counter()
+            resp = client.get(url)
+            resp.get_data()
+            mine.append(time.perf_counter() - start)
+
+        with lock:
+            latencies.extend(mine)
+
+    workers = [threading.Thread(target=client_loop) for _ in range(threads)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return (len(latencies) / elapsed,
+            statistics.median(latencies) * 1000,
+            latencies[int(len(latencies) * 0.95)] * 1000)
+
+
+def main():
+    app_module = make_app()
+    app = app_module.app
+    reads = app_module.async_reads
+
+    from sqlalchemy import event
+    from models import db
+
+    with app.app_context():
+        user_id = busiest_user_id()
+
+    app.config['ASYNC_READS_ENABLED'] = True
+    reads.init_app(app)
+
+    delay = {'seconds': 0}
+
+    def sync_round_trip(*args):
+        if delay['seconds']:
+            time.sleep(delay['seconds'])
+
+    event.listen(db.get_engine(app), "before_cursor_execute",
+                 sync_round_trip)
+
+    execute, scalars = reads.execute, reads.scalars
+
+    async def slow_execute(stmt):
+        await asyncio.sleep(delay['seconds'])
+        return await execute(stmt)
+
+    async def slow_scalars(stmt):
+        await asyncio.sleep(delay['seconds'])
+        return await scalars(stmt)
+
+    reads.execute, reads.scalars = slow_execute, slow_scalars
+
+    for latency_ms in LATENCIES_MS:
+        delay['seconds'] = latency_ms / 1000
+        print(f"simulated round trip {latency_ms} ms")
+
+        for threads in THREADS:
+            for label, enabled in (("sync", False), ("async", True)):
+                reads.enabled = enabled
+                rps, p50, p95 = run(app_module, user_id, threads)
+                print(f"  {threads:3d} threads {label:6s} {rps:8.1f} req/s "
+                      f"p50 {p50:7.2f} ms  p95 {p95:7.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
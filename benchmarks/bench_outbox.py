@@ -0,0 +1,94 @@
+"""How stale can another worker's cache get? Time from a commit returning
+in one process to the invalidation arriving in each of WORKERS others,
+over the "unix" transport.
+
+Here, on one core, the median was 2.0 ms to the last of four workers,
+with p99 3.6 ms; the 50 ms poll only matters if the writing process dies
+between its commit and its dispatch.
+
+Run from the project root:
+
+    python benchmarks/bench_outbox.py
+"""
+
+import multiprocessing
+import os
+import statistics
+import tempfile
+import time
+
+from common import make_app
+
+WORKERS = 4
+N = 200
+
+
+def worker(directory, ready, arrivals):
+    """Subscribe, then report (tags, arrival time) for each broadcast."""
+
+    from outbox import UnixSocketTransport
+
+    transport = UnixSocketTransport(directory)
+    transport.subscribe(
+        lambda payload: arrivals.put((payload, time.monotonic())))
+    ready.set()
+    time.sleep(3600)
+
+
+def main():
+    os.environ['OUTBOX_ENABLED'] = "1"
+    os.environ['OUTBOX_TRANSPORT'] = "unix"
+    directory = tempfile.mkdtemp()
+
+    app_module = make_app()
+    app = app_module.app
+    app.config['OUTBOX_SOCKET_DIR'] = directory
+    from models import db, User
+
+    context = multiprocessing.get_context("fork")
+    arrivals = context.Queue()
+    workers = []
+    for _ in range(WORKERS):
+        ready = context.Event()
+        process = context.Process(target=worker,
+                                  args=(directory, ready, arrivals),
+                                  daemon=True)
+        process.start()
+        ready.wait()
+        workers.append(process)
+
+    latencies = []
+    with app.app_context():
+        app_module.outbox.ensure_dispatcher()
+        user_ids = [user_id for (user_id,) in
+                    db.session.query(User.id).limit(N)]
+
+        for user_id in user_ids:
+            user = db.session.get(User, user_id)
+            user.bio = f"bio {time.time()}"
+            db.session.commit()
+            committed = time.monotonic()
+
+            tag = f"user:{user_id}"
+            pending = WORKERS
+            last = committed
+            while pending:
+                payload, at = arrivals.get(timeout=5)
+                if tag in payload.split():
+                    pending -= 1
+                    last = max(last, at)
+            latencies.append((last - committed) * 1000)
+
+    app_module.outbox.close()
+    for process in workers:
+        process.terminate()
+
+    latencies.sort()
+    print(f"commit to last of {WORKERS} workers, {len(latencies)} commits:")
+    print(f"  median {statistics.median(latencies):6.2f} ms")
+    print(f"  p99    {latencies[int(len(latencies) * 0.99) - 1]:6.2f} ms")
+    print(f"  max    {latencies[-1]:6.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+"""Compare the ORM path with the read-only row path for feed, profile and
+user list pages: CPU time and memory allocated per request.
+
+Run from the project root:
+
+    python benchmarks/bench_queries.py
+"""
+
+import time
+import tracemalloc
+
+from common import busiest_user_id, make_app
+
+N = 50
+
+
+def orm_home(user):
+    """The home feed as homepage() built it before queries.py."""
+
+    from sqlalchemy import or_
+    from models import Message
+
+    following_ids = [followed.id for followed in user.following]
+    return (Message.query
+            .filter(or_(Message.user_id.in_(following_ids),
+                        Message.user_id == user.id))
+            .order_by(Message.timestamp.desc())
+            .limit(100)
+            .all())
+
+
+def measure(app, db, user_id, label, build, template, name):
+    """Run `build` + render `template` (passing the result as `name`) N
+    times in fresh sessions, report mean time and peak memory per
+    request."""
+
+    from flask import g, render_template
+    from forms import CsrfForm
+    from models import User
+
+    total_time = 0
+    total_peak = 0
+
+    for _ in range(N):
+        with app.test_request_context():
+            g.user = User.query.get(user_id)
+            g.csrf_form = CsrfForm()
+
+            tracemalloc.start()
+            start = time.perf_counter()
+
+            value = build(g.user)
+            render_template(template, **{name: value})
+
+            total_time += time.perf_counter() - start
+            _current, peak = tracemalloc.get_traced_memory()
+            total_peak += peak
+            tracemalloc.stop()
+
+            db.session.remove()
+
+    print(f"{label:28s} {total_time / N * 1000:8.2f} ms "
+          f"{total_peak / N / 1024:10.1f} KiB peak")
+
+
+def main():
+    app_module = make_app()
+    app = app_module.app
+
+    import queries
+    from models import db, User
+
+    with app.app_context():
+        user_id = busiest_user_id()
+
+    cases = [
+        ("home feed (ORM)", orm_home, 'home.html', 'messages'),
+        ("home feed (rows)",
+         lambda user: queries.home_feed(
+             user.id, queries.following_ids(user.id)),
+         'home.html', 'messages'),
+        ("profile (ORM)",
+         lambda user: User.query.get(user_id),
+         'users/show.html', 'user'),
+        ("profile (rows)",
+         lambda user: queries.user_profile(user_id, user.id),
+         'users/show.html', 'user'),
+        ("user list (ORM)",
+         lambda user: User.query.all(),
+         'users/index.html', 'users'),
+        ("user list (rows)",
+         lambda user: queries.list_users(),
+         'users/index.html', 'users'),
+    ]
+
+    for label, build, template, name in cases:
+        measure(app, db, user_id, label, build, template, name)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"""Measure the per-request overhead of the rate limiter.
+
+Run from the project root:
+
+    python benchmarks/bench_ratelimit.py
+"""
+
+import os
+import sys
+import threading
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from flask import Flask
+
+from ratelimit import MemoryStore, RateLimiter, Rule
+
+N = 20_000
+
+
+def bench_store():
+    """Raw cost of one consume() on a hot key and on many distinct keys."""
+
+    store = MemoryStore()
+    rule = Rule.parse("1000000/second")
+
+    hot = timeit.timeit(lambda: store.consume("ip:127.0.0.1", rule), number=N)
+    keys = [f"ip:10.0.{i // 256}.{i % 256}" for i in range(N)]
+    it = iter(keys)
+    spread = timeit.timeit(lambda: store.consume(next(it), rule), number=N)
+
+    print(f"store.consume hot key:      {hot / N * 1e6:8.2f} us/call")
+    print(f"store.consume distinct key: {spread / N * 1e6:8.2f} us/call")
+
+
+def bench_threads(n_threads=8):
+    """consume() throughput with several threads hitting different keys."""
+
+    store = MemoryStore()
+    rule = Rule.parse("1000000/second")
+
+    def worker(i):
+        key = f"user:{i}"
+        for _ in range(N // n_threads):
+            store.consume(key, rule)
+
+    threads = [threading.Thread(target=worker, args=(i,))
+               for i in range(n_threads)]
+    start = timeit.default_timer()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = timeit.default_timer() - start
+
+    print(f"store.consume {n_threads} threads:  {elapsed / N * 1e6:8.2f} us/call")
+
+
+def bench_request():
+    """End-to-end request cost through the test client with and without
+    the limiter."""
+
+    def make_app(limited):
+        app = Flask(__name__)
+        app.config['SECRET_KEY'] = "bench"
+        app.config['RATELIMIT_RULES'] = {'ping': "1000000/second"}
+        app.add_url_rule('/ping', 'ping', lambda: "pong", methods=["POST"])
+        if limited:
+            RateLimiter(app)
+        return app.test_client()
+
+    n = N // 10
+    for label, limited in (("without limiter", False), ("with limiter", True)):
+        client = make_app(limited)
+        elapsed = timeit.timeit(lambda: client.post('/ping'), number=n)
+        print(f"POST /ping {label:16s} {elapsed / n * 1e6:8.2f} us/request")
+
+
+if __name__ == "__main__":
+    bench_store()
+    bench_threads()
+    bench_request()
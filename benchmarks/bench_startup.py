@@ -0,0 +1,155 @@
+"""Startup time per config profile, and memory per forked worker with and
+without preloading the app in the parent (as gunicorn --preload does).
+
+Memory is read from /proc/<pid>/smaps_rollup while all workers are alive:
+PSS splits shared pages evenly between the processes sharing them, and
+private is what a worker holds alone. Linux only.
+
+Run from the project root:
+
+    python benchmarks/bench_startup.py
+"""
+
+import gc
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+from common import ROOT, busiest_user_id, make_app
+
+RUNS = 5
+WORKERS = 4
+REQUESTS = 50
+
+IMPORT_TIME = (
+    "import time; start = time.perf_counter(); import app; "
+    "print(time.perf_counter() - start)"
+)
+
+
+def startup_time(profile, db_file):
+    """Median wall time of importing (and so building) the app in a fresh
+    interpreter."""
+
+    env = dict(os.environ, WARBLER_CONFIG=profile,
+               DATABASE_URL=f"sqlite:///{db_file}")
+    env.setdefault('SECRET_KEY', "bench")
+
+    times = []
+    for _ in range(RUNS):
+        out = subprocess.run(
+            [sys.executable, "-c", IMPORT_TIME], cwd=ROOT, env=env,
+            check=True, capture_output=True, text=True).stdout
+        times.append(float(out.split()[-1]))
+
+    return statistics.median(times)
+
+
+def memory(pid):
+    """(PSS, private) of a process in KiB."""
+
+    fields = {}
+    with open(f"/proc/{pid}/smaps_rollup") as f:
+        for line in f:
+            name, _, value = line.partition(":")
+            if value.strip().endswith("kB"):
+                fields[name] = int(value.split()[0])
+
+    return fields['Pss'], fields['Private_Clean'] + fields['Private_Dirty']
+
+
+def serve(user_id):
+    """What a worker does: import the app (a no-op if preloaded), answer
+    some logged-in requests, run a full collection."""
+
+    import app as app_module
+
+    client = app_module.app.test_client()
+    with client.session_transaction() as sess:
+        sess[app_module.CURR_USER_KEY] = user_id
+
+    for _ in range(REQUESTS):
+        client.get("/")
+        client.get(f"/users/{user_id}")
+
+    gc.collect()
+
+
+def run_workers(preload, freeze, user_id):
+    """Fork WORKERS workers, let each serve, measure them all together.
+    Runs in its own interpreter so the parent starts clean."""
+
+    if preload:
+        gc.disable()
+        import app  # noqa: F401
+        from models import db
+        db.get_engine(app.app).dispose()
+        if freeze:
+            gc.freeze()
+
+    ready_r, ready_w = os.pipe()
+    stop_r, stop_w = os.pipe()
+    pids = []
+
+    for _ in range(WORKERS):
+        pid = os.fork()
+        if pid == 0:
+            gc.enable()
+            serve(user_id)
+            os.write(ready_w, b".")
+            os.read(stop_r, 1)
+            os._exit(0)
+        pids.append(pid)
+
+    for _ in pids:
+        os.read(ready_r, 1)
+
+    usage = [memory(pid) for pid in pids]
+
+    os.write(stop_w, b"." * len(pids))
+    for pid in pids:
+        os.waitpid(pid, 0)
+
+    pss = sum(p for p, _ in usage) / len(usage)
+    private = sum(p for _, p in usage) / len(usage)
+    print(f"{pss:.0f} {private:.0f}")
+
+
+def main():
+    if len(sys.argv) > 1:
+        preload, freeze, user_id = sys.argv[1:]
+        run_workers(preload == "1", freeze == "1", int(user_id))
+        return
+
+    db_file = os.path.join(tempfile.mkdtemp(), "bench.db")
+    app_module = make_app(db_file)
+    with app_module.app.app_context():
+        user_id = busiest_user_id()
+
+    print(f"startup (median of {RUNS} imports)")
+    for profile in ("development", "production"):
+        seconds = startup_time(profile, db_file)
+        print(f"  {profile:26s} {seconds * 1000:8.1f} ms")
+
+    env = dict(os.environ, WARBLER_CONFIG="production",
+               DATABASE_URL=f"sqlite:///{db_file}")
+
+    print(f"memory per worker ({WORKERS} workers, {REQUESTS * 2} requests "
+          f"each)")
+    for label, preload, freeze in (
+        ("import after fork", "0", "0"),
+        ("preload", "1", "0"),
+        ("preload + gc.freeze()", "1", "1"),
+    ):
+        out = subprocess.run(
+            [sys.executable, __file__, preload, freeze, str(user_id)],
+            env=env, check=True, capture_output=True, text=True).stdout
+        pss, private = out.split()[-2:]
+        print(f"  {label:26s} {int(pss):8d} KiB PSS "
+              f"{int(private):8d} KiB private")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+"""Shared setup for benchmarks: an app on a throwaway SQLite database
+loaded with the sample data from generator/."""
+
+import os
+import sys
+import tempfile
+from csv import DictReader
+from datetime import datetime
+
+ROOT = os.path.join(os.path.dirname(__file__), "..")
+sys.path.insert(0, ROOT)
+
+
+def make_app(db_file=None):
+    """Import the app against a fresh SQLite file (a temporary one unless
+    `db_file` is given) and seed it. Returns the app module."""
+
+    db_file = db_file or os.path.join(tempfile.mkdtemp(), "bench.db")
+    os.environ['DATABASE_URL'] = f"sqlite:///{db_file}"
+    os.environ.setdefault('SECRET_KEY', "bench")
+
+    import app as app_module
+    from models import db, User, Message, Follows
+
+    app_module.app.config['WTF_CSRF_ENABLED'] = False
+
+    with app_module.app.app_context():
+        db.create_all()
+        generator = os.path.join(ROOT, "generator")
+
+        with open(os.path.join(generator, "users.csv")) as users:
+            db.session.bulk_insert_mappings(User, DictReader(users))
+
+        with open(os.path.join(generator, "messages.csv")) as messages:
+            rows = list(DictReader(messages))
+            for row in rows:
+                row['timestamp'] = datetime.fromisoformat(row['timestamp'])
+            db.session.bulk_insert_mappings(Message, rows)
+
+        with open(os.path.join(generator, "follows.csv")) as follows:
+            db.session.bulk_insert_mappings(Follows, DictReader(follows))
+
+        db.session.commit()
+
+    return app_module
+
+
+def busiest_user_id():
+    """Id of the user following the most people (the heaviest feed)."""
+
+    from sqlalchemy import func
+    from models import db, Follows
+
+    return (db.session.query(Follows.user_following_id)
+            .group_by(Follows.user_following_id)
+            .order_by(func.count().desc())
+            .limit(1)
+            .scalar())
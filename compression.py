@@ -0,0 +1,197 @@
+"""Response compression for pages and JSON.
+
+Responses whose type compresses well (HTML, JSON, CSS, JS, SVG, text,
+data exports) are gzip- or brotli-encoded, whichever the client prefers
+among those it accepts; brotli only when the brotli package is installed.
+Streamed pages (see rendering.py) and exports (see userdata.py) are
+compressed chunk by chunk and flushed after each one, so the first bytes
+still leave before the whole feed has rendered.
+
+Skipped: bodies under COMPRESSION_MIN_SIZE, where the headers would eat
+the savings; files sent with send_file (fingerprinted assets come
+precompressed, see assets.py, and images are compressed already); and
+anything that already has a Content-Encoding.
+
+Each compressed response's sizes and the CPU time spent compressing it
+are added to per-encoding totals, shown on /admin/stats, and to the
+request's profile capture when it has one (see profiler.py).
+"""
+
+import threading
+import time
+import zlib
+
+from flask import current_app, g, request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE = {
+    "text/html", "text/css", "text/plain", "text/javascript",
+    "application/javascript", "application/json", "image/svg+xml",
+    "application/x-ndjson", "text/csv",
+}
+
+
+class CompressionStats:
+    """Bytes in and out, and CPU seconds, for one response."""
+
+    __slots__ = ('encoding', 'bytes_in', 'bytes_out', 'cpu')
+
+    def __init__(self, encoding):
+        self.encoding = encoding
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.cpu = 0.0
+
+    def add(self, bytes_in, bytes_out, cpu):
+        self.bytes_in += bytes_in
+        self.bytes_out += bytes_out
+        self.cpu += cpu
+
+    def as_dict(self):
+        return {'encoding': self.encoding, 'bytes_in': self.bytes_in,
+                'bytes_out': self.bytes_out,
+                'cpu_ms': round(self.cpu * 1000, 3)}
+
+
+class Compression:
+    """Compress responses the client can decompress.
+
+    Configuration (app.config):
+
+    - COMPRESSION_ENABLED: compress responses (default False)
+    - COMPRESSION_MIN_SIZE: smallest body compressed, in bytes (default
+      1024); streamed bodies are always compressed
+    - COMPRESSION_LEVEL: gzip level, 1-9 (default 6)
+    - COMPRESSION_BROTLI_QUALITY: brotli quality, 0-11 (default 4; the
+      top levels are meant for static files, not every request)
+    """
+
+    def __init__(self, app=None):
+        # encoding -> [responses, bytes in, bytes out, CPU seconds]
+        self.totals = {}
+        self._lock = threading.Lock()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Register the response hook. Call before other extensions'
+        init_app: after_request hooks run in reverse order, so this one
+        then sees responses last, once caches have stored them
+        uncompressed."""
+
+        app.config.setdefault('COMPRESSION_ENABLED', False)
+        app.config.setdefault('COMPRESSION_MIN_SIZE', 1024)
+        app.config.setdefault('COMPRESSION_LEVEL', 6)
+        app.config.setdefault('COMPRESSION_BROTLI_QUALITY', 4)
+
+        app.after_request(self.compress)
+
+    def compress(self, response):
+        """after_request: encode the response if it's worth it."""
+
+        config = current_app.config
+        if (not config['COMPRESSION_ENABLED']
+                or request.method == "HEAD"
+                or response.status_code != 200
+                or response.direct_passthrough
+                or 'Content-Encoding' in response.headers
+                or response.mimetype not in COMPRESSIBLE):
+            return response
+
+        if (not response.is_streamed
+                and response.content_length is not None
+                and response.content_length < config['COMPRESSION_MIN_SIZE']):
+            return response
+
+        response.vary.add("Accept-Encoding")
+        offered = ["br", "gzip"] if brotli is not None else ["gzip"]
+        encoding = request.accept_encodings.best_match(offered)
+        if encoding is None:
+            return response
+
+        stats = CompressionStats(encoding)
+        g.compression_stats = stats
+        compressor = _Compressor(encoding, config)
+
+        if response.is_streamed:
+            response.response = self._stream(
+                response.response, response.charset, compressor, stats)
+            response.headers.pop('Content-Length', None)
+        else:
+            body = response.get_data()
+            start = time.thread_time()
+            data = compressor.compress(body) + compressor.finish()
+            stats.add(len(body), len(data), time.thread_time() - start)
+            response.set_data(data)
+            self._record(stats)
+
+        response.headers['Content-Encoding'] = encoding
+        return response
+
+    def _stream(self, inner, charset, compressor, stats):
+        """Compress and flush each chunk of `inner` as it's rendered."""
+
+        try:
+            for chunk in inner:
+                if isinstance(chunk, str):
+                    chunk = chunk.encode(charset)
+                start = time.thread_time()
+                data = compressor.compress(chunk) + compressor.flush()
+                stats.add(len(chunk), len(data), time.thread_time() - start)
+                if data:
+                    yield data
+
+            start = time.thread_time()
+            data = compressor.finish()
+            stats.add(0, len(data), time.thread_time() - start)
+            yield data
+        finally:
+            if hasattr(inner, 'close'):
+                inner.close()
+            self._record(stats)
+
+    def _record(self, stats):
+        with self._lock:
+            totals = self.totals.setdefault(stats.encoding, [0, 0, 0, 0.0])
+            totals[0] += 1
+            totals[1] += stats.bytes_in
+            totals[2] += stats.bytes_out
+            totals[3] += stats.cpu
+
+    def metrics(self):
+        """{encoding: {'responses', 'bytes_in', 'bytes_out', 'cpu_ms'}}
+        for this process."""
+
+        with self._lock:
+            return {encoding: {'responses': responses, 'bytes_in': bytes_in,
+                               'bytes_out': bytes_out,
+                               'cpu_ms': round(cpu * 1000, 1)}
+                    for encoding, (responses, bytes_in, bytes_out, cpu)
+                    in self.totals.items()}
+
+
+class _Compressor:
+    """compress() / flush() / finish() over zlib's gzip or brotli."""
+
+    def __init__(self, encoding, config):
+        if encoding == "br":
+            self._brotli = brotli.Compressor(
+                mode=brotli.MODE_TEXT,
+                quality=config['COMPRESSION_BROTLI_QUALITY'])
+            self.compress = self._brotli.process
+            self.flush = self._brotli.flush
+            self.finish = self._brotli.finish
+        else:
+            # wbits 16 + 15: a gzip header and trailer around deflate.
+            self._zlib = zlib.compressobj(
+                config['COMPRESSION_LEVEL'], zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            self.compress = self._zlib.compress
+            self.finish = self._zlib.flush
+
+    def flush(self):
+        return self._zlib.flush(zlib.Z_SYNC_FLUSH)
@@ -0,0 +1,121 @@
+"""Configuration profiles for create_app().
+
+Pick one by name ("development", "testing", "production") or pass a class
+from here. Without an explicit choice, WARBLER_CONFIG or FLASK_ENV decide,
+falling back to development.
+"""
+
+import os
+
+import dotenv
+
+# Before the classes below read the environment, so .env settings count.
+dotenv.load_dotenv()
+
+
+def _env_flag(name):
+    return os.environ.get(name) == "1"
+
+
+def _database_url(default):
+    # Heroku still hands out postgres:// URLs, which SQLAlchemy 1.4 rejects.
+    return (os.environ.get('DATABASE_URL', default)
+            .replace("postgres://", "postgresql://"))
+
+
+class Config:
+    """Settings shared by every profile."""
+
+    SQLALCHEMY_DATABASE_URI = _database_url("postgresql:///warbler")
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+    SQLALCHEMY_ECHO = False
+    SECRET_KEY = os.environ.get('SECRET_KEY')
+
+    # Load flask-debugtoolbar at all; only development does.
+    DEBUG_TOOLBAR = False
+    DEBUG_TB_INTERCEPT_REDIRECTS = True
+
+    RATELIMIT_TRUSTED_PROXIES = int(
+        os.environ.get('RATELIMIT_TRUSTED_PROXIES', 0))
+    WRITE_BUFFER_ENABLED = _env_flag('WRITE_BUFFER_ENABLED')
+    TEMPLATE_PRODUCTION = False
+    TEMPLATE_STREAMING = _env_flag('TEMPLATE_STREAMING')
+    ASSETS_FINGERPRINT = False
+    ASSETS_URL_PREFIX = os.environ.get('ASSETS_URL_PREFIX', "/assets")
+    IMAGE_PROXY_ENABLED = _env_flag('IMAGE_PROXY_ENABLED')
+    PAGE_CACHE_ENABLED = _env_flag('PAGE_CACHE_ENABLED')
+    PAGE_CACHE_DISK_DIR = os.environ.get('PAGE_CACHE_DISK_DIR')
+    OUTBOX_ENABLED = _env_flag('OUTBOX_ENABLED')
+    ENTITY_CACHE_ENABLED = _env_flag('ENTITY_CACHE_ENABLED')
+    COMPRESSION_ENABLED = _env_flag('COMPRESSION_ENABLED')
+    OUTBOX_TRANSPORT = os.environ.get('OUTBOX_TRANSPORT', "local")
+    TRENDING_ENABLED = _env_flag('TRENDING_ENABLED')
+    ASYNC_READS_ENABLED = _env_flag('ASYNC_READS_ENABLED')
+    ADMISSION_ENABLED = _env_flag('ADMISSION_ENABLED')
+    ADMISSION_METRICS_TOKEN = os.environ.get('ADMISSION_METRICS_TOKEN')
+    PROFILER_ENABLED = _env_flag('PROFILER_ENABLED')
+    PROFILER_SAMPLE_RATE = float(os.environ.get('PROFILER_SAMPLE_RATE', 0))
+    PROFILER_SLOW_MS = (float(os.environ['PROFILER_SLOW_MS'])
+                        if os.environ.get('PROFILER_SLOW_MS') else None)
+    WARMUP_PRIME_USERS = int(os.environ.get('WARMUP_PRIME_USERS', 0))
+    # Shards as space-separated name=URL pairs (see sharding.py).
+    SHARDS = dict(pair.split("=", 1) for pair in os.environ.get(
+        'SHARD_DATABASE_URLS', "").split())
+    # Users who may see /admin/stats, comma-separated.
+    ADMIN_USERNAMES = set(filter(None, os.environ.get(
+        'ADMIN_USERNAMES', "").split(",")))
+
+
+class DevelopmentConfig(Config):
+    """Local development: debug toolbar, templates reload on change."""
+
+    DEBUG_TOOLBAR = True
+    TEMPLATES_AUTO_RELOAD = True
+
+
+class TestingConfig(Config):
+    """Unit tests: separate database, no CSRF tokens to scrape, cheap
+    password hashes."""
+
+    TESTING = True
+    SQLALCHEMY_DATABASE_URI = _database_url("postgresql:///warbler_test")
+    SECRET_KEY = os.environ.get('SECRET_KEY', "testing")
+    WTF_CSRF_ENABLED = False
+    # bcrypt's minimum; 12 rounds costs ~250ms per hash.
+    BCRYPT_LOG_ROUNDS = 4
+    # Tests flush notifications and rollups, and dispatch the outbox,
+    # themselves.
+    NOTIFICATIONS_WINDOW = 0
+    ROLLUPS_WINDOW = 0
+    OUTBOX_POLL_INTERVAL = 0
+
+
+class ProductionConfig(Config):
+    """Deployed: compiled templates and fingerprinted assets, no debug
+    tooling imported at all."""
+
+    TEMPLATE_PRODUCTION = True
+    ASSETS_FINGERPRINT = True
+    WARMUP_ENABLED = True
+    # The Heroku router passes responses through uncompressed.
+    COMPRESSION_ENABLED = True
+    # Deployed behind the Heroku router, which appends the client's
+    # address to X-Forwarded-For.
+    RATELIMIT_TRUSTED_PROXIES = int(
+        os.environ.get('RATELIMIT_TRUSTED_PROXIES', 1))
+
+
+PROFILES = {
+    'development': DevelopmentConfig,
+    'testing': TestingConfig,
+    'production': ProductionConfig,
+}
+
+
+def profile_from_env():
+    """The profile named by WARBLER_CONFIG, else by FLASK_ENV."""
+
+    name = (os.environ.get('WARBLER_CONFIG')
+            or os.environ.get('FLASK_ENV')
+            or "development")
+    return PROFILES[name]
@@ -0,0 +1,114 @@
+"""Size-bounded LRU cache of files on local disk."""
+
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+class DiskCache:
+    """Byte strings stored as files in `directory`, one per key, evicted
+    least recently used first once their total size passes `max_bytes`.
+
+    Keys must be safe filenames; callers use hex digests.
+
+    Several processes (gunicorn workers) can share one directory. Each only
+    sees its own writes, so after every `max_bytes / 16` it has written, a
+    process rescans the directory before evicting: together they overshoot
+    the cap by at most that much each, not by a multiple of it.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.rescan_bytes = max(1, max_bytes // 16)
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._total = 0
+        self._unscanned = 0
+
+        os.makedirs(directory, exist_ok=True)
+        self._entries, self._total = self._scan()
+
+    def _scan(self):
+        """LRU order and total size from the files on disk, ordered by
+        mtime, which get() touches."""
+
+        files = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.endswith(".tmp"):
+                continue
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                # Evicted by another process while we listed.
+                continue
+            files.append((stat.st_mtime_ns, name, stat.st_size))
+
+        entries = OrderedDict()
+        for _mtime, name, size in sorted(files):
+            entries[name] = size
+
+        return entries, sum(entries.values())
+
+    def path(self, key):
+        return os.path.join(self.directory, key)
+
+    def get(self, key):
+        """Path of the cached file for `key`, or None."""
+
+        with self._lock:
+            if key not in self._entries:
+                return None
+            self._entries.move_to_end(key)
+
+        path = self.path(key)
+        try:
+            # Keeps the LRU order across restarts and processes.
+            _touch(path)
+        except FileNotFoundError:
+            with self._lock:
+                self._total -= self._entries.pop(key, 0)
+            return None
+
+        return path
+
+    def put(self, key, data):
+        """Store `data` under `key` and evict old entries if needed."""
+
+        path = self.path(key)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+        _touch(path)
+
+        with self._lock:
+            self._unscanned += len(data)
+            if self._unscanned >= self.rescan_bytes:
+                # Picks up other processes' writes, and our own file.
+                self._entries, self._total = self._scan()
+                self._unscanned = 0
+                self._entries.move_to_end(key)
+            else:
+                self._total += len(data) - self._entries.pop(key, 0)
+                self._entries[key] = len(data)
+
+            while self._total > self.max_bytes and len(self._entries) > 1:
+                old_key, size = self._entries.popitem(last=False)
+                self._total -= size
+                try:
+                    os.remove(self.path(old_key))
+                except FileNotFoundError:
+                    pass
+
+        return path
+
+
+def _touch(path):
+    """Set mtime from the precise clock; the filesystem's own timestamps
+    are too coarse to order files written milliseconds apart."""
+
+    now = time.time_ns()
+    os.utime(path, ns=(now, now))
@@ -0,0 +1,208 @@
+"""Second-level cache for users and messages by primary key.
+
+Nearly every request looks up the logged-in user, and many look up the
+user or message in the URL, always by id, for rows that rarely change.
+EntityCache.get() answers those from a bounded in-memory LRU of column
+values, one per process.
+
+A cached entry is never an object some session owns. A hit builds a
+detached copy from the stored values and merges it into the session
+without a SELECT (merge(load=False)), so relationships still lazy-load
+and changes still flush, as if it had come from the database; with
+detached=True the copy is returned as is, for read-only use outside the
+request's session.
+
+Entries carry the version of their row's tag ("user:3", "message:12"),
+read before the row was. Commits that change or delete a user or
+message bump the tag, as do outbox broadcasts from other workers (see
+outbox.py), so an entry filled from a read that raced a write is stale
+the moment the write commits. Without the outbox, other workers rely on
+the per-model TTLs.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+from flask import abort
+from sqlalchemy import event
+from sqlalchemy.orm import attributes, make_transient_to_detached
+from sqlalchemy.orm.attributes import set_committed_value
+
+from models import db, Message, User
+from outbox import invalidated
+
+TAGS = {User: "user", Message: "message"}
+
+
+class EntityCache:
+    """Cache User and Message primary-key lookups.
+
+    Configuration (app.config):
+
+    - ENTITY_CACHE_ENABLED: turn the cache on (default False)
+    - ENTITY_CACHE_TTL: seconds an entry may be served, by model name
+      (default 60 for User, 300 for Message)
+    - ENTITY_CACHE_MAX_ENTRIES: size of the LRU, all models together
+      (default 10000)
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.enabled = False
+        self.versions = {}
+        # tag -> (model, values, version, stored_at)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = dict.fromkeys(TAGS, 0)
+        self.misses = dict.fromkeys(TAGS, 0)
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Register invalidation listeners."""
+
+        app.config.setdefault('ENTITY_CACHE_ENABLED', False)
+        app.config.setdefault('ENTITY_CACHE_TTL',
+                              {'User': 60, 'Message': 300})
+        app.config.setdefault('ENTITY_CACHE_MAX_ENTRIES', 10000)
+
+        self.app = app
+        self.enabled = app.config['ENTITY_CACHE_ENABLED']
+
+        event.listen(db.session, 'after_flush', self._collect_changes)
+        event.listen(db.session, 'after_commit', self._bump_committed)
+        invalidated.connect(self._bump_broadcast)
+
+    ##########################################################################
+    # Lookups
+
+    def get(self, model, ident, detached=False):
+        """The `model` row with primary key `ident`, or None; a User or
+        Message in the session unless `detached`."""
+
+        if not self.enabled:
+            return db.session.get(model, ident)
+
+        session = db.session()
+        key = model.__mapper__.identity_key_from_primary_key((ident,))
+        if key in session.identity_map:
+            # Already loaded, and maybe changed, in this transaction.
+            return session.get(model, ident)
+
+        tag = f"{TAGS[model]}:{ident}"
+        with self._lock:
+            entry = self._entries.get(tag)
+            if entry is not None and self._is_fresh(tag, entry):
+                self._entries.move_to_end(tag)
+                self.hits[model] += 1
+                values = entry[1]
+            else:
+                self.misses[model] += 1
+                values = None
+                version = self.versions.get(tag, 0)
+
+        if values is not None:
+            obj = _detached_copy(model, values)
+            return obj if detached else session.merge(obj, load=False)
+
+        obj = session.get(model, ident)
+        if obj is not None:
+            self._store(tag, model, _column_values(obj), version)
+            if detached:
+                return _detached_copy(model, _column_values(obj))
+        return obj
+
+    def get_or_404(self, model, ident):
+        obj = self.get(model, ident)
+        if obj is None:
+            abort(404)
+        return obj
+
+    def _store(self, tag, model, values, version):
+        if values is None:
+            return
+
+        limit = self.app.config['ENTITY_CACHE_MAX_ENTRIES']
+        with self._lock:
+            self._entries[tag] = (model, values, version, time.monotonic())
+            self._entries.move_to_end(tag)
+            while len(self._entries) > limit:
+                self._entries.popitem(last=False)
+
+    def _is_fresh(self, tag, entry):
+        model, _, version, stored_at = entry
+        ttl = self.app.config['ENTITY_CACHE_TTL'][model.__name__]
+        return (time.monotonic() - stored_at <= ttl
+                and self.versions.get(tag, 0) == version)
+
+    def stats(self):
+        """{model name: {'hits', 'misses', 'entries'}} for this process."""
+
+        with self._lock:
+            entries = dict.fromkeys(TAGS, 0)
+            for model, *_ in self._entries.values():
+                entries[model] += 1
+            return {model.__name__: {'hits': self.hits[model],
+                                     'misses': self.misses[model],
+                                     'entries': entries[model]}
+                    for model in TAGS}
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    ##########################################################################
+    # Invalidation
+
+    def invalidate(self, *tags):
+        """Make the entries for these tags stale, including any being
+        filled right now."""
+
+        with self._lock:
+            for tag in tags:
+                self.versions[tag] = self.versions.get(tag, 0) + 1
+                self._entries.pop(tag, None)
+
+    def _collect_changes(self, session, flush_context):
+        """after_flush: note which users and messages this transaction
+        changed or deleted."""
+
+        tags = session.info.setdefault('entity_cache_tags', set())
+        for obj in (*session.dirty, *session.deleted):
+            kind = TAGS.get(type(obj))
+            if kind is not None:
+                tags.add(f"{kind}:{obj.id}")
+
+    def _bump_committed(self, session):
+        tags = session.info.pop('entity_cache_tags', None)
+        if tags:
+            self.invalidate(*tags)
+
+    def _bump_broadcast(self, sender, tags):
+        """Invalidate what a commit in any process touched; tags for
+        anything but users and messages are ignored."""
+
+        self.invalidate(*(tag for tag in tags
+                          if tag.partition(":")[0] in TAGS.values()))
+
+
+def _column_values(obj):
+    """`obj`'s loaded column values, or None if some aren't loaded."""
+
+    state = attributes.instance_state(obj)
+    values = {}
+    for prop in state.mapper.column_attrs:
+        if prop.key not in state.dict:
+            return None
+        values[prop.key] = state.dict[prop.key]
+    return values
+
+
+def _detached_copy(model, values):
+    obj = model.__mapper__.class_manager.new_instance()
+    for key, value in values.items():
+        set_committed_value(obj, key, value)
+    make_transient_to_detached(obj)
+    return obj
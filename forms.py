@@ -1,13 +1,16 @@
 from typing import Optional
 from flask_wtf import FlaskForm
-from wtforms import StringField, PasswordField, TextAreaField
+from wtforms import HiddenField, StringField, PasswordField, TextAreaField
 from wtforms.validators import DataRequired, Email, Length, Optional
 
+from idempotency import new_key
+
 
 class MessageForm(FlaskForm):
     """Form for adding/editing messages."""
 
-    text = TextAreaField('text', validators=[DataRequired()])
+    text = TextAreaField('text', validators=[DataRequired(), Length(max=140)])
+    idempotency_key = HiddenField(default=new_key)
 
 
 class UserAddForm(FlaskForm):
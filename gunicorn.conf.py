@@ -0,0 +1,49 @@
+"""Gunicorn settings (picked up automatically from the project root).
+
+The app is imported once in the master and workers are forked from it, so
+they share its memory pages instead of each importing and initializing
+everything again. Following the gc module's advice for fork-without-exec:
+collection is off in the master so it doesn't leave holes in those pages,
+everything allocated so far is frozen right before forking, and workers
+turn collection back on. Frozen objects are never scanned by the workers'
+collector, so their pages stay shared.
+
+Warm-up (warmup.py) does what's shareable in the master, once it's ready
+to fork, and the rest in each worker before it accepts connections.
+"""
+
+import gc
+import os
+
+os.environ.setdefault('WARBLER_CONFIG', "production")
+
+preload_app = True
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+
+gc.disable()
+
+
+def when_ready(server):
+    from app import warm_up
+    warm_up.prepare()
+
+
+def pre_fork(server, worker):
+    # Close the master's pooled connections so no worker inherits (and
+    # then shares) a database socket.
+    from app import sharding
+    from models import db
+    db.get_engine(server.app.wsgi()).dispose()
+    for engine in sharding.engines.values():
+        engine.dispose()
+
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    gc.enable()
+
+
+def post_worker_init(worker):
+    from app import warm_up
+    warm_up.run()
@@ -0,0 +1,282 @@
+"""Idempotency keys for Warbler's write routes.
+
+Forms that write carry a one-off key in a hidden field; API clients can
+send an Idempotency-Key header instead. The first POST with a key claims
+it and, once the view has redirected, records where to. Replays of the key
+by the same user, on the same endpoint, within IDEMPOTENCY_TTL get that
+redirect back without the view running again: a double-clicked "Add my
+message!" posts once, and a retried like doesn't toggle it back off.
+
+A replay that arrives while the first request is still running waits for
+it to finish, up to IDEMPOTENCY_WAIT seconds, then gets a 409.
+"""
+
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from uuid import uuid4
+
+from flask import current_app, g, redirect, request, session
+from markupsafe import Markup
+from werkzeug.exceptions import Conflict
+
+FORM_FIELD = "idempotency_key"
+HEADER = "Idempotency-Key"
+
+# Endpoints whose POSTs are deduplicated by default.
+DEFAULT_ENDPOINTS = {
+    'warbler.messages_add',
+    'warbler.add_or_remove_like',
+    'warbler.add_follow',
+    'warbler.stop_following',
+}
+
+# Recorded for a key whose first request hasn't finished yet.
+PENDING = ""
+
+
+def new_key():
+    """A fresh key for one form."""
+
+    return uuid4().hex
+
+
+def _digest(key):
+    """A fixed 16 bytes per key, however long the client's key is."""
+
+    return hashlib.blake2b(key.encode(), digest_size=16).digest()
+
+
+class MemoryStore:
+    """In-process store of recent keys and the redirects they produced.
+
+    Entries are (expires_at, location) tuples under 16-byte digests of the
+    key, split into shards like the rate limiter's MemoryStore. Each shard
+    is in insertion order, which with a single TTL is also expiry order, so
+    expired entries are dropped from the front as new ones arrive, and a
+    shard over `max_keys_per_shard` drops its oldest.
+
+    Only deduplicates requests that reach the same process; use RedisStore
+    to cover every worker.
+    """
+
+    def __init__(self, shards=16, max_keys_per_shard=10_000):
+        self._shards = [OrderedDict() for _ in range(shards)]
+        self._locks = [threading.Lock() for _ in range(shards)]
+        self.max_keys_per_shard = max_keys_per_shard
+
+    def _shard(self, digest):
+        idx = digest[0] % len(self._shards)
+        return self._shards[idx], self._locks[idx]
+
+    def claim(self, key, ttl, now=None):
+        """Record `key` as PENDING if it isn't known yet and return None;
+        otherwise return what it recorded (PENDING or a location)."""
+
+        now = time.time() if now is None else now
+        digest = _digest(key)
+        shard, lock = self._shard(digest)
+
+        with lock:
+            while shard:
+                oldest = next(iter(shard.values()))
+                if oldest[0] > now and len(shard) < self.max_keys_per_shard:
+                    break
+                shard.popitem(last=False)
+
+            entry = shard.get(digest)
+            if entry is not None and entry[0] > now:
+                return entry[1]
+
+            shard[digest] = (now + ttl, PENDING)
+            return None
+
+    def get(self, key, now=None):
+        """What `key` recorded, or None if it's unknown or expired."""
+
+        now = time.time() if now is None else now
+        digest = _digest(key)
+        entry = self._shard(digest)[0].get(digest)
+        if entry is None or entry[0] <= now:
+            return None
+        return entry[1]
+
+    def complete(self, key, location, ttl, now=None):
+        """Record the redirect `key`'s request produced."""
+
+        now = time.time() if now is None else now
+        digest = _digest(key)
+        shard, lock = self._shard(digest)
+
+        with lock:
+            shard[digest] = (now + ttl, location)
+            shard.move_to_end(digest)
+
+    def release(self, key):
+        """Forget `key`, so the client can try it again."""
+
+        digest = _digest(key)
+        shard, lock = self._shard(digest)
+
+        with lock:
+            shard.pop(digest, None)
+
+    def clear(self):
+        """Forget every key."""
+
+        for idx, shard in enumerate(self._shards):
+            with self._locks[idx]:
+                shard.clear()
+
+
+class RedisStore:
+    """Key store shared between workers and hosts, backed by Redis.
+
+    Takes an already-configured redis client. Claiming is a SET NX, so only
+    one request anywhere gets a key; Redis expires it.
+    """
+
+    def __init__(self, client, prefix="warbler:idem:"):
+        self.client = client
+        self.prefix = prefix
+
+    def _name(self, key):
+        return self.prefix + _digest(key).hex()
+
+    def claim(self, key, ttl, now=None):
+        """See MemoryStore.claim."""
+
+        name = self._name(key)
+        if self.client.set(name, PENDING, nx=True, ex=ttl):
+            return None
+        return self.get(key)
+
+    def get(self, key, now=None):
+        value = self.client.get(self._name(key))
+        return None if value is None else value.decode()
+
+    def complete(self, key, location, ttl, now=None):
+        self.client.set(self._name(key), location, ex=ttl)
+
+    def release(self, key):
+        self.client.delete(self._name(key))
+
+    def clear(self):
+        """Forget every key under our prefix."""
+
+        for name in self.client.scan_iter(self.prefix + "*"):
+            self.client.delete(name)
+
+
+class Idempotency:
+    """Answer replayed write POSTs with their first response.
+
+    Configuration (app.config):
+
+    - IDEMPOTENCY_ENABLED: turn deduplication on/off (default True)
+    - IDEMPOTENCY_ENDPOINTS: endpoints whose POSTs take a key (default
+      DEFAULT_ENDPOINTS)
+    - IDEMPOTENCY_TTL: seconds a key is remembered (default 3600)
+    - IDEMPOTENCY_WAIT: seconds a replay waits for the first request
+      before giving up with a 409 (default 5)
+    - IDEMPOTENCY_SESSION_KEY: session key holding the logged-in user's
+      id; keys are only honoured for logged-in users, and are per user
+    """
+
+    def __init__(self, app=None, store=None):
+        self.store = store or MemoryStore()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Register the request hooks and the `idempotency_field()`
+        template global."""
+
+        app.config.setdefault('IDEMPOTENCY_ENABLED', True)
+        app.config.setdefault('IDEMPOTENCY_ENDPOINTS', DEFAULT_ENDPOINTS)
+        app.config.setdefault('IDEMPOTENCY_TTL', 60 * 60)
+        app.config.setdefault('IDEMPOTENCY_WAIT', 5)
+        app.config.setdefault('IDEMPOTENCY_SESSION_KEY', "curr_user")
+
+        app.before_request(self.check_request)
+        app.after_request(self.record)
+        app.teardown_request(self.finish)
+        app.add_template_global(self.idempotency_field)
+
+    @staticmethod
+    def idempotency_field():
+        """A hidden input with a fresh key, for forms that aren't WTForms."""
+
+        return Markup(
+            f'<input type="hidden" name="{FORM_FIELD}" value="{new_key()}">')
+
+    def _key_for_request(self):
+        """The store key for the current request, or None if it doesn't
+        take part."""
+
+        config = current_app.config
+
+        if (not config['IDEMPOTENCY_ENABLED']
+                or request.method != "POST"
+                or request.endpoint not in config['IDEMPOTENCY_ENDPOINTS']):
+            return None
+
+        user_id = session.get(config['IDEMPOTENCY_SESSION_KEY'])
+        key = request.headers.get(HEADER) or request.form.get(FORM_FIELD)
+        if user_id is None or not key:
+            return None
+
+        return f"{user_id}:{request.endpoint}:{key}"
+
+    def check_request(self):
+        """before_request: replay a key's redirect, or claim the key."""
+
+        key = self._key_for_request()
+        if key is None:
+            return None
+
+        config = current_app.config
+        location = self.store.claim(key, config['IDEMPOTENCY_TTL'])
+        if location is None:
+            g.idempotency_key = key
+            return None
+
+        give_up = time.monotonic() + config['IDEMPOTENCY_WAIT']
+        while location == PENDING and time.monotonic() < give_up:
+            time.sleep(0.05)
+            location = self.store.get(key)
+
+        if location is None:
+            # The first request failed and let go of the key meanwhile.
+            return self.check_request()
+        if location == PENDING:
+            raise Conflict("This request is already being processed.")
+
+        response = redirect(location)
+        response.headers['Idempotent-Replayed'] = "true"
+        return response
+
+    def record(self, response):
+        """after_request: remember a redirect; anything else (a form shown
+        again with errors, say) frees the key for another try."""
+
+        key = g.pop('idempotency_key', None)
+        if key is None:
+            return response
+
+        if response.status_code in (301, 302, 303, 307, 308):
+            self.store.complete(key, response.headers['Location'],
+                                current_app.config['IDEMPOTENCY_TTL'])
+        else:
+            self.store.release(key)
+
+        return response
+
+    def finish(self, exc):
+        """teardown_request: free the key of a request that raised."""
+
+        key = g.pop('idempotency_key', None)
+        if key is not None:
+            self.store.release(key)
@@ -0,0 +1,307 @@
+"""Thumbnailing proxy for user avatars and header images.
+
+Users' image_url and header_image_url point anywhere on the internet and
+are shown full size on every card. Templates instead link to
+/img/<size>/<signature>?url=..., which fetches the original once, scales
+it down to one of a few fixed sizes, and keeps the result in an on-disk
+cache with LRU eviction. Responses carry long-lived cache headers.
+
+URLs are signed with the app's SECRET_KEY so the endpoint can't be used as
+an open proxy. The signature only proves we made the link, though, and
+users choose the URLs, so the default fetcher also refuses to connect to
+anything but public addresses (no localhost, private networks or cloud
+metadata endpoints), checked on every connection including redirects.
+"""
+
+import hashlib
+import hmac
+import http.client
+import io
+import ipaddress
+import os
+import socket
+import threading
+import time
+import urllib.request
+from collections import OrderedDict
+from urllib.parse import quote, urlsplit
+
+from flask import current_app, redirect, request, send_file
+from werkzeug.exceptions import NotFound
+
+from diskcache import DiskCache
+from singleflight import KeyedLocks
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+# Named thumbnail sizes (width, height); images are scaled and cropped to
+# fill them exactly.
+DEFAULT_SIZES = {
+    'small': (64, 64),
+    'avatar': (200, 200),
+    'header': (960, 320),
+}
+
+MAX_SOURCE_BYTES = 10 * 1024 * 1024
+
+# Failed originals remembered per process, so a dead link isn't retried
+# on every page view.
+MAX_REMEMBERED_FAILURES = 10_000
+
+
+class BlockedAddress(ValueError):
+    """The image URL points somewhere we won't fetch from. Not an OSError,
+    so urllib passes it through instead of wrapping it in URLError."""
+
+
+def check_public_address(address):
+    """Raise BlockedAddress unless `address` (an IP string) is a public
+    unicast address."""
+
+    ip = ipaddress.ip_address(address.split("%")[0])
+    if not ip.is_global or ip.is_multicast:
+        raise BlockedAddress(f"refusing to fetch from {address}")
+
+
+def _connect_public(*args, **kwargs):
+    """socket.create_connection, refusing non-public peers. Checking the
+    connected socket rather than a DNS lookup beforehand means a name
+    that re-resolves elsewhere can't slip through."""
+
+    sock = socket.create_connection(*args, **kwargs)
+    try:
+        check_public_address(sock.getpeername()[0])
+    except BlockedAddress:
+        sock.close()
+        raise
+    return sock
+
+
+class _PublicOnly:
+    """Connect through _connect_public, before any TLS handshake or
+    request is sent."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._create_connection = _connect_public
+
+
+class _PublicHTTPConnection(_PublicOnly, http.client.HTTPConnection):
+    pass
+
+
+class _PublicHTTPSConnection(_PublicOnly, http.client.HTTPSConnection):
+    pass
+
+
+class _PublicHTTPHandler(urllib.request.HTTPHandler):
+    def http_open(self, req):
+        return self.do_open(_PublicHTTPConnection, req)
+
+
+class _PublicHTTPSHandler(urllib.request.HTTPSHandler):
+    def https_open(self, req):
+        return self.do_open(_PublicHTTPSConnection, req,
+                            context=self._context)
+
+
+class _HTTPOnlyRedirectHandler(urllib.request.HTTPRedirectHandler):
+    """Follow redirects to http(s) only; urllib would also follow ftp://,
+    which the connection check doesn't cover."""
+
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        if urlsplit(newurl).scheme not in ("http", "https"):
+            raise BlockedAddress(f"refusing to follow redirect to {newurl}")
+        return super().redirect_request(req, fp, code, msg, headers, newurl)
+
+
+# No ProxyHandler: with an environment proxy, the peer checked would be
+# the proxy, not the image host.
+_opener = urllib.request.build_opener(
+    urllib.request.ProxyHandler({}), _PublicHTTPHandler,
+    _PublicHTTPSHandler, _HTTPOnlyRedirectHandler)
+
+
+def fetch_url(url, timeout=5):
+    """Default fetcher: download `url` from a public address, refusing
+    anything too large."""
+
+    if urlsplit(url).scheme not in ("http", "https"):
+        raise BlockedAddress(f"not an http(s) URL: {url}")
+
+    req = urllib.request.Request(url, headers={'User-Agent': "warbler-img"})
+    with _opener.open(req, timeout=timeout) as resp:
+        data = resp.read(MAX_SOURCE_BYTES + 1)
+
+    if len(data) > MAX_SOURCE_BYTES:
+        raise ValueError(f"image too large: {url}")
+
+    return data
+
+
+class ImageProxy:
+    """Serve scaled-down copies of external images.
+
+    Configuration (app.config):
+
+    - IMAGE_PROXY_ENABLED: rewrite image URLs through the proxy (default
+      False, link to the originals)
+    - IMAGE_PROXY_FETCHER: callable(url) -> bytes used to download
+      originals (default fetch_url); swap for a stub in tests
+    - IMAGE_PROXY_SIZES: name -> (width, height)
+    - IMAGE_PROXY_CACHE_DIR / IMAGE_PROXY_CACHE_BYTES: thumbnail cache
+      location and size cap (default 256MB)
+    - IMAGE_PROXY_MAX_AGE: Cache-Control max-age for thumbnails (default
+      30 days)
+    - IMAGE_PROXY_FAILURE_TTL: seconds an original that couldn't be
+      fetched or decoded is linked to directly before being retried
+      (default 10 minutes)
+    """
+
+    def __init__(self, app=None):
+        self.cache = None
+        # Concurrent requests for the same image fetch it only once.
+        self._fetch_locks = KeyedLocks()
+        # key -> monotonic time until which it isn't retried.
+        self._failures = OrderedDict()
+        self._failures_lock = threading.Lock()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Register the proxy route and the `thumbnail` template filter."""
+
+        app.config.setdefault('IMAGE_PROXY_ENABLED', False)
+        app.config.setdefault('IMAGE_PROXY_FETCHER', fetch_url)
+        app.config.setdefault('IMAGE_PROXY_SIZES', DEFAULT_SIZES)
+        app.config.setdefault(
+            'IMAGE_PROXY_CACHE_DIR',
+            os.path.join(app.instance_path, "thumbnails"))
+        app.config.setdefault('IMAGE_PROXY_CACHE_BYTES', 256 * 1024 * 1024)
+        app.config.setdefault('IMAGE_PROXY_MAX_AGE', 60 * 60 * 24 * 30)
+        app.config.setdefault('IMAGE_PROXY_FAILURE_TTL', 60 * 10)
+
+        if app.config['IMAGE_PROXY_ENABLED']:
+            self.cache = DiskCache(
+                app.config['IMAGE_PROXY_CACHE_DIR'],
+                app.config['IMAGE_PROXY_CACHE_BYTES'])
+
+        app.add_url_rule(
+            "/img/<size>/<signature>", "image_proxy", self.serve)
+        app.add_template_filter(self.thumbnail)
+
+    def sign(self, size, url):
+        """Signature tying `url` to `size` so only our own links work."""
+
+        secret = current_app.config['SECRET_KEY'].encode()
+        message = f"{size}:{url}".encode()
+        return hmac.new(secret, message, hashlib.sha256).hexdigest()[:20]
+
+    def thumbnail(self, url, size="avatar"):
+        """Template filter: link to `url` scaled to `size`.
+
+        Images under /static/ go through asset_url instead; with the proxy
+        disabled external URLs are returned unchanged.
+        """
+
+        config = current_app.config
+
+        if not url or not url.startswith(("http://", "https://")):
+            asset_url = current_app.jinja_env.filters.get("asset_url")
+            return asset_url(url) if asset_url else url
+
+        if not config['IMAGE_PROXY_ENABLED']:
+            return url
+
+        return (f"/img/{size}/{self.sign(size, url)}"
+                f"?url={quote(url, safe='')}")
+
+    def serve(self, size, signature):
+        """Send the cached thumbnail, making it on first request. If the
+        original can't be fetched or decoded, redirect to it instead."""
+
+        config = current_app.config
+        url = request.args.get("url", "")
+
+        if (self.cache is None
+                or size not in config['IMAGE_PROXY_SIZES']
+                or not hmac.compare_digest(signature, self.sign(size, url))):
+            raise NotFound()
+
+        key = hashlib.sha256(f"{size}:{url}".encode()).hexdigest()
+        path = self.cache.get(key)
+
+        if path is None:
+            if self._failed_recently(key):
+                return redirect(url)
+
+            with self._fetch_locks(key):
+                path = self.cache.get(key)
+                if path is None:
+                    if self._failed_recently(key):
+                        return redirect(url)
+                    try:
+                        data = make_thumbnail(
+                            config['IMAGE_PROXY_FETCHER'](url),
+                            config['IMAGE_PROXY_SIZES'][size])
+                    except Exception:
+                        current_app.logger.warning(
+                            "image proxy failed for %s", url, exc_info=True)
+                        self._remember_failure(
+                            key, config['IMAGE_PROXY_FAILURE_TTL'])
+                        return redirect(url)
+                    path = self.cache.put(key, data)
+
+        resp = send_file(
+            path, mimetype=_sniff_mimetype(path),
+            max_age=config['IMAGE_PROXY_MAX_AGE'])
+        resp.cache_control.public = True
+        return resp
+
+    def _failed_recently(self, key):
+        with self._failures_lock:
+            until = self._failures.get(key)
+            if until is None:
+                return False
+            if until > time.monotonic():
+                return True
+            del self._failures[key]
+            return False
+
+    def _remember_failure(self, key, ttl):
+        with self._failures_lock:
+            self._failures.pop(key, None)
+            self._failures[key] = time.monotonic() + ttl
+            while len(self._failures) > MAX_REMEMBERED_FAILURES:
+                self._failures.popitem(last=False)
+
+
+def make_thumbnail(data, size):
+    """Scale and crop image bytes to exactly `size`. PNGs with
+    transparency stay PNG; everything else becomes a JPEG."""
+
+    if Image is None:
+        raise RuntimeError("Pillow is required for thumbnails")
+
+    image = Image.open(io.BytesIO(data))
+    image = ImageOps.exif_transpose(image)
+    image = ImageOps.fit(image, size, Image.LANCZOS)
+
+    out = io.BytesIO()
+    if image.mode in ("RGBA", "LA", "P"):
+        image.save(out, "PNG", optimize=True)
+    else:
+        image.convert("RGB").save(out, "JPEG", quality=85, optimize=True,
+                                  progressive=True)
+
+    return out.getvalue()
+
+
+def _sniff_mimetype(path):
+    with open(path, "rb") as f:
+        magic = f.read(8)
+    return "image/png" if magic.startswith(b"\x89PNG") else "image/jpeg"
@@ -1,9 +1,12 @@
 """SQLAlchemy models for Warbler."""
 
+import sqlite3
 from datetime import datetime
 
 from flask_bcrypt import Bcrypt
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import delete, event
+from sqlalchemy.engine import Engine
 
 bcrypt = Bcrypt()
 db = SQLAlchemy()
@@ -78,29 +81,35 @@ class User(db.Model):
         nullable=False,
     )
 
+    # passive_deletes: the foreign keys are ON DELETE CASCADE, so deleting
+    # a user never needs to load these collections to clean them up.
     messages = db.relationship('Message', 
         order_by='Message.timestamp.desc()',
-        backref='user')
+        backref='user',
+        passive_deletes=True)
 
     followers = db.relationship(
         "User",
         secondary="follows",
         primaryjoin=(Follows.user_being_followed_id == id),
-        secondaryjoin=(Follows.user_following_id == id)
+        secondaryjoin=(Follows.user_following_id == id),
+        passive_deletes=True,
     )
 
     following = db.relationship(
         "User",
         secondary="follows",
         primaryjoin=(Follows.user_following_id == id),
-        secondaryjoin=(Follows.user_being_followed_id == id)
+        secondaryjoin=(Follows.user_being_followed_id == id),
+        passive_deletes=True,
     )
 
     liked_messages = db.relationship(
         'Message',
         secondary="likes",
         # cascade="all,delete",
-        backref="user_likes",
+        backref=db.backref("user_likes", passive_deletes=True),
+        passive_deletes=True,
     )
 
     def __repr__(self):
@@ -113,28 +122,33 @@ class User(db.Model):
 
     def is_followed_by(self, other_user):
         """Is this user followed by `other_user`?
-        Takes in user instance as argument, returns True/False."""
+        Takes in user instance (or read-only user row) as argument, returns
+        True/False."""
 
-        found_user_list = [user for user in self.followers if user == other_user]
+        found_user_list = [user for user in self.followers if user.id == other_user.id]
         return len(found_user_list) == 1
 
     def is_following(self, other_user):
         """Is this user following `other_use`?
-        Takes in user instance as argument, returns True/False."""
+        Takes in user instance (or read-only user row) as argument, returns
+        True/False."""
 
-        found_user_list = [user for user in self.following if user == other_user]
+        found_user_list = [user for user in self.following if user.id == other_user.id]
         return len(found_user_list) == 1
     
     def add_or_remove_like(self, message):
         """ Takes in a message. If the user has already liked the message, will remove
         the like from the message. If the user has not already liked the message, will
-        add the like to the message. 
+        add the like to the message. Returns whether the message is now
+        liked.
         """
 
         if self in message.user_likes:
             message.user_likes.remove(self)
+            return False
         else:          
             message.user_likes.append(self)
+            return True
 
     
     @classmethod
@@ -186,12 +200,31 @@ class User(db.Model):
 
         return False
 
+    @classmethod
+    def delete_by_id(cls, user_id):
+        """Delete a user with a single DELETE statement.
+
+        Their messages, likes and follows go with them through the
+        database's ON DELETE CASCADE, without being loaded. Returns the
+        number of users deleted (0 or 1).
+        """
+
+        return db.session.execute(
+            delete(cls).where(cls.id == user_id)).rowcount
+
 
 class Message(db.Model):
     """An individual message ("warble")."""
 
     __tablename__ = 'messages'
 
+    # Feeds and profiles order by timestamp, and archiving (partitions.py)
+    # takes the oldest months by timestamp range.
+    __table_args__ = (
+        db.Index('ix_messages_timestamp', 'timestamp'),
+        db.Index('ix_messages_user_id_timestamp', 'user_id', 'timestamp'),
+    )
+
     id = db.Column(
         db.Integer,
         primary_key=True,
@@ -214,6 +247,17 @@ class Message(db.Model):
         nullable=False,
     )
 
+    @classmethod
+    def delete_owned(cls, message_id, user_id):
+        """Delete message `message_id` if `user_id` wrote it, with a single
+        DELETE; its likes go through ON DELETE CASCADE (or, once messages
+        is partitioned, a trigger; see partitions.py). Returns the number
+        of messages deleted (0 or 1)."""
+
+        return db.session.execute(
+            delete(cls).where(cls.id == message_id, cls.user_id == user_id)
+        ).rowcount
+
 class Like(db.Model):
     """ An individual user like for a message """
 
@@ -232,6 +276,297 @@ class Like(db.Model):
     )
 
 
+class Notification(db.Model):
+    """Likes of one message, or new followers, for one user, coalesced
+    into a single row (see notifications.py)."""
+
+    __tablename__ = 'notifications'
+
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'kind', 'subject_id'),
+        db.Index('ix_notifications_user_updated', 'user_id', 'updated_at'),
+    )
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='CASCADE'),
+        nullable=False,
+    )
+
+    # "like" or "follow".
+    kind = db.Column(
+        db.String(10),
+        nullable=False,
+    )
+
+    # The liked message's id; 0 for follows.
+    subject_id = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    # Events ever coalesced into this row, and those since the user last
+    # read their notifications.
+    count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    unread = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    last_actor_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='SET NULL'),
+    )
+
+    updated_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+
+class NotificationCounter(db.Model):
+    """A user's unread notification events, so every page can show the
+    count with one primary-key read."""
+
+    __tablename__ = 'notification_counters'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='CASCADE'),
+        primary_key=True,
+    )
+
+    unread = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+
+class DailyUserStats(db.Model):
+    """One user's activity on one (UTC) day (see rollups.py)."""
+
+    __tablename__ = 'daily_user_stats'
+
+    __table_args__ = (
+        db.Index('ix_daily_user_stats_user_day', 'user_id', 'day'),
+    )
+
+    day = db.Column(
+        db.Date,
+        primary_key=True,
+    )
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='CASCADE'),
+        primary_key=True,
+    )
+
+    posts = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    likes_given = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    likes_received = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    follows_gained = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    follows_lost = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+
+class OutboxEvent(db.Model):
+    """Entities changed by one committed flush, waiting to be broadcast
+    to every worker's caches (see outbox.py)."""
+
+    __tablename__ = 'outbox'
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    # Space-separated tags, e.g. "message:12 user:3".
+    tags = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    created_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+
+class MessageArchiveBlock(db.Model):
+    """A compressed batch of archived messages (see partitions.py)."""
+
+    __tablename__ = 'message_archive_blocks'
+
+    __table_args__ = (
+        db.Index('ix_message_archive_blocks_ids', 'first_id', 'last_id'),
+    )
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    # Lowest and highest message id in the block, for finding a message.
+    first_id = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    last_id = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    count = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    # zlib-compressed JSON: [id, text, timestamp, user_id, like count] rows.
+    data = db.Column(
+        db.LargeBinary,
+        nullable=False,
+    )
+
+    archived_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+
+class TrendingSnapshot(db.Model):
+    """Saved trending-tag counts for one kind of tag (see trending.py)."""
+
+    __tablename__ = 'trending_snapshots'
+
+    kind = db.Column(
+        db.Text,
+        primary_key=True,
+    )
+
+    # JSON: sketch shape, bucket numbers and candidate tags.
+    meta = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    # The buckets' count-min sketch counters, back to back.
+    counts = db.Column(
+        db.LargeBinary,
+        nullable=False,
+    )
+
+    saved_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+
+class ShardBucket(db.Model):
+    """Which shard one bucket of user ids lives on (see sharding.py)."""
+
+    __tablename__ = 'shard_buckets'
+
+    # user_id % SHARD_BUCKETS
+    bucket = db.Column(
+        db.Integer,
+        primary_key=True,
+        autoincrement=False,
+    )
+
+    shard = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    # "active", or "frozen" while a move finishes: no writes.
+    state = db.Column(
+        db.Text,
+        nullable=False,
+        default="active",
+    )
+
+
+class ShardSequence(db.Model):
+    """Where the next block of ids for a sharded table starts."""
+
+    __tablename__ = 'shard_sequences'
+
+    # "users" or "messages"
+    name = db.Column(
+        db.Text,
+        primary_key=True,
+    )
+
+    next_id = db.Column(
+        db.BigInteger,
+        nullable=False,
+    )
+
+
+@event.listens_for(Engine, "connect")
+def enable_sqlite_foreign_keys(dbapi_connection, connection_record):
+    """SQLite ignores foreign keys (and so ON DELETE CASCADE) unless asked
+    per connection."""
+
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA foreign_keys=ON")
+        cursor.close()
+
+
+def dialect_insert(conn, table):
+    """An INSERT for `table` that can take ON CONFLICT clauses, on
+    PostgreSQL or SQLite."""
+
+    if conn.dialect.name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    return insert(table)
+
+
 def connect_db(app):
     """Connect this database to provided Flask app.
 
@@ -239,4 +574,5 @@ def connect_db(app):
     """
 
     db.app = app
-    db.init_app(app)
\ No newline at end of file
+    db.init_app(app)
+    bcrypt.init_app(app)
\ No newline at end of file
@@ -0,0 +1,406 @@
+"""Coalesced notifications for likes and new followers.
+
+Liking a message or following someone records an event in memory; every
+NOTIFICATIONS_WINDOW seconds the pending events are written as one upsert
+per (user, kind, subject) group, so a viral message's hundred likes in a
+second cost one statement, not a hundred rows. Each group is a single
+row: "alice and 11 others liked your warble". Old rows, and rows beyond
+NOTIFICATIONS_PER_USER, are pruned as they're written.
+
+A group counts people, not clicks: the views record a like or follow
+only when it's new, and retract it on unlike or unfollow, so liking,
+unliking and liking again leaves a count of one. Within a window each
+actor nets to +1, 0 or -1.
+
+Every page shows the unread count from notification_counters, one
+primary-key read, kept up to date by the flush. Reading the notifications
+page zeroes it.
+
+Pending events are per process and are lost if the process dies before
+flushing; notifications are a convenience, not a record.
+"""
+
+import atexit
+import os
+import threading
+from datetime import datetime, timedelta
+
+from flask import g
+from sqlalchemy import and_, case, delete, func, select, update
+
+from models import (db, dialect_insert, Message, Notification,
+                    NotificationCounter, User)
+
+LIKE = "like"
+FOLLOW = "follow"
+
+
+class NotificationRow:
+    """A notification as the notifications page shows it."""
+
+    __slots__ = ('kind', 'subject_id', 'count', 'unread', 'updated_at',
+                 'actor', 'text')
+
+    def __init__(self, kind, subject_id, count, unread, updated_at, actor,
+                 text):
+        self.kind = kind
+        self.subject_id = subject_id
+        self.count = count
+        self.unread = unread
+        self.updated_at = updated_at
+        self.actor = actor
+        self.text = text
+
+    def __repr__(self):
+        return f"<NotificationRow {self.kind} x{self.count}>"
+
+
+class Notifications:
+    """Record, batch and read coalesced notifications.
+
+    Configuration (app.config):
+
+    - NOTIFICATIONS_ENABLED: record notifications (default True)
+    - NOTIFICATIONS_WINDOW: seconds between background flushes (default
+      1); 0 starts no flusher, leaving it to explicit flush() calls
+    - NOTIFICATIONS_MAX_PENDING: flush early once this many groups are
+      pending (default 1000)
+    - NOTIFICATIONS_PER_USER: notifications kept per user (default 50)
+    - NOTIFICATIONS_RETENTION_DAYS: notifications not updated for this
+      long are dropped (default 30)
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.enabled = False
+        # (user_id, kind, subject_id) -> [{actor id: +1 or -1}, time], the
+        # actors in the order they last acted
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._flusher = None
+        self._stop = threading.Event()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Register the `unread_notifications()` template global and, when
+        batching, flush from each process's first request on."""
+
+        app.config.setdefault('NOTIFICATIONS_ENABLED', True)
+        app.config.setdefault('NOTIFICATIONS_WINDOW', 1.0)
+        app.config.setdefault('NOTIFICATIONS_MAX_PENDING', 1000)
+        app.config.setdefault('NOTIFICATIONS_PER_USER', 50)
+        app.config.setdefault('NOTIFICATIONS_RETENTION_DAYS', 30)
+
+        self.app = app
+        self.enabled = app.config['NOTIFICATIONS_ENABLED']
+
+        app.add_template_global(self.unread_count, 'unread_notifications')
+
+        if self.enabled and app.config['NOTIFICATIONS_WINDOW']:
+            app.before_request(self.ensure_flusher)
+            atexit.register(self.close)
+            os.register_at_fork(after_in_child=self._after_fork)
+
+    ##########################################################################
+    # Recording
+
+    def record(self, kind, user_id, actor_id, subject_id=0, now=None):
+        """Note that `actor_id` liked `user_id`'s message `subject_id`, or
+        followed them. Acting on yourself isn't news."""
+
+        if not self.enabled or user_id == actor_id:
+            return
+
+        self._add(kind, user_id, actor_id, subject_id, 1, now)
+
+    def retract(self, kind, user_id, actor_id, subject_id=0, now=None):
+        """Take back what record() noted, on unlike or unfollow."""
+
+        if not self.enabled or user_id == actor_id:
+            return
+
+        self._add(kind, user_id, actor_id, subject_id, -1, now)
+
+    def _add(self, kind, user_id, actor_id, subject_id, delta, now):
+        now = now or datetime.utcnow()
+        key = (user_id, kind, subject_id)
+
+        with self._lock:
+            pending = self._pending.setdefault(key, [{}, now])
+            _net(pending[0], actor_id, delta)
+            if delta > 0:
+                pending[1] = now
+            full = (len(self._pending)
+                    >= self.app.config['NOTIFICATIONS_MAX_PENDING'])
+
+        if full:
+            self.flush()
+
+    def forget(self, message_id, user_id):
+        """Drop notifications about `user_id`'s deleted message, in the
+        session's transaction."""
+
+        with self._lock:
+            self._pending.pop((user_id, LIKE, message_id), None)
+
+        conn = db.session.connection()
+        conn.execute(delete(Notification).where(
+            Notification.user_id == user_id,
+            Notification.kind == LIKE,
+            Notification.subject_id == message_id))
+        _recount(conn, {user_id})
+
+    ##########################################################################
+    # Flushing
+
+    def flush(self, conn=None, now=None):
+        """Write all pending events, on `conn` or in a transaction of our
+        own. Returns the number of notification rows written."""
+
+        with self._lock:
+            if not self._pending:
+                return 0
+            batch, self._pending = self._pending, {}
+
+        try:
+            if conn is None:
+                with db.get_engine(self.app).begin() as conn:
+                    self._write_batch(conn, batch, now)
+            else:
+                self._write_batch(conn, batch, now)
+        except Exception:
+            with self._lock:
+                for key, (actors, at) in batch.items():
+                    pending = self._pending.setdefault(key, [{}, at])
+                    # The batch's actions came first.
+                    later, pending[0] = pending[0], actors
+                    for actor, delta in later.items():
+                        _net(actors, actor, delta)
+            raise
+
+        return len(batch)
+
+    def _write_batch(self, conn, batch, now=None):
+        """Upsert a batch of groups, prune, and recount the users it
+        touched."""
+
+        config = self.app.config
+        now = now or datetime.utcnow()
+
+        user_ids = {user_id for user_id, _, _ in batch}
+        actor_ids = {actor_id for actors, _ in batch.values()
+                     for actor_id in actors}
+        # Users deleted since their events were recorded.
+        live = set(conn.execute(
+            select(User.id).where(User.id.in_(user_ids | actor_ids)))
+            .scalars())
+
+        rows = []
+        retracted = []
+        for (user_id, kind, subject_id), (actors, at) in batch.items():
+            events = sum(actors.values())
+            actor_id = next((actor for actor, delta
+                             in reversed(actors.items()) if delta > 0), None)
+            if user_id not in live or (events == 0 and actor_id is None):
+                continue
+            rows.append({'user_id': user_id, 'kind': kind,
+                         'subject_id': subject_id, 'count': events,
+                         'unread': max(events, 0),
+                         'last_actor_id': (actor_id if actor_id in live
+                                           else None),
+                         'updated_at': at})
+            retracted.extend((user_id, kind, subject_id, actor)
+                             for actor, delta in actors.items() if delta < 0)
+        if not rows:
+            return
+
+        # Retractions carry no actor, and leave the row's time alone.
+        table = Notification.__table__
+        stmt = dialect_insert(conn, table)
+        news = stmt.excluded.last_actor_id.isnot(None)
+        unread = table.c.unread + stmt.excluded.count
+        conn.execute(
+            stmt.on_conflict_do_update(
+                index_elements=['user_id', 'kind', 'subject_id'],
+                set_={
+                    'count': table.c.count + stmt.excluded.count,
+                    'unread': case((unread < 0, 0), else_=unread),
+                    'last_actor_id': func.coalesce(
+                        stmt.excluded.last_actor_id, table.c.last_actor_id),
+                    'updated_at': case(
+                        (news, stmt.excluded.updated_at),
+                        else_=table.c.updated_at),
+                }),
+            rows)
+
+        # A row naming someone who took theirs back names no one; a row
+        # nobody is left in goes.
+        for user_id, kind, subject_id, actor_id in retracted:
+            conn.execute(
+                update(Notification)
+                .where(Notification.user_id == user_id,
+                       Notification.kind == kind,
+                       Notification.subject_id == subject_id,
+                       Notification.last_actor_id == actor_id)
+                .values(last_actor_id=None))
+        touched = {row['user_id'] for row in rows}
+        conn.execute(delete(Notification).where(
+            Notification.user_id.in_(touched), Notification.count <= 0))
+
+        _prune(conn, touched, config['NOTIFICATIONS_PER_USER'],
+               now - timedelta(days=config['NOTIFICATIONS_RETENTION_DAYS']))
+        _recount(conn, touched)
+
+    def ensure_flusher(self):
+        """before_request: start flushing in the process that serves the
+        request, never in a preloading gunicorn master."""
+
+        if self._flusher is None:
+            with self._lock:
+                if self._flusher is None:
+                    self._start_flusher()
+
+    def _start_flusher(self):
+        """Flush every NOTIFICATIONS_WINDOW seconds on a daemon thread."""
+
+        window = self.app.config['NOTIFICATIONS_WINDOW']
+
+        def run():
+            while not self._stop.wait(window):
+                try:
+                    self.flush()
+                except Exception:
+                    self.app.logger.exception("notifications flush failed")
+
+        self._flusher = threading.Thread(
+            target=run, name="notifications", daemon=True)
+        self._flusher.start()
+
+    def _after_fork(self):
+        """In a forked worker, drop the parent's events and flusher; the
+        worker's first request starts its own."""
+
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._pending = {}
+        self._flusher = None
+
+    def close(self):
+        """Stop the background flusher and flush what's left."""
+
+        if self._flusher is None:
+            return
+
+        self._stop.set()
+        try:
+            self.flush()
+        except Exception:
+            self.app.logger.exception("final notifications flush failed")
+
+    ##########################################################################
+    # Reading
+
+    def unread_count(self):
+        """Template global: the logged-in user's unread events."""
+
+        if not self.enabled or not g.user:
+            return 0
+
+        if 'unread_notifications' not in g:
+            g.unread_notifications = db.session.execute(
+                select(NotificationCounter.unread)
+                .where(NotificationCounter.user_id == g.user.id)
+            ).scalar() or 0
+        return g.unread_notifications
+
+    def for_user(self, user_id):
+        """NotificationRows for `user_id`, most recently updated first."""
+
+        stmt = (select(Notification.kind, Notification.subject_id,
+                       Notification.count, Notification.unread,
+                       Notification.updated_at, User.id, User.username,
+                       User.image_url, Message.text)
+                .outerjoin(User, User.id == Notification.last_actor_id)
+                .outerjoin(Message, and_(Notification.kind == LIKE,
+                                         Message.id == Notification.subject_id))
+                .where(Notification.user_id == user_id)
+                .order_by(Notification.updated_at.desc())
+                .limit(self.app.config['NOTIFICATIONS_PER_USER']))
+
+        rows = []
+        for (kind, subject_id, count, unread, updated_at,
+             actor_id, username, image_url, text) in db.session.execute(stmt):
+            actor = (_Actor(actor_id, username, image_url)
+                     if actor_id is not None else None)
+            rows.append(NotificationRow(kind, subject_id, count, unread,
+                                        updated_at, actor, text))
+        return rows
+
+    def mark_read(self, user_id):
+        """Zero `user_id`'s unread events, in the session's transaction."""
+
+        db.session.execute(
+            update(Notification)
+            .where(Notification.user_id == user_id, Notification.unread > 0)
+            .values(unread=0))
+        db.session.execute(
+            update(NotificationCounter)
+            .where(NotificationCounter.user_id == user_id,
+                   NotificationCounter.unread > 0)
+            .values(unread=0))
+        g.unread_notifications = 0
+
+
+def _net(actors, actor_id, delta):
+    """Add `delta` to an actor's net action and move them to the end."""
+
+    actors[actor_id] = max(-1, min(1, actors.pop(actor_id, 0) + delta))
+
+
+class _Actor:
+    __slots__ = ('id', 'username', 'image_url')
+
+    def __init__(self, id, username, image_url):
+        self.id = id
+        self.username = username
+        self.image_url = image_url
+
+
+def _prune(conn, user_ids, per_user, cutoff):
+    """Delete these users' notifications older than `cutoff` or beyond
+    their `per_user` most recent."""
+
+    conn.execute(delete(Notification).where(
+        Notification.user_id.in_(user_ids),
+        Notification.updated_at < cutoff))
+
+    ranked = (select(Notification.id,
+                     func.row_number().over(
+                         partition_by=Notification.user_id,
+                         order_by=(Notification.updated_at.desc(),
+                                   Notification.id.desc())).label('rank'))
+              .where(Notification.user_id.in_(user_ids))
+              .subquery())
+    conn.execute(delete(Notification).where(Notification.id.in_(
+        select(ranked.c.id).where(ranked.c.rank > per_user))))
+
+
+def _recount(conn, user_ids):
+    """Set these users' unread counters from their notifications."""
+
+    if not user_ids:
+        return
+
+    sums = dict(conn.execute(
+        select(Notification.user_id, func.sum(Notification.unread))
+        .where(Notification.user_id.in_(user_ids))
+        .group_by(Notification.user_id)).all())
+
+    stmt = dialect_insert(conn, NotificationCounter.__table__)
+    conn.execute(
+        stmt.on_conflict_do_update(index_elements=['user_id'],
+                                   set_={'unread': stmt.excluded.unread}),
+        [{'user_id': user_id, 'unread': sums.get(user_id) or 0}
+         for user_id in user_ids])
@@ -0,0 +1,456 @@
+"""Transactional outbox and cross-worker cache invalidation.
+
+Caches live in each worker, but writes happen in one. So every commit
+that touches a user, message, like or follow also inserts an outbox row
+naming what changed ("message:12 user:3"), in the same transaction: if
+the write commits, so does its event, and a rolled-back write leaves
+none. Write-buffer batches do the same inside their own transactions.
+
+Each worker runs a dispatcher that claims outbox rows (FOR UPDATE SKIP
+LOCKED, so two workers never broadcast the same row), publishes their
+tags on a transport and deletes them. Every worker subscribes to the
+transport and re-sends what arrives as the `invalidated` signal, which
+caches such as the page cache listen to.
+
+The writer's own dispatcher is woken as soon as its commit returns, so
+other workers are usually told within a millisecond or two. If that
+worker dies first, any other dispatcher picks the rows up within
+OUTBOX_POLL_INTERVAL. Delivery is at least once: a row whose broadcast
+went out but whose delete failed is broadcast again, which for an
+invalidation is harmless.
+
+Transports (OUTBOX_TRANSPORT):
+
+- "local": this process only. For a single worker, and for tests.
+- "unix": a datagram socket per process in OUTBOX_SOCKET_DIR, for the
+  workers of one machine. A worker too busy to drain its socket misses
+  events rather than stalling the others; its caches' TTLs cover that.
+- "postgres": LISTEN/NOTIFY on the app's database, for every worker on
+  every node.
+"""
+
+import atexit
+import os
+import select as select_module
+import socket
+import threading
+import uuid
+from contextlib import suppress
+from datetime import datetime
+
+from blinker import Namespace
+from sqlalchemy import delete, event, func, insert, select
+from sqlalchemy.orm import attributes
+
+from models import db, Follows, Like, Message, OutboxEvent, ShardBucket, User
+from writebuffer import batch_flushed, batch_writing, FOLLOW, LIKE
+
+# Sent with tags= [tag, ...] in every process for each broadcast event,
+# including the process that wrote it.
+invalidated = Namespace().signal('outbox-invalidated')
+
+# PostgreSQL's NOTIFY payload limit is 8000 bytes.
+MAX_PAYLOAD = 7900
+
+
+class Outbox:
+    """Record changed entities with each commit and broadcast them.
+
+    Configuration (app.config):
+
+    - OUTBOX_ENABLED: write and dispatch events (default False)
+    - OUTBOX_TRANSPORT: "local", "unix" or "postgres" (default "local")
+    - OUTBOX_SOCKET_DIR: where the "unix" transport's sockets live
+      (default: "bus" in the instance folder)
+    - OUTBOX_POLL_INTERVAL: seconds between a dispatcher's checks for
+      rows other workers left behind (default 0.05); 0 starts no
+      dispatcher, leaving it to explicit dispatch() calls
+    - OUTBOX_BATCH_SIZE: rows claimed per dispatch (default 500)
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.enabled = False
+        self.transport = None
+        self._lock = threading.Lock()
+        self._dispatcher = None
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Listen for writes and, when dispatching, start from each
+        process's first request on."""
+
+        app.config.setdefault('OUTBOX_ENABLED', False)
+        app.config.setdefault('OUTBOX_TRANSPORT', "local")
+        app.config.setdefault('OUTBOX_SOCKET_DIR',
+                              os.path.join(app.instance_path, "bus"))
+        app.config.setdefault('OUTBOX_POLL_INTERVAL', 0.05)
+        app.config.setdefault('OUTBOX_BATCH_SIZE', 500)
+
+        self.app = app
+        self.enabled = app.config['OUTBOX_ENABLED']
+
+        event.listen(db.session, 'after_flush', self._record_flush)
+        event.listen(db.session, 'after_commit', self._wake_committed)
+        event.listen(db.session, 'after_rollback', self._forget_rolled_back)
+        batch_writing.connect(self._record_batch)
+        batch_flushed.connect(self._wake_batch)
+
+        if self.enabled and app.config['OUTBOX_POLL_INTERVAL']:
+            app.before_request(self.ensure_dispatcher)
+            atexit.register(self.close)
+            os.register_at_fork(after_in_child=self._after_fork)
+
+    ##########################################################################
+    # Recording
+
+    def publish(self, *tags):
+        """Record an event for writes the session can't see, such as bulk
+        deletes, in the session's transaction."""
+
+        if self.enabled and tags:
+            _insert(db.session.connection(), tags)
+            db.session.info['outbox_written'] = True
+
+    def _record_flush(self, session, flush_context):
+        """after_flush: record what this flush wrote, in its transaction."""
+
+        if not self.enabled:
+            return
+
+        tags = set()
+        for obj in (*session.new, *session.dirty, *session.deleted):
+            tags.update(tags_for(obj))
+        if tags:
+            _insert(session.connection(), tags)
+            session.info['outbox_written'] = True
+
+    def _record_batch(self, sender, conn, batch):
+        if self.enabled:
+            _insert(conn, batch_tags(batch))
+
+    def _wake_committed(self, session):
+        if session.info.pop('outbox_written', False):
+            self._wake.set()
+
+    def _forget_rolled_back(self, session):
+        session.info.pop('outbox_written', None)
+
+    def _wake_batch(self, sender, batch):
+        if self.enabled:
+            self._wake.set()
+
+    ##########################################################################
+    # Dispatching
+
+    def dispatch(self, conn=None):
+        """Claim, broadcast and delete up to OUTBOX_BATCH_SIZE events, on
+        `conn` or in a transaction of our own. Returns how many."""
+
+        if conn is None:
+            with db.get_engine(self.app).begin() as conn:
+                return self._dispatch(conn)
+        return self._dispatch(conn)
+
+    def _dispatch(self, conn):
+        rows = conn.execute(
+            select(OutboxEvent.id, OutboxEvent.tags)
+            .order_by(OutboxEvent.id)
+            .limit(self.app.config['OUTBOX_BATCH_SIZE'])
+            .with_for_update(skip_locked=True)).all()
+        if not rows:
+            return 0
+
+        conn.execute(delete(OutboxEvent).where(
+            OutboxEvent.id.in_([row_id for row_id, _ in rows])))
+
+        tags = set()
+        for _, row_tags in rows:
+            tags.update(row_tags.split())
+        # Before the delete commits: if publishing fails, the rows stay.
+        for payload in _payloads(sorted(tags)):
+            self._transport().publish(payload)
+
+        return len(rows)
+
+    def _transport(self):
+        if self.transport is None:
+            with self._lock:
+                if self.transport is None:
+                    self.transport = make_transport(self.app)
+                    self.transport.subscribe(self._deliver)
+        return self.transport
+
+    def _deliver(self, payload):
+        """A broadcast arrived: tell this process's caches."""
+
+        invalidated.send(self, tags=payload.split())
+
+    def ensure_dispatcher(self):
+        """before_request: subscribe and start dispatching in the process
+        that serves the request, never in a preloading gunicorn master."""
+
+        if self._dispatcher is None:
+            with self._lock:
+                if self._dispatcher is None:
+                    self._start_dispatcher()
+            self._transport()
+
+    def _start_dispatcher(self):
+        """Dispatch when a commit here wrote events, and every
+        OUTBOX_POLL_INTERVAL seconds for ones other workers left."""
+
+        interval = self.app.config['OUTBOX_POLL_INTERVAL']
+        batch_size = self.app.config['OUTBOX_BATCH_SIZE']
+
+        def run():
+            while not self._stop.is_set():
+                self._wake.wait(interval)
+                self._wake.clear()
+                try:
+                    while self.dispatch() == batch_size:
+                        pass
+                except Exception:
+                    self.app.logger.exception("outbox dispatch failed")
+
+        self._dispatcher = threading.Thread(
+            target=run, name="outbox", daemon=True)
+        self._dispatcher.start()
+
+    def _after_fork(self):
+        """In a forked worker, drop the parent's dispatcher and transport;
+        the worker's first request starts its own."""
+
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self._dispatcher = None
+        self.transport = None
+
+    def close(self):
+        """Stop dispatching, send what's left and unsubscribe."""
+
+        if self._dispatcher is None:
+            return
+
+        self._stop.set()
+        self._wake.set()
+        try:
+            self.dispatch()
+        except Exception:
+            self.app.logger.exception("final outbox dispatch failed")
+        if self.transport is not None:
+            self.transport.close()
+
+
+def _insert(conn, tags):
+    conn.execute(insert(OutboxEvent.__table__).values(
+        tags=" ".join(sorted(tags)), created_at=datetime.utcnow()))
+
+
+def _payloads(tags):
+    """Space-separated tags, split so no payload exceeds MAX_PAYLOAD."""
+
+    payload = []
+    size = 0
+    for tag in tags:
+        if payload and size + len(tag) + 1 > MAX_PAYLOAD:
+            yield " ".join(payload)
+            payload, size = [], 0
+        payload.append(tag)
+        size += len(tag) + 1
+    if payload:
+        yield " ".join(payload)
+
+
+##############################################################################
+# What changed
+
+
+def tags_for(obj):
+    """Entities whose pages change when `obj` is written. Includes the
+    other side of any relationship collection that changed, e.g. the
+    followed user when someone's `following` list grows."""
+
+    if isinstance(obj, Like):
+        return {f"user:{obj.user_id}", f"message:{obj.message_id}"}
+    if isinstance(obj, Follows):
+        return {f"user:{obj.user_following_id}",
+                f"user:{obj.user_being_followed_id}"}
+    if isinstance(obj, ShardBucket):
+        # Every process reloads its bucket map (see sharding.py).
+        return {"shards"}
+    if not isinstance(obj, (User, Message)):
+        return set()
+
+    tags = _entity_tags(obj)
+    for rel in attributes.instance_state(obj).mapper.relationships:
+        history = attributes.get_history(
+            obj, rel.key, passive=attributes.PASSIVE_NO_INITIALIZE)
+        for other in (*(history.added or ()), *(history.deleted or ())):
+            tags.update(_entity_tags(other))
+
+    return tags
+
+
+def _entity_tags(obj):
+    """Tags for a User or Message itself; a message also shows up on its
+    author's profile."""
+
+    if isinstance(obj, User):
+        return {f"user:{obj.id}"}
+    if isinstance(obj, Message):
+        return {f"message:{obj.id}", f"user:{obj.user_id}"}
+    return set()
+
+
+def batch_tags(batch):
+    """Entities affected by a write-buffer batch."""
+
+    tags = set()
+    for (kind, user_id, target_id) in batch:
+        tags.add(f"user:{user_id}")
+        if kind == LIKE:
+            tags.add(f"message:{target_id}")
+        elif kind == FOLLOW:
+            tags.add(f"user:{target_id}")
+    return tags
+
+
+##############################################################################
+# Transports
+
+
+class LocalTransport:
+    """Delivers to subscribers in this process only."""
+
+    def __init__(self):
+        self._callbacks = []
+
+    def publish(self, payload):
+        for callback in self._callbacks:
+            callback(payload)
+
+    def subscribe(self, callback):
+        self._callbacks.append(callback)
+
+    def close(self):
+        self._callbacks = []
+
+
+class UnixSocketTransport:
+    """Delivers to every subscribed process on this machine: each binds a
+    datagram socket in `directory`, and publishing sends to them all."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self._sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._sender.setblocking(False)
+        self._receivers = []
+
+    def publish(self, payload):
+        data = payload.encode()
+        for name in os.listdir(self.directory):
+            if not name.endswith(".sock"):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                self._sender.sendto(data, path)
+            except (ConnectionRefusedError, FileNotFoundError):
+                # Left behind by a process that died.
+                with suppress(FileNotFoundError):
+                    os.unlink(path)
+            except BlockingIOError:
+                # Its queue is full; don't wait for it.
+                pass
+
+    def subscribe(self, callback):
+        path = os.path.join(self.directory,
+                            f"{os.getpid()}-{uuid.uuid4().hex[:8]}.sock")
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.bind(path)
+        self._receivers.append((sock, path))
+
+        def run():
+            while True:
+                try:
+                    data = sock.recv(MAX_PAYLOAD * 4)
+                except OSError:
+                    return
+                callback(data.decode())
+
+        threading.Thread(target=run, name="outbox-unix", daemon=True).start()
+
+    def close(self):
+        for sock, path in self._receivers:
+            # shutdown() wakes the receiving thread; close() alone won't.
+            with suppress(OSError):
+                sock.shutdown(socket.SHUT_RDWR)
+            sock.close()
+            with suppress(FileNotFoundError):
+                os.unlink(path)
+        self._receivers = []
+        self._sender.close()
+
+
+class PostgresTransport:
+    """Delivers to every subscribed process using the database: NOTIFY to
+    publish, a dedicated LISTENing connection per subscriber."""
+
+    def __init__(self, engine, channel="warbler_invalidate"):
+        self.engine = engine
+        self.channel = channel
+        self._listeners = []
+        self._closed = threading.Event()
+
+    def publish(self, payload):
+        with self.engine.begin() as conn:
+            conn.execute(select(func.pg_notify(self.channel, payload)))
+
+    def subscribe(self, callback):
+        raw = self.engine.raw_connection()
+        # Kept out of the pool: it spends its life LISTENing.
+        raw.detach()
+        dbapi_conn = raw.connection
+        dbapi_conn.autocommit = True
+        with dbapi_conn.cursor() as cursor:
+            cursor.execute(f"LISTEN {self.channel}")
+        self._listeners.append(raw)
+
+        def run():
+            while not self._closed.is_set():
+                try:
+                    ready, _, _ = select_module.select([dbapi_conn], [], [], 1)
+                    if ready:
+                        dbapi_conn.poll()
+                except Exception:
+                    return
+                while dbapi_conn.notifies:
+                    callback(dbapi_conn.notifies.pop(0).payload)
+
+        threading.Thread(target=run, name="outbox-pg", daemon=True).start()
+
+    def close(self):
+        self._closed.set()
+        for raw in self._listeners:
+            with suppress(Exception):
+                raw.close()
+        self._listeners = []
+
+
+def make_transport(app):
+    """The transport named by OUTBOX_TRANSPORT."""
+
+    name = app.config['OUTBOX_TRANSPORT']
+    if name == "local":
+        return LocalTransport()
+    if name == "unix":
+        return UnixSocketTransport(app.config['OUTBOX_SOCKET_DIR'])
+    if name == "postgres":
+        return PostgresTransport(db.get_engine(app))
+    raise ValueError(f"unknown OUTBOX_TRANSPORT {name!r}")
@@ -0,0 +1,285 @@
+"""Full-page cache for anonymous visitors.
+
+Requests without a session cookie all see the same HTML for a given URL,
+so GETs to the cached endpoints are answered from a bounded in-memory LRU
+(with an optional on-disk second tier) instead of re-querying and
+re-rendering.
+
+Each cached page records the version of every entity it shows ("user:3",
+"message:12"). Commits that touch a user, message, like or follow bump
+those versions, which makes dependent pages stale immediately in this
+process. With the outbox on (see outbox.py), other processes get the same
+bumps milliseconds later; without it they only see their own. Either
+way, entries also expire after PAGE_CACHE_TTL seconds.
+
+When many anonymous requests miss on the same page at once, only the
+first renders it; the rest wait for its result.
+"""
+
+import hashlib
+import pickle
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app, g, request, session
+from sqlalchemy import event
+
+from diskcache import DiskCache
+from models import db
+from outbox import batch_tags, invalidated, tags_for
+from singleflight import KeyedLocks
+from writebuffer import batch_flushed
+
+DEFAULT_ENDPOINTS = {
+    'warbler.homepage', 'warbler.users_show', 'warbler.messages_show'}
+
+
+class CachedPage:
+    """A stored response and the entity versions it was rendered from."""
+
+    __slots__ = ('status', 'headers', 'body', 'versions', 'stored_at')
+
+    def __init__(self, status, headers, body, versions, stored_at):
+        self.status = status
+        self.headers = headers
+        self.body = body
+        self.versions = versions
+        self.stored_at = stored_at
+
+
+class PageCache:
+    """Cache whole responses for anonymous GETs.
+
+    Configuration (app.config):
+
+    - PAGE_CACHE_ENABLED: turn the cache on (default False)
+    - PAGE_CACHE_ENDPOINTS: endpoints whose pages may be cached
+    - PAGE_CACHE_TTL: seconds a page may be served (default 60)
+    - PAGE_CACHE_MAX_ENTRIES: size of the in-memory LRU (default 1000)
+    - PAGE_CACHE_DISK_DIR: directory for the on-disk tier, or None for
+      memory only (default None)
+    - PAGE_CACHE_DISK_BYTES: size cap of the on-disk tier (default 256MB)
+    - PAGE_CACHE_WAIT: seconds a request waits for another request that
+      is already rendering the same page (default 5)
+    """
+
+    def __init__(self, app=None):
+        self.versions = {}
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._disk = None
+        self._rendering = KeyedLocks()
+        self.hits = 0
+        self.misses = 0
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Register request hooks and invalidation listeners."""
+
+        app.config.setdefault('PAGE_CACHE_ENABLED', False)
+        app.config.setdefault('PAGE_CACHE_ENDPOINTS', DEFAULT_ENDPOINTS)
+        app.config.setdefault('PAGE_CACHE_TTL', 60)
+        app.config.setdefault('PAGE_CACHE_MAX_ENTRIES', 1000)
+        app.config.setdefault('PAGE_CACHE_DISK_DIR', None)
+        app.config.setdefault('PAGE_CACHE_DISK_BYTES', 256 * 1024 * 1024)
+        app.config.setdefault('PAGE_CACHE_WAIT', 5)
+
+        if app.config['PAGE_CACHE_DISK_DIR']:
+            self._disk = DiskCache(app.config['PAGE_CACHE_DISK_DIR'],
+                                   app.config['PAGE_CACHE_DISK_BYTES'])
+
+        app.before_request(self.serve_cached)
+        app.after_request(self.store)
+        app.teardown_request(self.finish)
+
+        event.listen(db.session, 'after_flush', self._collect_changes)
+        event.listen(db.session, 'after_commit', self._bump_committed)
+        batch_flushed.connect(self._bump_batch)
+        invalidated.connect(self._bump_broadcast)
+
+    ##########################################################################
+    # Request hooks
+
+    def _cache_key(self):
+        """Key for the current request, or None if it mustn't be cached."""
+
+        config = current_app.config
+
+        if (not config['PAGE_CACHE_ENABLED']
+                or request.method != "GET"
+                or request.endpoint not in config['PAGE_CACHE_ENDPOINTS']
+                or current_app.session_cookie_name in request.cookies):
+            return None
+
+        return hashlib.sha256(request.full_path.encode()).hexdigest()
+
+    def serve_cached(self):
+        """before_request: answer from the cache, or become the one
+        request that renders this page."""
+
+        key = self._cache_key()
+        if key is None:
+            return None
+
+        page = self.get(key)
+        if page is not None:
+            return self._response(page, "HIT")
+
+        if not self._rendering.acquire(
+                key, timeout=current_app.config['PAGE_CACHE_WAIT']):
+            # Whoever is rendering is taking too long; render ourselves
+            # rather than queueing behind them.
+            return None
+
+        page = self.get(key)
+        if page is not None:
+            self._rendering.release(key)
+            return self._response(page, "HIT")
+
+        g.page_cache_key = key
+        g.page_cache_versions = self._versions_for_request()
+        self.misses += 1
+        return None
+
+    def store(self, response):
+        """after_request: keep a freshly rendered anonymous page."""
+
+        key = g.get('page_cache_key')
+        if key is None or response.status_code != 200 or session.modified:
+            return response
+
+        body = response.get_data()
+        page = CachedPage(
+            status=response.status_code,
+            headers=[(k, v) for k, v in response.headers
+                     if k.lower() not in ('set-cookie', 'content-length')],
+            body=body,
+            versions=g.page_cache_versions,
+            stored_at=time.time())
+        self.put(key, page)
+
+        response.headers['X-Page-Cache'] = "MISS"
+        return response
+
+    def finish(self, exc):
+        """teardown_request: let waiting requests through."""
+
+        key = g.pop('page_cache_key', None)
+        if key is not None:
+            self._rendering.release(key)
+
+    def depends_on(self, *tags):
+        """Declare that the page being rendered shows these entities, on
+        top of the ones named in the URL (see _versions_for_request)."""
+
+        if g.get('page_cache_key') is not None:
+            g.page_cache_versions.update(self._versions_for(tags))
+
+    def _versions_for_request(self):
+        """Versions of the entities named by the URL: a view argument
+        "user_id=3" means the page shows "user:3"."""
+
+        tags = [f"{name[:-3]}:{value}"
+                for name, value in (request.view_args or {}).items()
+                if name.endswith("_id")]
+        return self._versions_for(tags)
+
+    def _versions_for(self, tags):
+        return {tag: self.versions.get(tag, 0) for tag in tags}
+
+    def _response(self, page, state):
+        self.hits += 1
+        resp = current_app.response_class(
+            page.body, status=page.status, headers=page.headers)
+        resp.headers['X-Page-Cache'] = state
+        return resp
+
+    ##########################################################################
+    # Storage
+
+    def get(self, key):
+        """A fresh cached page for `key`, or None."""
+
+        with self._lock:
+            page = self._memory.get(key)
+            if page is not None:
+                self._memory.move_to_end(key)
+
+        if page is None and self._disk is not None:
+            path = self._disk.get(key)
+            if path is not None:
+                with open(path, "rb") as f:
+                    page = pickle.load(f)
+                self._remember(key, page)
+
+        if page is None or not self._is_fresh(page):
+            return None
+
+        return page
+
+    def put(self, key, page):
+        self._remember(key, page)
+        if self._disk is not None:
+            self._disk.put(key, pickle.dumps(page, pickle.HIGHEST_PROTOCOL))
+
+    def _remember(self, key, page):
+        """Add to the in-memory LRU, dropping the oldest entries past the
+        size limit."""
+
+        limit = current_app.config['PAGE_CACHE_MAX_ENTRIES']
+        with self._lock:
+            self._memory[key] = page
+            self._memory.move_to_end(key)
+            while len(self._memory) > limit:
+                self._memory.popitem(last=False)
+
+    def _is_fresh(self, page):
+        if time.time() - page.stored_at > current_app.config['PAGE_CACHE_TTL']:
+            return False
+        return all(self.versions.get(tag, 0) == version
+                   for tag, version in page.versions.items())
+
+    def clear(self):
+        """Drop every in-memory page (disk entries go stale on their own)."""
+
+        with self._lock:
+            self._memory.clear()
+
+    ##########################################################################
+    # Invalidation
+
+    def invalidate(self, *tags):
+        """Make every page that shows one of these entities stale."""
+
+        with self._lock:
+            for tag in tags:
+                self.versions[tag] = self.versions.get(tag, 0) + 1
+
+    def _collect_changes(self, session, flush_context):
+        """after_flush: note which entities this transaction touched."""
+
+        tags = session.info.setdefault('page_cache_tags', set())
+        for obj in (*session.new, *session.dirty, *session.deleted):
+            tags.update(tags_for(obj))
+
+    def _bump_committed(self, session):
+        """after_commit: invalidate what the committed transaction
+        touched."""
+
+        tags = session.info.pop('page_cache_tags', None)
+        if tags:
+            self.invalidate(*tags)
+
+    def _bump_batch(self, sender, batch):
+        """Invalidate pages affected by a flushed write-buffer batch."""
+
+        self.invalidate(*batch_tags(batch))
+
+    def _bump_broadcast(self, sender, tags):
+        """Invalidate what a commit in any process touched."""
+
+        self.invalidate(*tags)
+
@@ -0,0 +1,454 @@
+"""Time partitioning and archiving for messages.
+
+On PostgreSQL, `flask messages partition` turns `messages` into a table
+partitioned by month of `timestamp` (messages_p2024_01, ...), plus a
+default partition for anything outside the monthly ones. Feed and profile
+queries then only touch the recent partitions' indexes, and retiring a
+month is a DROP instead of a huge DELETE and the vacuum after it.
+
+`flask messages archive` moves months older than the retention horizon
+out of `messages` into message_archive_blocks: blocks of a few hundred
+messages in id order, each zlib-compressed JSON. /messages/<id> still
+finds them through archived_message(); they no longer show in feeds,
+profiles or likes, and can't be liked or deleted.
+
+SQLite has no partitions, so there `messages` stays one table and months
+are only logical: ranges on the timestamp index. Archiving works the same
+way, deleting each archived block's rows by id.
+
+Run `flask messages maintain` daily (cron or Heroku Scheduler): it creates
+the next few months' partitions ahead of time and archives whatever has
+passed the horizon. Rows for a month without a partition land in the
+default partition and are moved out when the month's partition is made.
+
+Partitioning changes two things in the schema:
+
+- The primary key becomes (id, timestamp), since PostgreSQL requires the
+  partition key in it. Ids still come from the same sequence, so they
+  stay unique.
+- likes.message_id can no longer be a foreign key (nothing unique on id
+  alone to point at); an AFTER DELETE trigger on messages deletes a
+  message's likes instead, and the write buffer checks that a message
+  still exists before inserting a like for it.
+"""
+
+import json
+import zlib
+from datetime import datetime
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import column, func, select, table, text, true
+
+from models import db, Like, Message, MessageArchiveBlock, User
+from queries import MessageRow, UserRow
+
+DEFAULT_PARTITION = "messages_default"
+
+# Deletes a message's likes, standing in for the foreign key. Skipped while
+# maintenance moves rows between partitions, which is a delete and insert.
+DELETE_LIKES_TRIGGER = """
+CREATE OR REPLACE FUNCTION messages_delete_likes() RETURNS trigger AS $$
+BEGIN
+    IF current_setting('warbler.moving_messages', true) = 'on' THEN
+        RETURN NULL;
+    END IF;
+    DELETE FROM likes WHERE message_id = OLD.id;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER messages_delete_likes AFTER DELETE ON messages
+    FOR EACH ROW EXECUTE FUNCTION messages_delete_likes();
+"""
+
+
+def month_start(when):
+    """Midnight on the first of `when`'s month."""
+
+    return when.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def add_months(month, n):
+    """The first of the month `n` months after `month` (a month_start)."""
+
+    index = month.year * 12 + month.month - 1 + n
+    return month.replace(year=index // 12, month=index % 12 + 1)
+
+
+def partition_name(month):
+    return f"messages_p{month:%Y_%m}"
+
+
+def archive_horizon(now, retention_months):
+    """Messages before this are archived."""
+
+    return add_months(month_start(now), -retention_months)
+
+
+class MessagePartitions:
+    """Time partitions and archive for messages; the work is done by the
+    `messages` CLI.
+
+    Configuration (app.config):
+
+    - MESSAGES_PARTITION_MONTHS_AHEAD: months of partitions created ahead
+      of the current one (default 3)
+    - MESSAGES_RETENTION_MONTHS: whole months kept in `messages` before
+      the current one; older ones are archived (default 24)
+    - MESSAGES_ARCHIVE_BLOCK_SIZE: messages per compressed archive block
+      (default 256)
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('MESSAGES_PARTITION_MONTHS_AHEAD', 3)
+        app.config.setdefault('MESSAGES_RETENTION_MONTHS', 24)
+        app.config.setdefault('MESSAGES_ARCHIVE_BLOCK_SIZE', 256)
+
+        app.cli.add_command(messages_cli)
+
+
+##############################################################################
+# Partitions (PostgreSQL)
+
+
+def is_partitioned(conn):
+    """Is `messages` a partitioned table?"""
+
+    if conn.dialect.name != "postgresql":
+        return False
+
+    return conn.execute(text(
+        "SELECT relkind FROM pg_class "
+        "WHERE oid = to_regclass('messages')")).scalar() == "p"
+
+
+def monthly_partitions(conn):
+    """{month: partition name} of the partitions attached to `messages`."""
+
+    names = conn.execute(text(
+        "SELECT c.relname FROM pg_inherits i "
+        "JOIN pg_class c ON c.oid = i.inhrelid "
+        "WHERE i.inhparent = 'messages'::regclass")).scalars()
+
+    return {datetime.strptime(name, "messages_p%Y_%m"): name
+            for name in names if name != DEFAULT_PARTITION}
+
+
+def ensure_indexes(conn):
+    """Create the model's indexes on `messages` if missing: tables made
+    before they were added don't have them. On a partitioned table they
+    cascade to every partition."""
+
+    for index in Message.__table__.indexes:
+        index.create(conn, checkfirst=True)
+
+
+def convert(conn, now, months_ahead):
+    """Replace the plain `messages` table with a partitioned one holding
+    the same rows, with monthly partitions from the oldest message to
+    `months_ahead` past `now`. Takes an exclusive lock for the copy."""
+
+    conn.execute(text("LOCK TABLE messages IN ACCESS EXCLUSIVE MODE"))
+
+    sequence = conn.execute(text(
+        "SELECT pg_get_serial_sequence('messages', 'id')")).scalar()
+    primary_key = conn.execute(text(
+        "SELECT conname FROM pg_constraint "
+        "WHERE conrelid = 'messages'::regclass AND contype = 'p'")).scalar()
+    likes_foreign_keys = conn.execute(text(
+        "SELECT conname FROM pg_constraint "
+        "WHERE conrelid = 'likes'::regclass "
+        "AND confrelid = 'messages'::regclass AND contype = 'f'")
+    ).scalars().all()
+
+    for name in likes_foreign_keys:
+        conn.execute(text(f'ALTER TABLE likes DROP CONSTRAINT "{name}"'))
+
+    conn.execute(text("ALTER TABLE messages RENAME TO messages_unpartitioned"))
+    conn.execute(text(
+        f'ALTER TABLE messages_unpartitioned RENAME CONSTRAINT "{primary_key}" '
+        f"TO messages_unpartitioned_pkey"))
+    for index in Message.__table__.indexes:
+        conn.execute(text(f"DROP INDEX IF EXISTS {index.name}"))
+
+    conn.execute(text(f"""
+        CREATE TABLE messages (
+            id INTEGER NOT NULL DEFAULT nextval('{sequence}'),
+            text VARCHAR(140) NOT NULL,
+            timestamp TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+            user_id INTEGER NOT NULL
+                REFERENCES users (id) ON DELETE CASCADE,
+            PRIMARY KEY (id, timestamp)
+        ) PARTITION BY RANGE (timestamp)"""))
+    conn.execute(text(
+        f"CREATE TABLE {DEFAULT_PARTITION} PARTITION OF messages DEFAULT"))
+    ensure_indexes(conn)
+
+    oldest = conn.execute(text(
+        "SELECT min(timestamp) FROM messages_unpartitioned")).scalar()
+    month = month_start(min(oldest or now, now))
+    while month <= add_months(month_start(now), months_ahead):
+        _create_partition(conn, month)
+        month = add_months(month, 1)
+
+    conn.execute(text(
+        "INSERT INTO messages (id, text, timestamp, user_id) "
+        "SELECT id, text, timestamp, user_id FROM messages_unpartitioned"))
+    conn.execute(text(f"ALTER SEQUENCE {sequence} OWNED BY messages.id"))
+    conn.execute(text("DROP TABLE messages_unpartitioned"))
+    conn.execute(text(DELETE_LIKES_TRIGGER))
+
+
+def create_partitions(conn, now, months_ahead):
+    """Create any missing monthly partitions from `now`'s month to
+    `months_ahead` after it. Returns the names created."""
+
+    existing = monthly_partitions(conn)
+    created = []
+
+    month = month_start(now)
+    while month <= add_months(month_start(now), months_ahead):
+        if month not in existing:
+            created.append(_create_partition(conn, month))
+        month = add_months(month, 1)
+
+    return created
+
+
+def _create_partition(conn, month):
+    """Add `month`'s partition, first moving its rows out of the default
+    partition (which can't hold rows that belong to another one)."""
+
+    name = partition_name(month)
+    start = f"'{month:%Y-%m-%d}'"
+    end = f"'{add_months(month, 1):%Y-%m-%d}'"
+
+    conn.execute(text(f"CREATE TABLE {name} (LIKE messages INCLUDING DEFAULTS)"))
+    conn.execute(text("SET LOCAL warbler.moving_messages = on"))
+    conn.execute(text(f"""
+        WITH moved AS (
+            DELETE FROM {DEFAULT_PARTITION}
+            WHERE timestamp >= {start} AND timestamp < {end}
+            RETURNING id, text, timestamp, user_id)
+        INSERT INTO {name} (id, text, timestamp, user_id)
+        SELECT id, text, timestamp, user_id FROM moved"""))
+    conn.execute(text("SET LOCAL warbler.moving_messages = off"))
+    conn.execute(text(
+        f"ALTER TABLE messages ATTACH PARTITION {name} "
+        f"FOR VALUES FROM ({start}) TO ({end})"))
+
+    return name
+
+
+##############################################################################
+# Archive
+
+
+def _messages_table(name):
+    return table(name, column('id'), column('text'), column('timestamp'),
+                 column('user_id'))
+
+
+def _write_blocks(conn, source, where, block_size, delete=False):
+    """Copy the rows of `source` matching `where` into archive blocks, in
+    id order, a block per query. With `delete`, each block's rows are then
+    deleted from `source` by id, so nothing is deleted that wasn't
+    archived. Returns the number of messages archived."""
+
+    likes = (select(func.count())
+             .where(Like.message_id == source.c.id)
+             .scalar_subquery())
+    stmt = (select(source.c.id, source.c.text, source.c.timestamp,
+                   source.c.user_id, likes)
+            .where(where)
+            .order_by(source.c.id)
+            .limit(block_size))
+
+    archived = 0
+    last_id = None
+    while True:
+        after = source.c.id > last_id if last_id is not None else true()
+        block = conn.execute(stmt.where(after)).all()
+        if not block:
+            return archived
+
+        data = [[id, text, timestamp.isoformat(), user_id, like_count]
+                for id, text, timestamp, user_id, like_count in block]
+        conn.execute(MessageArchiveBlock.__table__.insert().values(
+            first_id=block[0].id,
+            last_id=block[-1].id,
+            count=len(block),
+            data=zlib.compress(json.dumps(data).encode()),
+            archived_at=datetime.utcnow(),
+        ))
+        if delete:
+            # Likes go with them, by cascade or by trigger.
+            conn.execute(source.delete().where(
+                source.c.id.in_([row.id for row in block])))
+
+        archived += len(block)
+        last_id = block[-1].id
+
+
+def archive_partition(conn, name, block_size):
+    """Detach partition `name`, archive its rows and drop it."""
+
+    conn.execute(text(f"ALTER TABLE messages DETACH PARTITION {name}"))
+
+    source = _messages_table(name)
+    archived = _write_blocks(conn, source, true(), block_size)
+
+    # Dropping the table doesn't run the delete trigger.
+    conn.execute(Like.__table__.delete().where(
+        Like.message_id.in_(select(source.c.id))))
+    conn.execute(text(f"DROP TABLE {name}"))
+
+    return archived
+
+
+def archive(conn, now, retention_months, block_size):
+    """Archive every message older than the retention horizon: whole
+    partitions where there are some, then any older rows still in
+    `messages`. Returns the number of messages archived."""
+
+    horizon = archive_horizon(now, retention_months)
+    archived = 0
+
+    if is_partitioned(conn):
+        for month, name in sorted(monthly_partitions(conn).items()):
+            if add_months(month, 1) <= horizon:
+                archived += archive_partition(conn, name, block_size)
+
+    messages = Message.__table__
+    archived += _write_blocks(conn, messages, messages.c.timestamp < horizon,
+                              block_size, delete=True)
+
+    return archived
+
+
+def archived_message(message_id):
+    """MessageRow for an archived message, or None. Like state isn't kept:
+    archived messages are read-only."""
+
+    blocks = db.session.execute(
+        select(MessageArchiveBlock.data)
+        .where(MessageArchiveBlock.first_id <= message_id,
+               MessageArchiveBlock.last_id >= message_id)).scalars()
+
+    for data in blocks:
+        for id, text, timestamp, user_id, _ in json.loads(
+                zlib.decompress(data)):
+            if id != message_id:
+                continue
+
+            user = db.session.execute(
+                select(*UserRow.COLUMNS).where(User.id == user_id)).first()
+            if user is None:
+                return None
+
+            return MessageRow(id, text, datetime.fromisoformat(timestamp),
+                              UserRow(*user), False)
+
+    return None
+
+
+##############################################################################
+# CLI
+
+
+messages_cli = AppGroup(
+    "messages", help="Partition and archive the messages table.")
+
+
+def _partition(conn, now):
+    config = current_app.config
+
+    ensure_indexes(conn)
+    if conn.dialect.name != "postgresql":
+        click.echo("No native partitions on "
+                   f"{conn.dialect.name}; months stay logical.")
+        return
+
+    months_ahead = config['MESSAGES_PARTITION_MONTHS_AHEAD']
+    if not is_partitioned(conn):
+        click.echo("Converting messages to a partitioned table...")
+        convert(conn, now, months_ahead)
+
+    for name in create_partitions(conn, now, months_ahead):
+        click.echo(f"Created {name}.")
+
+
+def _archive(conn, now):
+    config = current_app.config
+
+    archived = archive(conn, now, config['MESSAGES_RETENTION_MONTHS'],
+                       config['MESSAGES_ARCHIVE_BLOCK_SIZE'])
+    click.echo(f"Archived {archived} messages.")
+
+
+@messages_cli.command("partition")
+def partition_command():
+    """Partition messages by month (converting it the first time) and
+    create the months ahead."""
+
+    with db.engine.begin() as conn:
+        _partition(conn, datetime.utcnow())
+
+
+@messages_cli.command("archive")
+def archive_command():
+    """Archive messages older than the retention horizon."""
+
+    with db.engine.begin() as conn:
+        _archive(conn, datetime.utcnow())
+
+
+@messages_cli.command("maintain")
+def maintain_command():
+    """Create upcoming partitions, then archive; run this daily."""
+
+    now = datetime.utcnow()
+    with db.engine.begin() as conn:
+        _partition(conn, now)
+    with db.engine.begin() as conn:
+        _archive(conn, now)
+
+
+@messages_cli.command("status")
+def status_command():
+    """Show partitions, what the next archive run would take, and the
+    archive's size."""
+
+    config = current_app.config
+    horizon = archive_horizon(datetime.utcnow(),
+                              config['MESSAGES_RETENTION_MONTHS'])
+
+    with db.engine.connect() as conn:
+        if is_partitioned(conn):
+            for month, name in sorted(monthly_partitions(conn).items()):
+                rows = conn.execute(text(
+                    f"SELECT count(*) FROM {name}")).scalar()
+                click.echo(f"{name:20s} {rows:10d}")
+            rows = conn.execute(text(
+                f"SELECT count(*) FROM {DEFAULT_PARTITION}")).scalar()
+            click.echo(f"{DEFAULT_PARTITION:20s} {rows:10d}")
+        else:
+            click.echo("messages is not partitioned.")
+
+        due = conn.execute(select(func.count()).where(
+            Message.__table__.c.timestamp < horizon)).scalar()
+        click.echo(f"Due for archiving (before {horizon:%Y-%m-%d}): {due}")
+
+        blocks, messages, size = conn.execute(select(
+            func.count(),
+            func.coalesce(func.sum(MessageArchiveBlock.count), 0),
+            func.coalesce(func.sum(func.length(MessageArchiveBlock.data)), 0),
+        )).one()
+        click.echo(f"Archive: {messages} messages in {blocks} blocks, "
+                   f"{size / 1024:.1f} KiB")
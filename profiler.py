@@ -0,0 +1,450 @@
+"""Opt-in request profiling: stack sampling, SQL capture and slow-request
+reports.
+
+With PROFILER_ENABLED, a request is watched when it carries a valid signed
+X-Profile header (see `flask profiles token`), when it's picked by
+PROFILER_SAMPLE_RATE, or, if PROFILER_SLOW_MS is set, always, in case it
+turns out slow. A watched request has its SQL statements timed, and one
+background thread samples its Python stack every PROFILER_INTERVAL
+seconds, so the request itself does no extra work beyond the SQL timing.
+
+Requests picked by header or sample rate, and any request slower than
+PROFILER_SLOW_MS, are written to a capture directory:
+
+- meta.json: method, path, endpoint, status, duration, trigger
+- queries.json: each statement with its parameters, time and, for
+  SELECTs, the database's EXPLAIN plan
+- stacks.folded: sampled stacks in collapsed format, one
+  "frame;frame;frame count" line per stack, ready for flamegraph.pl or
+  speedscope
+
+`flask profiles list` and `flask profiles diff A B` read them back.
+"""
+
+import json
+import os
+import random
+import shutil
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+
+import click
+from flask import current_app, g, has_request_context, request
+from flask.cli import AppGroup
+from itsdangerous import BadSignature, URLSafeTimedSerializer
+from sqlalchemy import event
+
+from models import db
+
+TOKEN_SALT = "warbler-profiler"
+
+
+class Capture:
+    """What's been recorded about one watched request."""
+
+    def __init__(self, trigger):
+        self.trigger = trigger
+        self.started = time.perf_counter()
+        self.queries = []
+        self.stacks = Counter()
+
+
+class Sampler:
+    """One daemon thread that snapshots the stacks of registered request
+    threads. Idle (blocked on an event) while nothing is registered."""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._watched = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+
+    def watch(self, capture):
+        """Sample the calling thread into `capture` until unwatch()."""
+
+        with self._lock:
+            self._watched[threading.get_ident()] = capture
+            # Started on first use, so a forked worker starts its own.
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._run, name="profiler-sampler", daemon=True)
+                self._thread.start()
+            self._wake.set()
+
+    def unwatch(self):
+        with self._lock:
+            self._watched.pop(threading.get_ident(), None)
+            if not self._watched:
+                self._wake.clear()
+
+    def _run(self):
+        while True:
+            self._wake.wait()
+            time.sleep(self.interval)
+
+            with self._lock:
+                watched = list(self._watched.items())
+
+            frames = sys._current_frames()
+            for thread_id, capture in watched:
+                frame = frames.get(thread_id)
+                if frame is not None:
+                    capture.stacks[_collapse(frame)] += 1
+
+
+def _collapse(frame):
+    """Root-first "func (file:line);..." for a frame and its callers."""
+
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        filename = os.path.basename(code.co_filename)
+        names.append(f"{code.co_name} ({filename}:{code.co_firstlineno})")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+class Profiler:
+    """Watch requests and write captures for the interesting ones.
+
+    Configuration (app.config):
+
+    - PROFILER_ENABLED: turn profiling on (default False)
+    - PROFILER_SAMPLE_RATE: fraction of requests captured at random
+      (default 0)
+    - PROFILER_SLOW_MS: capture any request slower than this; None to
+      only capture requests picked by header or sample rate (default None)
+    - PROFILER_INTERVAL: seconds between stack samples (default 0.01)
+    - PROFILER_HEADER: request header carrying a signed token (default
+      X-Profile)
+    - PROFILER_TOKEN_MAX_AGE: seconds a token stays valid (default 1 day)
+    - PROFILER_DIR: where captures are written (default
+      instance/profiles)
+    - PROFILER_MAX_CAPTURES: oldest captures are removed past this many
+      (default 200)
+    - PROFILER_MAX_EXPLAINS: distinct SELECTs explained per capture
+      (default 20)
+    """
+
+    def __init__(self, app=None):
+        self.sampler = None
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Register request hooks, SQL timing and the `profiles` CLI."""
+
+        app.config.setdefault('PROFILER_ENABLED', False)
+        app.config.setdefault('PROFILER_SAMPLE_RATE', 0)
+        app.config.setdefault('PROFILER_SLOW_MS', None)
+        app.config.setdefault('PROFILER_INTERVAL', 0.01)
+        app.config.setdefault('PROFILER_HEADER', "X-Profile")
+        app.config.setdefault('PROFILER_TOKEN_MAX_AGE', 60 * 60 * 24)
+        app.config.setdefault(
+            'PROFILER_DIR', os.path.join(app.instance_path, "profiles"))
+        app.config.setdefault('PROFILER_MAX_CAPTURES', 200)
+        app.config.setdefault('PROFILER_MAX_EXPLAINS', 20)
+
+        app.cli.add_command(profiles_cli)
+
+        if not app.config['PROFILER_ENABLED']:
+            return
+
+        self.sampler = Sampler(app.config['PROFILER_INTERVAL'])
+
+        app.before_request(self.start)
+        app.after_request(self.note_status)
+        app.teardown_request(self.finish)
+
+        engine = db.get_engine(app)
+        event.listen(engine, 'before_cursor_execute', _before_execute)
+        event.listen(engine, 'after_cursor_execute', _after_execute)
+
+    ##########################################################################
+    # Request hooks
+
+    def _trigger(self):
+        """Why the current request should be watched, or None."""
+
+        config = current_app.config
+        token = request.headers.get(config['PROFILER_HEADER'])
+
+        if token and valid_token(token):
+            return "header"
+        if random.random() < config['PROFILER_SAMPLE_RATE']:
+            return "sampled"
+        if config['PROFILER_SLOW_MS'] is not None:
+            return "slow"
+        return None
+
+    def start(self):
+        """before_request: start watching this request if it's picked."""
+
+        trigger = self._trigger()
+        if trigger is None:
+            return
+
+        g.profile_capture = Capture(trigger)
+        self.sampler.watch(g.profile_capture)
+
+    def note_status(self, response):
+        """after_request: remember the status for the capture."""
+
+        if 'profile_capture' in g:
+            g.profile_status = response.status_code
+        return response
+
+    def finish(self, exc):
+        """teardown_request: stop sampling and write the capture if the
+        request was picked or turned out slow. Runs after a streamed
+        response has finished, so rendering time is included."""
+
+        capture = g.pop('profile_capture', None)
+        if capture is None:
+            return
+
+        self.sampler.unwatch()
+        duration_ms = (time.perf_counter() - capture.started) * 1000
+
+        slow_ms = current_app.config['PROFILER_SLOW_MS']
+        if capture.trigger == "slow" and duration_ms < slow_ms:
+            return
+
+        try:
+            self._write(capture, duration_ms, exc)
+        except Exception:
+            current_app.logger.exception("writing profile capture failed")
+
+    ##########################################################################
+    # Captures
+
+    def _write(self, capture, duration_ms, exc):
+        config = current_app.config
+        now = time.time()
+        capture_id = (f"{time.strftime('%Y%m%d-%H%M%S', time.localtime(now))}"
+                      f".{int(now * 1000) % 1000:03d}-{uuid.uuid4().hex[:6]}")
+        path = os.path.join(config['PROFILER_DIR'], capture_id)
+        os.makedirs(path)
+
+        meta = {
+            'id': capture_id,
+            'method': request.method,
+            'path': request.full_path.rstrip("?"),
+            'endpoint': request.endpoint,
+            'status': 500 if exc else g.get('profile_status'),
+            'duration_ms': round(duration_ms, 2),
+            'trigger': capture.trigger,
+            'samples': sum(capture.stacks.values()),
+            'interval': config['PROFILER_INTERVAL'],
+            'queries': len(capture.queries),
+            'sql_ms': round(sum(q['ms'] for q in capture.queries), 2),
+        }
+        if 'compression_stats' in g:
+            meta['compression'] = g.compression_stats.as_dict()
+
+        queries = _explain(capture.queries, config['PROFILER_MAX_EXPLAINS'])
+
+        with open(os.path.join(path, "meta.json"), "w") as f:
+            json.dump(meta, f, indent=2)
+        with open(os.path.join(path, "queries.json"), "w") as f:
+            json.dump(queries, f, indent=2, default=repr)
+        with open(os.path.join(path, "stacks.folded"), "w") as f:
+            for stack, count in capture.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+        _prune(config['PROFILER_DIR'], config['PROFILER_MAX_CAPTURES'])
+
+
+##############################################################################
+# Tokens
+
+
+def _serializer():
+    return URLSafeTimedSerializer(current_app.secret_key, salt=TOKEN_SALT)
+
+
+def make_token():
+    """A value for the profiling header."""
+
+    return _serializer().dumps("profile")
+
+
+def valid_token(token):
+    try:
+        _serializer().loads(
+            token, max_age=current_app.config['PROFILER_TOKEN_MAX_AGE'])
+    except BadSignature:
+        return False
+    return True
+
+
+##############################################################################
+# SQL timing
+
+
+def _current_capture():
+    if has_request_context():
+        return g.get('profile_capture')
+    return None
+
+
+def _before_execute(conn, cursor, statement, parameters, context,
+                    executemany):
+    if _current_capture() is not None:
+        conn.info.setdefault('profiler_started', []).append(
+            time.perf_counter())
+
+
+def _after_execute(conn, cursor, statement, parameters, context,
+                   executemany):
+    capture = _current_capture()
+    started = conn.info.get('profiler_started')
+    if capture is None or not started:
+        return
+
+    capture.queries.append({
+        'statement': statement,
+        'parameters': parameters,
+        'executemany': executemany,
+        'ms': round((time.perf_counter() - started.pop()) * 1000, 3),
+    })
+
+
+def _explain(queries, limit):
+    """Queries as JSON-ready dicts, with a plan for the first `limit`
+    distinct SELECTs."""
+
+    engine = db.get_engine(current_app)
+    prefix = {
+        'postgresql': "EXPLAIN ",
+        'sqlite': "EXPLAIN QUERY PLAN ",
+    }.get(engine.dialect.name)
+
+    plans = {}
+    result = []
+
+    for query in queries:
+        statement = query['statement']
+        if (prefix and not query['executemany']
+                and statement.lstrip().upper().startswith("SELECT")
+                and statement not in plans and len(plans) < limit):
+            try:
+                with engine.connect() as conn:
+                    rows = conn.exec_driver_sql(
+                        prefix + statement, query['parameters'])
+                    plans[statement] = "\n".join(
+                        " ".join(str(col) for col in row) for row in rows)
+            except Exception as e:
+                plans[statement] = f"EXPLAIN failed: {e}"
+
+        result.append({**query, 'plan': plans.get(statement)})
+
+    return result
+
+
+def _prune(directory, keep):
+    """Remove all but the newest `keep` captures (ids sort by time)."""
+
+    captures = sorted(os.listdir(directory))
+    for name in captures[:-keep]:
+        shutil.rmtree(os.path.join(directory, name), ignore_errors=True)
+
+
+##############################################################################
+# CLI
+
+
+def _load_meta(directory, capture_id):
+    with open(os.path.join(directory, capture_id, "meta.json")) as f:
+        return json.load(f)
+
+
+def _load_stacks(directory, capture_id):
+    stacks = Counter()
+    with open(os.path.join(directory, capture_id, "stacks.folded")) as f:
+        for line in f:
+            stack, _, count = line.rstrip("\n").rpartition(" ")
+            stacks[stack] += int(count)
+    return stacks
+
+
+def _inclusive_shares(stacks):
+    """Fraction of samples in which each frame appears anywhere on the
+    stack."""
+
+    total = sum(stacks.values()) or 1
+    seen = Counter()
+    for stack, count in stacks.items():
+        for frame in set(stack.split(";")):
+            seen[frame] += count
+    return {frame: n / total for frame, n in seen.items()}
+
+
+profiles_cli = AppGroup(
+    "profiles", help="Inspect request profiles captured by the profiler.")
+
+
+@profiles_cli.command("token")
+def token_command():
+    """Print a token for the profiling header."""
+
+    header = current_app.config['PROFILER_HEADER']
+    click.echo(f"{header}: {make_token()}")
+
+
+@profiles_cli.command("list")
+@click.option("--limit", default=20, help="How many captures to show.")
+def list_command(limit):
+    """List the newest captures."""
+
+    directory = current_app.config['PROFILER_DIR']
+    if not os.path.isdir(directory):
+        click.echo("No captures.")
+        return
+
+    for capture_id in sorted(os.listdir(directory))[-limit:][::-1]:
+        meta = _load_meta(directory, capture_id)
+        click.echo(
+            f"{meta['id']}  {meta['duration_ms']:8.1f} ms  "
+            f"{meta['queries']:3d} queries  {meta['status'] or '-'}  "
+            f"{meta['trigger']:7s}  {meta['method']} {meta['path']}")
+
+
+@profiles_cli.command("diff")
+@click.argument("before")
+@click.argument("after")
+@click.option("--top", default=15, help="How many frames to show.")
+def diff_command(before, after, top):
+    """Compare two captures: totals, then the frames whose share of
+    samples changed most."""
+
+    directory = current_app.config['PROFILER_DIR']
+    a = _load_meta(directory, before)
+    b = _load_meta(directory, after)
+
+    for key, label in (('duration_ms', "duration ms"),
+                       ('sql_ms', "sql ms"),
+                       ('queries', "queries"),
+                       ('samples', "samples")):
+        click.echo(f"{label:12s} {a[key]:10} -> {b[key]:10}  "
+                   f"({b[key] - a[key]:+.1f})")
+
+    shares_a = _inclusive_shares(_load_stacks(directory, before))
+    shares_b = _inclusive_shares(_load_stacks(directory, after))
+    frames = set(shares_a) | set(shares_b)
+    changes = sorted(
+        frames,
+        key=lambda f: abs(shares_b.get(f, 0) - shares_a.get(f, 0)),
+        reverse=True)
+
+    click.echo("")
+    click.echo("share of samples (inclusive):")
+    for frame in changes[:top]:
+        was, now = shares_a.get(frame, 0), shares_b.get(frame, 0)
+        click.echo(f"  {was:6.1%} -> {now:6.1%}  ({now - was:+6.1%})  "
+                   f"{frame}")
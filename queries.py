@@ -0,0 +1,358 @@
+"""Read-only queries for feed, profile and list pages.
+
+These return small __slots__ row objects instead of ORM instances: each
+page is one (or two) SELECTs of just the columns its template prints, and
+nothing is added to the session's identity map. The row objects have the
+same attribute names as User/Message, so templates render them unchanged.
+
+Rows are snapshots: use the ORM models for anything that writes.
+"""
+
+from sqlalchemy import and_, exists, func, literal, or_, select
+from sqlalchemy.orm import aliased
+
+from models import db, Follows, Like, Message, User
+
+
+class UserRow:
+    """The User columns templates show on cards and profiles."""
+
+    __slots__ = ('id', 'username', 'image_url', 'header_image_url', 'bio',
+                 'location')
+
+    COLUMNS = (User.id, User.username, User.image_url, User.header_image_url,
+               User.bio, User.location)
+
+    def __init__(self, id, username, image_url, header_image_url, bio,
+                 location):
+        self.id = id
+        self.username = username
+        self.image_url = image_url
+        self.header_image_url = header_image_url
+        self.bio = bio
+        self.location = location
+
+    def __repr__(self):
+        return f"<UserRow #{self.id}: {self.username}>"
+
+
+class MessageRow:
+    """A message with its author and whether the viewer has liked it."""
+
+    __slots__ = ('id', 'text', 'timestamp', 'user', 'liked')
+
+    def __init__(self, id, text, timestamp, user, liked):
+        self.id = id
+        self.text = text
+        self.timestamp = timestamp
+        self.user = user
+        self.liked = liked
+
+    def __repr__(self):
+        return f"<MessageRow #{self.id} by {self.user.username}>"
+
+
+class ProfileRow(UserRow):
+    """A user plus what the profile header and tabs need.
+
+    Collections the page doesn't list are Count placeholders, so
+    `user.followers | length` still works without loading any followers.
+    """
+
+    __slots__ = ('messages', 'following', 'followers', 'liked_messages')
+
+
+class Count:
+    """Stands in for a collection when a template only needs its length."""
+
+    __slots__ = ('n',)
+
+    def __init__(self, n):
+        self.n = n
+
+    def __len__(self):
+        return self.n
+
+    def __repr__(self):
+        return f"<Count {self.n}>"
+
+
+def _message_rows(stmt):
+    """Run a messages-joined-to-users SELECT built by _messages_select and
+    build MessageRows."""
+
+    return message_rows_from(db.session.execute(stmt))
+
+
+def message_rows_from(result):
+    """MessageRows from the rows of a _messages_select SELECT, sharing one
+    UserRow per author."""
+
+    users = {}
+    rows = []
+
+    for row in result:
+        (message_id, text, timestamp, liked, *user_cols) = row
+        user = users.get(user_cols[0])
+        if user is None:
+            user = users[user_cols[0]] = UserRow(*user_cols)
+        rows.append(MessageRow(message_id, text, timestamp, user,
+                               bool(liked)))
+
+    return rows
+
+
+def _newest_first(stmt, before=None, limit=None):
+    """Order a messages SELECT newest first and, for keyset paging, keep
+    only messages older than `before`, a (timestamp, id) pair."""
+
+    if before is not None:
+        timestamp, message_id = before
+        stmt = stmt.where(or_(
+            Message.timestamp < timestamp,
+            and_(Message.timestamp == timestamp, Message.id < message_id)))
+
+    return (stmt.order_by(Message.timestamp.desc(), Message.id.desc())
+            .limit(limit))
+
+
+def _messages_select(viewer_id):
+    """SELECT message columns, the viewer's like state and author columns,
+    for filtering/ordering by the caller."""
+
+    if viewer_id:
+        liked = exists().where(and_(
+            Like.message_id == Message.id,
+            Like.user_id == viewer_id))
+    else:
+        liked = literal(False)
+
+    return (select(Message.id, Message.text, Message.timestamp,
+                   liked.label('liked'), *UserRow.COLUMNS)
+            .join(User, User.id == Message.user_id))
+
+
+##############################################################################
+# Statements
+#
+# Shared by the functions below and by the async read path (asyncreads.py),
+# which runs the same SELECTs on its own engine.
+
+
+def following_ids_select(user_id):
+    return (select(Follows.user_being_followed_id)
+            .where(Follows.user_following_id == user_id))
+
+
+def feed_select(author_ids, viewer_id=None, limit=100, before=None):
+    """Messages by any of `author_ids`, newest first."""
+
+    return _newest_first(
+        _messages_select(viewer_id).where(Message.user_id.in_(author_ids)),
+        before, limit)
+
+
+def home_feed_select(user_id, following_ids, limit=100, before=None):
+    return feed_select({user_id, *following_ids}, user_id, limit, before)
+
+
+def live_home_feed_select(user_id, pending=None, limit=100, before=None):
+    """The home feed with the followed ids as a subquery, so it doesn't
+    have to wait for them. `pending` is {followed id: following or not}
+    for follow changes not yet in the database."""
+
+    pending = pending or {}
+    added = {user_id, *(i for i, state in pending.items() if state)}
+    removed = [i for i, state in pending.items() if not state]
+
+    followed = following_ids_select(user_id)
+    if removed:
+        followed = followed.where(
+            Follows.user_being_followed_id.not_in(removed))
+
+    return _newest_first(
+        _messages_select(user_id).where(or_(
+            Message.user_id.in_(added), Message.user_id.in_(followed))),
+        before, limit)
+
+
+def user_summary_select(user_id):
+    """The user's card columns and all four counts, in one row."""
+
+    message_count = (select(func.count(Message.id))
+                     .where(Message.user_id == user_id)
+                     .scalar_subquery())
+    following_count = (select(func.count())
+                       .where(Follows.user_following_id == user_id)
+                       .scalar_subquery())
+    followers_count = (select(func.count())
+                       .where(Follows.user_being_followed_id == user_id)
+                       .scalar_subquery())
+    likes_count = (select(func.count())
+                   .where(Like.user_id == user_id)
+                   .scalar_subquery())
+
+    return (select(*UserRow.COLUMNS, message_count, following_count,
+                   followers_count, likes_count)
+            .where(User.id == user_id))
+
+
+def user_messages_select(user_id, viewer_id=None, limit=None, before=None):
+    return _newest_first(
+        _messages_select(viewer_id).where(Message.user_id == user_id),
+        before, limit)
+
+
+def liked_messages_select(user_id, viewer_id=None, limit=None, before=None):
+    # Aliased so the viewer's like-state subquery doesn't correlate to
+    # this join.
+    liked_by = aliased(Like)
+    return _newest_first(
+        _messages_select(viewer_id)
+        .join(liked_by, and_(liked_by.message_id == Message.id,
+                             liked_by.user_id == user_id)),
+        before, limit)
+
+
+def _users_select(column, user_id, limit=None, after=None):
+    """Users on the other end of `user_id`'s follows, by id, for keyset
+    paging after the id `after`. `column` is the Follows column that
+    holds `user_id`."""
+
+    other = (Follows.user_being_followed_id
+             if column is Follows.user_following_id
+             else Follows.user_following_id)
+    stmt = (select(*UserRow.COLUMNS)
+            .join(Follows, other == User.id)
+            .where(column == user_id))
+    if after is not None:
+        stmt = stmt.where(User.id > after)
+
+    return stmt.order_by(User.id).limit(limit)
+
+
+def following_select(user_id, limit=None, after=None):
+    return _users_select(Follows.user_following_id, user_id, limit, after)
+
+
+def followers_select(user_id, limit=None, after=None):
+    return _users_select(Follows.user_being_followed_id, user_id, limit,
+                         after)
+
+
+def message_select(message_id, viewer_id=None):
+    return _messages_select(viewer_id).where(Message.id == message_id)
+
+
+def profile_from(row):
+    """ProfileRow from a user_summary_select row (or None), with Count
+    placeholders for the collections."""
+
+    if row is None:
+        return None
+
+    *user_cols, messages, following, followers, likes = row
+    profile = ProfileRow(*user_cols)
+    profile.messages = Count(messages)
+    profile.following = Count(following)
+    profile.followers = Count(followers)
+    profile.liked_messages = Count(likes)
+
+    return profile
+
+
+##############################################################################
+# Queries
+
+
+def following_ids(user_id):
+    """Ids of the users `user_id` follows."""
+
+    return set(db.session.execute(following_ids_select(user_id)).scalars())
+
+
+def home_feed(user_id, following_ids, limit=100, before=None):
+    """The `limit` most recent messages by `user_id` and the users they
+    follow, with `user_id` as the viewer; older than `before`, a
+    (timestamp, id) pair, if given."""
+
+    return _message_rows(
+        home_feed_select(user_id, following_ids, limit, before))
+
+
+def message(message_id, viewer_id=None):
+    """MessageRow for `message_id`, or None."""
+
+    rows = _message_rows(message_select(message_id, viewer_id))
+    return rows[0] if rows else None
+
+
+def user_messages(user_id, viewer_id=None, limit=None, before=None):
+    """MessageRows by `user_id`, newest first."""
+
+    return _message_rows(
+        user_messages_select(user_id, viewer_id, limit, before))
+
+
+def liked_messages(user_id, viewer_id=None, limit=None, before=None):
+    """MessageRows `user_id` has liked, newest first."""
+
+    return _message_rows(
+        liked_messages_select(user_id, viewer_id, limit, before))
+
+
+def following(user_id, limit=None, after=None):
+    """UserRows for the users `user_id` follows, by id."""
+
+    return [UserRow(*row) for row in
+            db.session.execute(following_select(user_id, limit, after))]
+
+
+def followers(user_id, limit=None, after=None):
+    """UserRows for the users following `user_id`, by id."""
+
+    return [UserRow(*row) for row in
+            db.session.execute(followers_select(user_id, limit, after))]
+
+
+def list_users(search=None):
+    """All users, or those whose username contains `search`."""
+
+    stmt = select(*UserRow.COLUMNS)
+    if search:
+        stmt = stmt.where(User.username.like(f"%{search}%"))
+
+    return [UserRow(*row) for row in db.session.execute(stmt)]
+
+
+def user_summary(user_id):
+    """ProfileRow for `user_id` with all four counts, or None."""
+
+    return profile_from(
+        db.session.execute(user_summary_select(user_id)).first())
+
+
+def user_profile(user_id, viewer_id=None):
+    """Profile of `user_id` with all their messages, newest first, or None
+    if there is no such user."""
+
+    profile = user_summary(user_id)
+    if profile is None:
+        return None
+
+    profile.messages = user_messages(user_id, viewer_id)
+
+    return profile
+
+
+def user_likes(user_id, viewer_id=None):
+    """Profile of `user_id` with the messages they've liked, or None if
+    there is no such user."""
+
+    profile = user_summary(user_id)
+    if profile is None:
+        return None
+
+    profile.liked_messages = liked_messages(user_id, viewer_id)
+
+    return profile
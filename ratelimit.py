@@ -0,0 +1,272 @@
+"""Token-bucket rate limiting for Warbler routes."""
+
+import threading
+import time
+from collections import OrderedDict
+from math import ceil
+
+from flask import current_app, request, session
+from werkzeug.exceptions import TooManyRequests
+
+# Default per-endpoint rules. Each rule is "<requests>/<period>" with an
+# optional burst size after a colon, e.g. "5/minute:10". Endpoints not
+# listed here are not throttled.
+DEFAULT_RULES = {
+    'warbler.login': "10/minute",
+    'warbler.signup': "5/minute",
+    'warbler.messages_add': "30/minute:10",
+    'warbler.add_or_remove_like': "60/minute:20",
+    'warbler.add_follow': "30/minute:10",
+    'warbler.stop_following': "30/minute:10",
+    'api.login': "10/minute",
+    'api.create_message': "30/minute:10",
+    'api.export': "5/hour",
+}
+
+PERIODS = {
+    'second': 1,
+    'minute': 60,
+    'hour': 60 * 60,
+    'day': 60 * 60 * 24,
+}
+
+
+class Rule:
+    """A refill rate (tokens per second) and a bucket size."""
+
+    __slots__ = ('rate', 'burst')
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+
+    def __repr__(self):
+        return f"<Rule {self.rate:.4f}/s burst={self.burst}>"
+
+    @classmethod
+    def parse(cls, spec):
+        """Build a Rule from a string like "10/minute" or "10/minute:20".
+
+        Without an explicit burst, the bucket holds one period's worth of
+        requests.
+        """
+
+        spec, _, burst = spec.partition(':')
+        count, _, period = spec.partition('/')
+        count = int(count)
+        seconds = PERIODS[period.strip() or 'second']
+
+        return cls(rate=count / seconds, burst=int(burst) if burst else count)
+
+
+class MemoryStore:
+    """In-process bucket store, split into shards to keep lock hold times
+    short under many worker threads.
+
+    Buckets are immutable (tokens, stamp, full_at) tuples. Reading a bucket
+    needs no lock; the shard lock is only taken to check that nobody
+    replaced the bucket while we were computing its new state, and to swap
+    it in.
+
+    Each shard keeps its buckets in least-recently-used order and drops the
+    oldest once it holds more than `max_keys_per_shard`, so memory stays
+    bounded and eviction costs O(1) however many distinct clients arrive.
+    A bucket untouched for that long has usually refilled anyway.
+    """
+
+    def __init__(self, shards=16, max_keys_per_shard=10_000):
+        self._shards = [OrderedDict() for _ in range(shards)]
+        self._locks = [threading.Lock() for _ in range(shards)]
+        self.max_keys_per_shard = max_keys_per_shard
+
+    def consume(self, key, rule, cost=1, now=None):
+        """Take `cost` tokens from `key`'s bucket.
+
+        Returns (allowed, retry_after) where retry_after is the number of
+        seconds until enough tokens will be available (0 if allowed).
+        """
+
+        now = time.monotonic() if now is None else now
+        idx = hash(key) % len(self._shards)
+        shard = self._shards[idx]
+
+        while True:
+            current = shard.get(key)
+            tokens, allowed, retry_after = _refill_and_take(
+                current, rule, cost, now)
+            new = (tokens, now, now + (rule.burst - tokens) / rule.rate)
+
+            with self._locks[idx]:
+                if shard.get(key) is current:
+                    shard[key] = new
+                    shard.move_to_end(key)
+                    while len(shard) > self.max_keys_per_shard:
+                        shard.popitem(last=False)
+                    return allowed, retry_after
+
+    def clear(self):
+        """Forget every bucket."""
+
+        for idx, shard in enumerate(self._shards):
+            with self._locks[idx]:
+                shard.clear()
+
+
+class RedisStore:
+    """Bucket store shared between workers and hosts, backed by Redis.
+
+    Takes an already-configured redis client; the refill-and-take step runs
+    as a Lua script so it is atomic on the server.
+    """
+
+    SCRIPT = """
+    local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'stamp')
+    local rate = tonumber(ARGV[1])
+    local burst = tonumber(ARGV[2])
+    local cost = tonumber(ARGV[3])
+    local now = tonumber(ARGV[4])
+    local tokens = tonumber(bucket[1]) or burst
+    local stamp = tonumber(bucket[2]) or now
+    tokens = math.min(burst, tokens + (now - stamp) * rate)
+    local allowed = 0
+    local retry_after = 0
+    if tokens >= cost then
+        tokens = tokens - cost
+        allowed = 1
+    else
+        retry_after = (cost - tokens) / rate
+    end
+    redis.call('HSET', KEYS[1], 'tokens', tokens, 'stamp', now)
+    redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+    return {allowed, tostring(retry_after)}
+    """
+
+    def __init__(self, client, prefix="warbler:rl:"):
+        self.client = client
+        self.prefix = prefix
+        self._script = client.register_script(self.SCRIPT)
+
+    def consume(self, key, rule, cost=1, now=None):
+        """Take `cost` tokens from `key`'s bucket. See MemoryStore.consume."""
+
+        now = time.time() if now is None else now
+        allowed, retry_after = self._script(
+            keys=[self.prefix + key],
+            args=[rule.rate, rule.burst, cost, now])
+
+        return bool(allowed), float(retry_after)
+
+    def clear(self):
+        """Forget every bucket under our prefix."""
+
+        for key in self.client.scan_iter(self.prefix + "*"):
+            self.client.delete(key)
+
+
+def client_ip(trusted_proxies):
+    """The client's address, behind `trusted_proxies` proxies that each
+    append the address they were connected from to X-Forwarded-For. Only
+    the entries those proxies added are believed; anything earlier in the
+    header came from the client."""
+
+    if trusted_proxies:
+        forwarded = request.access_route
+        if request.headers.get('X-Forwarded-For') and \
+                len(forwarded) >= trusted_proxies:
+            return forwarded[-trusted_proxies]
+
+    return request.remote_addr
+
+
+def _refill_and_take(bucket, rule, cost, now):
+    """Refill a (tokens, stamp, full_at) bucket up to `now` and try to
+    take `cost`.
+
+    Returns (tokens_left, allowed, retry_after).
+    """
+
+    if bucket is None:
+        tokens = rule.burst
+    else:
+        tokens, stamp, _ = bucket
+        tokens = min(rule.burst, tokens + (now - stamp) * rule.rate)
+
+    if tokens >= cost:
+        return tokens - cost, True, 0
+
+    return tokens, False, (cost - tokens) / rule.rate
+
+
+class RateLimiter:
+    """Throttle configured endpoints per client IP and per logged-in user.
+
+    Configuration (app.config):
+
+    - RATELIMIT_ENABLED: turn the limiter on/off (default True)
+    - RATELIMIT_RULES: endpoint name -> rule string; merged over
+      DEFAULT_RULES, a value of None disables the rule for that endpoint
+    - RATELIMIT_METHODS: HTTP methods that are throttled (default POST
+      only, so viewing the login form is never limited)
+    - RATELIMIT_SESSION_KEY: session key holding the logged-in user's id
+    - RATELIMIT_TRUSTED_PROXIES: how many proxies in front of the app
+      append to X-Forwarded-For (default 0: use the socket's address).
+      Behind the Heroku router this is 1; set it no higher than the real
+      number, or clients can pick their own bucket by sending the header.
+    """
+
+    def __init__(self, app=None, store=None):
+        self.store = store or MemoryStore()
+        self.rules = {}
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Register the limiter on a Flask app."""
+
+        app.config.setdefault('RATELIMIT_ENABLED', True)
+        app.config.setdefault('RATELIMIT_RULES', {})
+        app.config.setdefault('RATELIMIT_METHODS', {'POST'})
+        app.config.setdefault('RATELIMIT_SESSION_KEY', "curr_user")
+        app.config.setdefault('RATELIMIT_TRUSTED_PROXIES', 0)
+
+        rules = {**DEFAULT_RULES, **app.config['RATELIMIT_RULES']}
+        self.rules = {
+            endpoint: Rule.parse(spec)
+            for endpoint, spec in rules.items()
+            if spec is not None
+        }
+
+        app.before_request(self.check_request)
+
+    def keys_for_request(self, app_config):
+        """Bucket keys for the current request: always the client IP, plus
+        the user id when someone is logged in."""
+
+        keys = [f"ip:{client_ip(app_config['RATELIMIT_TRUSTED_PROXIES'])}"]
+        user_id = session.get(app_config['RATELIMIT_SESSION_KEY'])
+        if user_id is not None:
+            keys.append(f"user:{user_id}")
+
+        return keys
+
+    def check_request(self):
+        """before_request hook: raise 429 if any bucket for this request is
+        empty."""
+
+        config = current_app.config
+        if not config['RATELIMIT_ENABLED']:
+            return
+
+        if request.method not in config['RATELIMIT_METHODS']:
+            return
+
+        rule = self.rules.get(request.endpoint)
+        if rule is None:
+            return
+
+        for key in self.keys_for_request(config):
+            allowed, retry_after = self.store.consume(
+                f"{request.endpoint}:{key}", rule)
+            if not allowed:
+                raise TooManyRequests(retry_after=max(1, ceil(retry_after)))
@@ -0,0 +1,97 @@
+"""Template rendering pipeline.
+
+In development templates are loaded lazily and re-read when they change on
+disk. In production mode:
+
+- compiled templates are kept in a persistent bytecode cache, so a fresh
+  worker unmarshals code objects instead of re-parsing every template
+- every template is compiled once at startup instead of on first request
+- templates are never re-checked for changes on disk
+- block tags don't leave blank lines and indentation behind
+- large pages can be streamed, so the first bytes go out before the whole
+  feed has rendered
+"""
+
+import os
+
+from flask import (
+    Response, current_app, render_template, stream_with_context)
+from jinja2 import FileSystemBytecodeCache
+
+
+class TemplatePipeline:
+    """Configure the app's Jinja environment for the current mode.
+
+    Configuration (app.config):
+
+    - TEMPLATE_PRODUCTION: enable production rendering (default False)
+    - TEMPLATE_BYTECODE_CACHE_DIR: where compiled templates are kept
+    - TEMPLATE_STREAMING: stream pages rendered with render_page()
+      (default False)
+    - TEMPLATE_STREAM_BUFFER: number of template chunks to collect before
+      each write while streaming (default 16)
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Set up the Jinja environment and, in production, precompile."""
+
+        app.config.setdefault('TEMPLATE_PRODUCTION', False)
+        app.config.setdefault(
+            'TEMPLATE_BYTECODE_CACHE_DIR',
+            os.path.join(app.instance_path, "jinja-cache"))
+        app.config.setdefault('TEMPLATE_STREAMING', False)
+        app.config.setdefault('TEMPLATE_STREAM_BUFFER', 16)
+
+        if not app.config['TEMPLATE_PRODUCTION']:
+            return
+
+        cache_dir = app.config['TEMPLATE_BYTECODE_CACHE_DIR']
+        os.makedirs(cache_dir, exist_ok=True)
+
+        env = app.jinja_env
+        env.bytecode_cache = FileSystemBytecodeCache(cache_dir)
+        env.auto_reload = False
+        env.trim_blocks = True
+        env.lstrip_blocks = True
+        # Templates compiled with the old settings must not be reused.
+        env.cache.clear()
+
+        precompile(app)
+
+
+def precompile(app):
+    """Load every template so it is compiled (or read from the bytecode
+    cache) now rather than during a request. Returns the number of
+    templates loaded."""
+
+    env = app.jinja_env
+    names = env.list_templates(extensions=["html"])
+
+    for name in names:
+        env.get_template(name)
+
+    return len(names)
+
+
+def render_page(template_name, **context):
+    """Render a template, streaming it when TEMPLATE_STREAMING is on.
+
+    Use this instead of render_template for long pages like feeds.
+    """
+
+    app = current_app._get_current_object()
+
+    if not app.config['TEMPLATE_STREAMING']:
+        return render_template(template_name, **context)
+
+    template = app.jinja_env.get_template(template_name)
+    app.update_template_context(context)
+
+    stream = template.stream(context)
+    stream.enable_buffering(app.config['TEMPLATE_STREAM_BUFFER'])
+
+    return Response(stream_with_context(stream), mimetype="text/html")
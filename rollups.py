@@ -0,0 +1,341 @@
+"""Daily activity rollups per user, and the admin stats built on them.
+
+The write paths record each post, like, unlike, follow and unfollow here;
+every ROLLUPS_WINDOW seconds the pending deltas are added to
+daily_user_stats, one row per (UTC day, user), with a single upsert. The
+admin stats page reads only that table (and users, for names), so "posts
+per day" or "most liked this week" never scan messages or likes.
+
+Likes are net: an unlike takes back the like. Deleted messages still
+count as posted that day.
+
+`flask rollups backfill` rebuilds the table from existing data, one chunk
+of ids at a time, with each chunk grouped in SQL. Likes and follows carry
+no timestamps, so a backfilled like counts on the liked message's day,
+and a follow counts as gained on the day of the backfill. Unfollows
+before the backfill are gone for good. Run it while writes are quiet:
+activity flushed during the run may be counted twice.
+"""
+
+import atexit
+import os
+import threading
+from datetime import date, datetime, timedelta
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import delete, func, select
+
+from models import (db, dialect_insert, DailyUserStats, Follows, Like,
+                    Message, User)
+
+COUNTERS = ('posts', 'likes_given', 'likes_received', 'follows_gained',
+            'follows_lost')
+
+
+class Rollups:
+    """Keep daily_user_stats up to date from the write paths.
+
+    Configuration (app.config):
+
+    - ROLLUPS_ENABLED: record activity (default True)
+    - ROLLUPS_WINDOW: seconds between background flushes (default 5); 0
+      starts no flusher, leaving it to explicit flush() calls
+    - ROLLUPS_MAX_PENDING: flush early once this many (day, user) rows
+      are pending (default 1000)
+    - ROLLUPS_BACKFILL_CHUNK: ids per backfill pass (default 10000)
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.enabled = False
+        # (day, user_id) -> {counter: delta}
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._flusher = None
+        self._stop = threading.Event()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('ROLLUPS_ENABLED', True)
+        app.config.setdefault('ROLLUPS_WINDOW', 5.0)
+        app.config.setdefault('ROLLUPS_MAX_PENDING', 1000)
+        app.config.setdefault('ROLLUPS_BACKFILL_CHUNK', 10000)
+
+        self.app = app
+        self.enabled = app.config['ROLLUPS_ENABLED']
+
+        app.cli.add_command(rollups_cli)
+
+        if self.enabled and app.config['ROLLUPS_WINDOW']:
+            app.before_request(self.ensure_flusher)
+            atexit.register(self.close)
+            os.register_at_fork(after_in_child=self._after_fork)
+
+    ##########################################################################
+    # Recording
+
+    def record(self, user_id, now=None, **deltas):
+        """Add `deltas` (counter=n) to `user_id`'s row for today."""
+
+        if not self.enabled:
+            return
+
+        key = ((now or datetime.utcnow()).date(), user_id)
+        with self._lock:
+            pending = self._pending.setdefault(key, {})
+            for name, delta in deltas.items():
+                pending[name] = pending.get(name, 0) + delta
+            full = (len(self._pending)
+                    >= self.app.config['ROLLUPS_MAX_PENDING'])
+
+        if full:
+            self.flush()
+
+    def posted(self, user_id, now=None):
+        self.record(user_id, now, posts=1)
+
+    def liked(self, user_id, author_id, liked=True, now=None):
+        """`user_id` liked (or, with liked=False, unliked) a message by
+        `author_id`."""
+
+        delta = 1 if liked else -1
+        self.record(user_id, now, likes_given=delta)
+        self.record(author_id, now, likes_received=delta)
+
+    def followed(self, user_id, following=True, now=None):
+        """Someone followed (or stopped following) `user_id`."""
+
+        if following:
+            self.record(user_id, now, follows_gained=1)
+        else:
+            self.record(user_id, now, follows_lost=1)
+
+    ##########################################################################
+    # Flushing
+
+    def flush(self, conn=None):
+        """Add all pending deltas, on `conn` or in a transaction of our
+        own. Returns the number of rows written."""
+
+        with self._lock:
+            if not self._pending:
+                return 0
+            batch, self._pending = self._pending, {}
+
+        try:
+            if conn is None:
+                with db.get_engine(self.app).begin() as conn:
+                    _add(conn, _rows(batch))
+            else:
+                _add(conn, _rows(batch))
+        except Exception:
+            with self._lock:
+                for key, deltas in batch.items():
+                    pending = self._pending.setdefault(key, {})
+                    for name, delta in deltas.items():
+                        pending[name] = pending.get(name, 0) + delta
+            raise
+
+        return len(batch)
+
+    def ensure_flusher(self):
+        """before_request: start flushing in the process that serves the
+        request, never in a preloading gunicorn master."""
+
+        if self._flusher is None:
+            with self._lock:
+                if self._flusher is None:
+                    self._start_flusher()
+
+    def _start_flusher(self):
+        """Flush every ROLLUPS_WINDOW seconds on a daemon thread."""
+
+        window = self.app.config['ROLLUPS_WINDOW']
+
+        def run():
+            while not self._stop.wait(window):
+                try:
+                    self.flush()
+                except Exception:
+                    self.app.logger.exception("rollups flush failed")
+
+        self._flusher = threading.Thread(
+            target=run, name="rollups", daemon=True)
+        self._flusher.start()
+
+    def _after_fork(self):
+        """In a forked worker, drop the parent's deltas and flusher; the
+        worker's first request starts its own."""
+
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._pending = {}
+        self._flusher = None
+
+    def close(self):
+        """Stop the background flusher and flush what's left."""
+
+        if self._flusher is None:
+            return
+
+        self._stop.set()
+        try:
+            self.flush()
+        except Exception:
+            self.app.logger.exception("final rollups flush failed")
+
+
+def _rows(batch):
+    return [{'day': day, 'user_id': user_id,
+             **{name: deltas.get(name, 0) for name in COUNTERS}}
+            for (day, user_id), deltas in batch.items()]
+
+
+def _add(conn, rows):
+    """Add rows of counter deltas into daily_user_stats. Rows for users
+    deleted since are dropped."""
+
+    live = set(conn.execute(
+        select(User.id).where(User.id.in_({row['user_id'] for row in rows})))
+        .scalars())
+    rows = [row for row in rows if row['user_id'] in live]
+    if not rows:
+        return
+
+    table = DailyUserStats.__table__
+    stmt = dialect_insert(conn, table)
+    conn.execute(
+        stmt.on_conflict_do_update(
+            index_elements=['day', 'user_id'],
+            set_={name: table.c[name] + stmt.excluded[name]
+                  for name in COUNTERS}),
+        rows)
+
+
+##############################################################################
+# Stats
+
+
+def daily_totals(days, today=None):
+    """Site-wide counters for each of the last `days` days, oldest first,
+    as (day, {counter: total}); days without activity are zeros."""
+
+    today = today or datetime.utcnow().date()
+    first = today - timedelta(days=days - 1)
+
+    totals = {
+        _as_date(day): dict(zip(COUNTERS, sums))
+        for day, *sums in db.session.execute(
+            select(DailyUserStats.day,
+                   *(func.sum(DailyUserStats.__table__.c[name])
+                     for name in COUNTERS))
+            .where(DailyUserStats.day >= first)
+            .group_by(DailyUserStats.day))
+    }
+    zeros = dict.fromkeys(COUNTERS, 0)
+
+    return [(day, totals.get(day, zeros))
+            for day in (first + timedelta(days=i) for i in range(days))]
+
+
+def top_users(counter, days, limit=10, today=None):
+    """(user id, username, total) for the users with the highest
+    `counter` over the last `days` days."""
+
+    today = today or datetime.utcnow().date()
+    total = func.sum(DailyUserStats.__table__.c[counter]).label('total')
+
+    return db.session.execute(
+        select(User.id, User.username, total)
+        .join(User, User.id == DailyUserStats.user_id)
+        .where(DailyUserStats.day > today - timedelta(days=days))
+        .group_by(User.id, User.username)
+        .having(total > 0)
+        .order_by(total.desc(), User.id)
+        .limit(limit)).all()
+
+
+def _as_date(value):
+    """SQLite's date() gives strings; PostgreSQL's gives dates."""
+
+    return date.fromisoformat(value) if isinstance(value, str) else value
+
+
+##############################################################################
+# Backfill
+
+
+def _chunks(conn, column, size):
+    """(low, high) id ranges of `size` covering `column`'s values."""
+
+    low, high = conn.execute(select(func.min(column), func.max(column))).one()
+    if low is None:
+        return
+    for start in range(low, high + 1, size):
+        yield start, start + size - 1
+
+
+def backfill(conn, chunk_size, today=None):
+    """Rebuild daily_user_stats from messages, likes and follows. Returns
+    the number of rows written."""
+
+    today = today or datetime.utcnow().date()
+    conn.execute(delete(DailyUserStats))
+
+    day = func.date(Message.timestamp)
+    written = 0
+
+    def add(counter, grouped):
+        nonlocal written
+        rows = [{'day': _as_date(row_day), 'user_id': user_id,
+                 **dict.fromkeys(COUNTERS, 0), counter: n}
+                for row_day, user_id, n in grouped]
+        if rows:
+            _add(conn, rows)
+            written += len(rows)
+
+    for low, high in _chunks(conn, Message.id, chunk_size):
+        in_chunk = Message.id.between(low, high)
+        add('posts', conn.execute(
+            select(day, Message.user_id, func.count())
+            .where(in_chunk)
+            .group_by(day, Message.user_id)))
+        add('likes_received', conn.execute(
+            select(day, Message.user_id, func.count())
+            .join(Like, Like.message_id == Message.id)
+            .where(in_chunk)
+            .group_by(day, Message.user_id)))
+        add('likes_given', conn.execute(
+            select(day, Like.user_id, func.count())
+            .join(Like, Like.message_id == Message.id)
+            .where(in_chunk)
+            .group_by(day, Like.user_id)))
+
+    followed = Follows.user_being_followed_id
+    for low, high in _chunks(conn, followed, chunk_size):
+        add('follows_gained', (
+            (today, user_id, n) for user_id, n in conn.execute(
+                select(followed, func.count())
+                .where(followed.between(low, high))
+                .group_by(followed))))
+
+    return written
+
+
+rollups_cli = AppGroup("rollups", help="Maintain the daily activity rollups.")
+
+
+@rollups_cli.command("backfill")
+@click.option("--chunk-size", type=int, default=None,
+              help="Ids per pass (default ROLLUPS_BACKFILL_CHUNK).")
+def backfill_command(chunk_size):
+    """Rebuild daily_user_stats from the raw tables."""
+
+    chunk_size = chunk_size or current_app.config['ROLLUPS_BACKFILL_CHUNK']
+    with db.engine.begin() as conn:
+        written = backfill(conn, chunk_size)
+    click.echo(f"Wrote {written} rollup rows.")
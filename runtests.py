@@ -0,0 +1,159 @@
+"""Run the test suite sharded across processes.
+
+    python runtests.py              # one worker per CPU
+    python runtests.py -j 4 test_user_views.py test_queries.py
+
+Each worker gets its own copy of the test database, so workers never see
+each other's rows. On PostgreSQL, the tables are built once in
+<name>_template and each worker's database is cloned from it with
+CREATE DATABASE ... TEMPLATE, which copies files instead of replaying the
+DDL. A SQLite file is copied the same way. In-memory SQLite isn't
+supported (see testing.py).
+
+Test files are dealt out to the workers biggest first, by how many tests
+they hold, and each worker runs its share with `python -m unittest`.
+"""
+
+import argparse
+import ast
+import glob
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+from sqlalchemy import create_engine, text
+from sqlalchemy.engine import make_url
+
+DEFAULT_URL = "postgresql:///warbler_test"
+
+
+def count_tests(path):
+    """How many test methods a file defines, without importing it."""
+
+    with open(path) as f:
+        tree = ast.parse(f.read(), path)
+
+    return sum(isinstance(node, ast.FunctionDef)
+               and node.name.startswith("test")
+               for node in ast.walk(tree))
+
+
+def deal(paths, workers):
+    """Split files into `workers` groups of about the same test count."""
+
+    groups = [[] for _ in range(workers)]
+    sizes = [0] * workers
+
+    for size, path in sorted(((count_tests(p), p) for p in paths),
+                             reverse=True):
+        i = sizes.index(min(sizes))
+        groups[i].append(path)
+        sizes[i] += size
+
+    return [group for group in groups if group]
+
+
+def build_template(url):
+    """Create the tables in a fresh template database (or file)."""
+
+    env = dict(os.environ, WARBLER_TEST_DATABASE_URL=url.render_as_string(
+        hide_password=False))
+    subprocess.run([sys.executable, "-c", "import testing"], env=env,
+                   check=True)
+
+
+def worker_urls(url, workers):
+    """Make one database per worker, cloned from a template; return their
+    URLs and a function that drops them again."""
+
+    url = make_url(url)
+
+    if url.get_backend_name() == "sqlite":
+        root, ext = os.path.splitext(url.database)
+        template = f"{root}_template{ext}"
+        if os.path.exists(template):
+            os.remove(template)
+        build_template(url.set(database=template))
+
+        paths = [f"{root}_{i}{ext}" for i in range(workers)]
+        for path in paths:
+            shutil.copyfile(template, path)
+
+        def drop():
+            for path in paths + [template]:
+                os.remove(path)
+
+        return [url.set(database=path) for path in paths], drop
+
+    template = f"{url.database}_template"
+    names = [f"{url.database}_{i}" for i in range(workers)]
+    engine = create_engine(url.set(database="postgres"),
+                           isolation_level="AUTOCOMMIT")
+
+    def drop(*databases):
+        with engine.connect() as conn:
+            for name in databases:
+                conn.execute(text(f'DROP DATABASE IF EXISTS "{name}"'))
+
+    drop(template, *names)
+    with engine.connect() as conn:
+        conn.execute(text(f'CREATE DATABASE "{template}"'))
+    build_template(url.set(database=template))
+    with engine.connect() as conn:
+        for name in names:
+            conn.execute(text(
+                f'CREATE DATABASE "{name}" TEMPLATE "{template}"'))
+
+    return ([url.set(database=name) for name in names],
+            lambda: drop(template, *names))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(),
+                        help="worker processes (default: one per CPU)")
+    parser.add_argument("files", nargs="*",
+                        help="test files (default: test_*.py)")
+    args = parser.parse_args(argv)
+
+    paths = args.files or sorted(glob.glob("test_*.py"))
+    groups = deal(paths, max(1, args.jobs))
+    url = os.environ.get('WARBLER_TEST_DATABASE_URL', DEFAULT_URL)
+    if (make_url(url).get_backend_name() == "sqlite"
+            and make_url(url).database in (None, "", ":memory:")):
+        parser.error("in-memory SQLite isn't supported; use a file")
+
+    start = time.perf_counter()
+    urls, drop = worker_urls(url, len(groups))
+
+    try:
+        workers = []
+        for group, worker_url in zip(groups, urls):
+            env = dict(os.environ,
+                       WARBLER_TEST_DATABASE_URL=worker_url.render_as_string(
+                           hide_password=False))
+            modules = [os.path.splitext(path)[0] for path in group]
+            workers.append(subprocess.Popen(
+                [sys.executable, "-m", "unittest", *modules], env=env,
+                stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True))
+
+        failed = []
+        for i, (group, worker) in enumerate(zip(groups, workers)):
+            output, _ = worker.communicate()
+            if worker.returncode:
+                failed.append(i)
+                print(f"--- worker {i}: {' '.join(group)}")
+                print(output)
+    finally:
+        drop()
+
+    print(f"{len(paths)} files in {len(groups)} workers, "
+          f"{time.perf_counter() - start:.1f}s: "
+          f"{'FAILED' if failed else 'OK'}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,202 @@
+"""Encoding for the /api/v1 endpoints.
+
+Rows from queries.py become plain dicts of just the fields the client
+asked for with `?fields=` (e.g. `?fields=id,text,user.username`), and are
+encoded with orjson, or with MessagePack when the client prefers
+application/msgpack and msgpack is installed. Lists are paged by keyset:
+a page carries an opaque `next_cursor` naming its last item, and the next
+page starts after it, so deep pages cost the same as the first.
+"""
+
+import base64
+import binascii
+from datetime import datetime
+
+import orjson
+from flask import current_app, request
+from werkzeug.exceptions import BadRequest
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+JSON = "application/json"
+MSGPACK = "application/msgpack"
+
+USER_FIELDS = ('id', 'username', 'image_url', 'header_image_url', 'bio',
+               'location')
+# Profiles add the counts; each maps to the ProfileRow collection it
+# counts.
+PROFILE_COUNTS = {
+    'messages': 'messages',
+    'following': 'following',
+    'followers': 'followers',
+    'likes': 'liked_messages',
+}
+PROFILE_FIELDS = USER_FIELDS + tuple(PROFILE_COUNTS)
+MESSAGE_FIELDS = ('id', 'text', 'timestamp', 'liked', 'user')
+
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+
+##############################################################################
+# Fields
+
+
+def parse_fields(spec, fields, nested=None):
+    """The fields picked by a `?fields=` value, as {name: subfields}, where
+    subfields is None for all of a nested object's fields. An empty `spec`
+    picks all of `fields`. `nested` maps a field to the fields of the
+    object it holds."""
+
+    nested = nested or {}
+    if not spec:
+        return dict.fromkeys(fields)
+
+    picked = {}
+    for name in spec.split(","):
+        name = name.strip()
+        head, _, sub = name.partition(".")
+        if head not in fields or (sub and sub not in nested.get(head, ())):
+            raise BadRequest(f"Unknown field: {name}")
+
+        if not sub:
+            picked[head] = None
+        elif picked.get(head, ()) is not None:
+            picked.setdefault(head, []).append(sub)
+
+    return picked
+
+
+def requested_fields(fields, nested=None):
+    """parse_fields for this request's `?fields=`."""
+
+    return parse_fields(request.args.get('fields'), fields, nested)
+
+
+def dump_user(user, fields=None):
+    """Dict of a UserRow's (or User's) fields."""
+
+    return {name: getattr(user, name) for name in fields or USER_FIELDS}
+
+
+def dump_profile(profile, fields):
+    """Dict of a ProfileRow's fields, with counts as numbers."""
+
+    return {name: (len(getattr(profile, PROFILE_COUNTS[name]))
+                   if name in PROFILE_COUNTS else getattr(profile, name))
+            for name in fields}
+
+
+def dump_messages(messages, fields):
+    """Dicts of MessageRows' fields. Messages by the same author share one
+    author dict, as the rows share one UserRow."""
+
+    authors = {}
+    user_fields = fields.get('user')
+
+    def author(user):
+        dumped = authors.get(user.id)
+        if dumped is None:
+            dumped = authors[user.id] = dump_user(user, user_fields)
+        return dumped
+
+    return [{name: author(message.user) if name == 'user'
+             else getattr(message, name)
+             for name in fields}
+            for message in messages]
+
+
+##############################################################################
+# Cursors
+
+
+def encode_cursor(*values):
+    """An opaque, URL-safe cursor holding `values`."""
+
+    return (base64.urlsafe_b64encode(orjson.dumps(values))
+            .rstrip(b"=").decode())
+
+
+def decode_cursor(cursor, *types):
+    """The values of a cursor made by encode_cursor, checked against
+    `types`; raises BadRequest if it's malformed."""
+
+    try:
+        values = orjson.loads(
+            base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        if len(values) != len(types):
+            raise ValueError(cursor)
+        return tuple(
+            datetime.fromisoformat(value) if kind is datetime else kind(value)
+            for kind, value in zip(types, values))
+    except (binascii.Error, orjson.JSONDecodeError, TypeError, ValueError):
+        raise BadRequest("Bad cursor")
+
+
+def message_cursor(message):
+    return encode_cursor(message.timestamp.isoformat(), message.id)
+
+
+def user_cursor(user):
+    return encode_cursor(user.id)
+
+
+def page_size():
+    """This request's `?limit=`, clamped to 1..MAX_PAGE_SIZE."""
+
+    limit = request.args.get('limit', DEFAULT_PAGE_SIZE, type=int)
+    return max(1, min(limit, MAX_PAGE_SIZE))
+
+
+def page_after(kind):
+    """The position in this request's `?cursor=`, or None: a (timestamp,
+    id) pair for messages, an id for users."""
+
+    cursor = request.args.get('cursor')
+    if not cursor:
+        return None
+    if kind == 'message':
+        return decode_cursor(cursor, datetime, int)
+    return decode_cursor(cursor, int)[0]
+
+
+def page(rows, limit, cursor_of):
+    """Split `rows`, fetched with limit + 1, into this page's rows and the
+    cursor for the next page (None on the last page)."""
+
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    return rows, cursor_of(rows[-1])
+
+
+##############################################################################
+# Responses
+
+
+def _msgpack_default(obj):
+    if isinstance(obj, datetime):
+        return obj.isoformat()
+    raise TypeError(f"Can't encode {type(obj).__name__}")
+
+
+def api_response(payload, status=200, headers=None):
+    """Encode `payload` as JSON, or as MessagePack if the client prefers
+    it and it's available."""
+
+    if (msgpack is not None
+            and request.accept_mimetypes.best_match((JSON, MSGPACK))
+            == MSGPACK):
+        body = msgpack.packb(payload, default=_msgpack_default)
+        mimetype = MSGPACK
+    else:
+        body = orjson.dumps(payload)
+        mimetype = JSON
+
+    response = current_app.response_class(body, status=status,
+                                          headers=headers, mimetype=mimetype)
+    response.vary.add('Accept')
+    return response
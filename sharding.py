@@ -0,0 +1,827 @@
+"""User-id sharding of users, messages, likes and follows.
+
+With SHARDS set, each user's row, their messages, their likes and the
+follows they make live together on one of several databases. Which one
+goes by bucket: a user id's bucket is `user_id % SHARD_BUCKETS`, and the
+`shard_buckets` table in the app's own database (the directory) says
+which shard holds each bucket. Every process keeps a copy of that map for
+SHARD_MAP_TTL seconds, and reloads it as soon as the outbox broadcasts a
+change to it (see outbox.py).
+
+Sharding.session() returns a SQLAlchemy ShardedSession over the shards:
+
+- new rows go to their owner's shard: a User by its id, a Message or Like
+  by its user_id, a Follows row by its follower. Ids for new users and
+  messages come in blocks from `shard_sequences` in the directory, so
+  they're unique across shards;
+- session.get(User, id) asks only the user's shard; a message by id is
+  looked for on each shard in turn;
+- queries filtered by the owner column (User.id, Message.user_id,
+  Like.user_id or Follows.user_following_id) with == or IN go only to
+  those users' shards; any other query goes to every shard and the rows
+  are concatenated.
+
+Joins across owners don't work across shards: a follower's Follows row
+isn't where the followed user is, so the followers, following and
+liked_messages relationships can't be loaded through the session. Nor
+can foreign keys cross shards, so shards are created without those two
+(likes to messages, follows to the followed user); a message's likes and
+a user's followers are deleted with a bulk delete, which goes to every
+shard. Usernames and emails are unique per shard only.
+
+home_feed() is the feed read done shard-aware: it reads the user's
+follows from their shard, asks each shard holding any of those authors
+for its newest messages (in parallel, SHARD_SCATTER_THREADS at a time),
+merges them by (timestamp, id), then marks the ones the viewer liked
+from the viewer's shard. It returns the same MessageRows as
+queries.home_feed.
+
+The app's own database stays the one of record while the views move
+over. With SHARDS set, the views write every signup, profile edit,
+account deletion, message, like and follow to the shards too, through
+session() (save_user, save_message, set_like, ...). Those writes go
+first, so a frozen bucket refuses one before anything is committed.
+Likes and follows reach the shards at once, even while the write
+buffer holds them back from the app's database. The home page and the
+API feed read from the shards with home_feed(); every other page still
+reads the app's own database, and new rows take their ids from it.
+
+Moving a bucket (`flask shards move`, `flask shards rebalance`) happens
+while it's in use:
+
+1. copy the bucket's rows to the new shard, in batches, paced to
+   SHARD_MOVE_ROWS_PER_SECOND;
+2. freeze the bucket: writes to it get a 503 with Retry-After. Wait
+   SHARD_MAP_TTL, so every process has seen that;
+3. copy again, which catches up on what changed (users are upserted,
+   other rows are insert-or-skip), and delete from the new shard what
+   was deleted from the old one meanwhile;
+4. point the bucket at the new shard and unfreeze it; wait SHARD_MAP_TTL
+   again, so no process still reads the old shard;
+5. delete the bucket's rows from the old shard.
+
+Reads carry on throughout. Each pass scans the old shard's tables for
+the bucket's rows.
+
+`flask shards init` creates the shards' tables and the directory's map
+and sequences; `flask shards load` copies an existing single database's
+rows onto their shards. Shards must be separate databases from the app's
+own, which keeps the directory.
+"""
+
+import heapq
+import os
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import (and_, bindparam, create_engine, delete, event, func,
+                        inspect, MetaData, select, update)
+from sqlalchemy.ext.horizontal_shard import ShardedSession
+from sqlalchemy.sql import operators
+from sqlalchemy.sql.elements import BinaryExpression, BindParameter
+from sqlalchemy.sql.selectable import AliasedReturnsRows, Select
+from werkzeug.exceptions import ServiceUnavailable
+
+import queries
+from models import (db, dialect_insert, Follows, Like, Message, ShardBucket,
+                    ShardSequence, User)
+from outbox import invalidated
+from userdata import Throttle
+
+# Sharded tables, parents first, and the column naming each row's owner.
+OWNER_COLUMNS = {
+    'users': 'id',
+    'messages': 'user_id',
+    'likes': 'user_id',
+    'follows': 'user_following_id',
+}
+
+# Foreign keys whose other end is usually on another shard.
+CROSS_SHARD_KEYS = {('likes', 'message_id'),
+                    ('follows', 'user_being_followed_id')}
+
+
+class ShardMoving(ServiceUnavailable):
+    """A write to a bucket that's being moved."""
+
+    description = "This account is being moved; try again in a moment."
+
+
+def shard_metadata():
+    """The sharded tables, without the foreign keys that would cross
+    shards."""
+
+    metadata = MetaData()
+    for name in OWNER_COLUMNS:
+        table = db.metadata.tables[name].to_metadata(metadata)
+        for constraint in list(table.foreign_key_constraints):
+            if (name, constraint.column_keys[0]) in CROSS_SHARD_KEYS:
+                table.constraints.discard(constraint)
+                for fk in constraint.elements:
+                    fk.parent.foreign_keys.discard(fk)
+                    table.foreign_keys.discard(fk)
+    return metadata
+
+
+class Sharding:
+    """Route users' rows to shards by user id.
+
+    Configuration (app.config):
+
+    - SHARDS: {name: database URL}; empty leaves sharding off (default)
+    - SHARD_BUCKETS: buckets user ids are spread over; fixed once the
+      shards are initialised (default 256)
+    - SHARD_MAP_TTL: seconds a process trusts its copy of the bucket map,
+      and how long a move waits for every process to catch up (default 5)
+    - SHARD_ID_BLOCK: ids a process reserves at a time (default 100)
+    - SHARD_SCATTER_THREADS: shards queried at once (default 8)
+    - SHARD_MOVE_BATCH_SIZE: rows copied per batch (default 1000)
+    - SHARD_MOVE_ROWS_PER_SECOND: pace of a move (default 5000; 0 for
+      unthrottled)
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.enabled = False
+        self.engines = {}
+        self._lock = threading.Lock()
+        # bucket -> (shard, state)
+        self._map = {}
+        self._loaded_at = None
+        # table -> [next id, end of block]
+        self._blocks = {}
+        self._executor = None
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('SHARDS', {})
+        app.config.setdefault('SHARD_BUCKETS', 256)
+        app.config.setdefault('SHARD_MAP_TTL', 5)
+        app.config.setdefault('SHARD_ID_BLOCK', 100)
+        app.config.setdefault('SHARD_SCATTER_THREADS', 8)
+        app.config.setdefault('SHARD_MOVE_BATCH_SIZE', 1000)
+        app.config.setdefault('SHARD_MOVE_ROWS_PER_SECOND', 5000)
+
+        self.app = app
+        app.extensions['sharding'] = self
+        self.enabled = bool(app.config['SHARDS'])
+        self.engines = {name: create_engine(url)
+                        for name, url in app.config['SHARDS'].items()}
+
+        app.cli.add_command(shards_cli)
+
+        if self.enabled:
+            invalidated.connect(self._map_changed, weak=False)
+            os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self):
+        """In a new worker: no reserved ids (the parent may hand out the
+        same ones) and no threads. gunicorn.conf.py closes the shards'
+        pooled connections before forking."""
+
+        self._lock = threading.Lock()
+        self._blocks = {}
+        self._executor = None
+        self._loaded_at = None
+
+    ##########################################################################
+    # Bucket map
+
+    def bucket_for(self, user_id):
+        return user_id % self.app.config['SHARD_BUCKETS']
+
+    def shard_for(self, user_id):
+        """Name of the shard holding `user_id`'s rows."""
+
+        return self.bucket_map()[self.bucket_for(user_id)][0]
+
+    def bucket_map(self):
+        """{bucket: (shard, state)}, reloaded from the directory once
+        SHARD_MAP_TTL has passed or the outbox says it changed."""
+
+        with self._lock:
+            if (self._loaded_at is None
+                    or time.monotonic() - self._loaded_at
+                    >= self.app.config['SHARD_MAP_TTL']):
+                with db.get_engine(self.app).connect() as conn:
+                    self._map = {
+                        bucket: (shard, state)
+                        for bucket, shard, state in conn.execute(select(
+                            ShardBucket.bucket, ShardBucket.shard,
+                            ShardBucket.state))}
+                self._loaded_at = time.monotonic()
+            return self._map
+
+    def _map_changed(self, sender, tags):
+        if "shards" in tags:
+            with self._lock:
+                self._loaded_at = None
+
+    def check_writable(self, user_ids):
+        """Raise ShardMoving if any of these users' buckets is frozen."""
+
+        if not self.enabled:
+            return
+
+        bucket_map = self.bucket_map()
+        for user_id in user_ids:
+            if bucket_map[self.bucket_for(user_id)][1] == "frozen":
+                raise ShardMoving(retry_after=max(
+                    1, self.app.config['SHARD_MAP_TTL']))
+
+    ##########################################################################
+    # Ids
+
+    def next_id(self, table):
+        """A new id for `table` ("users" or "messages"), unique across
+        shards."""
+
+        with self._lock:
+            block = self._blocks.get(table)
+            if block is None or block[0] >= block[1]:
+                block = self._blocks[table] = self._reserve(table)
+            block[0] += 1
+            return block[0] - 1
+
+    def _reserve(self, table):
+        """Take the next SHARD_ID_BLOCK ids from the directory. The UPDATE
+        locks the row until commit, so two processes never get the same
+        block."""
+
+        size = self.app.config['SHARD_ID_BLOCK']
+        with db.get_engine(self.app).begin() as conn:
+            updated = conn.execute(
+                update(ShardSequence)
+                .where(ShardSequence.name == table)
+                .values(next_id=ShardSequence.next_id + size))
+            if not updated.rowcount:
+                raise RuntimeError("No shard sequences; run `flask shards "
+                                   "init` first.")
+            end = conn.execute(select(ShardSequence.next_id)
+                               .where(ShardSequence.name == table)).scalar()
+        return [end - size, end]
+
+    ##########################################################################
+    # Session routing
+
+    def session(self, **kwargs):
+        """A new ShardedSession over the shards. The caller closes it."""
+
+        session = ShardedSession(
+            shard_chooser=self._choose_for_instance,
+            id_chooser=self._choose_for_identity,
+            execute_chooser=self._choose_for_statement,
+            shards=self.engines, **kwargs)
+        event.listen(session, 'before_flush', self._before_flush)
+        return session
+
+    def _before_flush(self, session, flush_context, instances):
+        """Give new users and messages their ids, which decide their
+        shard, and refuse writes to frozen buckets."""
+
+        for obj in session.new:
+            if isinstance(obj, (User, Message)) and obj.id is None:
+                obj.id = self.next_id(obj.__tablename__)
+
+        self.check_writable({
+            _owner_id(obj) for obj in (*session.new, *session.dirty,
+                                       *session.deleted)
+            if isinstance(obj, (User, Message, Like, Follows))})
+
+    def _choose_for_instance(self, mapper, instance, clause=None, **kw):
+        if instance is not None:
+            return self.shard_for(_owner_id(instance))
+
+        user_ids = _owner_ids(clause, {}) if clause is not None else None
+        shards = {self.shard_for(user_id) for user_id in user_ids or ()}
+        if len(shards) != 1:
+            raise LookupError(
+                "Can't tell which shard this is for; filter on the owner's "
+                "user id or pass bind_arguments={'shard_id': ...}.")
+        return shards.pop()
+
+    def _choose_for_identity(self, query, ident):
+        mapper = inspect(query.column_descriptions[0]['entity'])
+        owner = OWNER_COLUMNS.get(mapper.local_table.name)
+        for column, value in zip(mapper.primary_key, ident):
+            if column.key == owner:
+                return [self.shard_for(value)]
+        # A message by id alone: it could be anywhere.
+        return list(self.engines)
+
+    def _choose_for_statement(self, orm_context):
+        user_ids = _statement_owner_ids(orm_context.statement,
+                                        orm_context.parameters or {})
+
+        if orm_context.is_update or orm_context.is_delete:
+            if user_ids:
+                self.check_writable(user_ids)
+            elif any(state == "frozen"
+                     for _, state in self.bucket_map().values()):
+                # It could touch any bucket, the frozen one included.
+                raise ShardMoving(retry_after=max(
+                    1, self.app.config['SHARD_MAP_TTL']))
+
+        if user_ids:
+            return sorted({self.shard_for(user_id) for user_id in user_ids})
+        return list(self.engines)
+
+    ##########################################################################
+    # Writes from the views
+    #
+    # Each commits on the shards, and does nothing without SHARDS.
+
+    def save_user(self, user):
+        """Write `user`'s row, new or edited. It must have its id."""
+
+        self._write(lambda session: session.merge(_detached_copy(user)))
+
+    def save_message(self, message):
+        """Write a new message. It must have its id."""
+
+        self._write(lambda session: session.merge(_detached_copy(message)))
+
+    def set_like(self, user_id, message_id, liked):
+        self._write(lambda session: _set_row(
+            session, Like, {'user_id': user_id, 'message_id': message_id},
+            liked))
+
+    def set_following(self, user_id, other_id, following):
+        self._write(lambda session: _set_row(
+            session, Follows, {'user_following_id': user_id,
+                               'user_being_followed_id': other_id},
+            following))
+
+    def delete_message(self, message_id, user_id):
+        """Delete `user_id`'s message and, from every shard, its likes."""
+
+        def work(session):
+            session.query(Message).filter(
+                Message.user_id == user_id, Message.id == message_id,
+            ).delete(synchronize_session=False)
+            session.query(Like).filter(
+                Like.message_id == message_id,
+            ).delete(synchronize_session=False)
+
+        self._write(work)
+
+    def delete_user(self, user_id):
+        """Delete a user. Their own rows go by cascade on their shard;
+        likes of their messages and follows of them, from every shard."""
+
+        def work(session):
+            message_ids = session.execute(
+                select(Message.id).where(Message.user_id == user_id)
+            ).scalars().all()
+            if message_ids:
+                session.query(Like).filter(
+                    Like.message_id.in_(message_ids),
+                ).delete(synchronize_session=False)
+            session.query(Follows).filter(
+                Follows.user_being_followed_id == user_id,
+            ).delete(synchronize_session=False)
+            session.query(User).filter(
+                User.id == user_id,
+            ).delete(synchronize_session=False)
+
+        self._write(work)
+
+    def _write(self, work):
+        """Run `work(session)` in a transaction on a new session."""
+
+        if not self.enabled:
+            return
+
+        with self.session() as session, session.begin():
+            work(session)
+
+    ##########################################################################
+    # Scatter-gather reads
+
+    def home_feed(self, user_id, limit=100, before=None):
+        """Like queries.home_feed, gathered from every shard holding the
+        user or anyone they follow."""
+
+        following_ids = self._on_shard(
+            self.shard_for(user_id),
+            queries.following_ids_select(user_id)).scalars().all()
+
+        authors = defaultdict(set)
+        for author_id in {user_id, *following_ids}:
+            authors[self.shard_for(author_id)].add(author_id)
+
+        # Each shard's newest `limit`, merged: newest first by
+        # (timestamp, id), the same order each shard sorted by.
+        per_shard = self._scatter({
+            shard: queries.feed_select(author_ids, None, limit, before)
+            for shard, author_ids in authors.items()})
+        newest = heapq.merge(*per_shard.values(), reverse=True,
+                             key=lambda row: (row.timestamp, row[0]))
+        messages = queries.message_rows_from(islice(newest, limit))
+
+        if messages:
+            liked = set(self._on_shard(
+                self.shard_for(user_id),
+                select(Like.message_id).where(
+                    Like.user_id == user_id,
+                    Like.message_id.in_([m.id for m in messages]))
+            ).scalars())
+            for message in messages:
+                message.liked = message.id in liked
+
+        return messages
+
+    def _on_shard(self, shard, stmt):
+        """Run `stmt` on one shard; a buffered result."""
+
+        with self.engines[shard].connect() as conn:
+            return conn.execute(stmt).freeze()()
+
+    def _scatter(self, stmts):
+        """{shard: rows} for {shard: SELECT}, run in parallel."""
+
+        if len(stmts) == 1:
+            ((shard, stmt),) = stmts.items()
+            return {shard: self._on_shard(shard, stmt).all()}
+
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    self.app.config['SHARD_SCATTER_THREADS'],
+                    thread_name_prefix="shard-scatter")
+            executor = self._executor
+
+        futures = {shard: executor.submit(self._on_shard, shard, stmt)
+                   for shard, stmt in stmts.items()}
+        return {shard: future.result().all()
+                for shard, future in futures.items()}
+
+    ##########################################################################
+    # Setting up
+
+    def init_shards(self):
+        """Create the shards' tables, and the bucket map and sequences if
+        the directory has none, spreading buckets evenly. Safe to run
+        again, e.g. after adding a shard; then rebalance."""
+
+        metadata = shard_metadata()
+        for engine in self.engines.values():
+            metadata.create_all(engine)
+
+        names = sorted(self.engines)
+        if not ShardBucket.query.first():
+            db.session.add_all(
+                ShardBucket(bucket=bucket, shard=names[bucket % len(names)])
+                for bucket in range(self.app.config['SHARD_BUCKETS']))
+
+        for table, model in (('users', User), ('messages', Message)):
+            if db.session.get(ShardSequence, table) is None:
+                highest = max(
+                    [self._on_shard(name, select(func.max(model.id)))
+                     .scalar() or 0 for name in names]
+                    + [db.session.execute(select(func.max(model.id)))
+                       .scalar() or 0])
+                db.session.add(ShardSequence(name=table,
+                                             next_id=highest + 1))
+
+        db.session.commit()
+
+    def load(self, source):
+        """Copy every bucket's rows from `source`, an engine on the
+        unsharded database, to the shard the map gives it."""
+
+        for bucket, (shard, _) in sorted(self.bucket_map().items()):
+            self._copy(bucket, source, self.engines[shard])
+
+    ##########################################################################
+    # Moving buckets
+
+    def plan_rebalance(self):
+        """[(bucket, from shard, to shard)] that leave every shard with
+        the same number of buckets, give or take one."""
+
+        by_shard = {name: [] for name in self.engines}
+        for bucket, (shard, _) in sorted(self.bucket_map().items()):
+            by_shard[shard].append(bucket)
+
+        total = sum(map(len, by_shard.values()))
+        names = sorted(by_shard, key=lambda name: -len(by_shard[name]))
+        # The fullest shards keep the remainder.
+        quota = {name: total // len(names) + (i < total % len(names))
+                 for i, name in enumerate(names)}
+
+        surplus = [(bucket, name) for name in names
+                   for bucket in by_shard[name][quota[name]:]]
+        moves = []
+        for name in names:
+            for _ in range(quota[name] - len(by_shard[name])):
+                bucket, source = surplus.pop()
+                moves.append((bucket, source, name))
+        return sorted(moves)
+
+    def move_bucket(self, bucket, target, log=None):
+        """Move one bucket's rows to shard `target` while it's in use
+        (see the module docstring for the steps)."""
+
+        log = log or (lambda message: None)
+        row = db.session.get(ShardBucket, bucket)
+        source = row.shard
+        if source == target:
+            return
+        source_engine = self.engines[source]
+        target_engine = self.engines[target]
+        grace = self.app.config['SHARD_MAP_TTL']
+
+        moved = False
+        try:
+            log(f"bucket {bucket}: copying {source} -> {target}")
+            self._copy(bucket, source_engine, target_engine)
+
+            log(f"bucket {bucket}: frozen, catching up")
+            self._set_bucket(row, state="frozen")
+            time.sleep(grace)
+            self._copy(bucket, source_engine, target_engine)
+            self._prune(bucket, source_engine, target_engine)
+            self._set_bucket(row, shard=target, state="active")
+            moved = True
+        finally:
+            if not moved:
+                # Back as it was: unfrozen, and nothing left behind on the
+                # target for queries across every shard to find.
+                db.session.rollback()
+                self._set_bucket(row, state="active")
+                self._clear(bucket, target_engine)
+
+        log(f"bucket {bucket}: moved, clearing {source}")
+        time.sleep(grace)
+        self._clear(bucket, source_engine)
+
+    def _set_bucket(self, row, **values):
+        """Update the bucket's row; the outbox tells every process."""
+
+        for key, value in values.items():
+            setattr(row, key, value)
+        db.session.commit()
+        with self._lock:
+            self._loaded_at = None
+
+    def _clear(self, bucket, engine):
+        """Delete the bucket's rows from one shard, children first."""
+
+        with engine.begin() as conn:
+            for name in reversed(list(OWNER_COLUMNS)):
+                conn.execute(delete(db.metadata.tables[name])
+                             .where(self._in_bucket(name, bucket)))
+
+    def _in_bucket(self, name, bucket):
+        column = db.metadata.tables[name].c[OWNER_COLUMNS[name]]
+        return column % self.app.config['SHARD_BUCKETS'] == bucket
+
+    def _bucket_rows(self, conn, name, bucket, columns=None):
+        """The bucket's rows of table `name` in primary key order, a
+        batch at a time, from a server-side cursor."""
+
+        table = db.metadata.tables[name]
+        stmt = (select(*(columns or table.columns))
+                .where(self._in_bucket(name, bucket))
+                .order_by(*table.primary_key.columns))
+        return (conn.execution_options(stream_results=True).execute(stmt)
+                .partitions(self.app.config['SHARD_MOVE_BATCH_SIZE']))
+
+    def _copy(self, bucket, source, target):
+        """Copy the bucket's rows, parents first. Users are upserted, so a
+        second pass picks up profile edits; other rows never change, so
+        rows already there are skipped."""
+
+        throttle = Throttle(self.app.config['SHARD_MOVE_ROWS_PER_SECOND'])
+        for name in OWNER_COLUMNS:
+            table = db.metadata.tables[name]
+            with source.connect() as src, src.begin():
+                for rows in self._bucket_rows(src, name, bucket):
+                    with target.begin() as dst:
+                        stmt = dialect_insert(dst, table)
+                        if name == 'users':
+                            stmt = stmt.on_conflict_do_update(
+                                index_elements=['id'],
+                                set_={column.name: stmt.excluded[column.name]
+                                      for column in table.columns
+                                      if column.name != 'id'})
+                        else:
+                            stmt = stmt.on_conflict_do_nothing()
+                        dst.execute(stmt, [dict(row._mapping)
+                                           for row in rows])
+                    throttle(len(rows))
+
+    def _prune(self, bucket, source, target):
+        """Delete the bucket's rows that `target` has and `source` no
+        longer does, children first. Walks both sides in key order; only
+        the rows deleted since the first copy are held in memory."""
+
+        for name in reversed(list(OWNER_COLUMNS)):
+            table = db.metadata.tables[name]
+            keys = list(table.primary_key.columns)
+
+            with source.connect() as src, src.begin(), \
+                    target.connect() as dst, dst.begin():
+                stale = list(_only_in(
+                    _keys(self._bucket_rows(dst, name, bucket, keys)),
+                    _keys(self._bucket_rows(src, name, bucket, keys))))
+
+            if stale:
+                with target.begin() as conn:
+                    conn.execute(
+                        delete(table).where(and_(*(
+                            column == bindparam(f"key_{column.name}")
+                            for column in keys))),
+                        [{f"key_{column.name}": value
+                          for column, value in zip(keys, key)}
+                         for key in stale])
+
+
+##############################################################################
+# Helpers
+
+
+def _owner_id(obj):
+    """The user id that decides `obj`'s shard."""
+
+    if isinstance(obj, User):
+        return obj.id
+    if isinstance(obj, Follows):
+        return obj.user_following_id
+    if obj.user_id is None and getattr(obj, 'user', None) is not None:
+        return obj.user.id
+    return obj.user_id
+
+
+def _detached_copy(obj):
+    """A new instance with `obj`'s column values, for session.merge()."""
+
+    mapper = inspect(obj).mapper
+    return mapper.class_(**{attr.key: getattr(obj, attr.key)
+                            for attr in mapper.column_attrs})
+
+
+def _set_row(session, model, key, present):
+    """Add or delete the row with primary key `key` ({column: value}), as
+    `present` says; if it's already so, nothing."""
+
+    row = session.get(model, tuple(
+        key[column.key] for column in inspect(model).primary_key))
+    if present and row is None:
+        session.add(model(**key))
+    elif not present and row is not None:
+        session.delete(row)
+
+
+def _statement_owner_ids(statement, params):
+    """_owner_ids for a statement's WHERE clause or, failing that, a
+    subquery it selects from (as Query.count() makes)."""
+
+    while isinstance(statement, AliasedReturnsRows):
+        statement = statement.element
+
+    user_ids = _owner_ids(getattr(statement, 'whereclause', None), params)
+    if user_ids is None and isinstance(statement, Select):
+        for from_ in statement.get_final_froms():
+            user_ids = _statement_owner_ids(from_, params)
+            if user_ids is not None:
+                break
+    return user_ids
+
+
+def _owner_ids(where, params):
+    """User ids a WHERE clause limits rows to, by == or IN on an owner
+    column ANDed with the rest; None if it doesn't."""
+
+    if where is None:
+        return None
+
+    conjuncts = (where.clauses if getattr(where, 'operator', None)
+                 is operators.and_ else [where])
+    for clause in conjuncts:
+        if not (isinstance(clause, BinaryExpression)
+                and isinstance(clause.right, BindParameter)
+                and _is_owner_column(clause.left)):
+            continue
+
+        bind = clause.right
+        value = params.get(bind.key, bind.effective_value)
+        if value is None:
+            continue
+        if clause.operator is operators.eq:
+            return {value}
+        if clause.operator is operators.in_op:
+            return set(value)
+
+    return None
+
+
+def _is_owner_column(column):
+    table = getattr(column, 'table', None)
+    name = getattr(table, 'name', None)
+    return (name in OWNER_COLUMNS
+            and table is db.metadata.tables[name]
+            and column.key == OWNER_COLUMNS[name])
+
+
+def _keys(partitions):
+    for rows in partitions:
+        for row in rows:
+            yield tuple(row)
+
+
+def _only_in(ours, theirs):
+    """Keys in sorted iterable `ours` but not in sorted `theirs`."""
+
+    theirs = iter(theirs)
+    other = next(theirs, None)
+    for key in ours:
+        while other is not None and other < key:
+            other = next(theirs, None)
+        if key != other:
+            yield key
+
+
+##############################################################################
+# CLI
+
+
+shards_cli = AppGroup("shards", help="Set up and rebalance shards.")
+
+
+def _sharding():
+    sharding = current_app.extensions.get('sharding')
+    if sharding is None or not sharding.enabled:
+        raise click.ClickException("Set SHARDS first.")
+    return sharding
+
+
+@shards_cli.command("init")
+def init_command():
+    """Create the shards' tables, bucket map and id sequences."""
+
+    _sharding().init_shards()
+    click.echo("Shards ready.")
+
+
+@shards_cli.command("load")
+def load_command():
+    """Copy the app's own database's users, messages, likes and follows
+    onto their shards."""
+
+    _sharding().load(db.engine)
+    click.echo("Loaded.")
+
+
+@shards_cli.command("status")
+def status_command():
+    """Buckets and users per shard."""
+
+    sharding = _sharding()
+    buckets = defaultdict(int)
+    frozen = []
+    for bucket, (shard, state) in sharding.bucket_map().items():
+        buckets[shard] += 1
+        if state == "frozen":
+            frozen.append(bucket)
+
+    for name in sorted(sharding.engines):
+        users = sharding._on_shard(
+            name, select(func.count()).select_from(User)).scalar()
+        click.echo(f"{name}: {buckets[name]} buckets, {users} users")
+    if frozen:
+        click.echo(f"frozen: {', '.join(map(str, sorted(frozen)))}")
+
+
+@shards_cli.command("move")
+@click.argument("bucket", type=int)
+@click.argument("shard")
+def move_command(bucket, shard):
+    """Move one bucket to SHARD."""
+
+    sharding = _sharding()
+    if shard not in sharding.engines:
+        raise click.ClickException(f"No shard named {shard!r}.")
+    sharding.move_bucket(bucket, shard, log=click.echo)
+
+
+@shards_cli.command("rebalance")
+@click.option("--dry-run", is_flag=True, help="Only list the moves.")
+def rebalance_command(dry_run):
+    """Even out buckets across shards, one move at a time."""
+
+    sharding = _sharding()
+    for bucket, source, target in sharding.plan_rebalance():
+        if dry_run:
+            click.echo(f"bucket {bucket}: {source} -> {target}")
+        else:
+            sharding.move_bucket(bucket, target, log=click.echo)
@@ -0,0 +1,59 @@
+"""Per-key locks, so only one thread recomputes a missing cache entry
+while the others wait for it."""
+
+import threading
+
+
+class KeyedLocks:
+    """A lock per key, created on demand and dropped once nobody holds or
+    waits on it."""
+
+    def __init__(self):
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, key, timeout=-1):
+        """Take the lock for `key`. Returns False if `timeout` seconds
+        passed first."""
+
+        with self._lock:
+            entry = self._locks.get(key)
+            if entry is None:
+                entry = self._locks[key] = [threading.Lock(), 0]
+            entry[1] += 1
+
+        if entry[0].acquire(timeout=timeout):
+            return True
+
+        self._forget(key, entry)
+        return False
+
+    def release(self, key):
+        """Release the lock for `key` taken with acquire()."""
+
+        entry = self._locks[key]
+        entry[0].release()
+        self._forget(key, entry)
+
+    def _forget(self, key, entry):
+        with self._lock:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[key]
+
+    def __call__(self, key):
+        """Context manager holding the lock for `key`."""
+
+        return _Held(self, key)
+
+
+class _Held:
+    def __init__(self, locks, key):
+        self.locks = locks
+        self.key = key
+
+    def __enter__(self):
+        self.locks.acquire(self.key)
+
+    def __exit__(self, *exc):
+        self.locks.release(self.key)
@@ -0,0 +1,162 @@
+"""Admission control tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_admission.py
+
+
+import threading
+import time
+from unittest import TestCase
+
+from flask import Flask
+
+from admission import AUTH, FEED, AdmissionControl, LatencyLimit
+
+
+class LatencyLimitTestCase(TestCase):
+    """Test the latency-steered limit."""
+
+    def test_grows_under_target(self):
+        """A limit in use grows while latency stays under target."""
+
+        limit = LatencyLimit(initial=10, max_limit=50)
+        for _ in range(100):
+            limit.update(FEED, 0.05, int(limit.limit), target=0.5, now=100)
+
+        self.assertGreater(limit.limit, 15)
+
+    def test_idle_limit_stays(self):
+        """A limit that isn't being used doesn't grow."""
+
+        limit = LatencyLimit(initial=10)
+        for _ in range(50):
+            limit.update(FEED, 0.05, 1, target=0.5, now=100)
+
+        self.assertEqual(limit.limit, 10)
+
+    def test_cut_once_per_latency(self):
+        """Over target, the limit is cut once per average latency, and
+        never below the minimum."""
+
+        limit = LatencyLimit(initial=10, min_limit=2, backoff=0.5)
+        for _ in range(5):
+            limit.update(FEED, 1.0, 10, target=0.5, now=100)
+        self.assertEqual(limit.limit, 5)
+
+        limit.update(FEED, 1.0, 10, target=0.5, now=101)
+        limit.update(FEED, 1.0, 10, target=0.5, now=102)
+        self.assertEqual(limit.limit, 2)
+
+
+class AdmissionControlTestCase(TestCase):
+    """Test shedding in a Flask app."""
+
+    def setUp(self):
+        """A tiny app with a feed page that blocks until released and an
+        instant login page; two requests fit at once, one of them feed."""
+
+        app = Flask(__name__)
+        app.config['ADMISSION_ENABLED'] = True
+        app.config['ADMISSION_CLASSES'] = {'feed': FEED, 'login': AUTH}
+        app.config['ADMISSION_QUEUE_BUDGETS'] = {FEED: 0.2, AUTH: 2}
+        app.config['ADMISSION_SHARES'] = {FEED: 0.5, AUTH: 1.0}
+        app.config['ADMISSION_INITIAL_LIMIT'] = 2
+        app.config['ADMISSION_MIN_LIMIT'] = 2
+        app.config['ADMISSION_METRICS_TOKEN'] = "secret"
+
+        self.release = threading.Event()
+        self.entered = threading.Event()
+
+        @app.route('/feed')
+        def feed():
+            self.entered.set()
+            self.release.wait(5)
+            return "feed"
+
+        @app.route('/login')
+        def login():
+            return "login"
+
+        self.admission = AdmissionControl(app)
+        self.app = app
+
+    def tearDown(self):
+        self.release.set()
+
+    def get_in_thread(self, url, results):
+        thread = threading.Thread(
+            target=lambda: results.append(
+                self.app.test_client().get(url).status_code))
+        thread.start()
+        return thread
+
+    def test_sheds_feed_keeps_login(self):
+        """With the feed's share in use, another feed request is shed once
+        its budget runs out, while login still gets in."""
+
+        results = []
+        first = self.get_in_thread('/feed', results)
+        self.entered.wait(5)
+
+        client = self.app.test_client()
+        shed = client.get('/feed')
+        self.assertEqual(shed.status_code, 503)
+        self.assertEqual(shed.headers['Retry-After'], "5")
+        self.assertEqual(client.get('/login').status_code, 200)
+
+        self.release.set()
+        first.join()
+        self.assertEqual(results, [200])
+
+        stats = self.admission.metrics()['classes']
+        self.assertEqual((stats[FEED]['admitted'], stats[FEED]['shed_limit']),
+                         (1, 1))
+        self.assertEqual(stats[AUTH]['admitted'], 1)
+        self.assertEqual(stats[FEED]['in_flight'], 0)
+
+    def test_waiting_request_gets_freed_slot(self):
+        """A request within its budget waits for a slot rather than being
+        shed."""
+
+        self.app.config['ADMISSION_QUEUE_BUDGETS'] = {FEED: 2, AUTH: 2}
+
+        results = []
+        first = self.get_in_thread('/feed', results)
+        self.entered.wait(5)
+        second = self.get_in_thread('/feed', results)
+
+        time.sleep(0.1)
+        self.release.set()
+        first.join()
+        second.join()
+
+        self.assertEqual(results, [200, 200])
+
+    def test_backlog_wait_sheds(self):
+        """A request that sat in the backlog past its budget is shed
+        without running."""
+
+        started_ms = int((time.time() - 1) * 1000)
+        resp = self.app.test_client().get(
+            '/feed', headers={'X-Request-Start': f"t={started_ms}"})
+
+        self.assertEqual(resp.status_code, 503)
+        self.assertFalse(self.entered.is_set())
+        self.assertEqual(
+            self.admission.metrics()['classes'][FEED]['shed_queue'], 1)
+
+    def test_metrics_need_token(self):
+        """The metrics endpoint only answers the token's bearer."""
+
+        client = self.app.test_client()
+        client.get('/login')
+
+        self.assertEqual(client.get('/metrics/admission').status_code, 404)
+
+        resp = client.get('/metrics/admission',
+                          headers={'Authorization': "Bearer secret"})
+        text = resp.get_data(as_text=True)
+        self.assertIn('warbler_admission_admitted_total{class="auth"} 1',
+                      text)
+        self.assertIn("warbler_admission_limit", text)
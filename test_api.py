@@ -0,0 +1,199 @@
+"""JSON API tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_api.py
+
+
+from datetime import datetime, timedelta
+from unittest import TestCase, skipUnless
+
+from werkzeug.exceptions import BadRequest
+
+from testing import (DbTestCase, PASSWORD, make_follow, make_like,
+                     make_message, make_user)
+from models import Message
+import serializers
+from serializers import decode_cursor, encode_cursor, parse_fields
+
+
+class SerializersTestCase(TestCase):
+    """Test field selection and cursors."""
+
+    def test_parse_fields(self):
+        """Fields pick top-level names and nested ones with a dot; a whole
+        nested object wins over some of its fields."""
+
+        nested = {'user': ('id', 'username')}
+        fields = ('id', 'text', 'user')
+
+        self.assertEqual(parse_fields("", fields, nested),
+                         {'id': None, 'text': None, 'user': None})
+        self.assertEqual(parse_fields("id,user.username", fields, nested),
+                         {'id': None, 'user': ['username']})
+        self.assertEqual(parse_fields("user.id,user", fields, nested),
+                         {'user': None})
+
+        for spec in ("nope", "text.length", "user.password"):
+            with self.assertRaises(BadRequest):
+                parse_fields(spec, fields, nested)
+
+    def test_cursor_round_trip(self):
+        now = datetime(2024, 3, 15, 12, 0, 0, 123456)
+        cursor = encode_cursor(now.isoformat(), 7)
+
+        self.assertEqual(decode_cursor(cursor, datetime, int), (now, 7))
+        for bad in ("!!", encode_cursor(1), encode_cursor("x", "y")):
+            with self.assertRaises(BadRequest):
+                decode_cursor(bad, datetime, int)
+
+
+class ApiTestCase(DbTestCase):
+    """Test the /api/v1 endpoints."""
+
+    def setUp(self):
+        """Two users; the tester follows the other, who has five messages
+        a minute apart, and likes the oldest."""
+
+        super().setUp()
+
+        self.testuser = make_user("testuser")
+        self.other = make_user("other")
+        start = datetime(2024, 3, 15, 12, 0)
+        self.messages = [
+            make_message(self.other, f"message {i}",
+                         timestamp=start + timedelta(minutes=i))
+            for i in range(5)]
+        make_follow(self.testuser, self.other)
+        make_like(self.testuser, self.messages[0])
+
+    def test_feed_needs_login(self):
+        resp = self.client.get("/api/v1/feed")
+
+        self.assertEqual(resp.status_code, 401)
+        self.assertEqual(resp.json['error']['status'], 401)
+
+    def test_feed_pages(self):
+        """Pages follow each other by cursor, newest first, and the last
+        one has no cursor."""
+
+        self.login(self.testuser)
+
+        seen = []
+        url = "/api/v1/feed?limit=2"
+        while url:
+            body = self.client.get(url).json
+            seen.extend(message['id'] for message in body['data'])
+            url = (body['next_cursor']
+                   and f"/api/v1/feed?limit=2&cursor={body['next_cursor']}")
+
+        self.assertEqual(seen, [m.id for m in reversed(self.messages)])
+
+    def test_sparse_fields(self):
+        """Only the requested fields are sent."""
+
+        self.login(self.testuser)
+        resp = self.client.get(
+            "/api/v1/feed?limit=1&fields=id,user.username")
+
+        self.assertEqual(resp.json['data'],
+                         [{'id': self.messages[-1].id,
+                           'user': {'username': "other"}}])
+
+    def test_bad_requests(self):
+        self.login(self.testuser)
+
+        self.assertEqual(
+            self.client.get("/api/v1/feed?fields=password").status_code, 400)
+        self.assertEqual(
+            self.client.get("/api/v1/feed?cursor=nope").status_code, 400)
+
+    def test_profile(self):
+        """A profile has the user's card and counts."""
+
+        resp = self.client.get(f"/api/v1/users/{self.other.id}")
+
+        self.assertEqual(resp.json['username'], "other")
+        self.assertEqual((resp.json['messages'], resp.json['followers'],
+                          resp.json['following']), (5, 1, 0))
+        self.assertEqual(
+            self.client.get("/api/v1/users/0").status_code, 404)
+
+    def test_follows_and_likes(self):
+        self.login(self.testuser)
+
+        following = self.client.get(
+            f"/api/v1/users/{self.testuser.id}/following").json
+        followers = self.client.get(
+            f"/api/v1/users/{self.other.id}/followers").json
+        likes = self.client.get(
+            f"/api/v1/users/{self.testuser.id}/likes").json
+
+        self.assertEqual([u['username'] for u in following['data']],
+                         ["other"])
+        self.assertEqual([u['username'] for u in followers['data']],
+                         ["testuser"])
+        self.assertEqual([(m['id'], m['liked']) for m in likes['data']],
+                         [(self.messages[0].id, True)])
+
+    def test_login(self):
+        resp = self.client.post("/api/v1/session", json={
+            "username": "testuser", "password": PASSWORD})
+
+        self.assertEqual(resp.status_code, 201)
+        self.assertEqual(
+            self.client.get("/api/v1/feed?limit=1").status_code, 200)
+
+        bad = self.client.post("/api/v1/session", json={
+            "username": "testuser", "password": "wrong"})
+        self.assertEqual(bad.status_code, 401)
+
+    def test_create_message(self):
+        self.login(self.testuser)
+
+        resp = self.client.post("/api/v1/messages", json={"text": "Hello"})
+
+        self.assertEqual(resp.status_code, 201)
+        self.assertEqual(resp.json['user']['username'], "testuser")
+        location = f"/api/v1/messages/{resp.json['id']}"
+        self.assertTrue(resp.headers['Location'].endswith(location))
+        self.assertEqual(self.client.get(location).json['text'], "Hello")
+
+    def test_create_message_invalid(self):
+        """Messages must be JSON with 1 to 140 characters of text."""
+
+        self.login(self.testuser)
+
+        too_long = self.client.post("/api/v1/messages",
+                                    json={"text": "x" * 141})
+        form = self.client.post("/api/v1/messages", data={"text": "Hello"})
+
+        self.assertEqual(too_long.status_code, 422)
+        self.assertIn('text', too_long.json['error']['fields'])
+        self.assertEqual(form.status_code, 415)
+        self.assertEqual(Message.query.count(), 5)
+
+    def test_delete_message(self):
+        """Users can delete their own messages only."""
+
+        mine = make_message(self.testuser)
+        self.login(self.testuser)
+
+        self.assertEqual(
+            self.client.delete(f"/api/v1/messages/{mine.id}").status_code,
+            204)
+        self.assertEqual(
+            self.client.delete(f"/api/v1/messages/{mine.id}").status_code,
+            404)
+        self.assertEqual(self.client.delete(
+            f"/api/v1/messages/{self.messages[0].id}").status_code, 403)
+        self.assertEqual(Message.query.count(), 5)
+
+    @skipUnless(serializers.msgpack, "msgpack isn't installed")
+    def test_msgpack(self):
+        resp = self.client.get(f"/api/v1/messages/{self.messages[0].id}",
+                               headers={'Accept': serializers.MSGPACK})
+
+        self.assertEqual(resp.mimetype, serializers.MSGPACK)
+        self.assertEqual(
+            serializers.msgpack.unpackb(resp.data)['text'], "message 0")
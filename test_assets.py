@@ -0,0 +1,98 @@
+"""Static asset pipeline tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_assets.py
+
+
+import os
+import tempfile
+from unittest import TestCase
+
+from flask import Flask
+
+from assets import Assets, build
+
+
+class AssetsTestCase(TestCase):
+    """Test building, linking to and serving fingerprinted assets."""
+
+    def setUp(self):
+        """Build our static/ folder into a temp directory."""
+
+        self.app = Flask(__name__)
+        self.app.config['ASSETS_FINGERPRINT'] = True
+        self.app.config['ASSETS_OUTPUT_DIR'] = tempfile.mkdtemp()
+        self.assets = Assets(self.app)
+        self.client = self.app.test_client()
+
+    def test_build_fingerprints_and_compresses(self):
+        """Built names carry a content hash; CSS gets a .gz variant."""
+
+        built = self.assets.manifest['stylesheets/style.css']
+        out = self.app.config['ASSETS_OUTPUT_DIR']
+
+        self.assertRegex(built, r"^stylesheets/style\.[0-9a-f]{12}\.css$")
+        self.assertTrue(os.path.exists(os.path.join(out, built + ".gz")))
+
+    def test_css_urls_rewritten(self):
+        """Stylesheet references to /static/ images point at built files."""
+
+        out = self.app.config['ASSETS_OUTPUT_DIR']
+        with open(os.path.join(out, self.assets.manifest['stylesheets/style.css'])) as f:
+            css = f.read()
+
+        self.assertNotIn("/static/images", css)
+        self.assertIn(f'"../{self.assets.manifest["images/nav-bg.png"]}"', css)
+
+    def test_build_is_deterministic(self):
+        """Rebuilding unchanged files gives the same names."""
+
+        manifest = build(self.app.static_folder, tempfile.mkdtemp())
+
+        self.assertEqual(manifest, self.assets.manifest)
+
+    def test_asset_url(self):
+        """Known files are fingerprinted; other URLs pass through."""
+
+        with self.app.test_request_context():
+            self.assertTrue(self.assets.asset_url(
+                "/static/images/default-pic.png").startswith(
+                    "/assets/images/default-pic."))
+            self.assertEqual(self.assets.asset_url("http://x.com/a.png"),
+                             "http://x.com/a.png")
+            self.assertEqual(self.assets.asset_url("missing.png"),
+                             "/static/missing.png")
+
+    def test_serves_precompressed_immutable(self):
+        """Gzip-accepting clients get the .gz variant, cached forever."""
+
+        url = f"/assets/{self.assets.manifest['stylesheets/style.css']}"
+        resp = self.client.get(url, headers={'Accept-Encoding': "gzip"})
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.headers['Content-Encoding'], "gzip")
+        self.assertIn("immutable", resp.headers['Cache-Control'])
+        self.assertEqual(resp.mimetype, "text/css")
+
+    def test_startup_picks_up_changed_sources(self):
+        """An output directory left from an earlier build doesn't keep
+        serving files that have since changed."""
+
+        static_dir = tempfile.mkdtemp()
+        output_dir = tempfile.mkdtemp()
+
+        def start():
+            app = Flask(__name__, static_folder=static_dir)
+            app.config['ASSETS_FINGERPRINT'] = True
+            app.config['ASSETS_OUTPUT_DIR'] = output_dir
+            return Assets(app).manifest["app.js"]
+
+        with open(os.path.join(static_dir, "app.js"), "w") as f:
+            f.write("var version = 1;")
+        before = start()
+
+        with open(os.path.join(static_dir, "app.js"), "w") as f:
+            f.write("var version = 2;")
+
+        self.assertNotEqual(start(), before)
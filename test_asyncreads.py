@@ -0,0 +1,160 @@
+"""Async read path tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_asyncreads.py
+
+
+import os
+import tempfile
+from datetime import datetime
+from unittest import TestCase
+
+from flask import Flask
+
+import queries
+from asyncreads import (AsyncReads, async_database_url, home_page,
+                        message_page, user_page)
+from models import db, Follows, Like, Message, User
+
+
+def message_fields(rows):
+    return [(m.id, m.text, m.timestamp, m.user.id, m.user.username, m.liked)
+            for m in rows]
+
+
+def profile_fields(profile):
+    return (profile.id, profile.username, profile.image_url,
+            profile.header_image_url, profile.bio, profile.location,
+            len(profile.following), len(profile.followers),
+            len(profile.liked_messages))
+
+
+class AsyncReadsTestCase(TestCase):
+    """The async pages return what the sync queries do, on a SQLite file
+    read through aiosqlite."""
+
+    @classmethod
+    def setUpClass(cls):
+        """One app, database and event loop for the whole class."""
+
+        db_file = os.path.join(tempfile.mkdtemp(), "async.db")
+
+        cls.app = Flask(__name__)
+        cls.app.config['SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{db_file}"
+        cls.app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+        cls.app.config['ASYNC_READS_ENABLED'] = True
+        db.init_app(cls.app)
+        cls.reads = AsyncReads(cls.app)
+
+        with cls.app.app_context():
+            db.create_all()
+
+            alice = User.signup("alice", "alice@test.com", "password", None)
+            bob = User.signup("bob", "bob@test.com", "password", None)
+            carol = User.signup("carol", "carol@test.com", "password", None)
+            db.session.flush()
+
+            messages = [
+                Message(text=f"{user.username} #{n}", user_id=user.id,
+                        timestamp=datetime(2024, 1, 1 + n, user.id % 24))
+                for n in range(3)
+                for user in (alice, bob, carol)
+            ]
+            db.session.add_all(messages)
+            db.session.flush()
+
+            db.session.add_all([
+                Follows(user_following_id=alice.id,
+                        user_being_followed_id=bob.id),
+                Follows(user_following_id=carol.id,
+                        user_being_followed_id=alice.id),
+                Like(user_id=alice.id, message_id=messages[1].id),
+                Like(user_id=carol.id, message_id=messages[0].id),
+            ])
+
+            cls.alice_id, cls.bob_id = alice.id, bob.id
+            cls.carol_id = carol.id
+            cls.bob_message_id = messages[1].id
+            db.session.commit()
+
+    def setUp(self):
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+
+    def tearDown(self):
+        db.session.remove()
+        self.ctx.pop()
+
+    def test_async_url(self):
+        """Sync URLs map to the async driver for the same database."""
+
+        self.assertEqual(
+            str(async_database_url("postgresql:///warbler")),
+            "postgresql+asyncpg:///warbler")
+        self.assertTrue(self.app.config['ASYNC_DATABASE_URL'].drivername
+                        .startswith("sqlite+aiosqlite"))
+
+    def test_run(self):
+        """run() calls the coroutine on the loop and hands back its result."""
+
+        async def count_users(reads, offset):
+            return len(await reads.scalars(db.select(User.id))) + offset
+
+        self.assertEqual(self.reads.run(count_users, 10), 13)
+
+    def test_home_page_matches_sync(self):
+        """The viewer's summary and feed match the sync queries."""
+
+        me, feed = self.reads.run(
+            home_page, self.alice_id, lambda user_id: {})
+
+        following = queries.following_ids(self.alice_id)
+        self.assertEqual(profile_fields(me),
+                         profile_fields(queries.user_summary(self.alice_id)))
+        self.assertEqual(
+            message_fields(feed),
+            message_fields(queries.home_feed(self.alice_id, following)))
+        self.assertEqual({m.user.id for m in feed},
+                         {self.alice_id, self.bob_id})
+        self.assertTrue(any(m.liked for m in feed))
+
+    def test_home_page_uses_pending_follows(self):
+        """Follows and unfollows still in the write buffer shape the feed."""
+
+        _, feed = self.reads.run(
+            home_page, self.alice_id,
+            lambda user_id: {self.carol_id: True, self.bob_id: False})
+
+        self.assertEqual({m.user.id for m in feed},
+                         {self.alice_id, self.carol_id})
+
+    def test_user_page_matches_sync(self):
+        """Profile counters and messages match user_profile(), with and
+        without a viewer."""
+
+        for viewer_id in (None, self.alice_id, self.carol_id):
+            profile = self.reads.run(user_page, self.bob_id, viewer_id)
+            expected = queries.user_profile(self.bob_id, viewer_id)
+
+            self.assertEqual(profile_fields(profile),
+                             profile_fields(expected))
+            self.assertEqual(message_fields(profile.messages),
+                             message_fields(expected.messages))
+
+        self.assertIsNone(self.reads.run(user_page, 999999, None))
+
+    def test_message_page_matches_sync(self):
+        """The message, its author and the viewer's like state match the
+        ORM's."""
+
+        row = self.reads.run(message_page, self.bob_message_id,
+                             self.alice_id)
+        msg = Message.query.get(self.bob_message_id)
+
+        self.assertEqual((row.id, row.text, row.timestamp, row.user.username),
+                         (msg.id, msg.text, msg.timestamp, msg.user.username))
+        self.assertTrue(row.liked)
+        self.assertFalse(
+            self.reads.run(message_page, self.bob_message_id, None).liked)
+        self.assertIsNone(self.reads.run(message_page, 999999, None))
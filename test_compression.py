@@ -0,0 +1,98 @@
+"""Response compression tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_compression.py
+
+
+import gzip
+import unittest
+import zlib
+
+from testing import app, DbTestCase, make_message, make_user
+from app import compression
+from compression import brotli
+
+GZIP = {'Accept-Encoding': "gzip"}
+
+
+class CompressionTestCase(DbTestCase):
+    """Test negotiation, skipping and streaming compression."""
+
+    def setUp(self):
+        super().setUp()
+        app.config['COMPRESSION_ENABLED'] = True
+        compression.totals.clear()
+
+        self.user = make_user("alice")
+        for i in range(30):
+            make_message(self.user, f"Warble number {i}")
+        self.login(self.user)
+
+    def tearDown(self):
+        app.config['COMPRESSION_ENABLED'] = False
+        app.config['TEMPLATE_STREAMING'] = False
+        super().tearDown()
+
+    def test_gzip(self):
+        """Pages shrink, decompress to the same HTML and vary by
+        Accept-Encoding."""
+
+        plain = self.client.get(f"/users/{self.user.id}")
+        resp = self.client.get(f"/users/{self.user.id}", headers=GZIP)
+
+        self.assertIsNone(plain.headers.get('Content-Encoding'))
+        self.assertIn("Accept-Encoding", plain.headers['Vary'])
+        self.assertEqual(resp.headers['Content-Encoding'], "gzip")
+        self.assertIn("Accept-Encoding", resp.headers['Vary'])
+        self.assertEqual(gzip.decompress(resp.data), plain.data)
+        self.assertLess(len(resp.data), len(plain.data) / 2)
+
+        responses, bytes_in, bytes_out, _ = compression.totals['gzip']
+        self.assertEqual((responses, bytes_in, bytes_out),
+                         (1, len(plain.data), len(resp.data)))
+
+    @unittest.skipIf(brotli is None, "brotli isn't installed")
+    def test_brotli_preferred(self):
+        plain = self.client.get("/api/v1/feed")
+        resp = self.client.get("/api/v1/feed",
+                               headers={'Accept-Encoding': "gzip, br"})
+
+        self.assertEqual(resp.headers['Content-Encoding'], "br")
+        self.assertEqual(brotli.decompress(resp.data), plain.data)
+
+    def test_skips_small_and_images(self):
+        resp = self.client.get("/static/images/default-pic.png", headers=GZIP)
+        self.assertIsNone(resp.headers.get('Content-Encoding'))
+        resp.close()
+
+        app.config['COMPRESSION_MIN_SIZE'] = 10 ** 6
+        try:
+            resp = self.client.get(f"/users/{self.user.id}", headers=GZIP)
+        finally:
+            app.config['COMPRESSION_MIN_SIZE'] = 1024
+        self.assertIsNone(resp.headers.get('Content-Encoding'))
+
+    def test_streamed_chunk_by_chunk(self):
+        """A streamed page arrives as gzip chunks that each decompress
+        on their own, starting with the top of the page."""
+
+        app.config['TEMPLATE_STREAMING'] = True
+        app.config['TEMPLATE_STREAM_BUFFER'] = 2
+        try:
+            resp = self.client.get("/", headers=GZIP, buffered=False)
+            chunks = list(resp.response)
+            resp.close()
+        finally:
+            app.config['TEMPLATE_STREAM_BUFFER'] = 16
+
+        self.assertEqual(resp.headers['Content-Encoding'], "gzip")
+        self.assertNotIn('Content-Length', resp.headers)
+        self.assertGreater(len(chunks), 2)
+
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        first = decompressor.decompress(chunks[0])
+        self.assertTrue(first.lstrip().startswith(b"<!DOCTYPE"))
+        html = first + b"".join(map(decompressor.decompress, chunks[1:]))
+        self.assertIn(b"Warble number 0", html)
+        self.assertEqual(compression.totals['gzip'][0], 1)
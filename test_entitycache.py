@@ -0,0 +1,140 @@
+"""Entity cache tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_entitycache.py
+
+
+from sqlalchemy import event, inspect
+
+from testing import app, db, DbTestCase, make_message, make_user
+from app import entity_cache
+from models import Message, User
+from outbox import invalidated
+
+
+class EntityCacheTestCase(DbTestCase):
+    """Test hits, misses, invalidation and bounds of the entity cache."""
+
+    def setUp(self):
+        super().setUp()
+        entity_cache.enabled = True
+        entity_cache.clear()
+
+        self.user = make_user("alice")
+        self.message = make_message(self.user, "Hello")
+        db.session.expunge_all()
+
+        self.statements = []
+        event.listen(db.engine, 'before_cursor_execute', self.count)
+
+    def tearDown(self):
+        event.remove(db.engine, 'before_cursor_execute', self.count)
+        entity_cache.enabled = False
+        entity_cache.clear()
+        super().tearDown()
+
+    def count(self, conn, cursor, statement, *args):
+        self.statements.append(statement)
+
+    def lookup(self, model, ident, **kwargs):
+        """A lookup as a fresh request would make it."""
+
+        db.session.expunge_all()
+        return entity_cache.get(model, ident, **kwargs)
+
+    def test_second_lookup_hits(self):
+        misses = entity_cache.misses[User]
+
+        self.lookup(User, self.user.id)
+        self.statements.clear()
+        user = self.lookup(User, self.user.id)
+
+        self.assertEqual(self.statements, [])
+        self.assertEqual(user.username, "alice")
+        self.assertEqual(entity_cache.misses[User], misses + 1)
+        self.assertEqual(entity_cache.stats()['User']['entries'], 1)
+
+    def test_hit_is_usable(self):
+        """A hit is in the session: relationships load and changes
+        commit, which invalidates the entry."""
+
+        self.lookup(User, self.user.id)
+        user = self.lookup(User, self.user.id)
+
+        self.assertIn(user, db.session)
+        self.assertEqual([m.text for m in user.messages], ["Hello"])
+
+        user.bio = "Changed"
+        db.session.commit()
+
+        self.assertEqual(self.lookup(User, self.user.id).bio, "Changed")
+
+    def test_detached(self):
+        self.lookup(Message, self.message.id)
+        message = self.lookup(Message, self.message.id, detached=True)
+
+        self.assertTrue(inspect(message).detached)
+        self.assertEqual(message.text, "Hello")
+
+    def test_missing_not_cached(self):
+        self.assertIsNone(self.lookup(User, -1))
+        self.assertIsNone(self.lookup(User, -1))
+        self.assertEqual(entity_cache.stats()['User']['entries'], 0)
+
+    def test_broadcast_invalidates(self):
+        """An outbox broadcast from another worker drops the entry."""
+
+        self.lookup(User, self.user.id)
+        invalidated.send(None, tags=[f"user:{self.user.id}", "message:0"])
+        self.statements.clear()
+
+        self.lookup(User, self.user.id)
+
+        self.assertEqual(len(self.statements), 1)
+
+    def test_stale_fill_not_served(self):
+        """A row read before a commit bumped its version isn't served."""
+
+        tag = f"user:{self.user.id}"
+        version = entity_cache.versions.get(tag, 0)
+        entity_cache.invalidate(tag)
+        user = db.session.get(User, self.user.id)
+        entity_cache._store(tag, User, {'id': user.id}, version)
+        self.statements.clear()
+
+        self.lookup(User, self.user.id)
+
+        self.assertEqual(len(self.statements), 1)
+
+    def test_ttl_and_size(self):
+        app.config['ENTITY_CACHE_MAX_ENTRIES'] = 2
+        try:
+            for user in [self.user, make_user("bob"), make_user("carol")]:
+                self.lookup(User, user.id)
+        finally:
+            app.config['ENTITY_CACHE_MAX_ENTRIES'] = 10000
+        self.assertEqual(entity_cache.stats()['User']['entries'], 2)
+
+        app.config['ENTITY_CACHE_TTL'] = {'User': -1, 'Message': 300}
+        try:
+            hits = entity_cache.hits[User]
+            self.lookup(User, self.user.id)
+            self.lookup(User, self.user.id)
+        finally:
+            app.config['ENTITY_CACHE_TTL'] = {'User': 60, 'Message': 300}
+        self.assertEqual(entity_cache.hits[User], hits)
+
+    def test_requests_use_cache(self):
+        """Logged-in requests find their user in the cache, and deleting a
+        message drops it."""
+
+        self.login(self.user)
+        self.client.get(f"/messages/{self.message.id}")
+        hits = entity_cache.hits[User]
+        self.client.get(f"/messages/{self.message.id}")
+        self.assertGreater(entity_cache.hits[User], hits)
+
+        self.client.post(f"/messages/{self.message.id}/delete")
+
+        self.assertIsNone(self.lookup(Message, self.message.id))
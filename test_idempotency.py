@@ -0,0 +1,157 @@
+"""Idempotency key tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_idempotency.py
+
+
+from unittest import TestCase
+
+from flask import Flask, redirect, render_template_string, request
+
+from idempotency import FORM_FIELD, PENDING, Idempotency, MemoryStore
+
+
+class MemoryStoreTestCase(TestCase):
+    """Test the in-process key store."""
+
+    def setUp(self):
+        self.store = MemoryStore(shards=1)
+
+    def test_claim_once(self):
+        """Only the first claim of a key wins; later ones see its state."""
+
+        self.assertIsNone(self.store.claim("k", 60, now=100))
+        self.assertEqual(self.store.claim("k", 60, now=101), PENDING)
+
+        self.store.complete("k", "/users/1", 60, now=102)
+        self.assertEqual(self.store.claim("k", 60, now=103), "/users/1")
+
+    def test_expires(self):
+        """A key can be claimed again once its TTL is up."""
+
+        self.store.claim("k", 60, now=100)
+        self.store.complete("k", "/users/1", 60, now=100)
+
+        self.assertIsNone(self.store.get("k", now=160))
+        self.assertIsNone(self.store.claim("k", 60, now=160))
+
+    def test_release(self):
+        """A released key is free again."""
+
+        self.store.claim("k", 60, now=100)
+        self.store.release("k")
+
+        self.assertIsNone(self.store.claim("k", 60, now=101))
+
+    def test_size_bounded(self):
+        """Expired keys are dropped as new ones come in, and a shard never
+        holds more than its cap."""
+
+        store = MemoryStore(shards=1, max_keys_per_shard=100)
+        for i in range(1000):
+            store.claim(f"k{i}", 60, now=100)
+        self.assertEqual(len(store._shards[0]), 100)
+
+        store.claim("late", 60, now=200)
+        self.assertEqual(len(store._shards[0]), 1)
+
+
+class IdempotencyTestCase(TestCase):
+    """Test replaying POSTs in a Flask app."""
+
+    def setUp(self):
+        """A tiny app whose one write endpoint counts its calls."""
+
+        app = Flask(__name__)
+        app.config['SECRET_KEY'] = "test"
+        app.config['IDEMPOTENCY_ENDPOINTS'] = {'post', 'fail'}
+        self.calls = 0
+
+        @app.route('/post', methods=["GET", "POST"])
+        def post():
+            if request.method == "GET":
+                return render_template_string("{{ idempotency_field() }}")
+            self.calls += 1
+            return redirect(f"/done/{self.calls}")
+
+        @app.post('/fail')
+        def fail():
+            self.calls += 1
+            return "try again", 400
+
+        self.idempotency = Idempotency(app)
+        self.client = app.test_client()
+        with self.client.session_transaction() as sess:
+            sess['curr_user'] = 1
+
+    def test_replay_returns_first_redirect(self):
+        """The same key runs the view once; the replay gets its redirect."""
+
+        first = self.client.post('/post', data={FORM_FIELD: "abc"})
+        second = self.client.post('/post', data={FORM_FIELD: "abc"})
+
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(second.headers['Location'],
+                         first.headers['Location'])
+        self.assertEqual(second.headers['Idempotent-Replayed'], "true")
+
+    def test_header_key(self):
+        """API clients can send the key as a header."""
+
+        for _ in range(2):
+            self.client.post('/post', headers={'Idempotency-Key': "abc"})
+
+        self.assertEqual(self.calls, 1)
+
+    def test_keys_are_per_user(self):
+        """Another user's key never replays for you."""
+
+        self.client.post('/post', data={FORM_FIELD: "abc"})
+        with self.client.session_transaction() as sess:
+            sess['curr_user'] = 2
+        self.client.post('/post', data={FORM_FIELD: "abc"})
+
+        self.assertEqual(self.calls, 2)
+
+    def test_failure_frees_key(self):
+        """A response that isn't a redirect isn't recorded, so a retry
+        runs the view again."""
+
+        for _ in range(2):
+            resp = self.client.post('/fail', data={FORM_FIELD: "abc"})
+
+        self.assertEqual(resp.status_code, 400)
+        self.assertEqual(self.calls, 2)
+
+    def test_without_key(self):
+        """POSTs without a key, or from anonymous users, always run."""
+
+        self.client.post('/post')
+        self.client.post('/post')
+        with self.client.session_transaction() as sess:
+            del sess['curr_user']
+        self.client.post('/post', data={FORM_FIELD: "abc"})
+        self.client.post('/post', data={FORM_FIELD: "abc"})
+
+        self.assertEqual(self.calls, 4)
+
+    def test_in_flight_replay_conflicts(self):
+        """A replay that outwaits a still-running first request gets 409."""
+
+        self.client.application.config['IDEMPOTENCY_WAIT'] = 0
+        self.idempotency.store.claim("1:post:abc", 60)
+
+        resp = self.client.post('/post', data={FORM_FIELD: "abc"})
+
+        self.assertEqual(resp.status_code, 409)
+        self.assertEqual(self.calls, 0)
+
+    def test_field_has_fresh_keys(self):
+        """Each rendered field gets its own key."""
+
+        pages = {self.client.get('/post').get_data(as_text=True)
+                 for _ in range(2)}
+
+        self.assertEqual(len(pages), 2)
+        self.assertIn(f'name="{FORM_FIELD}"', pages.pop())
@@ -0,0 +1,186 @@
+"""Image proxy tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_imageproxy.py
+
+
+import io
+import os
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from unittest import TestCase
+
+from flask import Flask
+from PIL import Image
+
+from diskcache import DiskCache
+from imageproxy import (BlockedAddress, ImageProxy, check_public_address,
+                        fetch_url)
+
+IMAGE_URL = "https://example.com/me.jpg"
+
+
+def make_jpeg(width=800, height=600):
+    """Bytes of a plain JPEG image."""
+
+    out = io.BytesIO()
+    Image.new("RGB", (width, height), "blue").save(out, "JPEG")
+    return out.getvalue()
+
+
+class ImageProxyTestCase(TestCase):
+    """Test thumbnail generation, caching and URL rewriting."""
+
+    def setUp(self):
+        """Create an app whose fetcher is a stub that counts calls."""
+
+        self.fetched = []
+
+        def fetcher(url):
+            self.fetched.append(url)
+            return make_jpeg()
+
+        self.app = Flask(__name__)
+        self.app.config['SECRET_KEY'] = "test"
+        self.app.config['IMAGE_PROXY_ENABLED'] = True
+        self.app.config['IMAGE_PROXY_FETCHER'] = fetcher
+        self.app.config['IMAGE_PROXY_CACHE_DIR'] = tempfile.mkdtemp()
+        self.proxy = ImageProxy(self.app)
+        self.client = self.app.test_client()
+
+    def proxied(self, url, size="avatar"):
+        """Proxy URL for `url` as templates would render it."""
+
+        with self.app.test_request_context():
+            return self.proxy.thumbnail(url, size)
+
+    def test_fetches_once_and_resizes(self):
+        """The original is fetched on the first request only."""
+
+        url = self.proxied(IMAGE_URL)
+        first = self.client.get(url)
+        second = self.client.get(url)
+
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(second.status_code, 200)
+        self.assertEqual(self.fetched, [IMAGE_URL])
+        self.assertEqual(Image.open(io.BytesIO(first.data)).size, (200, 200))
+        self.assertIn("max-age=2592000", first.headers['Cache-Control'])
+
+    def test_rejects_bad_signature(self):
+        """Unsigned URLs aren't proxied."""
+
+        resp = self.client.get(f"/img/avatar/nope?url={IMAGE_URL}")
+
+        self.assertEqual(resp.status_code, 404)
+        self.assertEqual(self.fetched, [])
+
+    def test_falls_back_to_original(self):
+        """If the original can't be thumbnailed, redirect to it."""
+
+        self.app.config['IMAGE_PROXY_FETCHER'] = lambda url: b"not an image"
+        resp = self.client.get(self.proxied(IMAGE_URL))
+
+        self.assertEqual(resp.status_code, 302)
+        self.assertEqual(resp.location, IMAGE_URL)
+
+    def test_failure_remembered(self):
+        """A broken original is tried once, then linked to directly until
+        the failure expires."""
+
+        def fetcher(url):
+            self.fetched.append(url)
+            raise OSError("dead link")
+
+        self.app.config['IMAGE_PROXY_FETCHER'] = fetcher
+        url = self.proxied(IMAGE_URL)
+        codes = [self.client.get(url).status_code for _ in range(3)]
+
+        self.assertEqual(codes, [302, 302, 302])
+        self.assertEqual(len(self.fetched), 1)
+
+        self.app.config['IMAGE_PROXY_FAILURE_TTL'] = 0
+        self.proxy._failures.clear()
+        self.client.get(url)
+        self.assertEqual(len(self.fetched), 2)
+
+    def test_local_urls_not_proxied(self):
+        """Images we host ourselves are linked directly."""
+
+        self.assertEqual(self.proxied("/static/images/default-pic.png"),
+                         "/static/images/default-pic.png")
+
+
+class FetchUrlTestCase(TestCase):
+    """Test that the default fetcher only reaches public hosts."""
+
+    def test_non_public_addresses_blocked(self):
+        """Loopback, private, link-local (cloud metadata) and mapped
+        addresses are refused; public ones pass."""
+
+        for address in ("127.0.0.1", "10.1.2.3", "192.168.0.1",
+                        "169.254.169.254", "::1", "fe80::1",
+                        "::ffff:127.0.0.1", "0.0.0.0"):
+            with self.assertRaises(BlockedAddress, msg=address):
+                check_public_address(address)
+
+        check_public_address("93.184.216.34")
+
+    def test_refuses_to_connect_to_localhost(self):
+        """A URL pointing at this machine is never requested."""
+
+        requests = []
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                requests.append(self.path)
+                self.send_response(200)
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        server = HTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.shutdown)
+
+        with self.assertRaises(BlockedAddress):
+            fetch_url(f"http://127.0.0.1:{server.server_port}/secret")
+        with self.assertRaises(BlockedAddress):
+            fetch_url(f"https://127.0.0.1:{server.server_port}/secret")
+        with self.assertRaises(BlockedAddress):
+            fetch_url("file:///etc/passwd")
+
+        self.assertEqual(requests, [])
+
+
+class DiskCacheTestCase(TestCase):
+    """Test LRU eviction of the on-disk cache."""
+
+    def test_evicts_least_recently_used(self):
+        """Going over the byte cap removes the oldest untouched file."""
+
+        directory = tempfile.mkdtemp()
+        cache = DiskCache(directory, max_bytes=25)
+        cache.put("a", b"x" * 10)
+        cache.put("b", b"x" * 10)
+        cache.get("a")
+        cache.put("c", b"x" * 10)
+
+        self.assertEqual(sorted(os.listdir(directory)), ["a", "c"])
+        self.assertIsNone(cache.get("b"))
+
+    def test_processes_sharing_directory_stay_under_cap(self):
+        """Two caches on one directory, standing in for two workers,
+        evict each other's files rather than each filling the cap."""
+
+        directory = tempfile.mkdtemp()
+        workers = [DiskCache(directory, max_bytes=1000) for _ in range(2)]
+        for i in range(20):
+            workers[i % 2].put(f"k{i}", b"x" * 100)
+
+        total = sum(os.path.getsize(os.path.join(directory, name))
+                    for name in os.listdir(directory))
+        self.assertLessEqual(total, 1000)
@@ -5,50 +5,19 @@
 #    FLASK_ENV=production python -m unittest test_message_views.py
 
 
-import os
-from unittest import TestCase
+from testing import CURR_USER_KEY, DbTestCase, make_message, make_user
+from models import db, Message, User
 
-from models import db, connect_db, Message, User
 
-# BEFORE we import our app, let's set an environmental variable
-# to use a different database for tests (we need to do this
-# before we import our app, since that will have already
-# connected to the database
-
-os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
-
-# Now we can import app
-
-from app import app, CURR_USER_KEY
-
-# Create our tables (we do this here, so we only create the tables
-# once for all tests --- in each test, we'll delete the data
-# and create fresh new clean test data
-
-db.create_all()
-
-# Don't have WTForms use CSRF at all, since it's a pain to test
-
-app.config['WTF_CSRF_ENABLED'] = False
-
-
-class MessageViewTestCase(TestCase):
+class MessageViewTestCase(DbTestCase):
     """Test views for messages."""
 
     def setUp(self):
         """Create test client, add sample data."""
 
-        User.query.delete()
-        Message.query.delete()
-
-        self.client = app.test_client()
+        super().setUp()
 
-        self.testuser = User.signup(username="testuser",
-                                    email="test@test.com",
-                                    password="testuser",
-                                    image_url=None)
-
-        db.session.commit()
+        self.testuser = make_user("testuser", password="testuser")
 
     def test_add_message(self):
         """Can use add a message?"""
@@ -70,3 +39,62 @@ class MessageViewTestCase(TestCase):
 
             msg = Message.query.one()
             self.assertEqual(msg.text, "Hello")
+
+    def test_delete_message(self):
+        """Can a user delete their own message?"""
+
+        msg_id = make_message(self.testuser, "Bye").id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            resp = c.post(f"/messages/{msg_id}/delete")
+
+            self.assertEqual(resp.status_code, 302)
+            self.assertEqual(Message.query.count(), 0)
+
+    def test_delete_other_users_message(self):
+        """Are other users' messages left alone?"""
+
+        other = make_user("other")
+        msg_id = make_message(other, "Mine").id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            resp = c.post(f"/messages/{msg_id}/delete", follow_redirects=True)
+
+            self.assertIn("Access unauthorized", resp.get_data(as_text=True))
+            self.assertEqual(Message.query.count(), 1)
+
+    def test_double_submit_posts_once(self):
+        """A form posted twice with the same idempotency key makes one
+        message, and a replayed like doesn't undo itself."""
+
+        other_id = make_user("other").id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            form = {"text": "Hello", "idempotency_key": "k1"}
+            first = c.post("/messages/new", data=form)
+            second = c.post("/messages/new", data=form)
+
+            self.assertEqual(second.status_code, 302)
+            self.assertEqual(second.location, first.location)
+            self.assertEqual(Message.query.count(), 1)
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = other_id
+
+            msg_id = Message.query.one().id
+            for _ in range(2):
+                c.post(f"/messages/{msg_id}/like",
+                       data={"idempotency_key": "k2"})
+
+            self.assertEqual(
+                [m.id for m in User.query.get(other_id).liked_messages],
+                [msg_id])
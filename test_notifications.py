@@ -0,0 +1,177 @@
+"""Notification tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_notifications.py
+
+
+from datetime import datetime, timedelta
+
+from testing import DbTestCase, make_message, make_user
+from app import notifications
+from models import db, Notification, NotificationCounter
+from notifications import FOLLOW, LIKE
+
+NOW = datetime(2024, 3, 15, 12, 0)
+
+
+class NotificationsTestCase(DbTestCase):
+    """Test coalescing, flushing, pruning and reading notifications."""
+
+    def setUp(self):
+        """An author with a message and three fans."""
+
+        super().setUp()
+        notifications._pending.clear()
+
+        self.author = make_user("author")
+        self.message = make_message(self.author, "Hello")
+        self.fans = [make_user(f"fan{i}") for i in range(3)]
+
+    def flush(self, now=NOW):
+        return notifications.flush(db.session.connection(), now=now)
+
+    def unread(self, user):
+        return db.session.get(NotificationCounter, user.id).unread
+
+    def test_coalesces_likes(self):
+        """Likes of one message become one row, counted, with the last
+        fan as its actor."""
+
+        for fan in self.fans:
+            notifications.record(LIKE, self.author.id, fan.id,
+                                 self.message.id, now=NOW)
+        notifications.record(FOLLOW, self.author.id, self.fans[0].id,
+                             now=NOW)
+
+        self.assertEqual(self.flush(), 2)
+
+        like = Notification.query.filter_by(kind=LIKE).one()
+        self.assertEqual((like.count, like.unread, like.last_actor_id),
+                         (3, 3, self.fans[-1].id))
+        self.assertEqual(self.unread(self.author), 4)
+
+    def test_later_flushes_add_up(self):
+        notifications.record(LIKE, self.author.id, self.fans[0].id,
+                             self.message.id, now=NOW)
+        self.flush()
+        notifications.record(LIKE, self.author.id, self.fans[1].id,
+                             self.message.id, now=NOW)
+        self.flush()
+
+        self.assertEqual(Notification.query.one().count, 2)
+        self.assertEqual(self.unread(self.author), 2)
+
+    def test_own_actions_ignored(self):
+        notifications.record(LIKE, self.author.id, self.author.id,
+                             self.message.id)
+
+        self.assertEqual(self.flush(), 0)
+
+    def test_pruned(self):
+        """Only the most recent groups within the retention period are
+        kept, and the counter follows."""
+
+        app = notifications.app
+        app.config['NOTIFICATIONS_PER_USER'] = 2
+        try:
+            for i in range(3):
+                message = make_message(self.author)
+                notifications.record(LIKE, self.author.id, self.fans[0].id,
+                                     message.id,
+                                     now=NOW + timedelta(minutes=i))
+            notifications.record(FOLLOW, self.author.id, self.fans[0].id,
+                                 now=NOW - timedelta(days=60))
+            self.flush()
+        finally:
+            app.config['NOTIFICATIONS_PER_USER'] = 50
+
+        self.assertEqual(Notification.query.count(), 2)
+        self.assertEqual(self.unread(self.author), 2)
+
+    def test_counts_people_not_clicks(self):
+        """Liking, unliking and liking again counts once; taking a like
+        back after it was written lowers the count, and unnames its
+        actor."""
+
+        for fan in self.fans[:2]:
+            notifications.record(LIKE, self.author.id, fan.id,
+                                 self.message.id, now=NOW)
+        notifications.retract(LIKE, self.author.id, self.fans[0].id,
+                              self.message.id)
+        notifications.record(LIKE, self.author.id, self.fans[0].id,
+                             self.message.id, now=NOW)
+        self.flush()
+
+        like = Notification.query.one()
+        self.assertEqual((like.count, like.unread, like.last_actor_id),
+                         (2, 2, self.fans[0].id))
+
+        notifications.retract(LIKE, self.author.id, self.fans[0].id,
+                              self.message.id)
+        self.flush()
+        db.session.refresh(like)
+        self.assertEqual((like.count, like.unread, like.last_actor_id),
+                         (1, 1, None))
+
+        notifications.retract(LIKE, self.author.id, self.fans[1].id,
+                              self.message.id)
+        self.flush()
+        self.assertEqual(Notification.query.count(), 0)
+        self.assertEqual(self.unread(self.author), 0)
+
+    def test_like_view_records(self):
+        """Like, unlike, like again: one notification from one fan."""
+
+        self.login(self.fans[0])
+        for _ in range(3):
+            self.client.post(f"/messages/{self.message.id}/like")
+
+        self.flush()
+        self.assertEqual(Notification.query.one().count, 1)
+
+    def test_follow_view_records_once(self):
+        """Following again changes nothing; unfollowing takes it back."""
+
+        self.login(self.fans[0])
+        for _ in range(2):
+            self.client.post(f"/users/follow/{self.author.id}")
+        self.flush()
+        self.assertEqual(Notification.query.one().count, 1)
+
+        self.client.post(f"/users/stop-following/{self.author.id}")
+        self.flush()
+        self.assertEqual(Notification.query.count(), 0)
+
+    def test_page_marks_read(self):
+        """The page lists coalesced notifications and zeroes the count."""
+
+        for fan in self.fans:
+            notifications.record(LIKE, self.author.id, fan.id,
+                                 self.message.id, now=NOW)
+        self.flush()
+        db.session.commit()
+        self.login(self.author)
+
+        html = self.client.get("/").get_data(as_text=True)
+        self.assertIn('<span class="badge badge-primary">3</span>', html)
+
+        html = self.client.get("/notifications").get_data(as_text=True)
+        self.assertIn("@fan2", html)
+        self.assertIn("and 2 others", html)
+        self.assertIn("Hello", html)
+        self.assertNotIn("badge-primary", html)
+
+        self.assertEqual(self.unread(self.author), 0)
+
+    def test_deleted_message_forgotten(self):
+        notifications.record(LIKE, self.author.id, self.fans[0].id,
+                             self.message.id, now=NOW)
+        self.flush()
+        db.session.commit()
+        self.login(self.author)
+
+        self.client.post(f"/messages/{self.message.id}/delete")
+
+        self.assertEqual(Notification.query.count(), 0)
+        self.assertEqual(self.unread(self.author), 0)
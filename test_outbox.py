@@ -0,0 +1,177 @@
+"""Outbox and invalidation bus tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_outbox.py
+
+
+import os
+import socket
+import tempfile
+import threading
+import unittest
+from unittest import TestCase
+
+from testing import db, DbTestCase, make_message, make_user, ON_SQLITE
+from app import outbox, page_cache
+from models import OutboxEvent
+from outbox import (invalidated, PostgresTransport, UnixSocketTransport)
+from writebuffer import batch_writing, LIKE
+
+
+class OutboxTestCase(DbTestCase):
+    """Test writing events with commits and dispatching them."""
+
+    def setUp(self):
+        super().setUp()
+        outbox.enabled = True
+        outbox.transport = None
+
+        self.received = []
+        invalidated.connect(self.receive)
+
+    def tearDown(self):
+        invalidated.disconnect(self.receive)
+        outbox.enabled = False
+        outbox.transport = None
+        super().tearDown()
+
+    def receive(self, sender, tags):
+        self.received.append(tags)
+
+    def events(self):
+        return [event.tags for event
+                in OutboxEvent.query.order_by(OutboxEvent.id)]
+
+    def test_commit_writes_event(self):
+        """Each commit that writes an entity records it."""
+
+        user = make_user("alice")
+        user.bio = "Hi"
+        db.session.commit()
+
+        self.assertEqual(self.events(), [f"user:{user.id}"] * 2)
+
+    def test_rollback_writes_nothing(self):
+        user = make_user("alice")
+        OutboxEvent.query.delete()
+        db.session.commit()
+
+        user.bio = "Hi"
+        db.session.flush()
+        db.session.rollback()
+
+        self.assertEqual(self.events(), [])
+
+    def test_disabled_writes_nothing(self):
+        outbox.enabled = False
+        make_user("alice")
+
+        self.assertEqual(self.events(), [])
+
+    def test_bulk_delete_publishes(self):
+        """Deleting a message, which the session doesn't see, still
+        records it and its author."""
+
+        user = make_user("alice")
+        message = make_message(user)
+        OutboxEvent.query.delete()
+        db.session.commit()
+        self.login(user)
+
+        self.client.post(f"/messages/{message.id}/delete")
+
+        self.assertEqual(self.events(),
+                         [f"message:{message.id} user:{user.id}"])
+
+    def test_write_buffer_batch(self):
+        """A write-buffer batch records its event in its own transaction."""
+
+        batch_writing.send(None, conn=db.session.connection(),
+                           batch={(LIKE, 1, 2): True})
+
+        self.assertEqual(self.events(), ["message:2 user:1"])
+
+    def test_dispatch_broadcasts(self):
+        """Dispatching deletes the events and sends their tags, merged,
+        to every subscriber, where the page cache hears them."""
+
+        alice = make_user("alice")
+        make_message(alice)
+        before = page_cache.versions.get(f"user:{alice.id}", 0)
+
+        self.assertEqual(outbox.dispatch(db.session.connection()), 2)
+
+        self.assertEqual(self.events(), [])
+        self.assertEqual(len(self.received), 1)
+        self.assertIn(f"user:{alice.id}", self.received[0])
+        self.assertGreater(page_cache.versions[f"user:{alice.id}"], before)
+        self.assertEqual(outbox.dispatch(db.session.connection()), 0)
+
+
+class UnixSocketTransportTestCase(TestCase):
+    """Test broadcasting between sockets in one directory."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.transports = []
+
+    def tearDown(self):
+        for transport in self.transports:
+            transport.close()
+        for name in os.listdir(self.directory):
+            os.unlink(os.path.join(self.directory, name))
+        os.rmdir(self.directory)
+
+    def transport(self):
+        transport = UnixSocketTransport(self.directory)
+        self.transports.append(transport)
+        return transport
+
+    def test_every_subscriber_hears(self):
+        """Each subscriber gets each payload; sockets of dead processes
+        are cleared away."""
+
+        dead = os.path.join(self.directory, "1-dead.sock")
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.bind(dead)
+        sock.close()
+
+        heard = []
+        done = threading.Semaphore(0)
+
+        def receive(payload):
+            heard.append(payload)
+            done.release()
+
+        for _ in range(2):
+            self.transport().subscribe(receive)
+        self.transport().publish("user:1 message:2")
+
+        for _ in range(2):
+            self.assertTrue(done.acquire(timeout=5))
+        self.assertEqual(heard, ["user:1 message:2"] * 2)
+        self.assertFalse(os.path.exists(dead))
+
+
+@unittest.skipIf(ON_SQLITE, "LISTEN/NOTIFY needs PostgreSQL")
+class PostgresTransportTestCase(TestCase):
+    """Test broadcasting through LISTEN/NOTIFY."""
+
+    def test_subscriber_hears(self):
+        transport = PostgresTransport(db.engine, channel="warbler_test")
+        heard = []
+        done = threading.Event()
+
+        def receive(payload):
+            heard.append(payload)
+            done.set()
+
+        transport.subscribe(receive)
+        try:
+            transport.publish("user:1")
+            self.assertTrue(done.wait(5))
+        finally:
+            transport.close()
+
+        self.assertEqual(heard, ["user:1"])
@@ -0,0 +1,119 @@
+"""Full-page cache tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_pagecache.py
+
+
+from unittest import TestCase
+
+from testing import app, CURR_USER_KEY
+from app import page_cache
+from models import db, User, Message, Follows, Like
+
+
+class PageCacheTestCase(TestCase):
+    """Test caching and invalidation of anonymous pages."""
+
+    def setUp(self):
+        """Create a user with a message and turn the cache on."""
+
+        Like.query.delete()
+        Follows.query.delete()
+        Message.query.delete()
+        User.query.delete()
+
+        user = User.signup("testuser", "test@test.com", "password", None)
+        db.session.commit()
+        message = Message(text="first warble", user_id=user.id)
+        db.session.add(message)
+        db.session.commit()
+
+        self.user_id = user.id
+        self.message_id = message.id
+
+        app.config['PAGE_CACHE_ENABLED'] = True
+        page_cache.clear()
+        self.client = app.test_client()
+
+    def tearDown(self):
+        """Turn the cache off and clean up fouled transactions."""
+
+        app.config['PAGE_CACHE_ENABLED'] = False
+        db.session.rollback()
+
+    def test_anonymous_pages_cached(self):
+        """The second anonymous view of a profile is a cache hit."""
+
+        first = self.client.get(f"/users/{self.user_id}")
+        second = self.client.get(f"/users/{self.user_id}")
+
+        self.assertEqual(first.headers['X-Page-Cache'], "MISS")
+        self.assertEqual(second.headers['X-Page-Cache'], "HIT")
+        self.assertEqual(first.data, second.data)
+
+    def test_cached_with_csrf_enabled(self):
+        """Anonymous pages don't get a CSRF token in the session, which
+        would set a cookie and keep them out of the cache."""
+
+        app.config['WTF_CSRF_ENABLED'] = True
+        self.addCleanup(app.config.__setitem__, 'WTF_CSRF_ENABLED', False)
+
+        for url in (f"/users/{self.user_id}", f"/messages/{self.message_id}",
+                    "/"):
+            first = self.client.get(url)
+            second = self.client.get(url)
+
+            self.assertEqual(first.headers.get('X-Page-Cache'), "MISS", url)
+            self.assertEqual(second.headers.get('X-Page-Cache'), "HIT", url)
+            self.assertNotIn('Set-Cookie', first.headers)
+
+    def test_logged_in_not_cached(self):
+        """Requests with a session cookie bypass the cache."""
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user_id
+
+        self.client.get(f"/users/{self.user_id}")
+        resp = self.client.get(f"/users/{self.user_id}")
+
+        self.assertNotIn('X-Page-Cache', resp.headers)
+
+    def test_write_invalidates(self):
+        """Editing the user makes their cached profile stale."""
+
+        self.client.get(f"/users/{self.user_id}")
+
+        user = User.query.get(self.user_id)
+        user.bio = "brand new bio"
+        db.session.commit()
+
+        resp = self.client.get(f"/users/{self.user_id}")
+
+        self.assertEqual(resp.headers['X-Page-Cache'], "MISS")
+        self.assertIn("brand new bio", resp.get_data(as_text=True))
+
+    def test_new_message_invalidates_author_page(self):
+        """A new message shows up on its author's cached profile."""
+
+        self.client.get(f"/users/{self.user_id}")
+
+        db.session.add(Message(text="second warble", user_id=self.user_id))
+        db.session.commit()
+
+        resp = self.client.get(f"/users/{self.user_id}")
+
+        self.assertIn("second warble", resp.get_data(as_text=True))
+
+    def test_author_change_invalidates_message_page(self):
+        """Message pages depend on their author too."""
+
+        self.client.get(f"/messages/{self.message_id}")
+
+        user = User.query.get(self.user_id)
+        user.username = "renamed"
+        db.session.commit()
+
+        resp = self.client.get(f"/messages/{self.message_id}")
+
+        self.assertIn("@renamed", resp.get_data(as_text=True))
@@ -0,0 +1,220 @@
+"""Message partitioning and archive tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_partitions.py
+
+
+from datetime import datetime
+from unittest import TestCase, skipUnless
+
+from sqlalchemy import text
+
+from testing import app, CURR_USER_KEY
+from models import db, Like, Message, MessageArchiveBlock, User
+from partitions import (add_months, archive, archive_horizon,
+                        archived_message, convert, create_partitions,
+                        is_partitioned, monthly_partitions, partition_name)
+
+NOW = datetime(2024, 3, 15, 12, 0)
+
+ON_POSTGRES = db.engine.dialect.name == "postgresql"
+
+
+class MonthsTestCase(TestCase):
+    """Test month arithmetic."""
+
+    def test_add_months_across_years(self):
+        """Months wrap into the next and previous years."""
+
+        self.assertEqual(add_months(datetime(2023, 11, 1), 3),
+                         datetime(2024, 2, 1))
+        self.assertEqual(add_months(datetime(2024, 1, 1), -1),
+                         datetime(2023, 12, 1))
+
+    def test_horizon_is_whole_months(self):
+        """The horizon is the start of a month, `retention` months back."""
+
+        self.assertEqual(archive_horizon(NOW, 2), datetime(2024, 1, 1))
+        self.assertEqual(partition_name(datetime(2024, 1, 1)),
+                         "messages_p2024_01")
+
+
+class ArchiveTestCase(TestCase):
+    """Test archiving old messages and reading them back."""
+
+    def setUp(self):
+        """A user with one old, liked message and one recent one."""
+
+        MessageArchiveBlock.query.delete()
+        User.query.delete()
+        Message.query.delete()
+
+        self.client = app.test_client()
+
+        self.author = User.signup("author", "author@test.com", "password",
+                                  None)
+        self.fan = User.signup("fan", "fan@test.com", "password", None)
+        db.session.flush()
+
+        old = Message(text="Way back", timestamp=datetime(2023, 6, 1),
+                      user_id=self.author.id)
+        new = Message(text="Just now", timestamp=datetime(2024, 3, 1),
+                      user_id=self.author.id)
+        db.session.add_all([old, new])
+        db.session.flush()
+        db.session.add(Like(user_id=self.fan.id, message_id=old.id))
+
+        self.old_id, self.new_id = old.id, new.id
+        self.author_id = self.author.id
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def archive(self, retention_months=2):
+        with db.engine.begin() as conn:
+            return archive(conn, NOW, retention_months, block_size=256)
+
+    def test_archive_moves_old_messages(self):
+        """Messages before the horizon leave `messages` with their likes
+        and end up in one block."""
+
+        self.assertEqual(self.archive(), 1)
+
+        self.assertEqual([m.id for m in Message.query.all()], [self.new_id])
+        self.assertEqual(Like.query.count(), 0)
+
+        block = MessageArchiveBlock.query.one()
+        self.assertEqual((block.first_id, block.last_id, block.count),
+                         (self.old_id, self.old_id, 1))
+
+    def test_archived_message_readable(self):
+        """An archived message comes back as a read-only row."""
+
+        self.archive()
+
+        msg = archived_message(self.old_id)
+        self.assertEqual(msg.text, "Way back")
+        self.assertEqual(msg.timestamp, datetime(2023, 6, 1))
+        self.assertEqual(msg.user.username, "author")
+        self.assertIsNone(archived_message(self.new_id))
+
+    def test_show_archived_message(self):
+        """/messages/<id> still shows it, without the delete form."""
+
+        self.archive()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.author_id
+
+            resp = c.get(f"/messages/{self.old_id}")
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("Way back", html)
+            self.assertIn("archived", html)
+            self.assertNotIn(f"/messages/{self.old_id}/delete", html)
+
+            self.assertEqual(c.get("/messages/999999").status_code, 404)
+
+
+@skipUnless(ON_POSTGRES, "native partitions are PostgreSQL only")
+class PostgresPartitionTestCase(TestCase):
+    """Test converting `messages` to a partitioned table."""
+
+    def setUp(self):
+        User.query.delete()
+        Message.query.delete()
+        MessageArchiveBlock.query.delete()
+
+        user = User.signup("user", "user@test.com", "password", None)
+        db.session.flush()
+        self.user_id = user.id
+
+        message = Message(text="Old", timestamp=datetime(2024, 1, 20),
+                          user_id=self.user_id)
+        db.session.add(message)
+        db.session.flush()
+        self.message_id = message.id
+        db.session.commit()
+
+        with db.engine.begin() as conn:
+            convert(conn, NOW, months_ahead=1)
+
+    def tearDown(self):
+        """Put the plain table, and the likes foreign key to it, back for
+        the other tests."""
+
+        db.session.remove()
+        for model in (Like, Message):
+            model.__table__.drop(db.engine)
+        for model in (Message, Like):
+            model.__table__.create(db.engine)
+
+    def test_convert_keeps_rows(self):
+        """The rows survive, each month gets a partition, and new ids
+        continue the old sequence."""
+
+        with db.engine.connect() as conn:
+            self.assertTrue(is_partitioned(conn))
+            self.assertEqual(
+                sorted(monthly_partitions(conn).values()),
+                ["messages_p2024_01", "messages_p2024_02",
+                 "messages_p2024_03", "messages_p2024_04"])
+            self.assertEqual(conn.execute(text(
+                "SELECT id FROM messages_p2024_01")).scalars().all(),
+                [self.message_id])
+
+        msg = Message(text="New", timestamp=NOW, user_id=self.user_id)
+        db.session.add(msg)
+        db.session.commit()
+
+        self.assertGreater(msg.id, self.message_id)
+
+    def test_delete_removes_likes(self):
+        """The trigger deletes a message's likes."""
+
+        db.session.add(Like(user_id=self.user_id, message_id=self.message_id))
+        db.session.commit()
+
+        Message.delete_owned(self.message_id, self.user_id)
+        db.session.commit()
+
+        self.assertEqual(Like.query.count(), 0)
+
+    def test_new_partition_takes_rows_from_default(self):
+        """Rows that fell into the default partition move into their
+        month's partition when it's created, keeping their likes."""
+
+        future = Message(text="Later", timestamp=datetime(2024, 6, 2),
+                         user_id=self.user_id)
+        db.session.add(future)
+        db.session.flush()
+        db.session.add(Like(user_id=self.user_id, message_id=future.id))
+        db.session.commit()
+
+        with db.engine.begin() as conn:
+            created = create_partitions(conn, datetime(2024, 6, 1), 0)
+
+        self.assertEqual(created, ["messages_p2024_06"])
+        with db.engine.connect() as conn:
+            self.assertEqual(conn.execute(text(
+                "SELECT count(*) FROM messages_default")).scalar(), 0)
+        self.assertEqual(Like.query.count(), 1)
+
+    def test_archive_drops_old_partitions(self):
+        """Partitions past the horizon are archived and dropped."""
+
+        db.session.add(Like(user_id=self.user_id, message_id=self.message_id))
+        db.session.commit()
+
+        with db.engine.begin() as conn:
+            self.assertEqual(archive(conn, NOW, 1, 256), 1)
+
+        with db.engine.connect() as conn:
+            self.assertNotIn("messages_p2024_01",
+                             monthly_partitions(conn).values())
+        self.assertEqual(Like.query.count(), 0)
+        self.assertEqual(archived_message(self.message_id).text, "Old")
@@ -0,0 +1,149 @@
+"""Request profiler tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_profiler.py
+
+
+import json
+import os
+import shutil
+import tempfile
+import time
+from unittest import TestCase
+
+from flask import Flask
+from sqlalchemy import select
+
+from models import db, User
+from profiler import Profiler, make_token, _collapse, _inclusive_shares
+from testing import DATABASE_URL
+
+
+class ProfilerTestCase(TestCase):
+    """Test capturing requests picked by header or by slowness."""
+
+    def setUp(self):
+        """Create a tiny app with a query-running, sleeping view."""
+
+        self.directory = tempfile.mkdtemp()
+
+        app = Flask(__name__)
+        app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URL
+        app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+        app.config['SECRET_KEY'] = "secret"
+        app.config['PROFILER_ENABLED'] = True
+        app.config['PROFILER_DIR'] = self.directory
+        app.config['PROFILER_INTERVAL'] = 0.001
+        db.init_app(app)
+        Profiler(app)
+
+        @app.get("/work/<float:seconds>")
+        def work(seconds):
+            db.session.execute(select(User.id).where(User.id > 0)).all()
+            time.sleep(seconds)
+            return "done"
+
+        with app.app_context():
+            db.create_all()
+
+        self.app = app
+        self.client = app.test_client()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def captures(self):
+        return sorted(os.listdir(self.directory))
+
+    def read(self, capture_id, name):
+        with open(os.path.join(self.directory, capture_id, name)) as f:
+            return f.read()
+
+    def test_header_captures_request(self):
+        """A signed header captures meta, queries with plans and stacks."""
+
+        with self.app.app_context():
+            token = make_token()
+
+        resp = self.client.get("/work/0.05", headers={'X-Profile': token})
+
+        self.assertEqual(resp.status_code, 200)
+        [capture_id] = self.captures()
+
+        meta = json.loads(self.read(capture_id, "meta.json"))
+        self.assertEqual(meta['trigger'], "header")
+        self.assertEqual(meta['status'], 200)
+        self.assertEqual(meta['endpoint'], "work")
+        self.assertGreaterEqual(meta['duration_ms'], 50)
+
+        queries = json.loads(self.read(capture_id, "queries.json"))
+        self.assertEqual(len(queries), 1)
+        self.assertIn("FROM users", queries[0]['statement'])
+        self.assertTrue(queries[0]['plan'])
+
+        self.assertIn("work (test_profiler.py",
+                      self.read(capture_id, "stacks.folded"))
+
+    def test_bad_token_ignored(self):
+        """Unsigned or forged tokens don't trigger profiling."""
+
+        self.client.get("/work/0", headers={'X-Profile': "forged"})
+
+        self.assertEqual(self.captures(), [])
+
+    def test_only_slow_requests_captured(self):
+        """With a threshold set, only requests over it are written."""
+
+        self.app.config['PROFILER_SLOW_MS'] = 40
+
+        self.client.get("/work/0")
+        self.assertEqual(self.captures(), [])
+
+        self.client.get("/work/0.05")
+        [capture_id] = self.captures()
+        meta = json.loads(self.read(capture_id, "meta.json"))
+        self.assertEqual(meta['trigger'], "slow")
+
+    def test_cli_list_and_diff(self):
+        """The CLI lists captures and diffs two of them."""
+
+        self.app.config['PROFILER_SAMPLE_RATE'] = 1
+        self.client.get("/work/0.01")
+        self.client.get("/work/0.02")
+        first, second = self.captures()
+
+        runner = self.app.test_cli_runner()
+
+        listing = runner.invoke(args=["profiles", "list"])
+        self.assertIn(first, listing.output)
+        self.assertIn("/work/0.02", listing.output)
+
+        diff = runner.invoke(args=["profiles", "diff", first, second])
+        self.assertEqual(diff.exit_code, 0, diff.output)
+        self.assertIn("duration ms", diff.output)
+
+
+class StackHelpersTestCase(TestCase):
+    """Test collapsing and summarizing stacks."""
+
+    def test_collapse_is_root_first(self):
+        """The current function is the last frame."""
+
+        def inner():
+            import sys
+            return _collapse(sys._getframe())
+
+        stack = inner()
+
+        self.assertTrue(stack.split(";")[-1].startswith("inner "))
+        self.assertIn("test_collapse_is_root_first", stack)
+
+    def test_inclusive_shares(self):
+        """A frame counts once per sample however deep it appears."""
+
+        shares = _inclusive_shares({"a;b": 3, "a;c;b": 1})
+
+        self.assertEqual(shares["a"], 1)
+        self.assertEqual(shares["b"], 1)
+        self.assertEqual(shares["c"], 0.25)
@@ -0,0 +1,75 @@
+"""Read-only query layer tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_queries.py
+
+
+from testing import (DbTestCase, make_follow, make_like, make_message,
+                     make_user)
+from models import db
+import queries
+
+
+class QueriesTestCase(DbTestCase):
+    """Test feed, profile and list rows."""
+
+    def setUp(self):
+        """Two users; user 2 follows user 1 and likes one of their two
+        messages."""
+
+        super().setUp()
+
+        user_1 = make_user("testuser")
+        user_2 = make_user("testuser2")
+        old = make_message(user_1, "old")
+        make_message(user_1, "new")
+        make_follow(user_2, user_1)
+        make_like(user_2, old)
+
+        self.user_1_id = user_1.id
+        self.user_2_id = user_2.id
+        self.old_id = old.id
+
+    def test_home_feed(self):
+        """Feed includes followed users' messages, newest first, with the
+        viewer's like state, and adds nothing to the session."""
+
+        tracked = len(db.session.identity_map)
+        feed = queries.home_feed(
+            self.user_2_id, queries.following_ids(self.user_2_id))
+
+        self.assertEqual([m.text for m in feed], ["new", "old"])
+        self.assertEqual([m.liked for m in feed], [False, True])
+        self.assertIs(feed[0].user, feed[1].user)
+        self.assertEqual(feed[0].user.username, "testuser")
+        self.assertEqual(len(db.session.identity_map), tracked)
+
+    def test_user_profile_counts(self):
+        """Profile rows carry counts for the tabs they don't list."""
+
+        profile = queries.user_profile(self.user_1_id, self.user_2_id)
+
+        self.assertEqual(len(profile.messages), 2)
+        self.assertEqual(len(profile.followers), 1)
+        self.assertEqual(len(profile.following), 0)
+        self.assertEqual(len(profile.liked_messages), 0)
+
+    def test_user_likes(self):
+        """Likes page lists the liked messages."""
+
+        profile = queries.user_likes(self.user_2_id, self.user_2_id)
+
+        self.assertEqual([m.id for m in profile.liked_messages], [self.old_id])
+        self.assertEqual(len(profile.messages), 0)
+
+    def test_missing_user(self):
+        """Unknown users give None."""
+
+        self.assertIsNone(queries.user_profile(0))
+
+    def test_list_users_search(self):
+        """Search filters by username."""
+
+        self.assertEqual([u.username for u in queries.list_users("user2")],
+                         ["testuser2"])
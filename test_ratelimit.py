@@ -0,0 +1,154 @@
+"""Rate limiter tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_ratelimit.py
+
+
+from unittest import TestCase
+
+from flask import Flask
+
+from ratelimit import MemoryStore, RateLimiter, Rule
+
+
+class RuleTestCase(TestCase):
+    """Test parsing of rule strings."""
+
+    def test_parse_default_burst(self):
+        """Burst defaults to the request count."""
+
+        rule = Rule.parse("10/minute")
+
+        self.assertAlmostEqual(rule.rate, 10 / 60)
+        self.assertEqual(rule.burst, 10)
+
+    def test_parse_explicit_burst(self):
+        """Burst can be given after a colon."""
+
+        rule = Rule.parse("2/second:5")
+
+        self.assertEqual(rule.rate, 2)
+        self.assertEqual(rule.burst, 5)
+
+
+class MemoryStoreTestCase(TestCase):
+    """Test the in-process token bucket store."""
+
+    def setUp(self):
+        """Create a fresh store and a 1/second rule with a burst of 3."""
+
+        self.store = MemoryStore(shards=4)
+        self.rule = Rule(rate=1, burst=3)
+
+    def test_allows_burst_then_denies(self):
+        """A full bucket allows `burst` requests, then reports a wait."""
+
+        results = [self.store.consume("k", self.rule, now=100)
+                   for _ in range(4)]
+
+        self.assertEqual([allowed for allowed, _ in results],
+                         [True, True, True, False])
+        self.assertAlmostEqual(results[-1][1], 1)
+
+    def test_refills_over_time(self):
+        """Tokens come back at `rate` per second."""
+
+        for _ in range(3):
+            self.store.consume("k", self.rule, now=100)
+
+        self.assertFalse(self.store.consume("k", self.rule, now=100.5)[0])
+        self.assertTrue(self.store.consume("k", self.rule, now=101.5)[0])
+
+    def test_keys_are_independent(self):
+        """Emptying one bucket does not affect another."""
+
+        for _ in range(3):
+            self.store.consume("a", self.rule, now=100)
+
+        self.assertFalse(self.store.consume("a", self.rule, now=100)[0])
+        self.assertTrue(self.store.consume("b", self.rule, now=100)[0])
+
+    def test_evicts_least_recently_used(self):
+        """Over its size cap, a shard drops the bucket used longest ago."""
+
+        store = MemoryStore(shards=1, max_keys_per_shard=2)
+        store.consume("a", self.rule, now=100)
+        store.consume("b", self.rule, now=100)
+        store.consume("a", self.rule, now=101)
+        store.consume("c", self.rule, now=102)
+
+        self.assertEqual(list(store._shards[0]), ["a", "c"])
+
+    def test_size_bounded_under_distinct_keys(self):
+        """A flood of new keys, none of them full yet, can't grow a shard
+        past its cap."""
+
+        store = MemoryStore(shards=1, max_keys_per_shard=100)
+        for i in range(1000):
+            store.consume(f"ip:{i}", self.rule, now=100)
+
+        self.assertEqual(len(store._shards[0]), 100)
+
+
+class RateLimiterTestCase(TestCase):
+    """Test the limiter wired into a Flask app."""
+
+    def setUp(self):
+        """Create a tiny app with one throttled endpoint."""
+
+        app = Flask(__name__)
+        app.config['SECRET_KEY'] = "test"
+        app.config['RATELIMIT_RULES'] = {'ping': "2/minute"}
+
+        @app.route('/ping', methods=["GET", "POST"])
+        def ping():
+            return "pong"
+
+        self.limiter = RateLimiter(app)
+        self.client = app.test_client()
+
+    def test_returns_429_with_retry_after(self):
+        """Over-limit POSTs get a 429 and a Retry-After header."""
+
+        codes = [self.client.post('/ping').status_code for _ in range(3)]
+        resp = self.client.post('/ping')
+
+        self.assertEqual(codes, [200, 200, 429])
+        self.assertEqual(resp.status_code, 429)
+        self.assertGreaterEqual(int(resp.headers['Retry-After']), 1)
+
+    def test_get_is_not_throttled(self):
+        """Only POSTs are throttled by default."""
+
+        codes = {self.client.get('/ping').status_code for _ in range(5)}
+
+        self.assertEqual(codes, {200})
+
+    def test_user_bucket_separate_from_ip(self):
+        """A logged-in user gets their own bucket on top of the IP one."""
+
+        with self.client.session_transaction() as sess:
+            sess['curr_user'] = 1
+
+        self.client.post('/ping')
+        self.client.post('/ping')
+
+        self.assertIn("ping:user:1", self.limiter.store._shards[
+            hash("ping:user:1") % len(self.limiter.store._shards)])
+
+    def test_trusted_proxy_address(self):
+        """Behind a trusted proxy, clients get buckets by the address it
+        forwarded, and can't dodge them by sending their own header."""
+
+        self.client.application.config['RATELIMIT_TRUSTED_PROXIES'] = 1
+
+        def post(forwarded_for):
+            return self.client.post(
+                '/ping', headers={'X-Forwarded-For': forwarded_for},
+                environ_base={'REMOTE_ADDR': "10.0.0.1"}).status_code
+
+        self.assertEqual([post("1.1.1.1"), post("1.1.1.1"),
+                          post("1.1.1.1")], [200, 200, 429])
+        self.assertEqual(post("2.2.2.2"), 200)
+        self.assertEqual(post("spoofed, 1.1.1.1"), 429)
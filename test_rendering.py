@@ -0,0 +1,67 @@
+"""Template pipeline tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_rendering.py
+
+
+import os
+import tempfile
+from unittest import TestCase
+
+from flask import Flask
+from jinja2 import DictLoader
+
+from rendering import TemplatePipeline, render_page
+
+TEMPLATES = {
+    'base.html': "<main>{% block content %}{% endblock %}</main>",
+    'list.html': ("{% extends 'base.html' %}{% block content %}"
+                  "{% for i in items %}<p>{{ i }}</p>{% endfor %}"
+                  "{% endblock %}"),
+}
+
+
+class TemplatePipelineTestCase(TestCase):
+    """Test production template settings and streaming."""
+
+    def make_app(self, **config):
+        """Create an app with the test templates and the given config."""
+
+        app = Flask(__name__)
+        app.config['TEMPLATE_BYTECODE_CACHE_DIR'] = tempfile.mkdtemp()
+        app.config.update(config)
+        app.jinja_env.loader = DictLoader(TEMPLATES)
+        TemplatePipeline(app)
+        return app
+
+    def test_development_defaults(self):
+        """Without production mode the Jinja environment is untouched."""
+
+        app = self.make_app()
+
+        self.assertIsNone(app.jinja_env.bytecode_cache)
+        self.assertFalse(app.jinja_env.trim_blocks)
+
+    def test_production_precompiles(self):
+        """Production mode compiles every template into the bytecode cache."""
+
+        app = self.make_app(TEMPLATE_PRODUCTION=True)
+        cache_dir = app.config['TEMPLATE_BYTECODE_CACHE_DIR']
+
+        self.assertTrue(app.jinja_env.trim_blocks)
+        self.assertFalse(app.jinja_env.auto_reload)
+        self.assertEqual(len(os.listdir(cache_dir)),
+                         len(app.jinja_env.list_templates(extensions=["html"])))
+
+    def test_render_page_streams(self):
+        """render_page returns a streamed response when streaming is on."""
+
+        app = self.make_app(TEMPLATE_STREAMING=True)
+
+        with app.test_request_context():
+            resp = render_page('list.html', items=range(3))
+
+            self.assertTrue(resp.is_streamed)
+            self.assertEqual(resp.get_data(as_text=True),
+                             "<main><p>0</p><p>1</p><p>2</p></main>")
@@ -0,0 +1,144 @@
+"""Activity rollup tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_rollups.py
+
+
+from datetime import date, datetime
+
+from testing import (app, DbTestCase, make_follow, make_like, make_message,
+                     make_user)
+from app import rollups
+from models import db, DailyUserStats
+from rollups import backfill, daily_totals, top_users
+
+DAY_1 = datetime(2024, 3, 14, 9, 0)
+DAY_2 = datetime(2024, 3, 15, 9, 0)
+
+
+class RollupsTestCase(DbTestCase):
+    """Test recording, flushing, backfilling and reading rollups."""
+
+    def setUp(self):
+        super().setUp()
+        rollups._pending.clear()
+
+        self.author = make_user("author")
+        self.fan = make_user("fan")
+
+    def flush(self):
+        return rollups.flush(db.session.connection())
+
+    def stats(self, user, day):
+        row = db.session.get(DailyUserStats, (day, user.id))
+        return row and {name: getattr(row, name) for name in
+                        ('posts', 'likes_given', 'likes_received',
+                         'follows_gained', 'follows_lost')}
+
+    def test_deltas_add_up(self):
+        """Deltas coalesce in memory and add to what's stored; an unlike
+        takes a like back."""
+
+        rollups.posted(self.author.id, now=DAY_1)
+        rollups.liked(self.fan.id, self.author.id, now=DAY_1)
+        self.flush()
+        rollups.liked(self.fan.id, self.author.id, now=DAY_1)
+        rollups.liked(self.fan.id, self.author.id, False, now=DAY_1)
+        rollups.followed(self.author.id, now=DAY_1)
+        self.flush()
+
+        self.assertEqual(self.stats(self.author, DAY_1.date()),
+                         {'posts': 1, 'likes_given': 0, 'likes_received': 1,
+                          'follows_gained': 1, 'follows_lost': 0})
+        self.assertEqual(self.stats(self.fan, DAY_1.date())['likes_given'], 1)
+
+    def test_write_paths_record(self):
+        """Posting, liking and following through the views count."""
+
+        self.login(self.author)
+        self.client.post("/messages/new", data={"text": "Hello"})
+        message_id = self.client.get("/api/v1/feed").json['data'][0]['id']
+
+        stranger = make_user("stranger")
+        self.login(self.fan)
+        self.client.post(f"/messages/{message_id}/like")
+        # Following twice, or unfollowing someone not followed, isn't a
+        # change.
+        for _ in range(2):
+            self.client.post(f"/users/follow/{self.author.id}")
+            self.client.post(f"/users/stop-following/{stranger.id}")
+        self.flush()
+
+        today = datetime.utcnow().date()
+        author = self.stats(self.author, today)
+        self.assertEqual((author['posts'], author['likes_received'],
+                          author['follows_gained']), (1, 1, 1))
+        self.assertIsNone(self.stats(stranger, today))
+
+    def test_totals_and_top_users(self):
+        """Totals cover every day in range; leaderboards rank by the
+        counter over the week."""
+
+        rollups.posted(self.author.id, now=DAY_1)
+        rollups.posted(self.author.id, now=DAY_2)
+        rollups.posted(self.fan.id, now=DAY_2)
+        rollups.liked(self.fan.id, self.author.id, now=DAY_2)
+        self.flush()
+
+        totals = daily_totals(3, today=DAY_2.date())
+        self.assertEqual([(day, counts['posts']) for day, counts in totals],
+                         [(date(2024, 3, 13), 0), (date(2024, 3, 14), 1),
+                          (date(2024, 3, 15), 2)])
+
+        self.assertEqual(
+            [(name, n) for _, name, n
+             in top_users('posts', 7, today=DAY_2.date())],
+            [("author", 2), ("fan", 1)])
+        self.assertEqual(
+            [name for _, name, _
+             in top_users('likes_received', 1, today=DAY_2.date())],
+            ["author"])
+
+    def test_backfill(self):
+        """Backfill counts posts and likes on the message's day and
+        follows on the backfill's day, across chunks."""
+
+        messages = [make_message(self.author, timestamp=DAY_1),
+                    make_message(self.author, timestamp=DAY_2),
+                    make_message(self.fan, timestamp=DAY_2)]
+        make_like(self.fan, messages[0])
+        make_like(self.fan, messages[1])
+        make_follow(self.fan, self.author)
+        rollups.posted(self.author.id, now=DAY_1)
+        self.flush()
+
+        written = backfill(db.session.connection(), chunk_size=2,
+                           today=DAY_2.date())
+
+        self.assertGreater(written, 0)
+        self.assertEqual(self.stats(self.author, DAY_1.date()),
+                         {'posts': 1, 'likes_given': 0, 'likes_received': 1,
+                          'follows_gained': 0, 'follows_lost': 0})
+        self.assertEqual(self.stats(self.author, DAY_2.date()),
+                         {'posts': 1, 'likes_given': 0, 'likes_received': 1,
+                          'follows_gained': 1, 'follows_lost': 0})
+        self.assertEqual(self.stats(self.fan, DAY_2.date())['likes_given'], 1)
+
+    def test_admin_page(self):
+        """Only admins see the stats page."""
+
+        rollups.posted(self.author.id)
+        self.flush()
+        db.session.commit()
+        self.login(self.author)
+
+        self.assertEqual(self.client.get("/admin/stats").status_code, 404)
+
+        app.config['ADMIN_USERNAMES'] = {"author"}
+        try:
+            html = self.client.get("/admin/stats").get_data(as_text=True)
+        finally:
+            app.config['ADMIN_USERNAMES'] = set()
+
+        self.assertIn("@author</a> (1)", html)
@@ -0,0 +1,392 @@
+"""Sharding tests, with each shard in its own SQLite file."""
+
+# run these tests like:
+#
+#    python -m unittest test_sharding.py
+
+
+import os
+import shutil
+import tempfile
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from sqlalchemy import delete, event, func, select
+
+from testing import app, clear_tables, make_message, make_user
+import app as app_module
+from app import CURR_USER_KEY, sharding as app_sharding
+from models import (db, Follows, Like, Message, ShardBucket, ShardSequence,
+                    User)
+from sharding import Sharding, ShardMoving
+
+SHARD_CONFIG = {
+    'SHARD_BUCKETS': 4,
+    'SHARD_MAP_TTL': 0,
+    'SHARD_ID_BLOCK': 10,
+    'SHARD_MOVE_BATCH_SIZE': 2,
+    'SHARD_MOVE_ROWS_PER_SECOND': 0,
+}
+
+
+class ShardingTestCase(TestCase):
+    """Test routing, ids, the scattered home feed and moving buckets."""
+
+    def setUp(self):
+        clear_tables()
+        self.dir = tempfile.mkdtemp()
+        self.saved = {key: app.config.get(key)
+                      for key in ('SHARDS', *SHARD_CONFIG)}
+        app.config.update(SHARD_CONFIG, SHARDS={
+            name: f"sqlite:///{os.path.join(self.dir, name)}.db"
+            for name in ("a", "b")})
+
+        self.sharding = Sharding(app)
+        self.sharding.init_shards()
+        self.session = self.sharding.session()
+
+        self.statements = {name: 0 for name in self.sharding.engines}
+        for name, engine in self.sharding.engines.items():
+            event.listen(engine, 'before_cursor_execute',
+                         self._counter(name))
+
+    def _counter(self, name):
+        def count(*args):
+            self.statements[name] += 1
+        return count
+
+    def tearDown(self):
+        self.session.close()
+        for engine in self.sharding.engines.values():
+            engine.dispose()
+        app.config.update(self.saved)
+        app.extensions['sharding'] = app_sharding
+        db.session.remove()
+        clear_tables()
+        shutil.rmtree(self.dir)
+
+    def add_user(self, username, user_id=None):
+        user = User(id=user_id, username=username,
+                    email=f"{username}@test.com", password="x")
+        self.session.add(user)
+        self.session.commit()
+        return user
+
+    def rows(self, shard, model):
+        return self.sharding._on_shard(
+            shard, select(model.__table__)).all()
+
+    ##########################################################################
+    # Routing
+
+    def test_rows_follow_their_owner(self):
+        """A user's messages and likes, and the follows they make, land on
+        the user's shard; ids are unique across shards."""
+
+        # Buckets 0 and 2 are on a, 1 and 3 on b.
+        alice = self.add_user("alice", 4)
+        bob = self.add_user("bob", 5)
+        post = Message(text="hi from bob", user_id=bob.id)
+        self.session.add(post)
+        self.session.flush()
+        self.session.add_all([
+            Like(user_id=alice.id, message_id=post.id),
+            Follows(user_following_id=alice.id,
+                    user_being_followed_id=bob.id),
+        ])
+        self.session.commit()
+
+        self.assertEqual([row.id for row in self.rows("a", User)], [4])
+        self.assertEqual([row.id for row in self.rows("b", User)], [5])
+        self.assertEqual([row.text for row in self.rows("b", Message)],
+                         ["hi from bob"])
+        self.assertEqual(len(self.rows("a", Like)), 1)
+        self.assertEqual(len(self.rows("a", Follows)), 1)
+        self.assertEqual(self.rows("b", Like) + self.rows("b", Follows), [])
+
+        carol = self.add_user("carol")
+        dave = self.add_user("dave")
+        self.assertEqual(len({alice.id, bob.id, carol.id, dave.id}), 4)
+        self.assertNotEqual(self.sharding.shard_for(carol.id),
+                            self.sharding.shard_for(dave.id))
+
+    def test_queries_go_to_owners_shards(self):
+        alice = self.add_user("alice", 4)
+        self.add_user("bob", 5)
+        self.session.add(Message(text="hi", user_id=alice.id))
+        self.session.commit()
+        self.session.expunge_all()
+        self.statements.update(a=0, b=0)
+
+        self.assertEqual(self.session.get(User, 4).username, "alice")
+        self.assertEqual(
+            self.session.query(Message).filter(
+                Message.user_id == 4).count(), 1)
+        self.assertEqual(
+            len(self.session.query(User).filter(
+                User.id.in_([4, 8])).all()), 1)
+        self.assertEqual(self.statements, {'a': 3, 'b': 0})
+
+        # Not by owner: every shard.
+        self.assertEqual(
+            self.session.query(User).order_by(User.username).all()[1]
+            .username, "bob")
+        self.assertEqual(self.statements, {'a': 4, 'b': 1})
+
+    def test_frozen_bucket_refuses_writes(self):
+        alice = self.add_user("alice", 4)
+        self.add_user("bob", 5)
+        db.session.get(ShardBucket, 0).state = "frozen"
+        db.session.commit()
+
+        self.session.add(Message(text="hi", user_id=alice.id))
+        with self.assertRaises(ShardMoving):
+            self.session.flush()
+        self.session.rollback()
+
+        # Other buckets carry on; reads of the frozen one too.
+        self.session.add(Message(text="hi", user_id=5))
+        self.session.commit()
+        self.assertEqual(self.session.get(User, 4).username, "alice")
+
+        # A bulk delete that could reach the frozen bucket waits.
+        with self.assertRaises(ShardMoving):
+            self.session.query(Like).filter(Like.message_id == 1).delete()
+
+    ##########################################################################
+    # Home feed
+
+    def test_home_feed_gathers_across_shards(self):
+        """The feed merges followed users' messages from every shard,
+        newest first, and marks the viewer's likes."""
+
+        alice = self.add_user("alice", 4)
+        bob = self.add_user("bob", 5)
+        carol = self.add_user("carol", 7)
+        self.add_user("stranger", 6)
+        start = datetime(2024, 1, 1)
+        for minute, author in enumerate(
+                [alice, bob, carol, bob, alice, 6, carol, bob]):
+            self.session.add(Message(
+                text=f"m{minute}", user_id=getattr(author, 'id', author),
+                timestamp=start + timedelta(minutes=minute)))
+        self.session.add_all([
+            Follows(user_following_id=4, user_being_followed_id=5),
+            Follows(user_following_id=4, user_being_followed_id=7),
+        ])
+        self.session.commit()
+        liked = self.session.query(Message).filter(
+            Message.text == "m3").one()
+        self.session.add(Like(user_id=4, message_id=liked.id))
+        self.session.commit()
+
+        feed = self.sharding.home_feed(4, limit=4)
+
+        self.assertEqual([m.text for m in feed], ["m7", "m6", "m4", "m3"])
+        self.assertEqual([m.user.username for m in feed],
+                         ["bob", "carol", "alice", "bob"])
+        self.assertEqual([m.liked for m in feed],
+                         [False, False, False, True])
+
+        older = self.sharding.home_feed(
+            4, limit=4, before=(feed[-1].timestamp, feed[-1].id))
+        self.assertEqual([m.text for m in older], ["m2", "m1", "m0"])
+
+    ##########################################################################
+    # Moving
+
+    def test_move_bucket(self):
+        """A bucket's rows move with it, including changes made between
+        the copy and the freeze; the old shard is cleared."""
+
+        alice = self.add_user("alice", 4)
+        bob = self.add_user("bob", 5)
+        posts = [Message(text=f"m{i}", user_id=alice.id) for i in range(5)]
+        self.session.add_all(posts)
+        self.session.flush()
+        self.session.add_all([
+            Like(user_id=bob.id, message_id=posts[0].id),
+            Follows(user_following_id=alice.id,
+                    user_being_followed_id=bob.id),
+        ])
+        self.session.commit()
+        deleted_id = posts[1].id
+
+        copy = self.sharding._copy
+
+        def copy_then_write(bucket, source, target):
+            copy(bucket, source, target)
+            if self.sharding.bucket_map()[bucket][1] == "active":
+                # Between the first copy and the freeze.
+                with self.sharding.engines["a"].begin() as conn:
+                    conn.execute(delete(Message.__table__).where(
+                        Message.id == deleted_id))
+                    conn.execute(User.__table__.update().where(
+                        User.id == 4).values(bio="moved"))
+
+        self.sharding._copy = copy_then_write
+        self.sharding.move_bucket(0, "b")
+
+        self.assertEqual(self.sharding.bucket_map()[0], ("b", "active"))
+        self.assertEqual(self.rows("a", User), [])
+        self.assertEqual(self.rows("a", Message), [])
+        self.assertEqual(self.rows("a", Follows), [])
+        self.assertEqual(len(self.rows("b", Message)), 4)
+        self.assertNotIn(deleted_id,
+                         [row.id for row in self.rows("b", Message)])
+        # Bob's like of a moved message stays with bob.
+        self.assertEqual(len(self.rows("b", Like)), 1)
+
+        self.session.expunge_all()
+        self.assertEqual(self.session.get(User, 4).bio, "moved")
+        self.assertEqual(
+            self.session.query(Message).filter(
+                Message.user_id == 4).count(), 4)
+
+    def test_failed_move_leaves_bucket_where_it_was(self):
+        self.add_user("alice", 4)
+
+        def fail(*args):
+            raise RuntimeError("copy failed")
+
+        prune = self.sharding._prune
+        self.sharding._prune = fail
+        with self.assertRaises(RuntimeError):
+            self.sharding.move_bucket(0, "b")
+        self.sharding._prune = prune
+
+        self.assertEqual(self.sharding.bucket_map()[0], ("a", "active"))
+        self.assertEqual(len(self.rows("a", User)), 1)
+        self.assertEqual(self.rows("b", User), [])
+
+    def test_rebalance_plan(self):
+        for row in ShardBucket.query:
+            row.shard = "a"
+        db.session.commit()
+
+        moves = self.sharding.plan_rebalance()
+
+        self.assertEqual(len(moves), 2)
+        self.assertTrue(all(source == "a" and target == "b"
+                            for _, source, target in moves))
+
+        for bucket, _, target in moves:
+            self.sharding.move_bucket(bucket, target)
+        self.assertEqual(self.sharding.plan_rebalance(), [])
+
+    def test_load_from_unsharded(self):
+        """`load` copies the app's own database onto the shards, and new
+        ids start past what it had."""
+
+        users = [make_user(f"user{i}") for i in range(4)]
+        for user in users:
+            make_message(user)
+        user_ids = [user.id for user in users]
+        ShardBucket.query.delete()
+        ShardSequence.query.delete()
+        db.session.commit()
+        self.sharding.init_shards()
+
+        self.sharding.load(db.engine)
+
+        for user_id in user_ids:
+            shard = self.sharding.shard_for(user_id)
+            self.assertEqual(self.sharding._on_shard(shard, select(
+                func.count()).select_from(Message.__table__).where(
+                    Message.user_id == user_id)).scalar(), 1)
+        self.assertGreater(self.add_user("new").id, max(user_ids))
+
+    ##########################################################################
+    # Views
+
+    def use_in_views(self):
+        """Have the views write to and read from these shards, logged in
+        as a new user; returns the client."""
+
+        app_module.sharding = self.sharding
+        self.addCleanup(setattr, app_module, 'sharding', app_sharding)
+        app.config['RATELIMIT_ENABLED'] = False
+        self.addCleanup(app.config.update, RATELIMIT_ENABLED=True)
+
+        client = app.test_client()
+        resp = client.post("/signup", data={
+            "username": "alice", "email": "alice@test.com",
+            "password": "password"})
+        self.assertEqual(resp.status_code, 302)
+        return client
+
+    def test_views_write_to_shards(self):
+        """Signups, profile edits, messages, likes and follows reach the
+        shards as well as the app's database; deletions too."""
+
+        client = self.use_in_views()
+        alice_id = User.query.filter_by(username="alice").one().id
+        bob = make_user("bob")
+        self.sharding.save_user(bob)
+        post = make_message(bob, "hi from bob")
+        self.sharding.save_message(post)
+        bob_id, post_id = bob.id, post.id
+
+        client.post("/users/profile", data={
+            "username": "alice", "password": "password", "bio": "Hi!"})
+        client.post("/messages/new", data={"text": "hi from alice"})
+        client.post(f"/messages/{post_id}/like")
+        client.post(f"/users/follow/{bob_id}")
+
+        self.session.expunge_all()
+        self.assertEqual(self.session.get(User, alice_id).bio, "Hi!")
+        self.assertEqual(
+            [m.text for m in self.session.query(Message).filter(
+                Message.user_id == alice_id)], ["hi from alice"])
+        self.assertIsNotNone(self.session.get(Like, (alice_id, post_id)))
+        self.assertIsNotNone(self.session.get(Follows, (bob_id, alice_id)))
+
+        # Unlike and unfollow.
+        client.post(f"/messages/{post_id}/like")
+        client.post(f"/users/stop-following/{bob_id}")
+        self.session.expunge_all()
+        self.assertIsNone(self.session.get(Like, (alice_id, post_id)))
+        self.assertIsNone(self.session.get(Follows, (bob_id, alice_id)))
+
+        # Bob deletes his message, with alice's like of it, then his
+        # account.
+        client.post(f"/messages/{post_id}/like")
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = bob_id
+        client.post(f"/messages/{post_id}/delete")
+        self.assertEqual(self.rows(self.sharding.shard_for(alice_id), Like),
+                         [])
+        client.post(f"/users/follow/{alice_id}")
+        client.post("/users/delete")
+        self.session.expunge_all()
+        self.assertIsNone(self.session.get(User, bob_id))
+        self.assertEqual(self.session.query(Follows).all(), [])
+        self.assertEqual(User.query.count(), 1)
+
+    def test_views_read_feed_from_shards(self):
+        client = self.use_in_views()
+        alice = User.query.filter_by(username="alice").one()
+        # Only on the shards, to tell where the feed came from.
+        self.session.add(Message(text="only on a shard", user_id=alice.id))
+        self.session.commit()
+
+        self.assertIn("only on a shard",
+                      client.get("/").get_data(as_text=True))
+        self.assertEqual([m['text'] for m in
+                          client.get("/api/v1/feed").json['data']],
+                         ["only on a shard"])
+
+    def test_frozen_bucket_refuses_view_writes(self):
+        """A write to a frozen bucket is a 503, and the app's database
+        doesn't get it either."""
+
+        client = self.use_in_views()
+        alice = User.query.filter_by(username="alice").one()
+        db.session.get(ShardBucket,
+                       self.sharding.bucket_for(alice.id)).state = "frozen"
+        db.session.commit()
+
+        resp = client.post("/messages/new", data={"text": "hi"})
+
+        self.assertEqual(resp.status_code, 503)
+        self.assertEqual(Message.query.count(), 0)
@@ -0,0 +1,172 @@
+"""Trending tag tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_trending.py
+
+
+from unittest import TestCase
+
+from flask import Flask
+
+from models import db, TrendingSnapshot
+from trending import (CountMinSketch, HeavyHitters, Trending, WindowedSketch,
+                      parse_tags, HASHTAG, MENTION)
+from testing import DATABASE_URL
+
+
+class ParseTagsTestCase(TestCase):
+    """Test picking hashtags and mentions out of message text."""
+
+    def test_hashtags_and_mentions(self):
+        """Hashtags are lowercased, mentions keep their case."""
+
+        hashtags, mentions = parse_tags("#Flask is fun @Alice #python", 5)
+
+        self.assertEqual(hashtags, ["flask", "python"])
+        self.assertEqual(mentions, ["Alice"])
+
+    def test_ignores_mid_word(self):
+        """An email address or a#b isn't a tag."""
+
+        self.assertEqual(parse_tags("mail me@example.com or a#b", 5),
+                         ([], []))
+
+    def test_capped_and_distinct(self):
+        """Repeats count once and only the first `limit` tags are kept."""
+
+        hashtags, _ = parse_tags("#a #a #b #c #d", 2)
+
+        self.assertEqual(hashtags, ["a", "b"])
+
+
+class CountMinSketchTestCase(TestCase):
+    """Test the count-min sketch."""
+
+    def test_never_undercounts(self):
+        """Every estimate is at least the true count, even with
+        collisions."""
+
+        sketch = CountMinSketch(width=16, depth=3)
+        counts = {f"tag{i}": i for i in range(50)}
+        for key, n in counts.items():
+            sketch.add(key, n)
+
+        for key, n in counts.items():
+            self.assertGreaterEqual(sketch.query(key), n)
+
+    def test_merge_adds_counts(self):
+        """Merging two sketches is the same as counting into one."""
+
+        a = CountMinSketch(width=64, depth=4)
+        b = CountMinSketch(width=64, depth=4)
+        a.add("x", 3)
+        b.add("x", 4)
+        a.merge(b)
+
+        self.assertEqual(a.query("x"), 7)
+
+
+class WindowedSketchTestCase(TestCase):
+    """Test the sliding window of sketches."""
+
+    def test_old_buckets_expire(self):
+        """Counts older than the window stop counting."""
+
+        sketch = WindowedSketch(64, 4, bucket_seconds=10, buckets=3)
+        sketch.add("x", now=100)
+        sketch.add("x", now=115)
+
+        self.assertEqual(sketch.query("x", now=125), 2)
+        self.assertEqual(sketch.query("x", now=135), 1)
+
+        sketch.expire(now=135)
+        self.assertEqual(len(sketch.sketches), 1)
+
+
+class HeavyHittersTestCase(TestCase):
+    """Test top-k tracking."""
+
+    def test_top_k(self):
+        """The most frequent keys win and the candidate set stays
+        bounded."""
+
+        hitters = HeavyHitters(WindowedSketch(256, 4, 60, 5), k=2,
+                               capacity=4)
+        for key, n in [("a", 5), ("b", 1), ("c", 9), ("d", 2), ("e", 1),
+                       ("f", 1)]:
+            for _ in range(n):
+                hitters.add(key, now=100)
+
+        self.assertEqual(hitters.top(), [("c", 9), ("a", 5)])
+        self.assertLessEqual(len(hitters.estimates), 4)
+
+
+class TrendingSyncTestCase(TestCase):
+    """Test merging counts from several processes through the database."""
+
+    def setUp(self):
+        """Two Trending instances on one database stand in for two
+        workers (without their background threads)."""
+
+        self.app = Flask(__name__)
+        self.app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URL
+        self.app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+        db.init_app(self.app)
+
+        with self.app.app_context():
+            db.create_all()
+            TrendingSnapshot.query.delete()
+            db.session.commit()
+
+        self.workers = []
+        for _ in range(2):
+            worker = Trending(self.app)
+            worker.enabled = True
+            self.workers.append(worker)
+
+    def test_sync_merges_workers(self):
+        """Each worker sees the other's counts after both have synced."""
+
+        a, b = self.workers
+        a.record("#flask #flask2 @alice", now=1000)
+        b.record("#flask", now=1000)
+
+        a.sync(now=1001)
+        b.sync(now=1002)
+        a.sync(now=1003)
+
+        self.assertEqual(a.trending()[HASHTAG][0], ("flask", 2))
+        self.assertEqual(b.trending()[HASHTAG][0], ("flask", 2))
+        self.assertEqual(b.trending()[MENTION], [("alice", 1)])
+
+    def test_restart_loads_snapshot(self):
+        """A new process picks up the saved counts on its first sync."""
+
+        self.workers[0].record("#flask", now=1000)
+        self.workers[0].sync(now=1001)
+
+        restarted = Trending(self.app)
+        restarted.enabled = True
+        restarted.sync(now=1002)
+
+        self.assertEqual(restarted.trending()[HASHTAG], [("flask", 1)])
+
+    def test_syncer_starts_with_first_request(self):
+        """Loading the app (as a preloading gunicorn master does) starts
+        no syncer; the first request in the process does."""
+
+        app = Flask(__name__)
+        app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URL
+        app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+        app.config['TRENDING_ENABLED'] = True
+        app.config['TRENDING_SNAPSHOT_INTERVAL'] = 3600
+        db.init_app(app)
+        app.add_url_rule("/", "index", lambda: "ok")
+
+        trending = Trending(app)
+        self.addCleanup(trending.close)
+        self.assertIsNone(trending._syncer)
+
+        app.test_client().get("/")
+        self.assertTrue(trending._syncer.is_alive())
@@ -5,30 +5,13 @@
 #    python -m unittest test_user_model.py
 
 
-import os
-from unittest import TestCase
+import tracemalloc
+from datetime import datetime
+from sqlalchemy import event, func, insert, literal, select
 from sqlalchemy.exc import IntegrityError
 
-from models import db, User, Message, Follows
-
-# BEFORE we import our app, let's set an environmental variable
-# to use a different database for tests (we need to do this
-# before we import our app, since that will have already
-# connected to the database
-
-os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
-
-
-# Now we can import app
-
-from app import app, CURR_USER_KEY
-app.config['WTF_CSRF_ENABLED'] = False
-
-# Create our tables (we do this here, so we only create the tables
-# once for all tests --- in each test, we'll delete the data
-# and create fresh new clean test data
-
-db.create_all()
+from testing import app, DbTestCase
+from models import db, User, Message, Follows, Like
 
 TEST_USER_DATA_1 = {
     "email":"test@test.com",
@@ -51,15 +34,13 @@ TEST_USER_DATA_3 = {
     "image_url": None
 }
 
-class UserModelTestCase(TestCase):
+class UserModelTestCase(DbTestCase):
     """Test User Model."""
 
     def setUp(self):
         """Create test client, add sample data."""
 
-        Follows.query.delete()
-        Message.query.delete()
-        User.query.delete()
+        super().setUp()
 
         test_user_1 = User.signup(**TEST_USER_DATA_1)
         test_user_2 = User.signup(**TEST_USER_DATA_2)
@@ -69,12 +50,11 @@ class UserModelTestCase(TestCase):
         self.test_user_1_id = test_user_1.id
         self.test_user_2_id = test_user_2.id
 
-        self.client = app.test_client()
-    
-    def tearDown(self):
-        """Clean up fouled transactions."""
+    def assertConstraintOn(self, column, exception):
+        """The database's own error names `column`. PostgreSQL and SQLite
+        word it differently, so check only for the name."""
 
-        db.session.rollback()
+        self.assertRegex(str(exception.orig), rf"\b{column}\b")
 
     def test_user_model(self):
         """Does basic model work?"""
@@ -172,7 +152,8 @@ class UserModelTestCase(TestCase):
         self.assertEqual(test_user_3.username,"testuser3")
         self.assertEqual(test_user_3.email,"test3@test.com")
         self.assertNotEqual(test_user_3.password,"HASHED_PASSWORD")
-        self.assertTrue(test_user_3.password.startswith("$2b$12$"))
+        self.assertTrue(test_user_3.password.startswith(
+            f"$2b${app.config['BCRYPT_LOG_ROUNDS']:02d}$"))
         self.assertEqual(test_user_3.image_url,"/static/images/default-pic.png")
 
 
@@ -184,7 +165,7 @@ class UserModelTestCase(TestCase):
         with self.assertRaises(IntegrityError) as context:
             db.session.commit()
 
-        self.assertIn('null value in column "username"', str(context.exception))
+        self.assertConstraintOn("username", context.exception)
 
 
     def test_none_email_signup(self):
@@ -195,9 +176,58 @@ class UserModelTestCase(TestCase):
         with self.assertRaises(IntegrityError) as context:
             db.session.commit()
 
-        self.assertIn('null value in column "email"', str(context.exception))
+        self.assertConstraintOn("email", context.exception)
     
 
+    def test_delete_by_id_is_set_based(self):
+        """Deleting a user with 100k messages is one statement, and their
+        messages, likes and follows go without being loaded."""
+
+        # Generate the messages in the database rather than sending 100k
+        # rows over.
+        numbers = select(literal(1).label("n")).cte(recursive=True)
+        numbers = numbers.union_all(
+            select(numbers.c.n + 1).where(numbers.c.n < 100_000))
+        db.session.execute(
+            insert(Message).from_select(
+                ["text", "timestamp", "user_id"],
+                select(literal("warble"), literal(datetime.utcnow()),
+                       literal(self.test_user_1_id)).select_from(numbers)))
+
+        message_id = db.session.execute(
+            select(func.min(Message.id))).scalar()
+        db.session.add(Follows(user_being_followed_id=self.test_user_1_id,
+                               user_following_id=self.test_user_2_id))
+        db.session.add(Like(user_id=self.test_user_2_id,
+                            message_id=message_id))
+        db.session.commit()
+
+        statements = []
+
+        def count(conn, cursor, statement, *args):
+            # Not the test harness's SAVEPOINTs.
+            if "SAVEPOINT" not in statement:
+                statements.append(statement)
+
+        engine = db.get_engine(app)
+        event.listen(engine, "before_cursor_execute", count)
+        tracemalloc.start()
+        try:
+            User.delete_by_id(self.test_user_1_id)
+            db.session.commit()
+            _current, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+            event.remove(engine, "before_cursor_execute", count)
+
+        self.assertEqual(len(statements), 1)
+        self.assertLess(peak, 1024 * 1024)
+
+        self.assertEqual(Message.query.count(), 0)
+        self.assertEqual(Follows.query.count(), 0)
+        self.assertEqual(Like.query.count(), 0)
+        self.assertEqual(User.query.count(), 1)
+
     def test_none_password_signup(self):
         """Test user authentication does not work with invalid password."""
      
@@ -215,7 +245,7 @@ class UserModelTestCase(TestCase):
         with self.assertRaises(IntegrityError) as context:
             db.session.commit()
         
-        self.assertIn('duplicate key value violates unique constraint "users_username_key"', str(context.exception))
+        self.assertConstraintOn("username", context.exception)
 
 
     def test_nonunique_email_signup(self):
@@ -226,4 +256,4 @@ class UserModelTestCase(TestCase):
         with self.assertRaises(IntegrityError) as context:
             db.session.commit()
         
-        self.assertIn('duplicate key value violates unique constraint "users_email_key"', str(context.exception))
\ No newline at end of file
+        self.assertConstraintOn("email", context.exception)
\ No newline at end of file
@@ -5,70 +5,25 @@
 #    python -m unittest test_user_model.py
 
 
-import os
-from unittest import TestCase
 from flask import session, g
 
+from testing import CURR_USER_KEY, DbTestCase, make_user
 from models import db, User, Message, Follows
 
-# BEFORE we import our app, let's set an environmental variable
-# to use a different database for tests (we need to do this
-# before we import our app, since that will have already
-# connected to the database
-
-os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
-
-
-# Now we can import app
-
-from app import app, CURR_USER_KEY
-app.config['WTF_CSRF_ENABLED'] = False
-
-# Create our tables (we do this here, so we only create the tables
-# once for all tests --- in each test, we'll delete the data
-# and create fresh new clean test data
-
-db.create_all()
-
-TEST_USER_DATA_1 = {
-    "email":"test@test.com",
-    "username":"testuser",
-    "password":"HASHED_PASSWORD",
-    "image_url":""
-}
-
-TEST_USER_DATA_2 = {
-    "email":"test2@test.com",
-    "username":"testuser2",
-    "password":"HASHED_PASSWORD",
-    "image_url":""
-}
-
-class UserViewsTestCase(TestCase):
+class UserViewsTestCase(DbTestCase):
     """Test views for users."""
 
     def setUp(self):
         """Create test client, add sample data."""
 
-        Follows.query.delete()
-        Message.query.delete()
-        User.query.delete()
+        super().setUp()
 
-        test_user_1 = User.signup(**TEST_USER_DATA_1)
-        test_user_2 = User.signup(**TEST_USER_DATA_2)
-        db.session.add_all([test_user_1, test_user_2])
-        db.session.commit()
+        test_user_1 = make_user("testuser")
+        test_user_2 = make_user("testuser2")
 
         self.test_user_1_id = test_user_1.id
         self.test_user_2_id = test_user_2.id
 
-        self.client = app.test_client()
-    
-    def tearDown(self):
-        """Clean up fouled transactions."""
-
-        db.session.rollback()
-
 
 ##############################################################################
 # User signup/login/logout
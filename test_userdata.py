@@ -0,0 +1,176 @@
+"""Export and import tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_userdata.py
+
+
+import io
+import time
+from unittest import TestCase
+
+import orjson
+
+from testing import (app, clear_tables, make_follow, make_like,
+                     make_message, make_user)
+from app import CURR_USER_KEY
+from models import db, Follows, Like, Message, User
+from userdata import (CSV_COLUMNS, Throttle, export_chunks, import_records,
+                      read_records)
+
+
+class UserDataTestCase(TestCase):
+    """Test exporting, importing and pacing. Exports read through their
+    own connections, so these tests commit and clean up."""
+
+    def setUp(self):
+        clear_tables()
+        app.config['RATELIMIT_ENABLED'] = False
+
+        self.alice = make_user("alice", bio="Hi, I'm Alice")
+        self.bob = make_user("bob")
+        self.alice_id, self.bob_id = self.alice.id, self.bob.id
+        for i in range(5):
+            make_message(self.alice, f"Warble, number {i}")
+        bobs = make_message(self.bob, "Bob's warble")
+        make_like(self.alice, bobs)
+        make_follow(self.alice, self.bob)
+
+        self.client = app.test_client()
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.alice_id
+
+    def tearDown(self):
+        app.config['RATELIMIT_ENABLED'] = True
+        db.session.remove()
+        clear_tables()
+
+    def export(self, fmt, **kwargs):
+        return b"".join(export_chunks(db.engine, fmt, **kwargs))
+
+    def test_export_endpoint(self):
+        """The logged-in user's records stream as NDJSON, users first,
+        without the password hash."""
+
+        resp = self.client.post("/api/v1/export", buffered=False)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.mimetype, "application/x-ndjson")
+        self.assertIn("warbler-alice.ndjson",
+                      resp.headers['Content-Disposition'])
+        self.assertTrue(resp.is_streamed)
+        body = b"".join(resp.response)
+        resp.close()
+
+        records = [orjson.loads(line) for line in body.splitlines()]
+        self.assertEqual([r['type'] for r in records],
+                         ["user"] + ["message"] * 5 + ["like", "follow"])
+        self.assertEqual(records[0]['bio'], "Hi, I'm Alice")
+        self.assertNotIn('password', records[0])
+        self.assertEqual(records[1]['text'], "Warble, number 0")
+        self.assertEqual(records[-1], {'type': "follow",
+                                       'user_id': self.alice_id,
+                                       'followed_id': self.bob_id})
+
+    def test_export_csv(self):
+        with self.client.post("/api/v1/export?format=csv") as resp:
+            self.assertEqual(resp.mimetype, "text/csv")
+            lines = resp.data.decode().splitlines()
+
+        self.assertEqual(lines[0], ",".join(CSV_COLUMNS))
+        self.assertEqual(len(lines), 1 + 8)
+        self.assertIn('"Warble, number 0"', lines[2])
+
+        self.assertEqual(
+            self.client.post("/api/v1/export?format=xml").status_code, 400)
+
+    def test_concurrent_exports_capped(self):
+        """Past EXPORT_MAX_CONCURRENT streams in progress, a 503."""
+
+        open_responses = [self.client.post("/api/v1/export", buffered=False)
+                          for _ in range(app.config['EXPORT_MAX_CONCURRENT'])]
+        resp = self.client.post("/api/v1/export")
+        self.assertEqual(resp.status_code, 503)
+        self.assertIn('Retry-After', resp.headers)
+
+        # Closing a response gives its slot back, read to the end or not.
+        open_responses.pop().close()
+        with self.client.post("/api/v1/export") as resp:
+            self.assertEqual(resp.status_code, 200)
+        for resp in open_responses:
+            resp.close()
+
+    def test_round_trip(self):
+        """What's exported with passwords imports into empty tables as it
+        was, in either format, and importing again changes nothing."""
+
+        for fmt in ("ndjson", "csv"):
+            with self.subTest(fmt=fmt):
+                data = self.export(fmt, include_passwords=True, batch_size=2)
+                before = self.export("ndjson", include_passwords=True)
+                clear_tables()
+
+                counts = import_records(
+                    db.engine, read_records(io.BytesIO(data), fmt),
+                    batch_size=2)
+                self.assertEqual((counts['user'], counts['message'],
+                                  counts['like'], counts['follow']),
+                                 (2, 6, 1, 1))
+                self.assertEqual(
+                    self.export("ndjson", include_passwords=True), before)
+
+                import_records(db.engine,
+                               read_records(io.BytesIO(data), fmt))
+                self.assertEqual(Message.query.count(), 6)
+                self.assertIsNotNone(
+                    User.authenticate("alice", "password"))
+
+    def test_import_drops_missing_references(self):
+        """Rows whose user or message isn't there are dropped; users
+        without a password get a random one."""
+
+        lines = [
+            {'type': "user", 'id': 9001, 'username': "carol",
+             'email': "carol@test.com"},
+            {'type': "message", 'id': 9001, 'user_id': 9001, 'text': "hi",
+             'timestamp': "2024-01-02T03:04:05"},
+            {'type': "message", 'id': 9002, 'user_id': 404, 'text': "lost",
+             'timestamp': "2024-01-02T03:04:05"},
+            {'type': "like", 'user_id': 9001, 'message_id': 404},
+            {'type': "follow", 'user_id': 9001, 'followed_id': self.bob_id},
+        ]
+        data = b"".join(orjson.dumps(line) + b"\n" for line in lines)
+
+        counts = import_records(db.engine,
+                                read_records(io.BytesIO(data), "ndjson"))
+
+        self.assertEqual(counts['message dropped'], 1)
+        self.assertEqual(counts['like dropped'], 1)
+        self.assertEqual(counts['follow dropped'], 0)
+        carol = User.query.filter_by(username="carol").one()
+        self.assertTrue(carol.password)
+        self.assertEqual(Like.query.filter_by(user_id=9001).count(), 0)
+        self.assertEqual(Follows.query.filter_by(
+            user_following_id=9001).count(), 1)
+
+        # New rows get ids past the imported ones.
+        self.assertGreater(make_user("dave").id, 9001)
+
+    def test_cli(self):
+        runner = app.test_cli_runner()
+        result = runner.invoke(args=["userdata", "export", "alice"])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertEqual(len(result.stdout_bytes.splitlines()), 8)
+
+        result = runner.invoke(args=["userdata", "export", "nobody"])
+        self.assertNotEqual(result.exit_code, 0)
+
+    def test_throttle(self):
+        throttle = Throttle(1000)
+        start = time.monotonic()
+        for _ in range(5):
+            throttle(20)
+        self.assertGreaterEqual(time.monotonic() - start, 0.09)
+
+        start = time.monotonic()
+        Throttle(0)(10 ** 6)
+        self.assertLess(time.monotonic() - start, 0.01)
@@ -0,0 +1,74 @@
+"""Warm-up tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_warmup.py
+
+
+from datetime import datetime, timedelta
+
+from testing import app, DbTestCase, make_message, make_user
+from app import entity_cache, warm_up
+from models import User
+
+
+class WarmUpTestCase(DbTestCase):
+    """Test the warm-up phases and readiness."""
+
+    def setUp(self):
+        super().setUp()
+        app.config['WARMUP_ENABLED'] = True
+        warm_up.ready = False
+        warm_up.steps = {}
+        entity_cache.enabled = True
+        entity_cache.clear()
+
+    def tearDown(self):
+        app.config['WARMUP_ENABLED'] = False
+        app.config['WARMUP_PRIME_USERS'] = 0
+        warm_up.ready = True
+        warm_up.steps = {}
+        entity_cache.enabled = False
+        entity_cache.clear()
+        super().tearDown()
+
+    def test_ready_once_run(self):
+        resp = self.client.get("/health/ready")
+        self.assertEqual(resp.status_code, 503)
+        self.assertFalse(resp.json['ready'])
+
+        warm_up.prepare()
+        warm_up.run()
+
+        resp = self.client.get("/health/ready")
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(set(resp.json['steps']),
+                         {'mappers', 'templates', 'statements', 'pool'})
+
+    def test_primes_recently_active(self):
+        """Each worker primes the caches of the most recent posters."""
+
+        now = datetime.utcnow()
+        users = [make_user(f"user{i}") for i in range(3)]
+        for i, user in enumerate(users):
+            make_message(user, timestamp=now - timedelta(minutes=i))
+        app.config['WARMUP_PRIME_USERS'] = 2
+
+        warm_up.run()
+
+        self.assertTrue(warm_up.ready)
+        self.assertIn('caches', warm_up.steps)
+        self.assertEqual(entity_cache.stats()['User']['entries'], 2)
+        hits = entity_cache.hits[User]
+        for user in users[:2]:
+            entity_cache.get(User, user.id)
+        self.assertEqual(entity_cache.hits[User], hits + 2)
+
+    def test_disabled_is_ready(self):
+        app.config['WARMUP_ENABLED'] = False
+        warm_up.ready = True
+
+        warm_up.run()
+
+        self.assertEqual(warm_up.steps, {})
+        self.assertEqual(self.client.get("/health/ready").status_code, 200)
@@ -0,0 +1,163 @@
+"""Write buffer tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_writebuffer.py
+
+
+import json
+import os
+import tempfile
+import threading
+from unittest import TestCase
+
+from testing import app
+from models import db, User, Message, Follows, Like
+from writebuffer import WriteBuffer
+
+
+class WriteBufferTestCase(TestCase):
+    """Test buffering, flushing and crash recovery of like/follow writes."""
+
+    def setUp(self):
+        """Create two users and a message, and an enabled buffer logging
+        to a temp directory."""
+
+        Like.query.delete()
+        Follows.query.delete()
+        Message.query.delete()
+        User.query.delete()
+
+        self.user_1 = User.signup("testuser", "test@test.com", "password", None)
+        self.user_2 = User.signup("testuser2", "test2@test.com", "password", None)
+        db.session.commit()
+
+        self.message = Message(text="warble", user_id=self.user_1.id)
+        db.session.add(self.message)
+        db.session.commit()
+
+        self.log_dir = tempfile.mkdtemp()
+        app.config['WRITE_BUFFER_ENABLED'] = True
+        app.config['WRITE_BUFFER_WINDOW'] = 3600
+        app.config['WRITE_BUFFER_LOG'] = os.path.join(self.log_dir, "wb.log")
+
+        self.buffer = WriteBuffer(app)
+
+    def tearDown(self):
+        """Stop the buffer and clean up fouled transactions."""
+
+        self.buffer.close()
+        app.config['WRITE_BUFFER_ENABLED'] = False
+        db.session.rollback()
+        db.session.remove()
+
+    def test_toggles_coalesce(self):
+        """Three toggles leave one pending like and no rows until flush."""
+
+        for _ in range(3):
+            self.buffer.toggle_like(self.user_2, self.message)
+
+        self.assertEqual(Like.query.count(), 0)
+        self.assertTrue(self.buffer.has_liked(self.message, self.user_2))
+
+        self.assertEqual(self.buffer.flush(), 1)
+        self.assertEqual(Like.query.count(), 1)
+
+    def test_follow_visible_before_flush(self):
+        """Pending follows show up in reads before they are written."""
+
+        self.buffer.set_following(self.user_2, self.user_1, True)
+
+        self.assertEqual(Follows.query.count(), 0)
+        self.assertTrue(self.buffer.is_following(self.user_1, self.user_2))
+        self.assertEqual(self.buffer.following_ids(self.user_2),
+                         {self.user_1.id})
+        self.assertEqual(self.buffer.pending_follows(self.user_2.id),
+                         {self.user_1.id: True})
+
+    def test_set_following_reports_changes(self):
+        """Following twice, or unfollowing someone not followed, is a
+        no-op, with or without rows in the database."""
+
+        self.assertTrue(self.buffer.set_following(self.user_2, self.user_1,
+                                                  True))
+        self.assertFalse(self.buffer.set_following(self.user_2, self.user_1,
+                                                   True))
+        self.buffer.flush()
+
+        self.assertFalse(self.buffer.set_following(self.user_2, self.user_1,
+                                                   True))
+        self.assertTrue(self.buffer.set_following(self.user_2, self.user_1,
+                                                  False))
+        self.assertFalse(self.buffer.set_following(self.user_1, self.user_2,
+                                                   False))
+
+    def test_recovers_log_of_dead_process(self):
+        """A log left by a crashed worker is replayed and flushed."""
+
+        dead_log = app.config['WRITE_BUFFER_LOG'] + ".999999"
+        with open(dead_log, "w") as log:
+            log.write(f'["like", {self.user_2.id}, {self.message.id}, true]\n')
+            log.write('["follow", 1')
+
+        self.buffer._recover()
+
+        self.assertEqual(Like.query.count(), 1)
+        self.assertFalse(os.path.exists(dead_log))
+
+    def test_like_of_deleted_message_dropped(self):
+        """A pending like whose message was deleted before the flush isn't
+        written, even where likes.message_id isn't a foreign key."""
+
+        self.buffer.toggle_like(self.user_2, self.message)
+        Message.delete_owned(self.message.id, self.user_1.id)
+        db.session.commit()
+
+        self.buffer.flush()
+
+        self.assertEqual(Like.query.count(), 0)
+
+    def test_failed_flushes_keep_log(self):
+        """A batch that fails to write stays in the crash log through
+        later failed flushes, so a crash during an outage loses nothing."""
+
+        self.buffer.toggle_like(self.user_2, self.message)
+
+        def outage(batch):
+            raise RuntimeError("database down")
+
+        self.buffer._write_batch = outage
+        for _ in range(2):
+            with self.assertRaises(RuntimeError):
+                self.buffer.flush()
+        del self.buffer._write_batch
+
+        recovered = {}
+        for name in os.listdir(self.log_dir):
+            with open(os.path.join(self.log_dir, name)) as log:
+                for line in log:
+                    kind, user_id, target_id, state = json.loads(line)
+                    recovered[(kind, user_id, target_id)] = state
+
+        self.assertEqual(recovered,
+                         {("like", self.user_2.id, self.message.id): True})
+
+    def test_concurrent_toggles_all_count(self):
+        """Toggles of one pair from many threads each flip the state, so
+        an even number of them leaves it unliked."""
+
+        user_id, message = self.user_2.id, self.message
+        user = User.query.get(user_id)
+
+        def toggle():
+            with app.app_context():
+                for _ in range(25):
+                    self.buffer.toggle_like(user, message)
+
+        threads = [threading.Thread(target=toggle) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertFalse(self.buffer.has_liked(message, user))
@@ -0,0 +1,182 @@
+"""Test harness: database setup, transactional test cases and factories.
+
+Import this before `app` in a test module. It points the app at the test
+database, WARBLER_TEST_DATABASE_URL (default postgresql:///warbler_test),
+builds it with the testing profile (cheap bcrypt, no CSRF tokens) and
+creates the tables.
+
+SQLite works too, in a file (sqlite:////tmp/warbler_test.db), but not in
+memory: every pooled connection would open its own empty database, and
+the tests that read through their own connections need to see the same
+tables.
+
+DbTestCase runs each test inside a transaction that's rolled back
+afterwards, so every test starts from empty tables without deleting
+anything. Code under test can still commit and roll back: the session
+sits in a SAVEPOINT, and those only move it. Tests whose code opens its
+own connections (write buffer flushes, partition maintenance, trending
+sync) can't see uncommitted rows, so they keep committing and cleaning up
+after themselves.
+
+The factories add rows with sensible defaults and commit them (inside
+DbTestCase, that only moves the SAVEPOINT), so requests made by the test
+client see them. Users get a password hash computed once, so none of them
+costs a bcrypt round.
+
+`python runtests.py` runs the suite sharded across processes, each with
+its own copy of the database.
+"""
+
+import itertools
+import os
+from functools import lru_cache
+from unittest import TestCase
+
+os.environ.setdefault('WARBLER_CONFIG', "testing")
+
+DATABASE_URL = os.environ.get('WARBLER_TEST_DATABASE_URL',
+                              "postgresql:///warbler_test")
+os.environ['DATABASE_URL'] = DATABASE_URL
+
+from sqlalchemy import event  # noqa: E402
+from sqlalchemy.engine import make_url  # noqa: E402
+
+_url = make_url(DATABASE_URL)
+if (_url.get_backend_name() == "sqlite"
+        and _url.database in (None, "", ":memory:")):
+    raise RuntimeError("in-memory SQLite can't hold the test database; "
+                       "use a file, e.g. sqlite:////tmp/warbler_test.db")
+
+from app import app, CURR_USER_KEY  # noqa: E402
+from models import db, Follows, Like, Message, User  # noqa: E402
+
+ON_SQLITE = db.engine.dialect.name == "sqlite"
+
+db.create_all()
+
+PASSWORD = "password"
+
+_sequence = itertools.count(1)
+
+
+def clear_tables():
+    """Delete every row, committed, for tests that commit."""
+
+    for table in reversed(db.metadata.sorted_tables):
+        db.session.execute(table.delete())
+    db.session.commit()
+
+
+class DbTestCase(TestCase):
+    """A test case whose database changes are all rolled back.
+
+    Provides `self.client`, a test client, and `self.login(user)`.
+    Subclasses that override setUp/tearDown must call super().
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        """Start from empty tables, whatever committing tests left."""
+
+        super().setUpClass()
+        clear_tables()
+
+    def setUp(self):
+        self.connection = db.engine.connect()
+        self.transaction = self.connection.begin()
+        if ON_SQLITE:
+            # pysqlite begins transactions itself, late, and so breaks
+            # SAVEPOINT; on this connection, begin one right away.
+            self.connection.connection.isolation_level = None
+            self.connection.exec_driver_sql("BEGIN")
+        self.savepoint = self.connection.begin_nested()
+
+        db.session.remove()
+        # Objects the test made stay readable after the code under test
+        # commits and its request closes the session.
+        db.session.session_factory.configure(
+            bind=self.connection, binds={}, expire_on_commit=False)
+        event.listen(db.session, "after_transaction_end",
+                     self._restart_savepoint)
+
+        self.client = app.test_client()
+
+    def _restart_savepoint(self, session, transaction):
+        """Once the session commits or rolls back the SAVEPOINT, start
+        the next one."""
+
+        if not self.savepoint.is_active:
+            self.savepoint = self.connection.begin_nested()
+
+    def tearDown(self):
+        db.session.remove()
+        event.remove(db.session, "after_transaction_end",
+                     self._restart_savepoint)
+
+        factory = db.session.session_factory
+        factory.kw.pop('bind', None)
+        factory.kw.pop('binds', None)
+        factory.kw.pop('expire_on_commit', None)
+
+        self.transaction.rollback()
+        if ON_SQLITE:
+            self.connection.connection.isolation_level = ""
+        self.connection.close()
+
+    def login(self, user):
+        """Log the test client in as `user` (a User or an id)."""
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = getattr(user, 'id', user)
+
+
+##############################################################################
+# Factories
+
+
+@lru_cache()
+def password_hash(password=PASSWORD):
+    return User.hash_password(password)
+
+
+def make_user(username=None, password=PASSWORD, **fields):
+    """A User whose password is `password`."""
+
+    username = username or f"user{next(_sequence)}"
+    fields.setdefault('email', f"{username}@test.com")
+
+    user = User(username=username, password=password_hash(password),
+                **fields)
+    db.session.add(user)
+    db.session.commit()
+    return user
+
+
+def make_message(user, text=None, **fields):
+    """A Message by `user`."""
+
+    message = Message(text=text or f"warble {next(_sequence)}",
+                      user_id=getattr(user, 'id', user), **fields)
+    db.session.add(message)
+    db.session.commit()
+    return message
+
+
+def make_follow(follower, followed):
+    """`follower` follows `followed`."""
+
+    follow = Follows(user_following_id=getattr(follower, 'id', follower),
+                     user_being_followed_id=getattr(followed, 'id', followed))
+    db.session.add(follow)
+    db.session.commit()
+    return follow
+
+
+def make_like(user, message):
+    """`user` likes `message`."""
+
+    like = Like(user_id=getattr(user, 'id', user),
+                message_id=getattr(message, 'id', message))
+    db.session.add(like)
+    db.session.commit()
+    return like
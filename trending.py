@@ -0,0 +1,470 @@
+"""Trending hashtags and mentions over a sliding window.
+
+Counting tags exactly would mean scanning every recent message. Instead
+each posted message's #hashtags and @mentions are added to a count-min
+sketch: a fixed grid of counters that can overcount a little but never
+undercounts, in memory that doesn't grow with the number of distinct tags.
+The window is split into buckets aligned to wall-clock time, each with its
+own sketch, and buckets that fall out of the window are dropped. A small
+heap of candidate tags with their estimated counts gives the top K.
+
+Each process counts the messages it saw. Every TRENDING_SNAPSHOT_INTERVAL
+seconds a background thread adds those counts into the shared snapshot
+row in the database and reloads the merged result, so all workers agree,
+and a restart picks up where the last snapshot left off.
+"""
+
+import atexit
+import hashlib
+import heapq
+import json
+import os
+import re
+import threading
+import time
+from array import array
+from datetime import datetime
+
+from sqlalchemy import insert, select, update
+
+from models import db, TrendingSnapshot
+
+HASHTAG = "hashtag"
+MENTION = "mention"
+
+HASHTAG_RE = re.compile(r"(?<!\w)#(\w{1,50})")
+MENTION_RE = re.compile(r"(?<!\w)@(\w{1,50})")
+
+
+def parse_tags(text, limit):
+    """The first `limit` distinct hashtags (lowercased) and mentions in a
+    message, as two lists."""
+
+    hashtags = _first_distinct(
+        (tag.lower() for tag in HASHTAG_RE.findall(text)), limit)
+    mentions = _first_distinct(MENTION_RE.findall(text), limit)
+
+    return hashtags, mentions
+
+
+def _first_distinct(tokens, limit):
+    seen = []
+    for token in tokens:
+        if len(seen) == limit:
+            break
+        if token not in seen:
+            seen.append(token)
+    return seen
+
+
+class CountMinSketch:
+    """`depth` rows of `width` counters; a key increments one counter per
+    row and its estimate is the smallest of those counters."""
+
+    __slots__ = ('width', 'depth', 'counts')
+
+    def __init__(self, width, depth, counts=None):
+        self.width = width
+        self.depth = depth
+        self.counts = counts or array('I', bytes(4 * width * depth))
+
+    def _cells(self, key):
+        # Two halves of one digest give every row its own hash
+        # (Kirsch-Mitzenmacher); blake2b rather than hash() so cells are
+        # the same in every process.
+        digest = hashlib.blake2b(key.encode(), digest_size=8).digest()
+        h1 = int.from_bytes(digest[:4], "little")
+        h2 = int.from_bytes(digest[4:], "little") | 1
+        return [row * self.width + (h1 + row * h2) % self.width
+                for row in range(self.depth)]
+
+    def add(self, key, count=1):
+        for cell in self._cells(key):
+            self.counts[cell] += count
+
+    def query(self, key):
+        return min(self.counts[cell] for cell in self._cells(key))
+
+    def merge(self, other):
+        """Add another sketch of the same shape into this one."""
+
+        counts = self.counts
+        for i, n in enumerate(other.counts):
+            if n:
+                counts[i] += n
+
+
+class WindowedSketch:
+    """Count-min sketches for each `bucket_seconds` slice of the last
+    `buckets` slices. Buckets are numbered from the Unix epoch, so two
+    processes' buckets for the same slice line up and can be merged."""
+
+    def __init__(self, width, depth, bucket_seconds, buckets):
+        self.width = width
+        self.depth = depth
+        self.bucket_seconds = bucket_seconds
+        self.buckets = buckets
+        self.sketches = {}
+
+    def _bucket(self, now):
+        return int(now // self.bucket_seconds)
+
+    def add(self, key, now, count=1):
+        bucket = self._bucket(now)
+        sketch = self.sketches.get(bucket)
+        if sketch is None:
+            sketch = self.sketches[bucket] = CountMinSketch(
+                self.width, self.depth)
+            self.expire(now)
+        sketch.add(key, count)
+
+    def query(self, key, now):
+        oldest = self._bucket(now) - self.buckets
+        return sum(sketch.query(key)
+                   for bucket, sketch in self.sketches.items()
+                   if bucket > oldest)
+
+    def expire(self, now):
+        """Drop buckets that have slid out of the window."""
+
+        oldest = self._bucket(now) - self.buckets
+        for bucket in [b for b in self.sketches if b <= oldest]:
+            del self.sketches[bucket]
+
+    def merge(self, other):
+        for bucket, sketch in other.sketches.items():
+            mine = self.sketches.get(bucket)
+            if mine is None:
+                self.sketches[bucket] = CountMinSketch(
+                    self.width, self.depth, array('I', sketch.counts))
+            else:
+                mine.merge(sketch)
+
+    def shape(self):
+        return [self.width, self.depth, self.bucket_seconds]
+
+
+class HeavyHitters:
+    """Top-k keys of a WindowedSketch.
+
+    Keeps up to `capacity` candidates with their last estimate in a dict,
+    plus a min-heap of (estimate, key) to find the one to evict. Heap
+    entries go stale as estimates change; they're skipped when popped and
+    the heap is rebuilt when it grows too far past the dict.
+    """
+
+    def __init__(self, sketch, k, capacity=None):
+        self.sketch = sketch
+        self.k = k
+        self.capacity = capacity or 4 * k
+        self.estimates = {}
+        self._heap = []
+
+    def add(self, key, now, count=1):
+        self.sketch.add(key, now, count)
+        self.offer(key, self.sketch.query(key, now))
+
+    def offer(self, key, estimate):
+        """Consider `key` with this estimate for the candidate set."""
+
+        self.estimates[key] = estimate
+        heapq.heappush(self._heap, (estimate, key))
+
+        if len(self.estimates) > self.capacity:
+            self._evict_smallest()
+        if len(self._heap) > 4 * self.capacity:
+            self._rebuild()
+
+    def _evict_smallest(self):
+        while self._heap:
+            estimate, key = heapq.heappop(self._heap)
+            if self.estimates.get(key) == estimate:
+                del self.estimates[key]
+                return
+
+    def _rebuild(self):
+        self._heap = [(estimate, key)
+                      for key, estimate in self.estimates.items()]
+        heapq.heapify(self._heap)
+
+    def consider(self, keys, now):
+        """Offer each of `keys` that has a count at its current
+        estimate."""
+
+        for key in keys:
+            estimate = self.sketch.query(key, now)
+            if estimate:
+                self.offer(key, estimate)
+
+    def refresh(self, now):
+        """Re-estimate every candidate, e.g. after buckets expired or
+        another process's counts were merged in."""
+
+        self.sketch.expire(now)
+        self.estimates = {key: self.sketch.query(key, now)
+                          for key in self.estimates}
+        self.estimates = {key: n for key, n in self.estimates.items() if n}
+        self._rebuild()
+
+    def top(self):
+        """[(key, estimate)] for the k largest candidates."""
+
+        return heapq.nlargest(self.k, self.estimates.items(),
+                              key=lambda item: item[1])
+
+
+class Trending:
+    """Count hashtags and mentions in posted messages.
+
+    Configuration (app.config):
+
+    - TRENDING_ENABLED: count tags and sync snapshots (default False)
+    - TRENDING_WINDOW: seconds of history that count (default 1 hour)
+    - TRENDING_BUCKETS: slices the window is split into (default 12)
+    - TRENDING_TOP_K: tags shown per kind (default 10)
+    - TRENDING_SKETCH_WIDTH / TRENDING_SKETCH_DEPTH: count-min sketch size
+      (default 2048 x 4, 32KB per bucket)
+    - TRENDING_MAX_TAGS_PER_MESSAGE: hashtags (and, separately, mentions)
+      counted from one message (default 5)
+    - TRENDING_SNAPSHOT_INTERVAL: seconds between syncs with the database
+      (default 30)
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.enabled = False
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._syncer = None
+        self._merged = {}
+        self._local = {}
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Register the `trending()` template global and, when enabled, sync
+        from each process's first request on."""
+
+        app.config.setdefault('TRENDING_ENABLED', False)
+        app.config.setdefault('TRENDING_WINDOW', 60 * 60)
+        app.config.setdefault('TRENDING_BUCKETS', 12)
+        app.config.setdefault('TRENDING_TOP_K', 10)
+        app.config.setdefault('TRENDING_SKETCH_WIDTH', 2048)
+        app.config.setdefault('TRENDING_SKETCH_DEPTH', 4)
+        app.config.setdefault('TRENDING_MAX_TAGS_PER_MESSAGE', 5)
+        app.config.setdefault('TRENDING_SNAPSHOT_INTERVAL', 30)
+
+        self.app = app
+        self.enabled = app.config['TRENDING_ENABLED']
+
+        for kind in (HASHTAG, MENTION):
+            self._merged[kind] = HeavyHitters(
+                self._new_sketch(), app.config['TRENDING_TOP_K'])
+            self._local[kind] = self._new_sketch()
+
+        app.add_template_global(self.trending)
+
+        if self.enabled:
+            app.before_request(self.ensure_syncer)
+            atexit.register(self.close)
+            os.register_at_fork(after_in_child=self._after_fork)
+
+    def _new_sketch(self):
+        config = self.app.config
+        return WindowedSketch(
+            config['TRENDING_SKETCH_WIDTH'],
+            config['TRENDING_SKETCH_DEPTH'],
+            config['TRENDING_WINDOW'] / config['TRENDING_BUCKETS'],
+            config['TRENDING_BUCKETS'])
+
+    ##########################################################################
+    # Counting
+
+    def record(self, text, now=None):
+        """Count the tags in a newly posted message."""
+
+        if not self.enabled:
+            return
+
+        now = now or time.time()
+        hashtags, mentions = parse_tags(
+            text, self.app.config['TRENDING_MAX_TAGS_PER_MESSAGE'])
+
+        with self._lock:
+            for kind, tags in ((HASHTAG, hashtags), (MENTION, mentions)):
+                for tag in tags:
+                    self._local[kind].add(tag, now)
+                    # The merged view counts what's been synced so far;
+                    # add locally too so our own posts show up right away.
+                    self._merged[kind].add(tag, now)
+
+    def trending(self):
+        """Template global: {'hashtag': [(tag, count)], 'mention': [...]}."""
+
+        if not self.enabled:
+            return {HASHTAG: [], MENTION: []}
+
+        with self._lock:
+            return {kind: hitters.top()
+                    for kind, hitters in self._merged.items()}
+
+    ##########################################################################
+    # Snapshots
+
+    def sync(self, now=None):
+        """Add counts taken since the last sync into the database snapshot
+        and adopt the merged result."""
+
+        now = now or time.time()
+
+        with self._lock:
+            local, self._local = self._local, {
+                kind: self._new_sketch() for kind in self._local}
+
+        try:
+            merged = self._write_snapshots(local, now)
+        except Exception:
+            with self._lock:
+                for kind, sketch in local.items():
+                    self._local[kind].merge(sketch)
+            raise
+
+        with self._lock:
+            for kind, hitters in merged.items():
+                # Our own counts recorded while the sync ran aren't in the
+                # snapshot yet.
+                hitters.sketch.merge(self._local[kind])
+                hitters.refresh(now)
+                hitters.consider(self._merged[kind].estimates, now)
+                self._merged[kind] = hitters
+
+    def _write_snapshots(self, local, now):
+        """Merge each kind's local counts into its snapshot row under a row
+        lock. Returns kind -> HeavyHitters over the merged counts."""
+
+        table = TrendingSnapshot.__table__
+        engine = db.get_engine(self.app)
+        merged = {}
+
+        with engine.begin() as conn:
+            for kind, delta in local.items():
+                row = conn.execute(
+                    select(table.c.meta, table.c.counts)
+                    .where(table.c.kind == kind)
+                    .with_for_update()
+                ).first()
+
+                hitters = HeavyHitters(
+                    self._new_sketch(), self.app.config['TRENDING_TOP_K'])
+                if row is not None:
+                    candidates = _load(hitters.sketch, row.meta, row.counts)
+                else:
+                    candidates = []
+
+                hitters.sketch.merge(delta)
+                hitters.sketch.expire(now)
+                hitters.consider(candidates, now)
+                hitters.consider(self._local_keys(kind), now)
+
+                meta, counts = _dump(hitters)
+                values = dict(meta=meta, counts=counts,
+                              saved_at=datetime.utcfromtimestamp(now))
+                if row is None:
+                    conn.execute(insert(table).values(kind=kind, **values))
+                else:
+                    conn.execute(update(table)
+                                 .where(table.c.kind == kind)
+                                 .values(**values))
+
+                merged[kind] = hitters
+
+        return merged
+
+    def _local_keys(self, kind):
+        """Candidates this process knows about, so tags only we have seen
+        make it into the shared snapshot."""
+
+        with self._lock:
+            return list(self._merged[kind].estimates)
+
+    def ensure_syncer(self):
+        """before_request: start syncing in the process that serves the
+        request. A gunicorn master that preloads the app never serves one,
+        so it never syncs; only its workers do."""
+
+        if self._syncer is None:
+            with self._lock:
+                if self._syncer is None:
+                    self._start_syncer()
+
+    def _start_syncer(self):
+        """Sync every TRENDING_SNAPSHOT_INTERVAL seconds on a daemon
+        thread; the first sync loads the last snapshot."""
+
+        interval = self.app.config['TRENDING_SNAPSHOT_INTERVAL']
+
+        def run():
+            wait = 0
+            while not self._stop.wait(wait):
+                wait = interval
+                try:
+                    self.sync()
+                except Exception:
+                    self.app.logger.exception("trending sync failed")
+
+        self._syncer = threading.Thread(
+            target=run, name="trending-sync", daemon=True)
+        self._syncer.start()
+
+    def _after_fork(self):
+        """In a forked worker, forget any syncer the parent had; the
+        worker's first request starts its own."""
+
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._syncer = None
+
+    def close(self):
+        """Stop syncing and save what's been counted since the last sync."""
+
+        if self._syncer is None:
+            return
+
+        self._stop.set()
+        try:
+            self.sync()
+        except Exception:
+            self.app.logger.exception("final trending sync failed")
+
+
+def _dump(hitters):
+    """(meta JSON, counts bytes) for a snapshot row."""
+
+    sketch = hitters.sketch
+    buckets = sorted(sketch.sketches)
+    meta = json.dumps({
+        'shape': sketch.shape(),
+        'buckets': buckets,
+        'candidates': list(hitters.estimates),
+    })
+    counts = b"".join(sketch.sketches[b].counts.tobytes() for b in buckets)
+    return meta, counts
+
+
+def _load(sketch, meta, counts):
+    """Fill `sketch` from a snapshot row and return the row's candidate
+    keys. Snapshots taken with a different sketch shape are ignored."""
+
+    meta = json.loads(meta)
+    if meta['shape'] != sketch.shape():
+        return []
+
+    size = 4 * sketch.width * sketch.depth
+    for i, bucket in enumerate(meta['buckets']):
+        cells = array('I')
+        cells.frombytes(counts[i * size:(i + 1) * size])
+        sketch.sketches[bucket] = CountMinSketch(
+            sketch.width, sketch.depth, cells)
+
+    return meta['candidates']
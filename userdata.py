@@ -0,0 +1,402 @@
+"""Streaming export and bulk import of users' data.
+
+An export is a user's profile, messages, likes and follows (or, from the
+CLI, any number of users'), as NDJSON, one {"type": ...} record per line,
+or as CSV with a `type` column and one column per field. Users come
+first, then messages, likes and follows, so an import never meets a
+reference before what it refers to. Rows are read through server-side
+cursors a batch at a time and written out as each batch arrives, so
+memory stays flat however long the history.
+
+The importer reads the same formats and inserts a batch at a time, each
+in its own transaction, skipping rows that already exist (ON CONFLICT DO
+NOTHING) and rows whose user or message isn't there. Ids are kept, so
+it's meant for moving accounts into a database whose ids don't overlap,
+and an interrupted import can simply be run again.
+
+Both are paced to EXPORT_ROWS_PER_SECOND / IMPORT_ROWS_PER_SECOND, and
+each worker runs at most EXPORT_MAX_CONCURRENT exports at once (the API
+endpoint is also rate limited), so they don't crowd out interactive
+requests.
+
+The API's exports never include password hashes; `flask userdata export
+--with-passwords` does, so migrated users can still log in. Users
+imported without one get a random password.
+"""
+
+import csv
+import io
+import secrets
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+
+import click
+import orjson
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import func, select, text
+from werkzeug.exceptions import ServiceUnavailable
+
+from models import db, dialect_insert, Follows, Like, Message, User
+
+FORMATS = {
+    'ndjson': "application/x-ndjson",
+    'csv': "text/csv",
+}
+
+# Fields of each record type, in export order.
+FIELDS = {
+    'user': ('id', 'username', 'email', 'image_url', 'header_image_url',
+             'bio', 'location', 'password'),
+    'message': ('id', 'user_id', 'text', 'timestamp'),
+    'like': ('user_id', 'message_id'),
+    'follow': ('user_id', 'followed_id'),
+}
+
+CSV_COLUMNS = ('type', *dict.fromkeys(
+    field for fields in FIELDS.values() for field in fields))
+
+INT_FIELDS = {'id', 'user_id', 'message_id', 'followed_id'}
+
+
+class Throttle:
+    """Sleeps just enough to keep to `rate` rows a second; 0 means no
+    limit."""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.started = time.monotonic()
+        self.rows = 0
+
+    def __call__(self, rows):
+        if not self.rate:
+            return
+        self.rows += rows
+        ahead = self.rows / self.rate - (time.monotonic() - self.started)
+        if ahead > 0:
+            time.sleep(ahead)
+
+
+class UserData:
+    """Export and import users' data.
+
+    Configuration (app.config):
+
+    - EXPORT_BATCH_SIZE: rows fetched from the cursor at a time (default
+      1000)
+    - EXPORT_ROWS_PER_SECOND: pace of an export (default 5000; 0 for
+      unthrottled)
+    - EXPORT_MAX_CONCURRENT: exports one worker streams at once; more get
+      a 503 (default 2)
+    - IMPORT_BATCH_SIZE: rows per insert and transaction (default 1000)
+    - IMPORT_ROWS_PER_SECOND: pace of an import (default 5000; 0 for
+      unthrottled)
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self._slots = None
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('EXPORT_BATCH_SIZE', 1000)
+        app.config.setdefault('EXPORT_ROWS_PER_SECOND', 5000)
+        app.config.setdefault('EXPORT_MAX_CONCURRENT', 2)
+        app.config.setdefault('IMPORT_BATCH_SIZE', 1000)
+        app.config.setdefault('IMPORT_ROWS_PER_SECOND', 5000)
+
+        self.app = app
+        self._slots = threading.BoundedSemaphore(
+            app.config['EXPORT_MAX_CONCURRENT'])
+
+        app.cli.add_command(userdata_cli)
+
+    ##########################################################################
+    # Export
+
+    def export_response(self, user, fmt):
+        """A streamed download of `user`'s data in format `fmt`; 503 if
+        this worker is already streaming its share of exports."""
+
+        if not self._slots.acquire(blocking=False):
+            raise ServiceUnavailable(
+                "Too many exports in progress; try again shortly.",
+                retry_after=30)
+
+        config = self.app.config
+        chunks = export_chunks(
+            db.get_engine(self.app), fmt, user_ids=[user.id],
+            batch_size=config['EXPORT_BATCH_SIZE'],
+            throttle=Throttle(config['EXPORT_ROWS_PER_SECOND']))
+
+        response = self.app.response_class(chunks, mimetype=FORMATS[fmt])
+        response.headers['Content-Disposition'] = (
+            f'attachment; filename="warbler-{user.username}.{fmt}"')
+        # Given back once the server is done with the response, whether
+        # or not the client read all of it.
+        response.call_on_close(self._slots.release)
+        return response
+
+
+def export_chunks(engine, fmt, user_ids=None, include_passwords=False,
+                  batch_size=1000, throttle=None):
+    """Encoded chunks of an export of these users (all of them if None),
+    one per fetched batch."""
+
+    encode = _encode_ndjson if fmt == "ndjson" else _encode_csv
+    if fmt == "csv":
+        yield _csv_line(CSV_COLUMNS)
+
+    with engine.connect() as conn, conn.begin():
+        # stream_results: a server-side cursor where the driver has them.
+        conn = conn.execution_options(stream_results=True)
+        for kind, stmt in _export_selects(user_ids, include_passwords):
+            result = conn.execute(stmt)
+            for rows in result.partitions(batch_size):
+                yield encode(kind, rows)
+                if throttle is not None:
+                    throttle(len(rows))
+
+
+def _export_selects(user_ids, include_passwords):
+    """(type, select) in the order records are written."""
+
+    def only(column):
+        return column.in_(user_ids) if user_ids is not None else True
+
+    user_columns = [User.__table__.c[field] for field in FIELDS['user']
+                    if field != 'password' or include_passwords]
+
+    yield 'user', (select(*user_columns)
+                   .where(only(User.id)).order_by(User.id))
+    yield 'message', (select(Message.id, Message.user_id, Message.text,
+                             Message.timestamp)
+                      .where(only(Message.user_id)).order_by(Message.id))
+    yield 'like', (select(Like.user_id, Like.message_id)
+                   .where(only(Like.user_id))
+                   .order_by(Like.user_id, Like.message_id))
+    yield 'follow', (select(Follows.user_following_id.label('user_id'),
+                            Follows.user_being_followed_id
+                            .label('followed_id'))
+                     .where(only(Follows.user_following_id))
+                     .order_by(Follows.user_following_id,
+                               Follows.user_being_followed_id))
+
+
+def _encode_ndjson(kind, rows):
+    return b"".join(
+        orjson.dumps({'type': kind, **row._mapping}) + b"\n" for row in rows)
+
+
+def _encode_csv(kind, rows):
+    out = io.StringIO()
+    writer = csv.writer(out)
+    for row in rows:
+        record = row._mapping
+        writer.writerow(
+            [kind] + [_csv_value(record.get(column))
+                      for column in CSV_COLUMNS[1:]])
+    return out.getvalue().encode()
+
+
+def _csv_value(value):
+    if value is None:
+        return ""
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+
+def _csv_line(values):
+    out = io.StringIO()
+    csv.writer(out).writerow(values)
+    return out.getvalue().encode()
+
+
+##############################################################################
+# Import
+
+
+def read_records(f, fmt):
+    """(type, fields) for each record in binary file `f`."""
+
+    if fmt == "ndjson":
+        for line in f:
+            if line.strip():
+                record = orjson.loads(line)
+                yield record.pop('type'), _coerce(record)
+    else:
+        for record in csv.DictReader(io.TextIOWrapper(f, encoding="utf-8")):
+            kind = record.pop('type')
+            yield kind, _coerce(
+                {field: value for field, value in record.items()
+                 if field in FIELDS[kind]
+                 and (value != "" or field in ('bio', 'location'))})
+
+
+def _coerce(record):
+    """Ints and datetimes back from their text forms."""
+
+    for field in INT_FIELDS & record.keys():
+        record[field] = int(record[field])
+    if isinstance(record.get('timestamp'), str):
+        record['timestamp'] = datetime.fromisoformat(record['timestamp'])
+    return record
+
+
+def import_records(engine, records, batch_size=1000, throttle=None):
+    """Insert (type, fields) records a batch at a time. Returns a Counter
+    of records read and dropped for missing references, by type."""
+
+    counts = Counter()
+    batch = []
+    batch_kind = None
+
+    def flush():
+        if batch:
+            with engine.begin() as conn:
+                written = _insert_batch(conn, batch_kind, batch)
+            counts[batch_kind] += len(batch)
+            counts[f"{batch_kind} dropped"] += len(batch) - written
+            if throttle is not None:
+                throttle(len(batch))
+            batch.clear()
+
+    for kind, record in records:
+        if kind not in FIELDS:
+            raise ValueError(f"unknown record type {kind!r}")
+        if kind != batch_kind or len(batch) >= batch_size:
+            flush()
+            batch_kind = kind
+        batch.append(record)
+    flush()
+
+    with engine.begin() as conn:
+        _advance_sequences(conn)
+
+    return counts
+
+
+def _insert_batch(conn, kind, records):
+    """Insert one batch, skipping rows that exist or refer to missing
+    rows. Returns how many rows were offered to the database."""
+
+    if kind == 'user':
+        table = User.__table__
+        rows = [dict(record) for record in records]
+        missing = [row for row in rows if not row.get('password')]
+        if missing:
+            password = User.hash_password(secrets.token_urlsafe())
+            for row in missing:
+                row['password'] = password
+    elif kind == 'message':
+        table = Message.__table__
+        users = _existing(conn, User.id, {r['user_id'] for r in records})
+        rows = [record for record in records if record['user_id'] in users]
+    elif kind == 'like':
+        table = Like.__table__
+        users = _existing(conn, User.id, {r['user_id'] for r in records})
+        messages = _existing(conn, Message.id,
+                             {r['message_id'] for r in records})
+        rows = [record for record in records
+                if record['user_id'] in users
+                and record['message_id'] in messages]
+    else:
+        table = Follows.__table__
+        users = _existing(conn, User.id,
+                          {r['user_id'] for r in records}
+                          | {r['followed_id'] for r in records})
+        rows = [{'user_following_id': record['user_id'],
+                 'user_being_followed_id': record['followed_id']}
+                for record in records
+                if record['user_id'] in users
+                and record['followed_id'] in users]
+
+    if rows:
+        conn.execute(dialect_insert(conn, table).on_conflict_do_nothing(),
+                     rows)
+    return len(rows)
+
+
+def _existing(conn, column, ids):
+    return set(conn.execute(select(column).where(column.in_(ids))).scalars())
+
+
+def _advance_sequences(conn):
+    """Imported rows bring their own ids; move PostgreSQL's sequences past
+    them so new rows don't collide."""
+
+    if conn.dialect.name != "postgresql":
+        return
+
+    for table, column in (('users', User.id), ('messages', Message.id)):
+        highest = conn.execute(select(func.max(column))).scalar()
+        if highest is not None:
+            conn.execute(
+                text(f"SELECT setval(pg_get_serial_sequence('{table}', "
+                     f"'id'), :highest)"),
+                {'highest': highest})
+
+
+##############################################################################
+# CLI
+
+
+userdata_cli = AppGroup("userdata", help="Export and import users' data.")
+
+
+def _format_option(f, fmt):
+    if fmt:
+        return fmt
+    return "csv" if str(getattr(f, 'name', "")).endswith(".csv") else "ndjson"
+
+
+@userdata_cli.command("export")
+@click.argument("usernames", nargs=-1)
+@click.option("--output", "-o", type=click.File("wb"), default="-",
+              help="File to write (default stdout).")
+@click.option("--format", "fmt", type=click.Choice(sorted(FORMATS)),
+              default=None, help="Default: from the file name, else ndjson.")
+@click.option("--with-passwords", is_flag=True,
+              help="Include password hashes, for migrating accounts.")
+def export_command(usernames, output, fmt, with_passwords):
+    """Export these users' data, or everyone's."""
+
+    config = current_app.config
+    user_ids = None
+    if usernames:
+        user_ids = db.session.execute(
+            select(User.id).where(User.username.in_(usernames))
+        ).scalars().all()
+        if len(user_ids) != len(set(usernames)):
+            raise click.ClickException("Some of those users don't exist.")
+
+    for chunk in export_chunks(
+            db.engine, _format_option(output, fmt), user_ids=user_ids,
+            include_passwords=with_passwords,
+            batch_size=config['EXPORT_BATCH_SIZE'],
+            throttle=Throttle(config['EXPORT_ROWS_PER_SECOND'])):
+        output.write(chunk)
+
+
+@userdata_cli.command("import")
+@click.argument("source", type=click.File("rb"))
+@click.option("--format", "fmt", type=click.Choice(sorted(FORMATS)),
+              default=None, help="Default: from the file name, else ndjson.")
+def import_command(source, fmt):
+    """Import an export, skipping rows that already exist."""
+
+    config = current_app.config
+    counts = import_records(
+        db.engine, read_records(source, _format_option(source, fmt)),
+        batch_size=config['IMPORT_BATCH_SIZE'],
+        throttle=Throttle(config['IMPORT_ROWS_PER_SECOND']))
+
+    for kind in FIELDS:
+        click.echo(f"{kind}s: {counts[kind]} read, "
+                   f"{counts[f'{kind} dropped']} dropped for missing "
+                   f"references")
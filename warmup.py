@@ -0,0 +1,185 @@
+"""Warm-up of freshly started workers.
+
+A new worker's first requests used to pay for everything done lazily:
+configuring the mappers, compiling templates, compiling each statement
+for SQLAlchemy's cache, and opening database connections. After a deploy
+that showed up as a latency spike. Warm-up moves that work before the
+worker accepts its first request, in two phases, both run from hooks in
+gunicorn.conf.py:
+
+- prepare(), in the gunicorn master before it forks: configure mappers,
+  compile every template and run the hot read queries once, so their
+  compiled forms sit in the engine's statement cache. Workers inherit all
+  of it, in shared pages.
+- run(), in each worker before it starts accepting: fill the connection
+  pool and, with WARMUP_PRIME_USERS, prime this worker's caches for the
+  users who posted most recently: their home feeds and profiles (which
+  also warms the database's own buffers), their anonymous profile pages
+  when the page cache is on, and whatever else was registered with
+  @warm_up.primer, such as entity cache entries.
+
+GET /health/ready answers 503 until this worker's run() is done, then
+200, with the time each step took. Without WARMUP_ENABLED nothing runs
+and workers are ready from the start.
+"""
+
+import time
+
+from sqlalchemy import select
+from sqlalchemy.orm import configure_mappers
+
+import queries
+from models import db, Message
+from rendering import precompile
+
+
+class WarmUp:
+    """Warm workers up before they serve.
+
+    Configuration (app.config):
+
+    - WARMUP_ENABLED: warm up on boot and report readiness (default False)
+    - WARMUP_PRIME_USERS: recently active users whose caches each worker
+      primes (default 0)
+    - WARMUP_TIMEOUT: seconds priming may take before it stops early;
+      keep it under gunicorn's worker timeout (default 20)
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.ready = True
+        # step -> seconds
+        self.steps = {}
+        self.primers = []
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Register the readiness endpoint."""
+
+        app.config.setdefault('WARMUP_ENABLED', False)
+        app.config.setdefault('WARMUP_PRIME_USERS', 0)
+        app.config.setdefault('WARMUP_TIMEOUT', 20)
+
+        self.app = app
+        self.ready = not app.config['WARMUP_ENABLED']
+
+        app.add_url_rule("/health/ready", "warmup_ready", self.ready_view)
+
+    ##########################################################################
+    # Phases
+
+    def prepare(self):
+        """In the master: build what every worker would otherwise build
+        for itself."""
+
+        if not self.app.config['WARMUP_ENABLED']:
+            return
+
+        with self.app.app_context():
+            self._step("mappers", configure_mappers)
+            self._step("templates", lambda: precompile(self.app))
+            user_ids = self._recently_active(1)
+            self._step("statements",
+                       lambda: self._prime(user_ids, caches=False))
+
+    def run(self):
+        """In each worker: open connections and prime caches, then report
+        ready."""
+
+        if not self.app.config['WARMUP_ENABLED']:
+            return
+
+        started = time.perf_counter()
+        with self.app.app_context():
+            self._step("pool", self._fill_pool)
+            users = self.app.config['WARMUP_PRIME_USERS']
+            if users:
+                user_ids = self._recently_active(users)
+                self._step("caches", lambda: self._prime(user_ids))
+
+        self.ready = True
+        self.app.logger.info(
+            "warmed up in %.0f ms: %s", (time.perf_counter() - started) * 1000,
+            ", ".join(f"{name} {seconds * 1000:.0f} ms"
+                      for name, seconds in self.steps.items()))
+
+    def primer(self, f):
+        """Register `f(user_id)` to prime caches for a recently active
+        user."""
+
+        self.primers.append(f)
+        return f
+
+    def _step(self, name, work):
+        start = time.perf_counter()
+        try:
+            work()
+        except Exception:
+            # A cold worker is better than no worker.
+            self.app.logger.exception("warm-up step %s failed", name)
+        self.steps[name] = time.perf_counter() - start
+
+    ##########################################################################
+    # Steps
+
+    def _fill_pool(self):
+        """Open as many connections as the pool keeps, at once."""
+
+        engine = db.get_engine(self.app)
+        size = getattr(engine.pool, 'size', lambda: 1)()
+        conns = [engine.connect() for _ in range(size)]
+        for conn in conns:
+            conn.exec_driver_sql("SELECT 1")
+        for conn in conns:
+            conn.close()
+
+    def _recently_active(self, limit):
+        """Ids of the `limit` users who posted most recently."""
+
+        user_ids = []
+        for user_id in db.session.execute(
+                select(Message.user_id)
+                .order_by(Message.timestamp.desc())
+                .limit(limit * 10)).scalars():
+            if user_id not in user_ids:
+                user_ids.append(user_id)
+        db.session.remove()
+        return user_ids[:limit]
+
+    def _prime(self, user_ids, caches=True):
+        """Run the reads these users' first requests will make and, with
+        `caches`, fill this process's caches for them; stop once
+        WARMUP_TIMEOUT has passed."""
+
+        deadline = time.monotonic() + self.app.config['WARMUP_TIMEOUT']
+        client = self.app.test_client()
+        page_cache = caches and self.app.config.get('PAGE_CACHE_ENABLED')
+
+        for user_id in user_ids:
+            if time.monotonic() > deadline:
+                self.app.logger.warning(
+                    "warm-up stopped priming after %d s",
+                    self.app.config['WARMUP_TIMEOUT'])
+                break
+
+            queries.home_feed(user_id, queries.following_ids(user_id))
+            queries.user_profile(user_id, viewer_id=user_id)
+            if page_cache:
+                client.get(f"/users/{user_id}")
+            if caches:
+                for primer in self.primers:
+                    primer(user_id)
+            db.session.remove()
+
+    ##########################################################################
+    # Readiness
+
+    def ready_view(self):
+        """This worker's readiness, for the load balancer or orchestrator."""
+
+        body = {'ready': self.ready,
+                'steps': {name: round(seconds * 1000, 1)
+                          for name, seconds in self.steps.items()}}
+        return body, 200 if self.ready else 503
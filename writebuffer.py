@@ -0,0 +1,492 @@
+"""Write-behind buffer for like toggles and follow changes.
+
+With the buffer enabled, liking/unliking and following/unfollowing only
+record the *desired* final state of each (user, target) pair in memory and
+in a local append-only log. Every WRITE_BUFFER_WINDOW seconds the pending
+changes are flushed as one multi-row INSERT and one multi-row DELETE per
+table, so a burst of toggles on a viral message costs a couple of
+statements instead of one transaction each.
+
+Pending state is per process: the worker that took the write sees it
+immediately, other workers see it once it has been flushed.
+"""
+
+import atexit
+import json
+import os
+import threading
+
+from flask import g
+from flask.signals import Namespace
+from sqlalchemy import delete, insert, select, tuple_
+from sqlalchemy.exc import IntegrityError
+
+import queries
+from models import db, Follows, Like, Message
+
+LIKE = "like"
+FOLLOW = "follow"
+
+signals = Namespace()
+# Sent with conn= and batch= {(kind, user_id, target_id): state} inside
+# each flush's transaction, so more can be written in the same commit.
+batch_writing = signals.signal('write-buffer-batch-writing')
+# Sent with batch= after each flush, so caches of the affected pages can
+# be invalidated.
+batch_flushed = signals.signal('write-buffer-batch-flushed')
+
+
+class WriteBuffer:
+    """Coalesce like/follow writes and flush them in batches.
+
+    Configuration (app.config):
+
+    - WRITE_BUFFER_ENABLED: buffer writes (default False, write through)
+    - WRITE_BUFFER_WINDOW: seconds between background flushes (default 0.5)
+    - WRITE_BUFFER_MAX_PENDING: flush early once this many pairs are
+      pending (default 1000)
+    - WRITE_BUFFER_LOG: base path of the append-only crash log; each
+      process appends its pid
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.enabled = False
+        self._pending = {}
+        # The batch being written by flush(), still readable until it
+        # commits.
+        self._flushing = {}
+        self._lock = threading.Lock()
+        self._log = None
+        self._flusher = None
+        self._stop = threading.Event()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Register the buffer on a Flask app and replay any crash log."""
+
+        app.config.setdefault('WRITE_BUFFER_ENABLED', False)
+        app.config.setdefault('WRITE_BUFFER_WINDOW', 0.5)
+        app.config.setdefault('WRITE_BUFFER_MAX_PENDING', 1000)
+        app.config.setdefault(
+            'WRITE_BUFFER_LOG',
+            os.path.join(app.instance_path, "write-buffer.log"))
+
+        self.app = app
+        self.enabled = app.config['WRITE_BUFFER_ENABLED']
+
+        app.add_template_global(self.has_liked)
+        app.add_template_global(self.is_following)
+
+        if self.enabled:
+            self._open_log()
+            self._recover()
+            self._start_flusher()
+            atexit.register(self.close)
+            os.register_at_fork(after_in_child=self._after_fork)
+
+    ##########################################################################
+    # Writes
+
+    def toggle_like(self, user, message):
+        """Like `message` as `user`, or remove the like if it exists.
+        Returns whether the message is now liked."""
+
+        if not self.enabled:
+            liked = user.add_or_remove_like(message)
+            db.session.commit()
+            return liked
+
+        # The current state is read and the new one recorded under one
+        # lock, so concurrent toggles of the same pair each flip the state
+        # the previous one left. Only the database read happens outside.
+        key = (LIKE, user.id, message.id)
+        stored = None
+        while True:
+            with self._lock:
+                current = self._buffered(key)
+                if current is None:
+                    current = stored
+                if current is not None:
+                    full = self._record_locked(key, not current)
+                    break
+            stored = Like.query.get((user.id, message.id)) is not None
+
+        if full:
+            self.flush()
+
+        return not current
+
+    def set_following(self, user, other_user, following):
+        """Make `user` follow (or stop following) `other_user`. Returns
+        whether that changed anything."""
+
+        if not self.enabled:
+            if user.is_following(other_user) == following:
+                return False
+            if following:
+                user.following.append(other_user)
+            else:
+                user.following.remove(other_user)
+            db.session.commit()
+            return True
+
+        # As in toggle_like: compare and record under one lock.
+        key = (FOLLOW, user.id, other_user.id)
+        stored = None
+        while True:
+            with self._lock:
+                current = self._buffered(key)
+                if current is None:
+                    current = stored
+                if current is not None:
+                    full = (current != following
+                            and self._record_locked(key, following))
+                    break
+            stored = Follows.query.get((other_user.id, user.id)) is not None
+
+        if full:
+            self.flush()
+
+        return current != following
+
+    def _record_locked(self, key, state):
+        """Log and stash the desired final state for one pair; the lock
+        must be held. Returns whether it's time to flush."""
+
+        self._log.write(json.dumps([*key, state]) + "\n")
+        self._log.flush()
+        self._pending[key] = state
+        return len(self._pending) >= self.app.config[
+            'WRITE_BUFFER_MAX_PENDING']
+
+    def _buffered(self, key):
+        """The unwritten state for `key`, pending or mid-flush, or None."""
+
+        state = self._pending.get(key)
+        if state is None:
+            state = self._flushing.get(key)
+        return state
+
+    def forget(self, user_id=None, message_id=None):
+        """Drop pending changes involving a deleted user or message, so
+        the next flush doesn't insert rows pointing at them."""
+
+        with self._lock:
+            for key in list(self._pending):
+                kind, pair_user_id, target_id = key
+                if (pair_user_id == user_id
+                        or (kind == FOLLOW and target_id == user_id)
+                        or (kind == LIKE and target_id == message_id)):
+                    del self._pending[key]
+
+    ##########################################################################
+    # Reads (template globals)
+
+    def has_liked(self, message, user=None):
+        """Has `user` (default: the logged-in user) liked `message`,
+        including likes that haven't been flushed yet?"""
+
+        user = user or g.user
+        if user is None:
+            return False
+
+        pending = self._buffered((LIKE, user.id, message.id))
+        if pending is not None:
+            return pending
+
+        # Read-only rows from queries.py carry the viewer's like state.
+        liked = getattr(message, 'liked', None)
+        if liked is not None:
+            return liked
+
+        return user in message.user_likes
+
+    def is_following(self, other_user, user=None):
+        """Is `user` (default: the logged-in user) following `other_user`,
+        including follows that haven't been flushed yet?"""
+
+        user = user or g.user
+        if user is None:
+            return False
+
+        pending = self._buffered((FOLLOW, user.id, other_user.id))
+        if pending is not None:
+            return pending
+
+        return user.is_following(other_user)
+
+    def following_ids(self, user):
+        """Ids of the users `user` follows, including unflushed changes."""
+
+        return self.with_pending_follows(user.id,
+                                         queries.following_ids(user.id))
+
+    def with_pending_follows(self, user_id, ids):
+        """Apply `user_id`'s unflushed follow changes to a set of followed
+        ids (in place) and return it."""
+
+        for target_id, state in self.pending_follows(user_id).items():
+            if state:
+                ids.add(target_id)
+            else:
+                ids.discard(target_id)
+
+        return ids
+
+    def pending_follows(self, user_id):
+        """{followed id: following or not} for `user_id`'s unflushed
+        follow changes."""
+
+        return {target_id: state
+                for (kind, follower_id, target_id), state in {
+                    **self._flushing, **self._pending}.items()
+                if kind == FOLLOW and follower_id == user_id}
+
+    ##########################################################################
+    # Flushing
+
+    def flush(self):
+        """Write all pending changes to the database.
+
+        The crash log is rotated before writing, so changes recorded while
+        the flush is running land in the new log and are never truncated.
+        """
+
+        with self._lock:
+            if not self._pending:
+                return 0
+            batch, self._pending = self._pending, {}
+            self._flushing = batch
+            flushing_path = self._rotate_log()
+
+        try:
+            self._write_batch(batch)
+        except Exception:
+            with self._lock:
+                self._flushing = {}
+                # Anything recorded since the swap is newer and wins. The
+                # rest goes back into the live log before the .flushing
+                # copy is removed, so the next rotation can't overwrite
+                # the only record of it on disk.
+                restored = {key: state for key, state in batch.items()
+                            if key not in self._pending}
+                for key, state in restored.items():
+                    self._log.write(json.dumps([*key, state]) + "\n")
+                self._log.flush()
+                self._pending = {**restored, **self._pending}
+                os.remove(flushing_path)
+            raise
+
+        with self._lock:
+            self._flushing = {}
+        os.remove(flushing_path)
+        batch_flushed.send(self, batch=batch)
+        return len(batch)
+
+    def _write_batch(self, batch):
+        """Apply one batch as one DELETE and one INSERT per table.
+
+        Uses its own connection rather than db.session, so a flush that
+        happens inside a request never commits or discards that request's
+        session.
+        """
+
+        engine = db.get_engine(self.app)
+
+        with engine.begin() as conn:
+            for kind, table, cols in (
+                (LIKE, Like.__table__, ('user_id', 'message_id')),
+                (FOLLOW, Follows.__table__,
+                 ('user_following_id', 'user_being_followed_id')),
+            ):
+                adds = [dict(zip(cols, (u, t)))
+                        for (k, u, t), state in batch.items()
+                        if k == kind and state]
+                removes = [(u, t) for (k, u, t), state in batch.items()
+                           if k == kind and not state]
+
+                if removes:
+                    conn.execute(
+                        delete(table).where(
+                            tuple_(*(table.c[c] for c in cols)).in_(removes)))
+                if kind == LIKE and adds:
+                    adds = _existing_message_likes(conn, adds)
+                if adds:
+                    _insert_ignoring_conflicts(conn, table, adds)
+
+            batch_writing.send(self, conn=conn, batch=batch)
+
+    def _start_flusher(self):
+        """Flush every WRITE_BUFFER_WINDOW seconds on a daemon thread."""
+
+        window = self.app.config['WRITE_BUFFER_WINDOW']
+
+        def run():
+            while not self._stop.wait(window):
+                try:
+                    self.flush()
+                except Exception:
+                    self.app.logger.exception("write buffer flush failed")
+
+        self._flusher = threading.Thread(
+            target=run, name="write-buffer", daemon=True)
+        self._flusher.start()
+
+    def _after_fork(self):
+        """In a forked worker (gunicorn --preload): the parent's flusher
+        thread didn't survive the fork and its log belongs to the parent,
+        so start over with our own."""
+
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._pending = {}
+        self._flushing = {}
+        self._log = None
+        self._open_log()
+        self._start_flusher()
+
+    def close(self):
+        """Stop the background flusher and flush what's left."""
+
+        self._stop.set()
+        if self._log is not None:
+            self.flush()
+            self._log.close()
+            self._log = None
+
+    ##########################################################################
+    # Crash log
+
+    def _log_path(self, pid=None):
+        """Each process keeps its own log so workers never share a file."""
+
+        return f"{self.app.config['WRITE_BUFFER_LOG']}.{pid or os.getpid()}"
+
+    def _open_log(self):
+        path = self._log_path()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._log = open(path, "a", encoding="utf-8")
+
+    def _rotate_log(self):
+        """Move the current log aside and start a new one. Caller holds
+        the lock. Returns the path of the log being flushed."""
+
+        path = self._log_path()
+        flushing_path = f"{path}.flushing"
+
+        self._log.close()
+        os.replace(path, flushing_path)
+        self._log = open(path, "a", encoding="utf-8")
+
+        return flushing_path
+
+    def _recover(self):
+        """Adopt the logs of processes that died with unflushed writes,
+        then flush them."""
+
+        base = self.app.config['WRITE_BUFFER_LOG']
+        directory = os.path.dirname(base) or "."
+        prefix = os.path.basename(base) + "."
+
+        dead_pids = set()
+        for name in os.listdir(directory):
+            if name.startswith(prefix):
+                pid = name[len(prefix):].split(".")[0]
+                if pid.isdigit() and not _pid_alive(int(pid)):
+                    dead_pids.add(int(pid))
+
+        for pid in sorted(dead_pids):
+            path = self._log_path(pid)
+            # The .flushing log is older than the live one, so replay it
+            # first and let later entries win.
+            for leftover in (f"{path}.flushing", path):
+                if os.path.exists(leftover):
+                    self._replay(leftover)
+
+        with self._lock:
+            for (kind, user_id, target_id), state in self._pending.items():
+                self._log.write(
+                    json.dumps([kind, user_id, target_id, state]) + "\n")
+            self._log.flush()
+
+        for pid in dead_pids:
+            path = self._log_path(pid)
+            for leftover in (f"{path}.flushing", path):
+                if os.path.exists(leftover):
+                    os.remove(leftover)
+
+        try:
+            self.flush()
+        except Exception:
+            # The background flusher will retry.
+            self.app.logger.exception("write buffer recovery flush failed")
+
+    def _replay(self, path):
+        """Load desired states from one log file into the pending set."""
+
+        with open(path, encoding="utf-8") as log:
+            for line in log:
+                try:
+                    kind, user_id, target_id, state = json.loads(line)
+                except ValueError:
+                    # Torn write from the crash; everything before it is
+                    # intact.
+                    break
+                self._pending[(kind, user_id, target_id)] = state
+
+
+def _existing_message_likes(conn, rows):
+    """The like rows whose message still exists. Once messages is
+    partitioned (partitions.py), likes.message_id is no longer a foreign
+    key, so a like for a deleted or archived message would otherwise be
+    inserted. The messages are share-locked until commit so they can't be
+    deleted in between."""
+
+    live = set(conn.execute(
+        select(Message.id)
+        .where(Message.id.in_({row['message_id'] for row in rows}))
+        .with_for_update(read=True, key_share=True)).scalars())
+
+    return [row for row in rows if row['message_id'] in live]
+
+
+def _insert_ignoring_conflicts(conn, table, rows):
+    """Multi-row insert that skips rows that already exist. If some rows
+    point at a since-deleted user or message, fall back to inserting them
+    one at a time and drop the ones that fail."""
+
+    dialect = conn.dialect.name
+
+    def statement(values):
+        if dialect == "postgresql":
+            from sqlalchemy.dialects.postgresql import insert as pg_insert
+            return pg_insert(table).values(values).on_conflict_do_nothing()
+        if dialect == "sqlite":
+            return insert(table).values(values).prefix_with("OR IGNORE")
+        return insert(table).values(values)
+
+    try:
+        with conn.begin_nested():
+            conn.execute(statement(rows))
+    except IntegrityError:
+        for row in rows:
+            try:
+                with conn.begin_nested():
+                    conn.execute(statement([row]))
+            except IntegrityError:
+                pass
+
+
+def _pid_alive(pid):
+    """Is there a running process with this pid?"""
+
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True